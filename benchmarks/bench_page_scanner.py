@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Micro-benchmark of the page scanner against per line parsing, on saved provider pages"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+root_dir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, root_dir)
+
+from umake.page_scanner import PageScanner  # noqa: E402
+
+SERVER_CONTENT_DIR = os.path.join(root_dir, "tests", "data", "server-content")
+
+_android_checksum = r'<td>(\w{16,})</td>'
+_android_sdk_url = r'href=\"(https://dl.google.com.*-linux.*.zip)\"'
+
+# (page, download section start, section end, url regex, checksum regex)
+PAGES = {
+    "android-studio": ("developer.android.com/studio/index.html", "studio_linux_bundle_download", "</tr>",
+                       r'href=\"(.*android-studio-.*-linux.tar.gz)\"', _android_checksum),
+    "android-sdk": ("developer.android.com/studio/index.html", "sdk_linux_download", "</tr>",
+                    _android_sdk_url, _android_checksum),
+    "android-platform-tools": ("developer.android.com/studio/releases/platform-tools/index.html",
+                               "dac-download-linux", "</tr>", _android_sdk_url, None),
+    "go": ("golang.org/dl/index.html", "linux-amd64", "</tr>", r'href="(.*)">', r'<td><tt>(\w+)</tt></td>'),
+}
+
+
+def parse_per_line(content, section_start, section_end, url_regex, checksum_regex):
+    """Reference implementation: the former get_metadata loop, dispatching each line to a parse function"""
+    def parse_download_link(line, in_download):
+        url, checksum = (None, None)
+        if section_start in line:
+            in_download = True
+        if in_download:
+            p = re.search(url_regex, line)
+            if p:
+                url = p.group(1)
+            if checksum_regex:
+                p = re.search(checksum_regex, line)
+                if p:
+                    checksum = p.group(1)
+            if section_end in line:
+                in_download = False
+        if url is None and checksum is None:
+            return (None, in_download)
+        return ((url, checksum), in_download)
+
+    url, checksum = (None, None)
+    in_download = False
+    for line in content.splitlines(keepends=True):
+        download = None
+        if url is None or (checksum_regex and not checksum):
+            (download, in_download) = parse_download_link(line, in_download)
+        if download is not None:
+            (newurl, new_checksum) = download
+            url = newurl if newurl is not None else url
+            checksum = new_checksum if new_checksum is not None else checksum
+    return url, checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the page scanner to per line parsing")
+    parser.add_argument("-n", "--number", type=int, default=200, help="number of scans per measure")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="number of measures, the best one is kept")
+    args = parser.parse_args()
+
+    print("{:<24} {:>14} {:>14} {:>8}".format("page", "per line (us)", "scanner (us)", "speedup"))
+    for name, (path, section_start, section_end, url_regex, checksum_regex) in sorted(PAGES.items()):
+        with open(os.path.join(SERVER_CONTENT_DIR, path), "rb") as f:
+            content = f.read().decode()
+        scanner = PageScanner(url=url_regex, checksum=checksum_regex, section_start=section_start,
+                              section_end=section_end)
+        if scanner.scan(content) != parse_per_line(content, section_start, section_end, url_regex, checksum_regex):
+            sys.exit("{}: page scanner and per line parsing results differ".format(name))
+
+        per_line = min(timeit.repeat(lambda: parse_per_line(content, section_start, section_end, url_regex,
+                                                            checksum_regex),
+                                     number=args.number, repeat=args.repeat)) / args.number
+        scanned = min(timeit.repeat(lambda: scanner.scan(content),
+                                    number=args.number, repeat=args.repeat)) / args.number
+        print("{:<24} {:>14.1f} {:>14.1f} {:>7.1f}x".format(name, per_line * 1e6, scanned * 1e6, per_line / scanned))
+
+
+if __name__ == '__main__':
+    main()
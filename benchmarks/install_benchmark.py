@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Install one framework from the local test server, timing each installation phase
+
+This is run by run_benchmarks.py in a pristine HOME and XDG environment. Package requirements are considered as
+installed: only umake own code (DownloadCenter, Decompressor, BaseInstaller and frameworks) is measured."""
+
+import argparse
+from contextlib import ExitStack
+import json
+import os
+import sys
+from threading import Lock
+import time
+from unittest.mock import patch
+import urllib.parse
+
+root_dir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, root_dir)
+
+import requests  # noqa: E402
+from umake.frameworks import BaseCategory, load_frameworks  # noqa: E402
+from umake.interactions import InputText, LicenseAgreement, TextWithChoices  # noqa: E402
+from umake.network.download_center import DownloadCenter  # noqa: E402
+from umake.network.requirements_handler import RequirementsHandler  # noqa: E402
+from umake.tools import MainLoop  # noqa: E402
+from umake.ui import NullProgressBar, UI  # noqa: E402
+
+SERVER_CONTENT_DIR = os.path.join(root_dir, "tests", "data", "server-content")
+PHASES = ("metadata", "download", "checksum", "extract", "post_install")
+
+
+class PhaseTimer:
+    """Accumulate wall clock durations of installation phases"""
+
+    def __init__(self):
+        self.durations = dict.fromkeys(PHASES, 0.0)
+        self._starts = {}
+        self._lock = Lock()
+
+    def start(self, phase):
+        with self._lock:
+            self._starts.setdefault(phase, time.perf_counter())
+
+    def stop(self, phase):
+        with self._lock:
+            start = self._starts.pop(phase, None)
+            if start is not None:
+                self.durations[phase] += time.perf_counter() - start
+
+    def add(self, phase, duration):
+        with self._lock:
+            self.durations[phase] += duration
+
+    def marking(self, function, stop=None, start=None):
+        """Wrap function to stop and start phases when called"""
+        def wrapper(*args, **kwargs):
+            if stop:
+                self.stop(stop)
+            if start:
+                self.start(start)
+            return function(*args, **kwargs)
+        return wrapper
+
+    def timing(self, function, phase):
+        """Wrap function to add its whole duration to phase"""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+        return wrapper
+
+
+class BenchmarkUI(UI):
+    """Non interactive UI accepting every default, and saving timings when the installation is done"""
+
+    def __init__(self, framework_id, timer, result_path):
+        super().__init__(self)
+        self.framework_id = framework_id
+        self.timer = timer
+        self.result_path = result_path
+        self.start = time.perf_counter()
+
+    def _return_main_screen(self, status_code=0):
+        durations = dict(self.timer.durations)
+        # checksums are computed while downloading
+        durations["download"] = max(durations["download"] - durations["checksum"], 0)
+        with open(self.result_path, "w") as f:
+            json.dump({"framework": self.framework_id,
+                       "status": status_code,
+                       "total": time.perf_counter() - self.start,
+                       "phases": durations}, f)
+        MainLoop().quit(status_code=status_code)
+
+    def _new_progress_bar(self):
+        return NullProgressBar()
+
+    def _display(self, contentType):
+        if isinstance(contentType, InputText):
+            contentType.run_callback(result=contentType.default_input)
+        elif isinstance(contentType, LicenseAgreement):
+            contentType.choose(choice_id=0)
+        elif isinstance(contentType, TextWithChoices):
+            # YesNo and others: there is no default on those when reinstalling or overwriting, say yes
+            contentType.choose(answer="yes")
+
+
+def redirect_to_local_server(port):
+    """Patch requests so that hosts mirrored in the test server content are served by the local server on port"""
+    original_request = requests.Session.request
+
+    def request(session, method, url, **kwargs):
+        parsed_url = urllib.parse.urlsplit(url)
+        if parsed_url.hostname and os.path.isdir(os.path.join(SERVER_CONTENT_DIR, parsed_url.hostname)):
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, Host=parsed_url.hostname)
+            url = urllib.parse.urlunsplit(("http", "localhost:{}".format(port), parsed_url.path, parsed_url.query,
+                                           parsed_url.fragment))
+        return original_request(session, method, url, **kwargs)
+
+    return patch.object(requests.Session, "request", request)
+
+
+def no_requirements():
+    """Consider all package requirements as installed"""
+    def install_bucket(handler, bucket, progress_callback, installed_callback):
+        installed_callback(RequirementsHandler.RequirementsResult(bucket=bucket, error=None))
+        return False
+
+    return [patch.object(RequirementsHandler, "is_bucket_installed", return_value=True),
+            patch.object(RequirementsHandler, "install_bucket", install_bucket)]
+
+
+@MainLoop.in_mainloop_thread
+def install(framework, install_path):
+    framework.setup(install_path=install_path, auto_accept_license=True, assume_yes=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Install one framework from the local test server and time it")
+    parser.add_argument("--port", type=int, required=True, help="port of the local test server")
+    parser.add_argument("--result", required=True, help="json file to write the timings to")
+    parser.add_argument("--install-path", required=True, help="where to install the framework")
+    parser.add_argument("category")
+    parser.add_argument("framework")
+    args = parser.parse_args()
+
+    with ExitStack() as stack:
+        for patcher in no_requirements() + [redirect_to_local_server(args.port)]:
+            stack.enter_context(patcher)
+
+        load_frameworks()
+        category = BaseCategory.categories[args.category]
+        framework = category.frameworks[args.framework] if category else None
+        if framework is None:
+            sys.exit("Unknown framework {}/{}".format(args.category, args.framework))
+
+        timer = PhaseTimer()
+        framework_class = type(framework)
+        for method, stop, start in (("download_provider_page", None, "metadata"),
+                                    ("start_download_and_install", "metadata", "download"),
+                                    ("download_done", "download", None),
+                                    ("decompress_and_install", None, "extract"),
+                                    ("decompress_and_install_done", "extract", None)):
+            stack.enter_context(patch.object(framework_class, method,
+                                             timer.marking(getattr(framework_class, method), stop=stop, start=start)))
+        stack.enter_context(patch.object(framework_class, "post_install",
+                                         timer.timing(framework_class.post_install, "post_install")))
+        stack.enter_context(patch.object(DownloadCenter, "_checksum_for_fd",
+                                         classmethod(timer.timing(DownloadCenter._checksum_for_fd.__func__,
+                                                                  "checksum"))))
+
+        BenchmarkUI("{}/{}".format(args.category, args.framework), timer, args.result)
+        install(framework, args.install_path)
+        MainLoop().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Benchmark framework installations end to end against the local test server
+
+Each framework is installed --repeat times, in a pristine environment and a separate process, from the provider pages
+and archives in tests/data/server-content. Timings per phase (metadata, download, checksum, extract, post_install)
+are written as json, to compare DownloadCenter, Decompressor and BaseInstaller performance across releases."""
+
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+
+root_dir = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, root_dir)
+
+from tests.tools.local_server import LocalHttp  # noqa: E402
+from umake import settings  # noqa: E402
+
+BENCHMARKS_DIR = os.path.join(root_dir, "benchmarks")
+SERVER_CONTENT_DIR = os.path.join(root_dir, "tests", "data", "server-content")
+INSTALL_BENCHMARK = os.path.join(BENCHMARKS_DIR, "install_benchmark.py")
+PHASES = ("metadata", "download", "checksum", "extract", "post_install")
+
+DEFAULT_FRAMEWORKS = ["android/android-platform-tools", "android/android-studio", "go/go-lang", "nodejs/nodejs-lang"]
+
+
+def run_once(framework_id, port, timeout):
+    """Install framework_id in a pristine environment and return its result dict"""
+    category, framework = framework_id.split("/", 1)
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, LANGUAGE="C",
+                   XDG_CONFIG_HOME=os.path.join(home, ".config"),
+                   XDG_DATA_HOME=os.path.join(home, ".local", "share"),
+                   XDG_CACHE_HOME=os.path.join(home, ".cache"))
+        env.pop("UMAKE_FRAMEWORKS", None)
+        result_path = os.path.join(home, "result.json")
+        try:
+            process = subprocess.run([sys.executable, INSTALL_BENCHMARK, "--port", str(port), "--result", result_path,
+                                      "--install-path", os.path.join(home, "install"), category, framework],
+                                     env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return {"framework": framework_id, "error": "timeout after {}s".format(timeout)}
+        try:
+            with open(result_path) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return {"framework": framework_id,
+                    "error": process.stderr.decode("utf-8", "replace").strip() or "no result"}
+        if result["status"] != 0:
+            result["error"] = process.stderr.decode("utf-8", "replace").strip() or "failed installation"
+        return result
+
+
+def summarize(runs):
+    """Return median of total and phase timings for successful runs, None if there is none"""
+    successful_runs = [run for run in runs if "error" not in run]
+    if not successful_runs:
+        return None
+    summary = {"total": statistics.median(run["total"] for run in successful_runs)}
+    summary["phases"] = {phase: statistics.median(run["phases"][phase] for run in successful_runs)
+                         for phase in PHASES}
+    return summary
+
+
+def print_summary(results, out=sys.stderr):
+    columns = ("total",) + PHASES
+    print("{:<32}".format("framework (median, ms)") + "".join("{:>13}".format(c) for c in columns), file=out)
+    for framework_id, result in sorted(results.items()):
+        summary = result["median"]
+        if summary is None:
+            print("{:<32} failed: {}".format(framework_id, result["runs"][-1]["error"].splitlines()[-1]), file=out)
+            continue
+        values = [summary["total"]] + [summary["phases"][phase] for phase in PHASES]
+        print("{:<32}".format(framework_id) + "".join("{:>13.1f}".format(v * 1000) for v in values), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark framework installations against the local test server")
+    parser.add_argument("frameworks", nargs="*", default=DEFAULT_FRAMEWORKS,
+                        help="category/framework to benchmark (default: {})".format(" ".join(DEFAULT_FRAMEWORKS)))
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of installations per framework")
+    parser.add_argument("-o", "--output", help="json file to write results to (default: stdout)")
+    parser.add_argument("--port", type=int, default=9877, help="port for the local test server")
+    parser.add_argument("--timeout", type=int, default=300, help="timeout of one installation, in seconds")
+    args = parser.parse_args()
+
+    server = LocalHttp(SERVER_CONTENT_DIR, multi_hosts=True, port=args.port)
+    try:
+        results = {}
+        for framework_id in args.frameworks:
+            runs = [run_once(framework_id, args.port, args.timeout) for _ in range(args.repeat)]
+            results[framework_id] = {"runs": runs, "median": summarize(runs)}
+    finally:
+        server.stop()
+
+    # get the git revision when running from a branch
+    settings.from_dev = True
+    report = {"umake_version": settings.get_version(),
+              "python_version": platform.python_version(),
+              "machine": platform.machine(),
+              "date": datetime.now(timezone.utc).isoformat(),
+              "repeat": args.repeat,
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    print_summary(results)
+    return 0 if all(result["median"] is not None for result in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
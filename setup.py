@@ -174,6 +174,7 @@ setup(
     data_files=[
         ("share/ubuntu-make/log-confs", glob('log-confs/*.yaml')),
         ('share/zsh/vendor-completions', ['confs/completions/_umake']),
+        ('lib/systemd/user', ['confs/systemd/umake.socket', 'confs/systemd/umake.service']),
     ],
 
     cmdclass={
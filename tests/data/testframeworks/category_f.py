@@ -62,7 +62,8 @@ class FrameworkC(umake.frameworks.BaseFramework):
         super().__init__(name="Framework C", description="Description for framework C (good install dir, package req.)",
                          install_path_dir="/", packages_requirements=["foo", "bar"], **kwargs)
 
-    def setup(self, install_path=None, auto_accept_license=False):
+    def setup(self, install_path=None, auto_accept_license=False, dry_run=False):
+        self.dry_run = dry_run
         super().setup()
 
     def remove(self):
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the asyncio download center engine using a local asyncio server"""
+
+import os
+from os.path import join, getsize
+from time import time
+from unittest.mock import AsyncMock, Mock, call, patch
+from urllib.parse import quote
+from ..tools import get_data_dir, CopyingMock, LoggedTestCase
+from ..tools.async_local_server import AsyncLocalHttp
+from umake.network.async_download_center import AsyncDownloadCenter, AsyncEngine
+from umake.network.bundle import set_offline
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.scheduler import DownloadScheduler
+from umake.settings import UMAKE_DOWNLOAD_ENGINE_ENVIRON_VARIABLE
+from umake.tools import ChecksumType, Checksum, Singleton
+
+
+class TestAsyncDownloadCenter(LoggedTestCase):
+    """This will test the asyncio download center engine by sending one or more download requests"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = join(get_data_dir(), "server-content")
+        cls.server = AsyncLocalHttp(cls.server_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+
+    def setUp(self):
+        super().setUp()
+        self.callback = Mock()
+        self.fd_to_close = []
+        env_patcher = patch.dict(os.environ, {UMAKE_DOWNLOAD_ENGINE_ENVIRON_VARIABLE: "asyncio"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+
+    def tearDown(self):
+        super().tearDown()
+        for fd in self.fd_to_close:
+            fd.close()
+
+    def build_server_address(self, path):
+        """build server address to path to get requested"""
+        return "{}/{}".format(self.server.get_address(), path)
+
+    def wait_for_callback(self, mock_function_to_be_called, timeout=5):
+        """wait for the callback to be called until a timeout.
+
+        Add temp files to the clean file list afterwards"""
+        timeout = time() + timeout
+        while not mock_function_to_be_called.called:
+            if time() > timeout:
+                raise BaseException("Function not called within 5 seconds")
+        for calls in mock_function_to_be_called.call_args[0]:
+            for request in calls:
+                if calls[request].fd:
+                    self.fd_to_close.append(calls[request].fd)
+                if calls[request].buffer:
+                    self.fd_to_close.append(calls[request].buffer)
+
+    def download(self, url, **kwargs):
+        """Download url, returning its result"""
+        request = url if isinstance(url, DownloadItem) else DownloadItem(url)
+        DownloadCenter([request], self.callback, **kwargs)
+        self.wait_for_callback(self.callback)
+        self.assertEqual(self.callback.call_count, 1)
+        return self.callback.call_args[0][0][request.url]
+
+    def assert_content(self, filename, content):
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), content)
+
+    def test_engine_selected(self):
+        """We use the asyncio engine if requested by the environment"""
+        download_center = DownloadCenter([DownloadItem(self.build_server_address("simplefile"))], self.callback)
+        self.wait_for_callback(self.callback)
+        self.assertIsInstance(download_center, AsyncDownloadCenter)
+
+    def test_download(self):
+        """we deliver one successful download"""
+        result = self.download(self.build_server_address("simplefile"))
+
+        self.assert_content("simplefile", result.fd.read())
+        self.assertTrue('.' not in result.fd.name, result.fd.name)
+        self.assertIsNone(result.buffer)
+        self.assertIsNone(result.error)
+
+    def test_in_memory_download(self):
+        """we deliver download on memory objects"""
+        result = self.download(self.build_server_address("simplefile"), download=False)
+
+        self.assert_content("simplefile", result.buffer.read())
+        self.assertIsNone(result.fd)
+        self.assertIsNone(result.error)
+
+    def test_redirect_download(self):
+        """we deliver one successful download after being redirected"""
+        result = self.download(self.build_server_address("simplefile-redirect"))
+
+        self.assertEqual(result.final_url, self.build_server_address("simplefile"))
+        self.assert_content("simplefile", result.fd.read())
+        self.assertIsNone(result.error)
+
+    def test_header_download(self):
+        """we deliver one successful download with some headers"""
+        url = self.build_server_address('simplefile-headers?header=test')
+        result = self.download(DownloadItem(url, headers={"header": "test"}))
+
+        self.assert_content("simplefile", result.fd.read())
+        self.assertIsNone(result.error)
+
+    def test_cookies(self):
+        """Test handing of outgoing and incoming cookies."""
+        url = self.build_server_address("simplefile")
+        result = self.download(DownloadItem(url, cookies={'int': '5'}))
+
+        self.assertEqual('6', result.cookies['int'])
+
+    def test_content_encoding(self):
+        """Ensure we perform (or don't) content decoding properly."""
+        filename = "www.eclipse.org/technology/epp/downloads/release/version/"\
+                   "point_release/eclipse-java-linux-gtk.tar.gz"
+        url = self.build_server_address(filename + '-setheaders?content-encoding=gzip')
+        result = self.download(DownloadItem(url), download=False)
+        self.assertEqual(10240, len(result.buffer.getvalue()))
+
+        self.callback = Mock()
+        result = self.download(DownloadItem(url, ignore_encoding=True), download=False)
+        self.assertEqual(266, len(result.buffer.getvalue()))
+
+    def test_chunked_download(self):
+        """we deliver downloads sent with a chunked transfer encoding"""
+        result = self.download(self.build_server_address("biggerfile-chunked"), download=False)
+
+        self.assert_content("biggerfile", result.buffer.getvalue())
+        self.assertIsNone(result.error)
+
+    def test_download_with_no_content_length(self):
+        """we deliver downloads ending with the connection"""
+        report = CopyingMock()
+        url = self.build_server_address("biggerfile-with-no-content-length")
+        result = self.download(url, download=False, report=report)
+
+        self.assert_content("biggerfile", result.buffer.getvalue())
+        progress_calls = [progress_call for progress_call in report.call_args_list
+                          if progress_call != call('all downloads finished')]
+        self.assertEqual(progress_calls[-1], call({url: {'size': -1, 'current': 2 * AsyncDownloadCenter.BLOCK_SIZE}}))
+
+    def test_download_with_progress(self):
+        """we deliver progress hook while downloading, block by block"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        url = self.build_server_address(filename)
+        report = CopyingMock()
+        self.download(url, report=report)
+
+        self.assertEqual(report.call_args_list[:3],
+                         [call({url: {'size': filesize, 'current': 0}}),
+                          call({url: {'size': filesize, 'current': AsyncDownloadCenter.BLOCK_SIZE}}),
+                          call({url: {'size': filesize, 'current': filesize}})])
+
+    def test_multiple_downloads(self):
+        """we deliver more than on download in parallel"""
+        requests = [DownloadItem(self.build_server_address("biggerfile")),
+                    DownloadItem(self.build_server_address("simplefile"))]
+        DownloadCenter(requests, self.callback)
+        self.wait_for_callback(self.callback)
+
+        map_result = self.callback.call_args[0][0]
+        for filename in ("biggerfile", "simplefile"):
+            self.assert_content(filename, map_result[self.build_server_address(filename)].fd.read())
+        self.assertEqual(self.callback.call_count, 1, "Global done callback is only called once")
+
+    def test_404_url(self):
+        """we return an error for a request including a 404 url"""
+        result = self.download(self.build_server_address("does_not_exist"))
+
+        self.assertIn("404", result.error)
+        self.assertIn("File not found", result.error)
+        self.assertIsNone(result.buffer)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_download_with_md5(self):
+        """we deliver once successful download, matching md5sum"""
+        url = self.build_server_address("simplefile")
+        result = self.download(DownloadItem(url, Checksum(ChecksumType.md5, '268a5059001855fef30b4f95f82044ed')))
+
+        self.assert_content("simplefile", result.fd.read())
+        self.assertIsNone(result.error)
+
+    def test_download_with_wrong_md5(self):
+        """we raise an error if we don't have the correct md5sum"""
+        url = self.build_server_address("simplefile")
+        result = self.download(DownloadItem(url, Checksum(ChecksumType.md5, 'AAAAA')))
+
+        self.assertIn("Corrupted download", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_offline_mode(self):
+        """we still refuse to download anything in offline mode, from the threaded engine"""
+        set_offline(True)
+        self.addCleanup(set_offline, False)
+        result = self.download(self.build_server_address("simplefile"), download=False)
+
+        self.assertIn("offline", result.error)
+        self.expect_warn_error = True
+
+    def test_download_rate_limited(self):
+        """we deliver downloads at the requested rate"""
+        self.addCleanup(Singleton._instances.pop, DownloadScheduler, None)
+        Singleton._instances.pop(DownloadScheduler, None)
+        DownloadScheduler().set_rate_limits(per_download=20000)
+        start = time()
+        result = self.download(self.build_server_address("biggerfile"))
+
+        # 9000 bytes with a 5000 bytes burst
+        self.assertGreater(time() - start, 0.15)
+        self.assert_content("biggerfile", result.fd.read())
+
+    def test_reuse_connection(self):
+        """we reuse the same connection for sequential fetches to the same host"""
+        Singleton._instances.pop(AsyncEngine, None)
+        connections = self.server.connections
+        for filename in ("simplefile", "biggerfile-redirect", "simplefile-chunked"):
+            self.callback = Mock()
+            result = self.download(self.build_server_address(filename), download=False)
+            self.assertIsNone(result.error)
+
+        self.assertEqual(self.server.connections - connections, 1)
+        self.assertEqual(AsyncEngine().pool.opened_connections, 1)
+
+    def test_many_concurrent_downloads(self):
+        """we deliver a lot of concurrent fetches over a few connections"""
+        Singleton._instances.pop(AsyncEngine, None)
+        requests = [DownloadItem(self.build_server_address("simplefile?{}".format(i))) for i in range(1000)]
+        DownloadCenter(requests, self.callback, download=False)
+        self.wait_for_callback(self.callback, timeout=30)
+
+        map_result = self.callback.call_args[0][0]
+        self.assertEqual(len(map_result), 1000)
+        for result in map_result.values():
+            self.assertIsNone(result.error)
+        self.assert_content("simplefile", map_result[requests[0].url].buffer.getvalue())
+        self.assertLessEqual(AsyncEngine().pool.opened_connections, AsyncEngine.MAX_CONNECTIONS_PER_HOST)
+
+    def test_redirect_to_other_host(self):
+        """we don't send credentials to another host we are redirected to"""
+        other_server = AsyncLocalHttp(self.server_dir)
+        self.addCleanup(other_server.stop)
+        other_url = "{}/simplefile".format(other_server.get_address())
+        url = self.build_server_address("simplefile-redirect?location={}".format(quote(other_url, safe="")))
+        result = self.download(DownloadItem(url, headers={"Authorization": "token secret", "X-Umake": "test"},
+                                            cookies={"session": "secret"}))
+
+        self.assertIsNone(result.error)
+        self.assertEqual(result.final_url, other_url)
+        self.assertEqual(self.server.request_headers[-1]["authorization"], "token secret")
+        self.assertIn("session=secret", self.server.request_headers[-1]["cookie"])
+        self.assertNotIn("authorization", other_server.request_headers[-1])
+        self.assertNotIn("cookie", other_server.request_headers[-1])
+        self.assertEqual(other_server.request_headers[-1]["x-umake"], "test")
+
+    def test_refuse_https_to_http_redirect(self):
+        """we refuse to be redirected from https to http"""
+        with patch.object(AsyncDownloadCenter, "_get", new=AsyncMock(return_value="http://localhost/simplefile")):
+            result = self.download("https://localhost/simplefile-redirect", download=False)
+
+        self.assertIn("Refusing to follow the redirect", result.error)
+        self.expect_warn_error = True
+
+    def test_stalled_server(self):
+        """we give up on a server not sending anything"""
+        with patch("umake.network.async_download_center.TIMEOUT", 0.2):
+            result = self.download(self.build_server_address("simplefile-stalled"), download=False)
+
+        self.assertIn("Timed out", result.error)
+        self.expect_warn_error = True
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the batch installation of frameworks from a manifest"""
+
+import os
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+from ..tools import LoggedTestCase
+from umake.interactions import DisplayMessage, InputText, LicenseAgreement, YesNo
+from umake.tools import MainLoop, Singleton
+from umake.ui.batch import BatchUI, load_manifest
+
+
+class TestLoadManifest(LoggedTestCase):
+    """This will test converting manifests to frameworks command line arguments"""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.tempdir, "manifest.yaml")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def write_manifest(self, content):
+        with open(self.manifest_path, "w") as f:
+            f.write(content)
+
+    def test_load_manifest(self):
+        """We convert each framework to its arguments"""
+        self.write_manifest("frameworks:\n"
+                            "  - category: ide\n"
+                            "    framework: pycharm\n"
+                            "    path: /tmp/pycharm\n"
+                            "    accept_license: true\n"
+                            "    options: [--eap]\n"
+                            "  - category: go\n"
+                            "  - framework: foo\n")
+        self.assertEqual(load_manifest(self.manifest_path),
+                         [["ide", "pycharm", "/tmp/pycharm", "--accept-license", "--eap"],
+                          ["go"],
+                          ["foo"]])
+
+    def test_load_manifest_expand_path(self):
+        """We expand paths relative to the home directory"""
+        self.write_manifest("frameworks:\n"
+                            "  - category: go\n"
+                            "    path: ~/go\n")
+        self.assertEqual(load_manifest(self.manifest_path), [["go", os.path.expanduser("~/go")]])
+
+    def test_load_manifest_no_framework(self):
+        """We refuse a manifest entry without any category or framework"""
+        self.write_manifest("frameworks:\n"
+                            "  - path: /tmp/foo\n")
+        self.assertRaises(BaseException, load_manifest, self.manifest_path)
+
+    def test_load_manifest_no_frameworks_list(self):
+        """We refuse a manifest without a frameworks list"""
+        self.write_manifest("foo: bar\n")
+        self.assertRaises(BaseException, load_manifest, self.manifest_path)
+
+    def test_load_invalid_manifest(self):
+        """We refuse an invalid yaml manifest"""
+        self.write_manifest("frameworks: [\n")
+        self.assertRaises(BaseException, load_manifest, self.manifest_path)
+
+    def test_load_missing_manifest(self):
+        """We refuse a missing manifest"""
+        self.assertRaises(BaseException, load_manifest, os.path.join(self.tempdir, "foo"))
+
+
+class TestBatchUI(LoggedTestCase):
+    """This will test the UI waiting for all frameworks installations"""
+
+    def setUp(self):
+        super().setUp()
+        self.config_handler_patcher = patch("umake.ui.batch.ConfigHandler")
+        self.config_handler = self.config_handler_patcher.start()
+        self.defer_user_env_patcher = patch("umake.ui.batch.defer_user_env_writes")
+        self.defer_user_env = self.defer_user_env_patcher.start()
+        self.flush_user_env_patcher = patch("umake.ui.batch.flush_user_env")
+        self.flush_user_env = self.flush_user_env_patcher.start()
+        self.ui = Mock()
+        self.batch_ui = BatchUI(self.ui, 2)
+
+    def tearDown(self):
+        self.config_handler_patcher.stop()
+        self.defer_user_env_patcher.stop()
+        self.flush_user_env_patcher.stop()
+        Singleton._instances = {}
+        super().tearDown()
+
+    def test_defer_config_writes(self):
+        """We defer config writes until all frameworks are installed"""
+        self.assertTrue(self.config_handler.return_value.defer_writes.called)
+        self.assertFalse(self.config_handler.return_value.flush.called)
+
+    def test_defer_user_env_writes(self):
+        """We write the user env file once all frameworks are installed"""
+        self.assertTrue(self.defer_user_env.called)
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            self.batch_ui._return_main_screen(status_code=0)
+        self.assertFalse(self.flush_user_env.called)
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            self.batch_ui._return_main_screen(status_code=0)
+        self.assertTrue(self.flush_user_env.called)
+
+    def test_return_main_screen_once_all_done(self):
+        """We return to the main screen once all frameworks are done, with the worst status code"""
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            self.batch_ui._return_main_screen(status_code=2)
+        self.assertFalse(self.ui._return_main_screen.called)
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            self.batch_ui._return_main_screen(status_code=0)
+        self.ui._return_main_screen.assert_called_once_with(status_code=2)
+        self.assertTrue(self.config_handler.return_value.flush.called)
+
+    def test_license_not_accepted(self):
+        """We decline licenses not accepted in the manifest, and report a failure"""
+        self.expect_warn_error = True
+        callback_yes = Mock()
+        callback_no = Mock()
+        self.batch_ui._display(LicenseAgreement("License text", callback_yes, callback_no))
+        self.assertFalse(callback_yes.called)
+        self.assertTrue(callback_no.called)
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            self.batch_ui._return_main_screen(status_code=0)
+        with self.assertRaises(MainLoop.ReturnMainLoop):
+            self.batch_ui._return_main_screen(status_code=0)
+        self.ui._return_main_screen.assert_called_once_with(status_code=1)
+
+    def test_default_answers(self):
+        """We answer the default to prompts"""
+        callback_input = Mock()
+        callback_yes = Mock()
+        callback_no = Mock()
+        self.batch_ui._display(InputText("Choose installation path:", callback_input, "/foo"))
+        self.batch_ui._display(YesNo("Really?", callback_yes, callback_no))
+        callback_input.assert_called_once_with("/foo")
+        self.assertTrue(callback_no.called)
+        self.assertFalse(self.ui._display.called)
+
+    def test_forward_messages_and_events(self):
+        """We forward messages and progress events to the other UI"""
+        message = DisplayMessage("foo")
+        self.batch_ui._display(message)
+        self.batch_ui._report("download", {"url": "http://foo"})
+        self.ui._display.assert_called_once_with(message)
+        self.ui._report.assert_called_once_with("download", {"url": "http://foo"})
+
+    def test_quiet_progress_bar(self):
+        """We don't display progress bars of parallel installations"""
+        bar = self.batch_ui._new_progress_bar()
+        bar.update(42)
+        bar.finish()
+        self.assertTrue(bar.finished)
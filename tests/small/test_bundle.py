@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for offline bundles"""
+
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+from ..tools import LoggedTestCase
+from umake.network import bundle
+from umake.network.bundle import Bundle
+from umake.tools import Checksum, ChecksumType
+
+
+class TestBundle(LoggedTestCase):
+    """This will test bundle creation and lookups"""
+
+    def setUp(self):
+        super().setUp()
+        self.bundle_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        bundle.use_bundle(None)
+        bundle.set_offline(False)
+        shutil.rmtree(self.bundle_dir)
+        super().tearDown()
+
+    def test_create_and_reload(self):
+        """We can lookup urls stored in a previously created bundle"""
+        Bundle(self.bundle_dir, create=True).add("http://foo/bar", BytesIO(b"content"), "http://foo/baz")
+
+        content_path, final_url = Bundle(self.bundle_dir).get("http://foo/bar")
+        self.assertEqual(final_url, "http://foo/baz")
+        with open(content_path, "rb") as f:
+            self.assertEqual(f.read(), b"content")
+
+    def test_missing_url(self):
+        """We return None for urls not in the bundle"""
+        Bundle(self.bundle_dir, create=True).add("http://foo/bar", BytesIO(b"content"), "http://foo/bar")
+        self.assertIsNone(Bundle(self.bundle_dir).get("http://foo/other"))
+
+    def test_complete_existing_bundle(self):
+        """Creating a bundle in an existing one keeps previous content"""
+        Bundle(self.bundle_dir, create=True).add("http://foo/bar", BytesIO(b"content"), "http://foo/bar")
+        Bundle(self.bundle_dir, create=True).add("http://foo/baz", BytesIO(b"other"), "http://foo/baz")
+
+        current_bundle = Bundle(self.bundle_dir)
+        self.assertIsNotNone(current_bundle.get("http://foo/bar"))
+        self.assertIsNotNone(current_bundle.get("http://foo/baz"))
+
+    def test_record_framework(self):
+        """We record resolved framework metadata"""
+        Bundle(self.bundle_dir, create=True).add_framework("ide/foo", "http://foo/bar",
+                                                           Checksum(ChecksumType.sha256, "abcd"), "license")
+        self.assertEqual(Bundle(self.bundle_dir).get_framework("ide/foo"),
+                         {"url": "http://foo/bar", "checksum_type": "sha256", "checksum": "abcd",
+                          "license": "license"})
+
+    def test_invalid_bundle(self):
+        """We refuse to replay a directory without manifest"""
+        self.assertRaises(BaseException, Bundle, self.bundle_dir)
+
+    def test_unsupported_bundle_version(self):
+        """We refuse to replay a bundle in a format we don't know about"""
+        with open(os.path.join(self.bundle_dir, Bundle.MANIFEST_FILENAME), "w") as f:
+            json.dump({"version": 42}, f)
+        self.assertRaises(BaseException, Bundle, self.bundle_dir)
+
+    def test_replay_implies_offline(self):
+        """Replaying a bundle forbids any network access"""
+        Bundle(self.bundle_dir, create=True).add("http://foo/bar", BytesIO(b"content"), "http://foo/bar")
+        bundle.use_bundle(Bundle(self.bundle_dir))
+        self.assertTrue(bundle.is_offline())
+        self.assertTrue(bundle.is_url_available("http://foo/bar"))
+        self.assertFalse(bundle.is_url_available("http://foo/other"))
+
+    def test_url_availability_online(self):
+        """We don't know about url availability online without bundle"""
+        self.assertIsNone(bundle.is_url_available("http://foo/bar"))
@@ -19,9 +19,10 @@
 
 """Tests for the cli module"""
 
+from argparse import Namespace
 import importlib
 from ..tools import LoggedTestCase
-from umake.ui.cli import mangle_args_for_default_framework
+from umake.ui.cli import get_framework_for_args, mangle_args_for_default_framework
 import os
 import sys
 from ..tools import get_data_dir, change_xdg_path, patchelem
@@ -205,3 +206,23 @@ class TestCLIFromFrameworks(LoggedTestCase):
         """We mangle the -r remove option if global (before the category name) to append it to the framework option"""
         self.assertEqual(mangle_args_for_default_framework(["-r", "category-a", "framework-a"]),
                          ["category-a", "framework-a", "-r"])
+
+    def test_get_framework_for_args(self):
+        """We return the framework of a category"""
+        self.assertEqual(get_framework_for_args(Namespace(category="category-a", framework="framework-b")),
+                         frameworks.BaseCategory.categories["category-a"].frameworks["framework-b"])
+
+    def test_get_default_framework_for_args(self):
+        """We return the default framework of a category if none is provided"""
+        self.assertEqual(get_framework_for_args(Namespace(category="category-a", framework=None)),
+                         frameworks.BaseCategory.categories["category-a"].frameworks["framework-a"])
+
+    def test_get_main_category_framework_for_args(self):
+        """We return frameworks of the main category"""
+        self.assertEqual(get_framework_for_args(Namespace(category="framework-free-a")),
+                         frameworks.BaseCategory.main_category.frameworks["framework-free-a"])
+
+    def test_get_unknown_framework_for_args(self):
+        """We return None for unknown frameworks"""
+        self.assertIsNone(get_framework_for_args(Namespace(category="category-a", framework="foo")))
+        self.assertIsNone(get_framework_for_args(Namespace(category="foo")))
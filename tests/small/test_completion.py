@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in he hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests the static completion cache"""
+
+import argcomplete
+import argparse
+import os
+import shutil
+import tempfile
+from ..tools import LoggedTestCase
+from unittest.mock import patch
+
+from umake import completion
+
+
+class TestCompletionCache(LoggedTestCase):
+    """This will test the completion cache and its argcomplete answers"""
+
+    def setUp(self):
+        super().setUp()
+        self.initial_env = os.environ.copy()
+        self.cache_dir = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.cache_dir, "output")
+        xdg_patcher = patch("umake.completion.xdg_cache_home", self.cache_dir)
+        xdg_patcher.start()
+        self.addCleanup(xdg_patcher.stop)
+
+        self.parser = argparse.ArgumentParser()
+        self.parser.add_argument("-v", "--verbose", action="count", default=0)
+        self.parser.add_argument("--profile")
+        categories = self.parser.add_subparsers(dest="category")
+        ide = categories.add_parser("ide").add_subparsers(dest="framework")
+        for name in ("pycharm", "pycharm-professional", "eclipse"):
+            framework = ide.add_parser(name)
+            framework.add_argument("destdir", nargs="?")
+            framework.add_argument("-r", "--remove", action="store_true")
+        categories.add_parser("go")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        # restore original environment. Do not use the dict copy which erases the object and doesn't have the magical
+        # _Environ which setenv() for subprocess
+        os.environ.clear()
+        os.environ.update(self.initial_env)
+        super().tearDown()
+
+    def complete(self, comp_line):
+        """Set argcomplete environment for comp_line and return the answer, None if not served from cache"""
+        os.environ["_ARGCOMPLETE"] = "1"
+        os.environ["COMP_LINE"] = comp_line
+        os.environ["COMP_POINT"] = str(len(comp_line))
+        os.environ["_ARGCOMPLETE_STDOUT_FILENAME"] = self.output_file
+        if not completion.complete_from_cache():
+            return None
+        with open(self.output_file) as f:
+            return [word for word in f.read().split("\013") if word]
+
+    def test_parser_to_tree(self):
+        """We dump options, subcommands and positional arguments"""
+        tree = completion.parser_to_tree(self.parser)
+        self.assertIn("--verbose", tree["options"])
+        self.assertIn("--profile", tree["options_with_value"])
+        self.assertNotIn("--verbose", tree["options_with_value"])
+        self.assertEqual(sorted(tree["subcommands"]), ["go", "ide"])
+        self.assertTrue(tree["subcommands"]["ide"]["subcommands"]["eclipse"]["positional"])
+
+    def test_no_cache(self):
+        """We fallback to the slow path if there is no cache"""
+        self.assertIsNone(self.complete("umake i"))
+
+    def test_not_in_completion_mode(self):
+        """We never answer outside of completion mode"""
+        completion.save_cache(self.parser)
+        self.assertFalse(completion.complete_from_cache())
+
+    def test_complete_categories(self):
+        """We complete categories from the cache"""
+        completion.save_cache(self.parser)
+        self.assertEqual(self.complete("umake "), ["go", "ide"])
+        self.assertEqual(self.complete("umake i"), ["ide "])
+
+    def test_complete_frameworks(self):
+        """We complete frameworks of a category from the cache"""
+        completion.save_cache(self.parser)
+        self.assertEqual(self.complete("umake ide pych"), ["pycharm", "pycharm-professional"])
+
+    def test_complete_options(self):
+        """We complete options of the current subcommand"""
+        completion.save_cache(self.parser)
+        self.assertEqual(self.complete("umake ide pycharm --r"), ["--remove "])
+        self.assertEqual(self.complete("umake --v"), ["--verbose "])
+
+    def test_skip_option_value(self):
+        """Values of options taking one aren't considered as subcommands"""
+        completion.save_cache(self.parser)
+        self.assertEqual(self.complete("umake --profile ide i"), ["ide "])
+
+    def test_complete_destdir(self):
+        """We complete paths for positional arguments"""
+        os.mkdir(os.path.join(self.cache_dir, "foo"))
+        completion.save_cache(self.parser)
+        self.assertEqual(self.complete("umake ide pycharm {}".format(os.path.join(self.cache_dir, "f"))),
+                         [os.path.join(self.cache_dir, "foo") + os.sep])
+
+    def complete_live(self, comp_line):
+        """Return argcomplete answer for comp_line, computed from the parser"""
+        os.environ["_ARGCOMPLETE"] = "1"
+        os.environ["COMP_LINE"] = comp_line
+        os.environ["COMP_POINT"] = str(len(comp_line))
+        os.environ["_ARGCOMPLETE_STDOUT_FILENAME"] = self.output_file
+        # don't write argcomplete debug output to a file descriptor used by the test runner
+        with patch.object(argcomplete.CompletionFinder, "_init_debug_stream"):
+            argcomplete.autocomplete(self.parser, exit_method=lambda code: None)
+        with open(self.output_file) as f:
+            return [word for word in f.read().split("\013") if word]
+
+    def test_single_completion_like_argcomplete(self):
+        """A single completion is followed by a space, like argcomplete does"""
+        completion.save_cache(self.parser)
+        for comp_line in ("umake i", "umake ide ecl", "umake ide pycharm --r", "umake ide pycharm-"):
+            self.assertEqual(self.complete(comp_line), self.complete_live(comp_line))
+
+    def test_single_completion_no_space(self):
+        """A single completion isn't followed by a space if it's a directory or if the shell doesn't want one"""
+        os.mkdir(os.path.join(self.cache_dir, "foo"))
+        completion.save_cache(self.parser)
+        self.assertEqual(self.complete("umake ide pycharm {}".format(os.path.join(self.cache_dir, "f"))),
+                         [os.path.join(self.cache_dir, "foo") + os.sep])
+        os.environ["_ARGCOMPLETE_SUPPRESS_SPACE"] = "1"
+        self.assertEqual(self.complete("umake i"), ["ide"])
+
+    def test_special_chars(self):
+        """We let argcomplete escape completions with special characters and deal with quoted words"""
+        os.mkdir(os.path.join(self.cache_dir, "foo bar"))
+        completion.save_cache(self.parser)
+        self.assertIsNone(self.complete("umake ide pycharm {}".format(os.path.join(self.cache_dir, "f"))))
+        self.assertIsNone(self.complete("umake ide 'pych'"))
+
+    def test_outdated_cache(self):
+        """We fallback to the slow path if the cache stamp changed"""
+        completion.save_cache(self.parser)
+        with patch("umake.completion.get_stamp", return_value=["new"]):
+            self.assertIsNone(self.complete("umake i"))
+
+    def test_invalidate_cache(self):
+        """We can invalidate the cache"""
+        completion.save_cache(self.parser)
+        completion.invalidate_cache()
+        self.assertIsNone(self.complete("umake i"))
+
+    def test_unbalanced_quotes(self):
+        """We let the slow path deal with unparsable lines"""
+        completion.save_cache(self.parser)
+        self.assertIsNone(self.complete("umake ide 'pych"))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the daemon running commands forwarded by the umake client"""
+
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake import daemon
+
+
+def fake_command(argv):
+    """Record what the command was run with in argv[1], and behave as requested by argv[2]"""
+    with open(argv[1], "w") as f:
+        json.dump({"argv": argv, "cwd": os.getcwd(), "env": os.environ.get("UMAKE_TEST_VAR"),
+                   "stdin": os.fstat(0).st_ino}, f)
+    action = argv[2]
+    if action == "exit":
+        raise SystemExit(3)
+    if action == "kill":
+        os.kill(os.getpid(), signal.SIGKILL)
+    if action == "hand_back":
+        daemon.hand_back_to_client()
+    if action == "wait":
+        time.sleep(0.2)
+        open(argv[1] + ".done", "w").close()
+    return 0
+
+
+class TestDaemon(LoggedTestCase):
+    """This will test the daemon and its client"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.result_path = os.path.join(self.tmpdir, "result")
+        env_patcher = patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.tmpdir, "UMAKE_TEST_VAR": "foo"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        os.environ.pop(daemon.settings.UMAKE_NO_DAEMON_ENVIRON_VARIABLE, None)
+        geteuid_patcher = patch("umake.daemon.os.geteuid", return_value=1000)
+        self.geteuid = geteuid_patcher.start()
+        self.addCleanup(geteuid_patcher.stop)
+
+    def start_daemon(self):
+        """Start the daemon in a forked process"""
+        with patch.dict(os.environ, {"LISTEN_PID": "0"}):
+            sock, socket_activated = daemon._get_listening_socket()
+        self.assertFalse(socket_activated)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # the frameworks are loaded by the tests themselves
+                with patch("umake.daemon.warm_up"):
+                    server = daemon.Daemon(sock, run_command=fake_command)
+                    server.warm_up()
+                    server.serve_forever()
+            finally:
+                os._exit(0)
+        sock.close()
+        self.addCleanup(self.stop_daemon, pid)
+        return pid
+
+    def stop_daemon(self, pid):
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    def get_result(self):
+        with open(self.result_path) as f:
+            return json.load(f)
+
+    def test_socket_path(self):
+        """We create the socket in the user runtime directory"""
+        self.assertEqual(daemon.get_socket_path(), os.path.join(self.tmpdir, "umake", "daemon.sock"))
+
+    def test_run_command(self):
+        """We run the command in the client directory and environment, with its standard file descriptors"""
+        self.start_daemon()
+        os.environ["UMAKE_TEST_VAR"] = "bar"
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+
+        self.assertEqual(daemon.forward_to_daemon(["umake", self.result_path, "ok"]), 0)
+        result = self.get_result()
+        self.assertEqual(result["argv"], ["umake", self.result_path, "ok"])
+        self.assertEqual(result["cwd"], os.path.realpath(self.tmpdir))
+        self.assertEqual(result["env"], "bar")
+        self.assertEqual(result["stdin"], os.fstat(0).st_ino)
+
+    def test_several_commands(self):
+        """We serve commands one after the other"""
+        self.start_daemon()
+        self.assertEqual(daemon.forward_to_daemon(["umake", self.result_path, "ok"]), 0)
+        self.assertEqual(daemon.forward_to_daemon(["umake", self.result_path, "exit"]), 3)
+        self.assertEqual(daemon.forward_to_daemon(["umake", self.result_path, "ok"]), 0)
+
+    def test_wait_for_command(self):
+        """We only return once the command finished"""
+        self.start_daemon()
+        self.assertEqual(daemon.forward_to_daemon(["umake", self.result_path, "wait"]), 0)
+        self.assertTrue(os.path.exists(self.result_path + ".done"))
+
+    def test_exit_code(self):
+        """We return the command exit code"""
+        self.start_daemon()
+        self.assertEqual(daemon.forward_to_daemon(["umake", self.result_path, "exit"]), 3)
+
+    def test_killed_command(self):
+        """We return the shell exit code of a command killed by a signal"""
+        self.start_daemon()
+        self.assertEqual(daemon.forward_to_daemon(["umake", self.result_path, "kill"]), 128 + signal.SIGKILL)
+
+    def test_hand_back(self):
+        """We run the command locally if the daemon hands it back"""
+        self.start_daemon()
+        self.assertIsNone(daemon.forward_to_daemon(["umake", self.result_path, "hand_back"]))
+        self.assertTrue(os.path.exists(self.result_path))
+
+    def test_different_environment(self):
+        """We run the command locally if the client environment changes the warm state"""
+        self.start_daemon()
+        os.environ[daemon.settings.UMAKE_FRAMEWORKS_ENVIRON_VARIABLE] = self.tmpdir
+        self.assertIsNone(daemon.forward_to_daemon(["umake", self.result_path, "ok"]))
+        self.assertFalse(os.path.exists(self.result_path))
+
+    def test_no_daemon(self):
+        """We run the command locally if no daemon is running"""
+        self.assertIsNone(daemon.forward_to_daemon(["umake", self.result_path, "ok"]))
+
+    def test_stale_socket(self):
+        """We run the command locally if the daemon socket isn't listened to"""
+        os.makedirs(os.path.dirname(daemon.get_socket_path()))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(daemon.get_socket_path())
+        sock.close()
+        self.assertIsNone(daemon.forward_to_daemon(["umake", self.result_path, "ok"]))
+
+    def test_disabled(self):
+        """We run the command locally if the daemon is disabled in the environment"""
+        self.start_daemon()
+        os.environ[daemon.settings.UMAKE_NO_DAEMON_ENVIRON_VARIABLE] = "1"
+        self.assertIsNone(daemon.forward_to_daemon(["umake", self.result_path, "ok"]))
+        self.assertFalse(os.path.exists(self.result_path))
+
+    def test_root(self):
+        """We run the command locally when run as root"""
+        self.start_daemon()
+        self.geteuid.return_value = 0
+        self.assertIsNone(daemon.forward_to_daemon(["umake", self.result_path, "ok"]))
+        self.assertFalse(os.path.exists(self.result_path))
+
+    def test_hand_back_outside_daemon(self):
+        """We don't do anything when asked to hand back a command not run by the daemon"""
+        daemon.hand_back_to_client()
+
+    def test_socket_activation(self):
+        """We use the socket passed by systemd"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        with patch.dict(os.environ, {"LISTEN_PID": str(os.getpid()), "LISTEN_FDS": "1"}),\
+                patch("umake.daemon.socket.socket") as socket_mock:
+            result, socket_activated = daemon._get_listening_socket()
+            self.assertNotIn("LISTEN_PID", os.environ)
+        self.assertTrue(socket_activated)
+        socket_mock.assert_called_with(fileno=daemon.SD_LISTEN_FDS_START)
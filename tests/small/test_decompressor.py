@@ -73,6 +73,28 @@ class TestDecompressor(LoggedTestCase):
         self.assertTrue(os.path.isfile(os.path.join(self.tempdir, 'server-content', 'subdir', 'otherfile')))
         self.assertEqual(self.on_done.call_count, 1, "Global done callback is only called once")
 
+    def test_decompress_report_files(self):
+        """We report the number of files extracted from a .tgz file"""
+        filepath = os.path.join(self.compressfiles_dir, "valid.tgz")
+        report = Mock()
+        Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=self.tempdir, dir='')}, self.on_done,
+                     report=report)
+        self.wait_for_callback(self.on_done)
+
+        self.assertEqual(report.call_count, 6)
+        self.assertEqual(report.call_args[0][0], {filepath: {"files": 6}})
+
+    def test_decompress_zip_report_files(self):
+        """We report the number of files extracted from a zip file"""
+        filepath = os.path.join(self.compressfiles_dir, "valid.zip")
+        report = Mock()
+        Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=self.tempdir, dir='')}, self.on_done,
+                     report=report)
+        self.wait_for_callback(self.on_done)
+
+        self.assertIsNone(self.on_done.call_args[0][0].popitem()[1].error)
+        self.assertEqual(report.call_args[0][0], {filepath: {"files": 7}})
+
     def test_decompress_move_dir_content(self):
         """We decompress a valid file decompressing one subdir content (other files in root are kept in place)"""
         filepath = os.path.join(self.compressfiles_dir, "valid.tgz")
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for block level delta downloads"""
+
+from io import BytesIO
+import os
+import random
+import shutil
+import tempfile
+from ..tools import LoggedTestCase
+from umake.network.delta import BlockIndex, find_seed_blocks, get_index_url, plan, remove_stale_seeds
+
+
+class TestBlockIndex(LoggedTestCase):
+    """This will test block indexes"""
+
+    def test_from_file(self):
+        """We describe every block, the last one being shorter"""
+        index = BlockIndex.from_file(BytesIO(b"a" * 10 + b"b" * 5), block_size=10)
+        self.assertEqual(index.length, 15)
+        self.assertEqual(len(index.blocks), 2)
+        self.assertEqual(index.blocks[1], BlockIndex.describe_block(b"bbbbb"))
+        self.assertEqual(index.block_range(1), (10, 15))
+
+    def test_serialization(self):
+        """We load back a serialized index, even with a last block shorter than a block head"""
+        index = BlockIndex.from_file(BytesIO(os.urandom(1003)), block_size=100)
+        loaded = BlockIndex.loads(index.dumps())
+        self.assertEqual((loaded.block_size, loaded.length, loaded.sha256), (100, 1003, index.sha256))
+        self.assertEqual(loaded.blocks, index.blocks)
+        self.assertEqual(len(loaded.blocks[-1][1]), 3)
+
+    def test_invalid(self):
+        """We raise on invalid indexes"""
+        valid = BlockIndex.from_file(BytesIO(b"foo"), block_size=100).dumps()
+        for content in ("", "foo", "{}", valid.replace('"version": 1', '"version": 42'),
+                        valid.replace('"length": 3', '"length": 300')):
+            self.assertRaises(BaseException, BlockIndex.loads, content)
+
+    def test_index_url(self):
+        """We publish the index next to the artifact, keeping query parameters"""
+        self.assertEqual(get_index_url("https://foo.com/bar.tar?sig=baz"),
+                         "https://foo.com/bar.tar.umake-index?sig=baz")
+
+
+class TestSeedBlocks(LoggedTestCase):
+    """This will test finding blocks in seeds and planning the rebuild"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.content = random.Random(42).randbytes(100 * 64)
+
+    def seed(self, content, name="seed"):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def index(self, content):
+        return BlockIndex.from_file(BytesIO(content), block_size=64)
+
+    def test_same_content(self):
+        """We find every block of an unchanged file"""
+        path = self.seed(self.content)
+        matches = find_seed_blocks(self.index(self.content), [path])
+        self.assertEqual(matches, {block_no: (path, block_no * 64) for block_no in range(100)})
+        self.assertEqual(plan(self.index(self.content), matches), [("seed", path, 0, 6400)])
+
+    def test_changed_block(self):
+        """We only miss changed blocks"""
+        path = self.seed(self.content)
+        new_content = self.content[:640] + b"x" * 64 + self.content[704:]
+        index = self.index(new_content)
+        matches = find_seed_blocks(index, [path])
+        self.assertEqual(sorted(set(range(100)) - set(matches)), [10])
+        self.assertEqual(plan(index, matches), [("seed", path, 0, 640), ("fetch", 640, 704),
+                                                ("seed", path, 704, 6400 - 704)])
+
+    def test_insertion(self):
+        """We find blocks shifted by an insertion"""
+        path = self.seed(self.content)
+        new_content = self.content[:1000] + b"inserted" + self.content[1000:]
+        index = self.index(new_content)
+        matches = find_seed_blocks(index, [path])
+        # only blocks around the insertion are missing
+        self.assertLessEqual(len(index.blocks) - len(matches), 3)
+
+    def test_deletion(self):
+        """We find blocks shifted by a deletion"""
+        path = self.seed(self.content)
+        new_content = self.content[:1000] + self.content[1100:]
+        index = self.index(new_content)
+        matches = find_seed_blocks(index, [path])
+        self.assertLessEqual(len(index.blocks) - len(matches), 3)
+
+    def test_several_seeds(self):
+        """We look for blocks in every seed"""
+        first = self.seed(self.content[:3200], "first")
+        second = self.seed(self.content[3200:], "second")
+        matches = find_seed_blocks(self.index(self.content), [first, second])
+        self.assertEqual(len(matches), 100)
+        self.assertEqual(matches[60], (second, 640))
+
+    def test_unusable_seeds(self):
+        """We ignore empty, missing and unrelated seeds"""
+        seeds = [self.seed(b"", "empty"), os.path.join(self.tmpdir, "doesntexist"),
+                 self.seed(os.urandom(6400), "unrelated")]
+        self.assertEqual(find_seed_blocks(self.index(self.content), seeds), {})
+
+    def test_plan_merges_close_ranges(self):
+        """We fetch close missing blocks in one range"""
+        path = self.seed(self.content)
+        index = self.index(self.content)
+        matches = {block_no: (path, block_no * 64) for block_no in range(100) if block_no not in (10, 12, 50)}
+        self.assertEqual(plan(index, matches), [("seed", path, 0, 640), ("fetch", 640, 832),
+                                                ("seed", path, 832, 3200 - 832), ("fetch", 3200, 3264),
+                                                ("seed", path, 3264, 6400 - 3264)])
+
+    def test_remove_stale_seeds(self):
+        """We remove previous seeds"""
+        keep = self.seed(b"foo", "keep")
+        self.seed(b"bar", "stale")
+        remove_stale_seeds(self.tmpdir, [keep])
+        self.assertEqual(os.listdir(self.tmpdir), ["keep"])
+        remove_stale_seeds(os.path.join(self.tmpdir, "doesntexist"), [])
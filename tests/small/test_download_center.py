@@ -21,14 +21,23 @@
 
 import urllib3
 from enum import Enum
+import hashlib
+from io import BytesIO
 import os
+import random
+import shutil
 from os.path import join, getsize
+import tempfile
 from time import time
-from unittest.mock import Mock, call
+from unittest.mock import Mock, call, patch
 from ..tools import get_data_dir, CopyingMock, LoggedTestCase
-from ..tools.local_server import LocalHttp
-from umake.network.download_center import DownloadCenter, DownloadItem
-from umake.tools import ChecksumType, Checksum
+from ..tools.local_server import LocalHttp, RequestHandler
+from umake.network.bundle import Bundle, use_bundle, set_offline
+from umake.network.delta import BlockIndex
+from umake.network.download_center import DownloadCenter, DownloadItem, SpeculativeDownload, SpooledBuffer, WriteBehind
+from umake.network.gpg import Keyring, Signature
+from umake.network.scheduler import DownloadPriority, DownloadScheduler
+from umake.tools import ChecksumType, Checksum, Singleton
 
 
 class TestDownloadCenter(LoggedTestCase):
@@ -403,6 +412,36 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.fd)
         self.assertIsNone(result.error)
 
+    def test_in_memory_download_spilled_to_disk(self):
+        """we spill in memory downloads to disk once they are bigger than the memory threshold"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        request = DownloadItem(url, None)
+        DownloadCenter([request], self.callback, download=False, memory_threshold=4)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertTrue(result.buffer._rolled)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        self.assertEqual(content, result.buffer.getvalue())
+        self.assertEqual(content, result.buffer.read())
+        self.assertIsNone(result.fd)
+        self.assertIsNone(result.error)
+
+    def test_in_memory_download_under_threshold(self):
+        """we keep small in memory downloads in memory"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        request = DownloadItem(url, None)
+        DownloadCenter([request], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertFalse(result.buffer._rolled)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.getvalue())
+
     def test_unsupported_protocol(self):
         """Raises an exception when trying to download for an unsupported protocol"""
         filename = "simplefile"
@@ -494,6 +533,205 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.fd)
         self.expect_warn_error = True
 
+    def get_swift_signature(self, filename):
+        """Return the signature of filename in the swift fixtures, checked against its published keys"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with patch("umake.network.gpg.xdg_cache_home", cache_dir):
+            keyring = Keyring("swift", [self.build_server_address("swift.org/keys/all-keys.asc")])
+        with open(join(self.server_dir, "swift.org", "builds", filename), "rb") as f:
+            return Signature(keyring, f.read())
+
+    def test_download_with_signature(self):
+        """we deliver one successful download, matching its signature"""
+        filename = "swift-mock-ubuntu15.10.tar.gz"
+        request = self.build_server_address("swift.org/builds/" + filename)
+        DownloadCenter([DownloadItem(request, signature=self.get_swift_signature(filename + ".sig"))], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, "swift.org", "builds", filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_download_with_wrong_signature(self):
+        """we raise an error if the download doesn't match its signature"""
+        request = self.build_server_address("simplefile")
+        signature = self.get_swift_signature("swift-mock-ubuntu15.10.tar.gz.sig")
+        DownloadCenter([DownloadItem(request, signature=signature)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Signature of {} isn't valid".format(request), result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_create_bundle(self):
+        """we store downloaded content in the bundle we are creating"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        with tempfile.TemporaryDirectory() as bundle_dir:
+            bundle = Bundle(bundle_dir, create=True)
+            use_bundle(bundle)
+            self.addCleanup(use_bundle, None)
+            DownloadCenter([DownloadItem(url, None)], self.callback)
+            self.wait_for_callback(self.callback)
+
+            self.assertIsNone(self.callback.call_args[0][0][url].error)
+            content_path, final_url = Bundle(bundle_dir).get(url)
+            self.assertEqual(final_url, url)
+            with open(join(self.server_dir, filename), 'rb') as file_on_disk, open(content_path, 'rb') as f:
+                self.assertEqual(file_on_disk.read(), f.read())
+
+    def test_replay_bundle(self):
+        """we serve content from the bundle we replay, without any network access"""
+        url = "http://unreachable.invalid/simplefile"
+        with tempfile.TemporaryDirectory() as bundle_dir:
+            with open(join(self.server_dir, "simplefile"), 'rb') as f:
+                Bundle(bundle_dir, create=True).add(url, f, url + "-final")
+            use_bundle(Bundle(bundle_dir))
+            self.addCleanup(set_offline, False)
+            self.addCleanup(use_bundle, None)
+            DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, '268a5059001855fef30b4f95f82044ed'))],
+                           self.callback)
+            self.wait_for_callback(self.callback)
+
+            result = self.callback.call_args[0][0][url]
+            self.assertIsNone(result.error)
+            self.assertEqual(result.final_url, url + "-final")
+            with open(join(self.server_dir, "simplefile"), 'rb') as file_on_disk:
+                self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_offline_mode(self):
+        """we refuse to download anything not in a bundle in offline mode"""
+        url = self.build_server_address("simplefile")
+        set_offline(True)
+        self.addCleanup(set_offline, False)
+        DownloadCenter([DownloadItem(url, None)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIn("offline", result.error)
+        self.assertIsNone(result.buffer)
+        self.expect_warn_error = True
+
+    def wait_for_speculative_download(self, speculative_download):
+        """wait for the speculative download to be finished, attached or not"""
+        timeout = time() + 5
+        while speculative_download._result is None:
+            if time() > timeout:
+                raise BaseException("Speculative download not finished within 5 seconds")
+
+    def test_download_priority(self):
+        """we schedule downloads to files as artifacts and in memory ones as metadata, unless they have a priority"""
+        urls = [self.build_server_address("simplefile"), self.build_server_address("biggerfile")]
+        for download, priority in ((True, DownloadPriority.artifact), (False, DownloadPriority.metadata)):
+            with patch("umake.network.download_center.DownloadScheduler") as scheduler:
+                self.callback.reset_mock()
+                DownloadCenter([DownloadItem(urls[0]), DownloadItem(urls[1], priority=DownloadPriority.prefetch)],
+                               self.callback, download=download)
+                self.wait_for_callback(self.callback)
+                self.assertEqual(sorted(call[0][0].value for call in scheduler.return_value.start.call_args_list),
+                                 [priority.value, DownloadPriority.prefetch.value])
+                self.assertEqual(scheduler.return_value.start.return_value.close.call_count, 2)
+
+    def test_download_rate_limited(self):
+        """we deliver downloads at the requested rate"""
+        self.addCleanup(Singleton._instances.pop, DownloadScheduler, None)
+        Singleton._instances.pop(DownloadScheduler, None)
+        DownloadScheduler().set_rate_limits(per_download=20000)
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        start = time()
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        # 9000 bytes with a 5000 bytes burst
+        self.assertGreater(time() - start, 0.15)
+        result = self.callback.call_args[0][0][url]
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_speculative_download_priority(self):
+        """we prefetch speculative downloads in the background, and make them artifacts once attached"""
+        url = self.build_server_address("simplefile")
+        with patch("umake.network.download_center.DownloadScheduler") as scheduler:
+            speculative_download = SpeculativeDownload([DownloadItem(url, None)])
+            speculative_download.attach(self.callback)
+            self.wait_for_callback(self.callback)
+        scheduler.return_value.start.assert_called_once_with(DownloadPriority.prefetch)
+        self.assertEqual(speculative_download._download_center._priority, DownloadPriority.artifact)
+
+    def test_speculative_download_attach_before_done(self):
+        """we deliver a speculative download attached while in progress as a normal download"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        speculative_download = SpeculativeDownload([DownloadItem(url, None)])
+        report = Mock()
+        speculative_download.attach(self.callback, report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertEqual(self.callback.call_count, 1)
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+        self.assertTrue(report.called)
+
+    def test_speculative_download_attach_after_done(self):
+        """we deliver the result and last progress of a speculative download finished before being attached"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        speculative_download = SpeculativeDownload([DownloadItem(url, None)])
+        self.wait_for_speculative_download(speculative_download)
+        report = Mock()
+        speculative_download.attach(self.callback, report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertEqual(self.callback.call_count, 1)
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+            self.assertEqual(content, result.fd.read())
+        size = len(content)
+        report.assert_called_once_with({url: {"current": size, "size": size}})
+
+    def test_speculative_download_in_memory(self):
+        """we deliver a speculative download kept in memory"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        speculative_download = SpeculativeDownload([DownloadItem(url, None)], download=False)
+        speculative_download.attach(self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.fd)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.read())
+
+    def test_speculative_download_discard(self):
+        """we throw away a discarded speculative download, finished or not"""
+        url = self.build_server_address("biggerfile")
+        speculative_download = SpeculativeDownload([DownloadItem(url, None)])
+        speculative_download.discard()
+        self.wait_for_speculative_download(speculative_download)
+
+        self.assertFalse(self.callback.called)
+        result = speculative_download._result[url]
+        self.assertTrue(result.error or result.fd.closed)
+
+    def test_speculative_download_discard_after_done(self):
+        """we remove the temporary file of a finished and discarded speculative download"""
+        url = self.build_server_address("simplefile")
+        speculative_download = SpeculativeDownload([DownloadItem(url, None)])
+        self.wait_for_speculative_download(speculative_download)
+        result = speculative_download._result[url]
+        speculative_download.discard()
+
+        self.assertTrue(result.fd.closed)
+        self.assertFalse(os.path.exists(result.fd.name))
+
 
 class TestDownloadCenterSecure(LoggedTestCase):
     """This will test the download center in secure mode by sending one or more download requests"""
@@ -588,3 +826,223 @@ class TestDownloadCenterSecure(LoggedTestCase):
         self.assertIsNone(result.buffer)
         self.assertIsNone(result.fd)
         self.expect_warn_error = True
+
+
+class TestDeltaDownload(LoggedTestCase):
+    """This will test downloading only changes from previous content"""
+
+    def setUp(self):
+        super().setUp()
+        self.server_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.server_dir)
+        self.server = LocalHttp(self.server_dir, port=9877)
+        self.addCleanup(self.server.stop)
+        self.callback = Mock()
+        self.fd_to_close = []
+        self.addCleanup(lambda: [fd.close() for fd in self.fd_to_close])
+        self.previous_content = random.Random(42).randbytes(20 * 1024)
+        self.content = self.previous_content[:5000] + b"changed" + self.previous_content[5007:]
+        self.write_server_file("file", self.content)
+        self.seed = join(self.server_dir, "previous")
+        with open(self.seed, "wb") as f:
+            f.write(self.previous_content)
+        self.url = "{}/file".format(self.server.get_address())
+
+    def write_server_file(self, filename, content):
+        with open(join(self.server_dir, filename), "wb") as f:
+            f.write(content)
+
+    def write_index(self, content=None):
+        index = BlockIndex.from_file(BytesIO(content or self.content), block_size=1024)
+        self.write_server_file("file.umake-index", index.dumps().encode())
+
+    def download(self, seeds):
+        DownloadCenter([DownloadItem(self.url, Checksum(ChecksumType.sha256, hashlib.sha256(self.content).hexdigest()),
+                                     seeds=seeds)], self.callback)
+        TestDownloadCenter.wait_for_callback(self, self.callback)
+        result = self.callback.call_args[0][0][self.url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.fd.read(), self.content)
+        return result
+
+    def test_delta_download(self):
+        """We only download changed blocks"""
+        self.write_index()
+        result = self.download([self.seed])
+        self.assertEqual(self.server.served_ranges, [(4096, 5120)])
+        self.assertTrue(result.block_index)
+
+    def test_no_index(self):
+        """We download everything if the server doesn't publish an index"""
+        result = self.download([self.seed])
+        self.assertEqual(self.server.served_ranges, [])
+        self.assertFalse(result.block_index)
+
+    def test_index_unreachable(self):
+        """We download everything without any warning if the index can't be downloaded"""
+        with patch("umake.network.delta.get_index_url", return_value="http://localhost:1/file.umake-index"):
+            result = self.download([self.seed])
+        self.assertEqual(self.server.served_ranges, [])
+        self.assertFalse(result.block_index)
+
+    def test_no_seed(self):
+        """We download everything without any seed, but tell the server publishes an index"""
+        self.write_index()
+        result = self.download([])
+        self.assertEqual(self.server.served_ranges, [])
+        self.assertTrue(result.block_index)
+
+    def test_no_delta_requested(self):
+        """We don't look for an index without seeds"""
+        self.write_index()
+        result = self.download(None)
+        self.assertFalse(result.block_index)
+
+    def test_no_range_support(self):
+        """We download everything if the server doesn't support ranges"""
+        self.write_index()
+        with patch.object(RequestHandler, "ranges", False):
+            self.download([self.seed])
+        self.expect_warn_error = True
+
+    def test_invalid_index(self):
+        """We download everything if the content rebuilt from the index is invalid"""
+        self.write_server_file("file.umake-index",
+                               BlockIndex.from_file(BytesIO(self.content), block_size=1024).dumps()
+                               .replace(hashlib.sha256(self.content).hexdigest(), "0" * 64).encode())
+        self.download([self.seed])
+        self.expect_warn_error = True
+
+
+class TestWriteBehind(LoggedTestCase):
+    """This will test writing downloaded blocks from another thread"""
+
+    def setUp(self):
+        super().setUp()
+        self.dest = tempfile.TemporaryFile()
+        self.addCleanup(self.dest.close)
+
+    def reader(self, content):
+        source = tempfile.TemporaryFile()
+        self.addCleanup(source.close)
+        source.write(content)
+        source.seek(0)
+        return source.readinto
+
+    def test_readinto(self):
+        """We write every read block to dest"""
+        content = os.urandom(10000)
+        read = self.reader(content)
+        with WriteBehind(self.dest, 1024) as writer:
+            while writer.readinto(read):
+                pass
+        self.dest.seek(0)
+        self.assertEqual(self.dest.read(), content)
+        self.assertEqual(writer.network_bytes, 10000)
+        self.assertEqual(writer.disk_bytes, 10000)
+
+    def test_buffers_reused(self):
+        """We only allocate a bounded number of buffers, reused once written"""
+        read = self.reader(os.urandom(100 * 1024))
+        with WriteBehind(self.dest, 1024, buffers=4) as writer:
+            while writer.readinto(read):
+                pass
+        self.assertLessEqual(writer._allocated_buffers, 4)
+        self.assertEqual(self.dest.tell(), 100 * 1024)
+
+    def test_write(self):
+        """We write queued bytes in order"""
+        with WriteBehind(self.dest, 1024) as writer:
+            for data in writer.timed(iter([b"foo", b"bar", b"baz"])):
+                writer.write(data)
+        self.dest.seek(0)
+        self.assertEqual(self.dest.read(), b"foobarbaz")
+        self.assertEqual(writer.network_bytes, 9)
+
+    def test_in_memory(self):
+        """We write in memory destinations directly, without any thread"""
+        dest = SpooledBuffer(max_size=1024)
+        with WriteBehind(dest, 1024) as writer:
+            writer.write(b"foo")
+            self.assertIsNone(writer._thread)
+            self.assertEqual(dest.getvalue(), b"foo")
+
+    def test_writer_error(self):
+        """We raise writing errors to the reader"""
+        dest = Mock()
+        dest.write.side_effect = OSError("No space left on device")
+        writer = WriteBehind(dest, 1024)
+        writer.write(b"foo")
+        self.assertRaises(OSError, writer.close)
+
+    def test_writer_error_doesnt_block_reader(self):
+        """We keep giving buffers back to the reader after a writing error"""
+        dest = Mock()
+        dest.write.side_effect = OSError("No space left on device")
+        read = self.reader(os.urandom(100 * 1024))
+        writer = WriteBehind(dest, 1024, buffers=2)
+        with self.assertRaises(OSError):
+            while writer.readinto(read):
+                pass
+            writer.close()
+
+    def test_preallocate(self):
+        """We preallocate the announced size and truncate to the written one"""
+        with patch("umake.network.download_center.os.posix_fallocate") as fallocate:
+            with WriteBehind(self.dest, 1024, size=4096) as writer:
+                writer.write(b"foo")
+        fallocate.assert_called_once_with(self.dest.fileno(), 0, 4096)
+        self.assertEqual(os.fstat(self.dest.fileno()).st_size, 3)
+
+    def test_preallocate_unknown_size(self):
+        """We don't preallocate if the size is unknown"""
+        with patch("umake.network.download_center.os.posix_fallocate") as fallocate:
+            with WriteBehind(self.dest, 1024) as writer:
+                writer.write(b"foo")
+        fallocate.assert_not_called()
+
+    def test_abort(self):
+        """We discard pending blocks when aborting"""
+        with patch("umake.network.download_center.os.posix_fallocate"):
+            with self.assertRaises(BaseException):
+                with WriteBehind(self.dest, 1024, size=4096):
+                    raise BaseException("Cancelled")
+
+    def test_no_fsync_by_default(self):
+        """We don't sync temporary files by default"""
+        with patch("umake.network.download_center.os.fdatasync") as fdatasync:
+            with WriteBehind(self.dest, 1024) as writer:
+                writer.write(b"foo")
+        fdatasync.assert_not_called()
+
+    def test_fsync_end(self):
+        """We sync once at the end with the end policy"""
+        with patch("umake.network.download_center.os.fdatasync") as fdatasync:
+            with WriteBehind(self.dest, 1024, fsync_policy="end") as writer:
+                writer.write(b"foo")
+                writer.write(b"bar")
+        fdatasync.assert_called_once_with(self.dest.fileno())
+
+    def test_fsync_periodic(self):
+        """We sync every few written bytes with the periodic policy"""
+        with patch("umake.network.download_center.os.fdatasync") as fdatasync, \
+                patch.object(WriteBehind, "PERIODIC_FSYNC_SIZE", 4):
+            with WriteBehind(self.dest, 1024, fsync_policy="periodic") as writer:
+                for data in (b"foo", b"bar", b"baz"):
+                    writer.write(data)
+        # after foobar, then at the end
+        self.assertEqual(fdatasync.call_count, 2)
+
+    def test_fsync_policy_from_environment(self):
+        """We read the default fsync policy from the environment"""
+        with patch.dict(os.environ, {"UMAKE_FSYNC_POLICY": "end"}):
+            writer = WriteBehind(self.dest, 1024)
+        writer.close()
+        self.assertEqual(writer._fsync_policy, "end")
+
+    def test_invalid_fsync_policy(self):
+        """We warn and don't sync on unknown fsync policy"""
+        writer = WriteBehind(self.dest, 1024, fsync_policy="sometimes")
+        writer.close()
+        self.assertEqual(writer._fsync_policy, "none")
+        self.expect_warn_error = True
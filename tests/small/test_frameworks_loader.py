@@ -701,16 +701,53 @@ class TestFrameworkLoadOnDemandLoader(BaseFrameworkLoader):
     def test_root_needed_setup_call_root(self):
         """Framework with root access needed call sudo"""
         with patch('umake.frameworks.subprocess') as subprocess_mock,\
+                patch('umake.tools.subprocess') as tools_subprocess_mock,\
                 patch.object(umake.frameworks.os, 'geteuid', return_value=1000) as geteuid,\
                 patch('umake.frameworks.MainLoop') as mainloop_mock,\
+                patch('umake.frameworks.PrivilegedHelper') as helper_mock,\
                 patch('umake.frameworks.RequirementsHandler') as requirement_mock:
             requirement_mock.return_value.is_bucket_installed.return_value = False
             self.loadFramework("testframeworks")
-            self.assertTrue(self.CategoryHandler.categories["category-f"].frameworks["framework-c"].need_root_access)
-            self.CategoryHandler.categories["category-f"].frameworks["framework-c"].setup()
+            framework = self.CategoryHandler.categories["category-f"].frameworks["framework-c"]
+            self.assertTrue(framework.need_root_access)
+            # root access isn't only needed for package requirements
+            framework.need_root_for_requirements_only = False
+            framework.setup()
 
             self.assertEqual(subprocess_mock.call.call_args[0][0][0], "sudo")
             self.assertTrue(mainloop_mock.return_value.quit.called)
+            self.assertFalse(helper_mock.return_value.start.called)
+
+    def test_root_needed_for_requirements_setup_starts_helper(self):
+        """Framework with root access needed only for package requirements starts the privileged helper"""
+        with patch('umake.frameworks.subprocess') as subprocess_mock,\
+                patch.object(umake.frameworks.os, 'geteuid', return_value=1000) as geteuid,\
+                patch('umake.frameworks.MainLoop') as mainloop_mock,\
+                patch('umake.frameworks.PrivilegedHelper') as helper_mock,\
+                patch('umake.frameworks.RequirementsHandler') as requirement_mock:
+            requirement_mock.return_value.is_bucket_installed.return_value = False
+            self.loadFramework("testframeworks")
+            framework = self.CategoryHandler.categories["category-f"].frameworks["framework-c"]
+            self.assertTrue(framework.need_root_for_requirements_only)
+            framework.setup()
+
+            self.assertTrue(helper_mock.return_value.start.called)
+            self.assertFalse(subprocess_mock.call.called)
+            self.assertFalse(mainloop_mock.return_value.quit.called)
+
+    def test_root_needed_for_requirements_helper_fails(self):
+        """We exit if the privileged helper can't get root access"""
+        with patch.object(umake.frameworks.os, 'geteuid', return_value=1000) as geteuid,\
+                patch('umake.frameworks.UI') as ui_mock,\
+                patch('umake.frameworks.PrivilegedHelper') as helper_mock,\
+                patch('umake.frameworks.RequirementsHandler') as requirement_mock:
+            requirement_mock.return_value.is_bucket_installed.return_value = False
+            helper_mock.return_value.start.side_effect = BaseException("Couldn't get root access")
+            self.loadFramework("testframeworks")
+            self.CategoryHandler.categories["category-f"].frameworks["framework-c"].setup()
+
+            ui_mock.return_main_screen.assert_called_once_with(status_code=1)
+            self.expect_warn_error = True
 
     def test_no_root_needed_setup_doesnt_call_root(self):
         """Framework without root access needed don't call sudo"""
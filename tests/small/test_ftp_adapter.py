@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the FTP adapter and its connection pool"""
+
+from ftplib import error_perm
+from unittest.mock import patch
+import requests
+import requests.exceptions
+from ..tools import LoggedTestCase
+from umake.network.ftp_adapter import FTPAdapter, FTPConnectionPool
+
+
+class FakeFTP:
+    """Fake ftplib.FTP server connection, serving files from a dict"""
+
+    files = {}
+    instances = []
+
+    def __init__(self, host=None, timeout=None, user=None):
+        self.host = host
+        self.alive = True
+        self.closed = False
+        self.rests = []
+        FakeFTP.instances.append(self)
+
+    def set_pasv(self, value):
+        self.passive = value
+
+    def voidcmd(self, cmd):
+        if not self.alive:
+            raise EOFError()
+        return "200 OK"
+
+    def size(self, path):
+        if path not in self.files:
+            raise error_perm("550 No such file")
+        return len(self.files[path])
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        self.rests.append(rest)
+        content = self.files[cmd.split(' ', 1)[1]][rest or 0:]
+        # deliver odd sized blocks, like a real server would
+        for i in range(0, len(content), 3):
+            callback(content[i:i + 3])
+        return "226 Transfer complete"
+
+    def close(self):
+        self.closed = True
+
+
+class TestFTPAdapter(LoggedTestCase):
+    """This will test the FTP adapter against a fake FTP server"""
+
+    def setUp(self):
+        super().setUp()
+        FakeFTP.files = {"foo/bar": b"0123456789abcdefghij"}
+        FakeFTP.instances = []
+        patcher = patch("umake.network.ftp_adapter.FTP", FakeFTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = FTPConnectionPool()
+        adapter_pool_patcher = patch.object(FTPAdapter, "pool", self.pool)
+        adapter_pool_patcher.start()
+        self.addCleanup(adapter_pool_patcher.stop)
+        self.session = requests.Session()
+        self.session.mount("ftp://", FTPAdapter())
+
+    def test_stream_exact_size_chunks(self):
+        """Streamed chunks have exactly the requested size, but the last one"""
+        r = self.session.get("ftp://localhost/foo/bar", stream=True)
+        chunks = [bytes(chunk) for chunk in r.raw.stream(amt=8)]
+        r.close()
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(int(r.headers["content-length"]), 20)
+        self.assertEqual([len(chunk) for chunk in chunks], [8, 8, 4])
+        self.assertEqual(b"".join(chunks), b"0123456789abcdefghij")
+
+    def test_stream_small_chunks(self):
+        """Chunks smaller than the server blocks are sliced from them"""
+        r = self.session.get("ftp://localhost/foo/bar", stream=True)
+        chunks = [bytes(chunk) for chunk in r.raw.stream(amt=2)]
+        r.close()
+
+        self.assertEqual(len(chunks), 10)
+        self.assertEqual(b"".join(chunks), b"0123456789abcdefghij")
+
+    def test_non_stream(self):
+        """Content is available on non streamed requests"""
+        r = self.session.get("ftp://localhost/foo/bar")
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b"0123456789abcdefghij")
+
+    def test_head(self):
+        """HEAD requests only get the size, without any transfer"""
+        r = self.session.head("ftp://localhost/foo/bar")
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(int(r.headers["content-length"]), 20)
+        self.assertEqual(FakeFTP.instances[0].rests, [])
+
+    def test_missing_file(self):
+        """We return a 404 for files which don't exist"""
+        r = self.session.get("ftp://localhost/foo/doesnt_exist", stream=True)
+
+        self.assertEqual(r.status_code, 404)
+
+    def test_resume_with_range(self):
+        """A Range header resumes the transfer with REST"""
+        r = self.session.get("ftp://localhost/foo/bar", stream=True, headers={"Range": "bytes=12-"})
+        content = b"".join(bytes(chunk) for chunk in r.raw.stream(amt=8192))
+        r.close()
+
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(int(r.headers["content-length"]), 8)
+        self.assertEqual(r.headers["content-range"], "bytes 12-19/20")
+        self.assertEqual(content, b"cdefghij")
+        self.assertEqual(FakeFTP.instances[0].rests, [12])
+
+    def test_unsupported_range(self):
+        """We error out on Range headers that can't be mapped to REST"""
+        with self.assertRaises(requests.exceptions.InvalidHeader):
+            self.session.get("ftp://localhost/foo/bar", headers={"Range": "bytes=0-5"})
+
+    def test_reuse_connection(self):
+        """Connections to the same host are reused once a transfer is done"""
+        for i in range(3):
+            r = self.session.get("ftp://localhost/foo/bar", stream=True)
+            list(r.raw.stream(amt=8192))
+            r.close()
+
+        self.assertEqual(len(FakeFTP.instances), 1)
+        self.assertTrue(FakeFTP.instances[0].passive)
+
+    def test_no_reuse_across_hosts(self):
+        """Connections are only reused for the same host"""
+        self.session.get("ftp://localhost/foo/bar")
+        self.session.get("ftp://otherhost/foo/bar")
+
+        self.assertEqual([conn.host for conn in FakeFTP.instances], ["localhost", "otherhost"])
+
+    def test_dead_connection_replaced(self):
+        """Idle connections which don't answer anymore are closed and replaced"""
+        self.session.get("ftp://localhost/foo/bar")
+        FakeFTP.instances[0].alive = False
+        r = self.session.get("ftp://localhost/foo/bar")
+
+        self.assertEqual(r.content, b"0123456789abcdefghij")
+        self.assertEqual(len(FakeFTP.instances), 2)
+        self.assertTrue(FakeFTP.instances[0].closed)
+
+    def test_interrupted_transfer_not_reused(self):
+        """Connections with a transfer not consumed till the end are not given back to the pool"""
+        # big enough for the transfer to be blocked on a full queue
+        FakeFTP.files["foo/bar"] = b"x" * 3 * (FTPAdapter.QUEUE_SIZE + 10)
+        r = self.session.get("ftp://localhost/foo/bar", stream=True)
+        r.close()
+        self.session.get("ftp://localhost/foo/bar")
+
+        self.assertEqual(len(FakeFTP.instances), 2)
+        self.assertTrue(FakeFTP.instances[0].closed)
+
+    def test_pool_max_idle(self):
+        """Only max_idle_per_host connections are kept idle for one host"""
+        pool = FTPConnectionPool(max_idle_per_host=1)
+        first = pool.acquire("localhost")
+        second = pool.acquire("localhost")
+        pool.release("localhost", first)
+        pool.release("localhost", second)
+
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        self.assertEqual(pool.acquire("localhost"), first)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for gpg keyrings and signature verification"""
+
+from io import BytesIO
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake.network.gpg import Keyring, Signature
+
+
+class GpgTestCase(LoggedTestCase):
+    """Generate a signing key, an other and an expired one, and content signed by each of them"""
+
+    CONTENT = b"content to sign\n" * 1000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.gnupg_home = tempfile.mkdtemp()
+        cls.keys = {}
+        cls.signatures = {}
+        for name, expire, options in (("signer", "never", []), ("other", "never", []),
+                                      ("expired", "1d", ["--faked-system-time", "20200101T000000!"])):
+            cls.gpg(*options, "--quick-gen-key", "{} <{}@example.com>".format(name, name), "ed25519", "sign", expire)
+            cls.keys[name] = cls.gpg("--armor", "--export", "{}@example.com".format(name))
+            cls.signatures[name] = cls.gpg(*options, "--detach-sign", "-u", "{}@example.com".format(name),
+                                           input=cls.CONTENT)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        subprocess.call(["gpgconf", "--homedir", cls.gnupg_home, "--kill", "all"])
+        shutil.rmtree(cls.gnupg_home)
+
+    @classmethod
+    def gpg(cls, *args, input=None):
+        return subprocess.run(["gpg", "--homedir", cls.gnupg_home, "--batch", "--passphrase", "", *args],
+                              input=input, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        patcher = patch("umake.network.gpg.xdg_cache_home", self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.published_keys = ["signer"]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def get_keyring(self, **kwargs):
+        keyring = Keyring("test", ["http://localhost/keys.asc"], **kwargs)
+        keyring._download_keys = lambda: [("http://localhost/{}.asc".format(name), self.keys[name])
+                                          for name in self.published_keys]
+        return keyring
+
+
+class TestKeyring(GpgTestCase):
+    """This will test keyrings refresh"""
+
+    def test_keyring_path(self):
+        """We store the keyring in the umake cache directory"""
+        self.assertEqual(self.get_keyring().path, os.path.join(self.cache_dir, "umake", "keyrings", "test"))
+
+    def test_missing_keyring_is_stale(self):
+        """We need to refresh a keyring which was never downloaded"""
+        self.assertTrue(self.get_keyring().is_stale())
+
+    def test_refresh(self):
+        """We import published keys and don't refresh them again until the keyring is too old"""
+        keyring = self.get_keyring()
+        keyring.refresh()
+        self.assertFalse(keyring.is_stale())
+        self.assertEqual(keyring._keys_validity(), [True])
+        self.assertFalse(os.path.exists(keyring.path + ".new"))
+        self.assertFalse(os.path.exists(keyring.path + ".old"))
+
+        stamp = os.path.join(keyring.path, Keyring.STAMP_FILENAME)
+        too_old = time.time() - Keyring.MAX_AGE - 1
+        os.utime(stamp, (too_old, too_old))
+        self.assertTrue(keyring.is_stale())
+
+    def test_refresh_drops_unpublished_keys(self):
+        """We only keep keys which are still published after a refresh"""
+        keyring = self.get_keyring()
+        self.published_keys = ["signer", "other"]
+        keyring.refresh()
+        self.assertEqual(len(keyring._keys_validity()), 2)
+        self.published_keys = ["other"]
+        keyring.refresh()
+        self.assertEqual(len(keyring._keys_validity()), 1)
+
+    def test_expired_key_is_stale(self):
+        """We refresh a keyring having an expired key, even if it's recent"""
+        keyring = self.get_keyring()
+        self.published_keys = ["signer", "expired"]
+        keyring.refresh()
+        self.assertEqual(sorted(keyring._keys_validity()), [False, True])
+        self.assertTrue(keyring.is_stale())
+
+    def test_refresh_invalid_key(self):
+        """We keep the current keyring if any downloaded key is invalid"""
+        keyring = self.get_keyring()
+        keyring.refresh()
+        self.keys = dict(self.keys, other=b"not a key")
+        self.published_keys = ["signer", "other"]
+        self.assertRaises(BaseException, keyring.refresh)
+        self.assertEqual(keyring._keys_validity(), [True])
+        self.assertFalse(os.path.exists(keyring.path + ".new"))
+
+    def test_ensure(self):
+        """We only refresh stale keyrings"""
+        keyring = self.get_keyring()
+        with patch.object(keyring, "refresh", wraps=keyring.refresh) as refresh:
+            keyring.ensure()
+            keyring.ensure()
+        refresh.assert_called_once_with()
+
+    def test_force_refresh(self):
+        """We refresh a keyring on demand, even if it isn't stale"""
+        keyring = self.get_keyring()
+        keyring.refresh()
+        self.published_keys = ["signer", "other"]
+        keyring.force_refresh()
+        self.assertEqual(len(keyring._keys_validity()), 2)
+
+    def test_ensure_keeps_valid_keyring(self):
+        """We keep using a stale keyring if it can't be refreshed but has a valid key"""
+        self.expect_warn_error = True
+        keyring = self.get_keyring(max_age=0)
+        keyring.refresh()
+        keyring._download_keys = lambda: (_ for _ in ()).throw(BaseException("no network"))
+        keyring.ensure()
+        self.assertEqual(keyring._keys_validity(), [True])
+
+    def test_ensure_fails_without_valid_key(self):
+        """We raise if a keyring can't be refreshed and has no valid key"""
+        keyring = self.get_keyring()
+        keyring._download_keys = lambda: (_ for _ in ()).throw(BaseException("no network"))
+        self.assertRaises(BaseException, keyring.ensure)
+
+
+class TestSignatureVerifier(GpgTestCase):
+    """This will test verifying signatures of streamed content"""
+
+    def verify(self, keyring, signature, content=None, dest=None):
+        content = self.CONTENT if content is None else content
+        with Signature(keyring, signature).verifier("content") as verifier:
+            for i in range(0, len(content), 1000):
+                verifier.update(content[i:i + 1000])
+            verifier.finish(dest)
+
+    def test_valid_signature(self):
+        """We accept content matching its signature"""
+        self.verify(self.get_keyring(), self.signatures["signer"])
+
+    def test_verifier_prepares_keyring(self):
+        """We download the keyring before verifying if needed"""
+        keyring = self.get_keyring()
+        self.verify(keyring, self.signatures["signer"])
+        self.assertFalse(keyring.is_stale())
+
+    def test_bad_signature(self):
+        """We reject content not matching its signature"""
+        self.assertRaises(BaseException, self.verify, self.get_keyring(), self.signatures["signer"],
+                          content=self.CONTENT + b"tampered")
+
+    def test_invalid_signature(self):
+        """We reject signatures which aren't signatures"""
+        self.assertRaises(BaseException, self.verify, self.get_keyring(), b"not a signature")
+
+    def test_unknown_key(self):
+        """We reject content signed by a key which isn't published"""
+        self.assertRaises(BaseException, self.verify, self.get_keyring(), self.signatures["other"],
+                          dest=BytesIO(self.CONTENT))
+
+    def test_new_key(self):
+        """We refresh the keyring and verify again from dest when content is signed by a newly published key"""
+        keyring = self.get_keyring()
+        keyring.refresh()
+        self.published_keys = ["signer", "other"]
+        self.verify(keyring, self.signatures["other"], dest=BytesIO(self.CONTENT))
+        self.assertEqual(len(keyring._keys_validity()), 2)
+
+    def test_new_key_without_dest(self):
+        """We can't check content again without dest"""
+        keyring = self.get_keyring()
+        keyring.refresh()
+        self.published_keys = ["signer", "other"]
+        self.assertRaises(BaseException, self.verify, keyring, self.signatures["other"])
+
+    def test_expired_key(self):
+        """We reject content signed by an expired key"""
+        self.published_keys = ["expired"]
+        self.assertRaises(BaseException, self.verify, self.get_keyring(), self.signatures["expired"],
+                          dest=BytesIO(self.CONTENT))
+
+    def test_restart(self):
+        """We forget content fed before restarting"""
+        with Signature(self.get_keyring(), self.signatures["signer"]).verifier("content") as verifier:
+            verifier.update(b"garbage")
+            verifier.restart()
+            verifier.update(self.CONTENT)
+            verifier.finish()
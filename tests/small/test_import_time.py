@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2026 Canonical
+#
+# Authors:
+#  agent
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Ensure umake startup doesn't regress by importing heavy modules too early"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import monotonic
+from ..tools import get_root_dir, LoggedTestCase
+from umake import settings
+
+
+class TestImportTime(LoggedTestCase):
+    """Parse python -X importtime output and time cheap umake commands"""
+
+    HEAVY_MODULES = ("gi", "apt", "requests", "progressbar", "yaml")
+
+    # wall time budget, in bare interpreter startups, and heavy modules allowed per command. Checking framework
+    # package requirements opens the apt cache
+    BUDGETS = {
+        "--version": (10, ()),
+        "--help": (60, ("apt",)),
+        "-l": (60, ("apt",)),
+    }
+
+    def setUp(self):
+        super().setUp()
+        # no configuration to parse
+        self.xdg_dir = tempfile.mkdtemp()
+        self.env = os.environ.copy()
+        self.env.pop("LOG_CFG", None)
+        self.env["XDG_CONFIG_HOME"] = os.path.join(self.xdg_dir, "config")
+        self.env["XDG_CACHE_HOME"] = os.path.join(self.xdg_dir, "cache")
+        self.env[settings.UMAKE_NO_DAEMON_ENVIRON_VARIABLE] = "1"
+
+    def tearDown(self):
+        shutil.rmtree(self.xdg_dir)
+        super().tearDown()
+
+    def get_wall_time(self, args, runs=3):
+        """Return the best wall time of running python with args, in seconds"""
+        best = None
+        for i in range(runs):
+            start = monotonic()
+            subprocess.run([sys.executable] + args, env=self.env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            duration = monotonic() - start
+            if best is None or duration < best:
+                best = duration
+        return best
+
+    def get_imported_modules(self, arg):
+        """Return all modules imported by umake arg"""
+        output = subprocess.run([sys.executable, "-X", "importtime", os.path.join(get_root_dir(), "bin", "umake"),
+                                 arg], env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                universal_newlines=True).stderr
+        imported_modules = set()
+        for line in output.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            try:
+                _, cumulative, module = line[len("import time:"):].split("|")
+                int(cumulative)
+            except ValueError:
+                # header line
+                continue
+            imported_modules.add(module.strip())
+        return imported_modules
+
+    def check_budget(self, arg):
+        startups, allowed_heavy_modules = self.BUDGETS[arg]
+        imported_modules = self.get_imported_modules(arg)
+        self.assertIn("umake", imported_modules)
+        for module in self.HEAVY_MODULES:
+            if module in allowed_heavy_modules:
+                continue
+            for imported in imported_modules:
+                self.assertFalse(imported == module or imported.startswith(module + "."),
+                                 "{} was imported for umake {}".format(imported, arg))
+
+        # relative to the interpreter startup, to not depend on the machine speed
+        budget = startups * self.get_wall_time(["-c", "pass"])
+        duration = self.get_wall_time([os.path.join(get_root_dir(), "bin", "umake"), arg])
+        self.assertLess(duration, budget, "umake {} took {:.3f}s > {:.3f}s budget".format(arg, duration, budget))
+
+    def test_version_import_time(self):
+        """umake --version is fast and doesn't import heavy modules"""
+        self.check_budget("--version")
+
+    def test_help_import_time(self):
+        """umake --help doesn't import GLib, requests, progressbar nor yaml"""
+        self.check_budget("--help")
+
+    def test_list_import_time(self):
+        """umake -l doesn't import GLib, requests, progressbar nor yaml"""
+        self.check_budget("-l")
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the JSON lines ui module"""
+
+from io import StringIO
+import json
+import logging
+from unittest.mock import Mock, patch
+from ..tools import LoggedTestCase
+from umake.interactions import DisplayMessage, InputText, LicenseAgreement, YesNo
+from umake.tools import Singleton
+from umake.ui import UI
+from umake.ui.jsonl import JsonLinesUI
+
+
+class TestJsonLinesUI(LoggedTestCase):
+    """This will test the JSON lines events streamed by the UI"""
+
+    def setUp(self):
+        super().setUp()
+        self.output = StringIO()
+        self.ui = JsonLinesUI(output=self.output)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.ui._error_handler)
+        Singleton._instances = {}
+        super().tearDown()
+
+    def get_events(self):
+        return [json.loads(line) for line in self.output.getvalue().splitlines()]
+
+    def test_message(self):
+        """We emit displayed messages as message events"""
+        self.ui._display(DisplayMessage("Installing foo"))
+        events = self.get_events()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["event"], "message")
+        self.assertEqual(events[0]["text"], "Installing foo")
+        self.assertIn("time", events[0])
+
+    def test_report_download(self):
+        """We emit download events with a rate"""
+        UI.report("download", url="http://foo", current=0, size=100)
+        events = self.get_events()
+        self.assertEqual(events[0]["event"], "download")
+        self.assertEqual(events[0]["url"], "http://foo")
+        self.assertEqual(events[0]["current"], 0)
+        self.assertEqual(events[0]["size"], 100)
+        self.assertEqual(events[0]["rate"], 0)
+
+    def test_progress_coalesced(self):
+        """We coalesce close progress events of the same item, and flush the latest before other events"""
+        UI.report("download", url="http://foo", current=0, size=100)
+        UI.report("download", url="http://foo", current=10, size=100)
+        UI.report("download", url="http://foo", current=20, size=100)
+        self.assertEqual(len(self.get_events()), 1)
+
+        self.ui._display(DisplayMessage("Installing foo"))
+        events = self.get_events()
+        self.assertEqual([event["event"] for event in events], ["download", "download", "message"])
+        self.assertEqual(events[1]["current"], 20)
+
+    def test_progress_different_items_not_coalesced(self):
+        """We don't coalesce progress events of different items"""
+        UI.report("download", url="http://foo", current=0, size=100)
+        UI.report("download", url="http://bar", current=0, size=100)
+        self.assertEqual([event["url"] for event in self.get_events()], ["http://foo", "http://bar"])
+
+    def test_progress_complete_not_delayed(self):
+        """We always emit final progress events right away"""
+        UI.report("download", url="http://foo", current=0, size=100)
+        UI.report("download", url="http://foo", current=100, size=100)
+        UI.report("requirements", step="installing", percentage=10)
+        UI.report("requirements", step="installing", percentage=100)
+        events = self.get_events()
+        self.assertEqual(len(events), 4)
+        self.assertEqual(events[1]["current"], 100)
+        self.assertEqual(events[3]["percentage"], 100)
+
+    def test_progress_bar(self):
+        """We emit progress bar updates as progress events"""
+        bar = UI.new_progress_bar()
+        bar.update(42)
+        self.assertFalse(bar.finished)
+        bar.finish()
+        self.assertTrue(bar.finished)
+        events = self.get_events()
+        self.assertEqual(events[0]["event"], "progress")
+        self.assertEqual(events[0]["percentage"], 42)
+
+    def test_error(self):
+        """We emit logged errors as error events"""
+        self.expect_warn_error = True
+        logging.getLogger("foo").error("Something bad happened")
+        events = self.get_events()
+        self.assertEqual(events[0]["event"], "error")
+        self.assertEqual(events[0]["message"], "Something bad happened")
+
+    @patch("umake.ui.jsonl.MainLoop")
+    def test_return_main_screen(self, mainloop_mock):
+        """We emit a done event with the status code and quit"""
+        self.ui._return_main_screen(status_code=1)
+        events = self.get_events()
+        self.assertEqual(events[0]["event"], "done")
+        self.assertEqual(events[0]["status_code"], 1)
+        mainloop_mock.return_value.quit.assert_called_with(status_code=1)
+
+    @patch("sys.stdin", StringIO("a\n"))
+    def test_license_prompt(self):
+        """We emit a license prompt, answered on stdin"""
+        callback_yes = Mock()
+        callback_no = Mock()
+        self.ui._display(LicenseAgreement("License text", callback_yes, callback_no))
+        events = self.get_events()
+        self.assertEqual(events[0]["event"], "prompt")
+        self.assertEqual(events[0]["type"], "license")
+        self.assertEqual(events[0]["text"], "License text")
+        self.assertEqual(len(events[0]["choices"]), 2)
+        self.assertTrue(callback_yes.called)
+        self.assertFalse(callback_no.called)
+
+    @patch("sys.stdin", StringIO("\n"))
+    def test_prompt_default(self):
+        """We select the default choice on an empty line"""
+        callback_yes = Mock()
+        callback_no = Mock()
+        self.ui._display(YesNo("Really?", callback_yes, callback_no))
+        self.assertEqual(self.get_events()[0]["type"], "choices")
+        self.assertFalse(callback_yes.called)
+        self.assertTrue(callback_no.called)
+
+    @patch("sys.stdin", StringIO("foo\n\n"))
+    def test_prompt_invalid_answer(self):
+        """We prompt again after an invalid answer"""
+        self.expect_warn_error = True
+        callback_yes = Mock()
+        callback_no = Mock()
+        self.ui._display(YesNo("Really?", callback_yes, callback_no))
+        events = self.get_events()
+        self.assertEqual([event["event"] for event in events], ["prompt", "error", "prompt"])
+        self.assertTrue(callback_no.called)
+
+    @patch("sys.stdin", StringIO("\n"))
+    def test_input_text_default(self):
+        """We use the default input on an empty line"""
+        callback = Mock()
+        self.ui._display(InputText("Choose installation path:", callback, "/foo"))
+        events = self.get_events()
+        self.assertEqual(events[0]["type"], "input")
+        self.assertEqual(events[0]["default"], "/foo")
+        callback.assert_called_with("/foo")
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the page scanner"""
+
+from io import BytesIO, StringIO
+from os.path import join
+import re
+from ..tools import get_data_dir, LoggedTestCase
+from umake.page_scanner import PageScanner, decode_lines
+
+
+class TestPageScanner(LoggedTestCase):
+    """This will test extraction of download links from pages"""
+
+    PAGE = ('<h1>Downloads</h1>\n'
+            '<tr id="foo-linux-i386">\n'
+            '  <td><a href="https://foo.com/foo-i386.tar.gz">foo</a></td>\n'
+            '  <td>1111111111111111</td>\n'
+            '</tr>\n'
+            '<tr id="foo-linux-amd64"><td><a href="https://foo.com/foo-amd64.tar.gz">foo</a></td>\n'
+            '  <td>2222222222222222</td>\n'
+            '</tr>\n'
+            '<tr id="bar-linux-amd64">\n'
+            '  <td><a href="https://foo.com/bar-amd64.tar.gz">bar</a></td>\n'
+            '</tr>\n'
+            '<tr id="bar-linux-amd64">\n'
+            '  <td>3333333333333333</td>\n'
+            '</tr>\n'
+            '<div id="license">\n'
+            'Some license\n'
+            'text\n'
+            '<input id="agree_license">\n')
+
+    def test_scan_whole_page(self):
+        """We take the first url and checksum of the page without any section"""
+        scanner = PageScanner(url=r'href="(.*)"', checksum=re.compile(r'<td>(\w+)</td>'))
+        self.assertEqual(scanner.scan(self.PAGE), ("https://foo.com/foo-i386.tar.gz", "1111111111111111"))
+
+    def test_scan_section(self):
+        """We only look into the section, starting with the line of the section start"""
+        scanner = PageScanner(url=r'href="(.*)"', checksum=r'<td>(\w+)</td>', section_start="foo-linux-amd64",
+                              section_end="</tr>")
+        self.assertEqual(scanner.scan(self.PAGE), ("https://foo.com/foo-amd64.tar.gz", "2222222222222222"))
+
+    def test_scan_missing_checksum_in_first_section(self):
+        """We carry on to the next sections to find a missing checksum"""
+        scanner = PageScanner(url=r'href="(.*)"', checksum=r'<td>(\w+)</td>', section_start="bar-linux-amd64",
+                              section_end="</tr>")
+        self.assertEqual(scanner.scan(self.PAGE), ("https://foo.com/bar-amd64.tar.gz", "3333333333333333"))
+
+    def test_scan_without_checksum(self):
+        """We stop at the first url if we don't expect any checksum"""
+        scanner = PageScanner(url=r'href="(.*)"', section_start="linux-amd64", section_end="</tr>")
+        self.assertEqual(scanner.scan(self.PAGE), ("https://foo.com/foo-amd64.tar.gz", None))
+
+    def test_scan_match_last(self):
+        """We return the last url and checksum if requested"""
+        scanner = PageScanner(url=r'href="(.*)"', checksum=r'<td>(\w+)</td>', section_start="linux-amd64",
+                              section_end="</tr>")
+        self.assertEqual(scanner.scan(self.PAGE, match_last=True),
+                         ("https://foo.com/bar-amd64.tar.gz", "3333333333333333"))
+
+    def test_scan_line_section(self):
+        """A section can be limited to the line of the section start"""
+        scanner = PageScanner(url=r'href="([^"]*)"', section_start="foo-linux-amd64", section_end="\n")
+        self.assertEqual(scanner.scan(self.PAGE), ("https://foo.com/foo-amd64.tar.gz", None))
+        scanner = PageScanner(url=r'href="([^"]*)"', section_start="foo-linux-i386", section_end="\n")
+        self.assertEqual(scanner.scan(self.PAGE), (None, None))
+
+    def test_scan_not_found(self):
+        """We return None for what we can't find"""
+        scanner = PageScanner(url=r'href="(.*)"', checksum=r'<td>(\w+)</td>', section_start="baz")
+        self.assertEqual(scanner.scan(self.PAGE), (None, None))
+
+    def test_scan_license(self):
+        """We return the license lines, without the line ending it"""
+        scanner = PageScanner(url=r'href="(.*)"', license_start='<div id="license"', license_end='<input id="agree_')
+        self.assertEqual(scanner.scan_license(self.PAGE), '<div id="license">\nSome license\ntext\n')
+
+    def test_scan_no_license(self):
+        """We return an empty license if there is none"""
+        self.assertEqual(PageScanner(url=r'href="(.*)"').scan_license(self.PAGE), "")
+        scanner = PageScanner(url=r'href="(.*)"', license_start='<div id="other_license"', license_end='<input')
+        self.assertEqual(scanner.scan_license(self.PAGE), "")
+
+    def test_scan_lines_with_license(self):
+        """We get the download link and the license in one pass over the lines"""
+        scanner = PageScanner(url=r'href="(.*)"', checksum=r'<td>(\w+)</td>', section_start="bar-linux-amd64",
+                              section_end="</tr>", license_start='<div id="license"', license_end='<input id="agree_')
+        with StringIO() as license_txt:
+            self.assertEqual(scanner.scan_lines(self.PAGE.splitlines(keepends=True), license_txt=license_txt),
+                             ("https://foo.com/bar-amd64.tar.gz", "3333333333333333"))
+            self.assertEqual(license_txt.getvalue(), '<div id="license">\nSome license\ntext\n')
+
+    def test_scan_lines_stops_early(self):
+        """We don't read the rest of the page once the download link is found"""
+        lines = iter(self.PAGE.splitlines(keepends=True))
+        scanner = PageScanner(url=r'href="(.*)"', checksum=r'<td>(\w+)</td>')
+        self.assertEqual(scanner.scan_lines(lines), ("https://foo.com/foo-i386.tar.gz", "1111111111111111"))
+        self.assertEqual(next(lines), '</tr>\n')
+
+    def test_decode_lines(self):
+        """We decode a binary buffer line by line"""
+        buffer = BytesIO("caf\u00e9\nna\u00efve\nend".encode("utf-8"))
+        self.assertEqual(list(decode_lines(buffer)), ["caf\u00e9\n", "na\u00efve\n", "end"])
+
+    def test_decode_lines_truncated(self):
+        """A buffer ending in the middle of a character raises an error"""
+        buffer = BytesIO("caf\u00e9\n".encode("utf-8") + "\u00e9".encode("utf-8")[:1])
+        self.assertRaises(UnicodeDecodeError, list, decode_lines(buffer))
+
+    def test_scan_provider_page(self):
+        """We find the download link of a saved provider page"""
+        with open(join(get_data_dir(), "server-content", "golang.org", "dl", "index.html"), "rb") as f:
+            content = f.read().decode()
+        scanner = PageScanner(url=r'href="(.*)">', checksum=r'<td><tt>(\w+)</tt></td>', section_start="linux-386",
+                              section_end="</tr>")
+        self.assertEqual(scanner.scan(content),
+                         ("https://golang.org/fake.go.linux-386.tar.gz",
+                          "c26c1bb756f83e63d0dc850c2128367d17b99af09c7e5407e8e7de50e9716d41"))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the privileged helper installing package requirements as root"""
+
+from io import StringIO
+import json
+import sys
+from unittest.mock import Mock, patch
+from ..tools import LoggedTestCase
+from umake.network.privileged_helper import PrivilegedHelper, serve
+from umake.tools import Singleton
+
+# stands for the helper run as root: answers every request with its progress and result
+FAKE_HELPER = """
+import json, sys
+print(json.dumps({"ready": True}), flush=True)
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["command"] == "fail":
+        print(json.dumps({"error": "failed"}), flush=True)
+    elif request["command"] == "exit":
+        sys.exit(1)
+    else:
+        print(json.dumps({"progress": {"step": 0, "percentage": 50}}), flush=True)
+        print(json.dumps({"result": request}), flush=True)
+"""
+
+
+class TestPrivilegedHelper(LoggedTestCase):
+    """This will test the privileged helper client"""
+
+    def setUp(self):
+        super().setUp()
+        Singleton._instances.pop(PrivilegedHelper, None)
+        self.addCleanup(Singleton._instances.pop, PrivilegedHelper, None)
+
+    def start_helper(self, cmd):
+        with patch("umake.network.privileged_helper.get_root_command", return_value=cmd):
+            helper = PrivilegedHelper()
+            helper.start()
+        self.addCleanup(helper.stop)
+        return helper
+
+    def test_start(self):
+        """We start the helper once"""
+        helper = self.start_helper([sys.executable, "-c", FAKE_HELPER])
+        process = helper._process
+        self.assertTrue(PrivilegedHelper().started)
+        PrivilegedHelper().start()
+        self.assertIs(helper._process, process)
+
+    def test_start_fails(self):
+        """We raise if the helper couldn't get root access"""
+        with patch("umake.network.privileged_helper.get_root_command", return_value=["false"]):
+            self.assertRaises(BaseException, PrivilegedHelper().start)
+        self.assertFalse(PrivilegedHelper().started)
+
+    def test_start_no_command(self):
+        """We raise if there is no command to get root access"""
+        with patch("umake.network.privileged_helper.get_root_command", return_value=["/doesnt/exist"]):
+            self.assertRaises(BaseException, PrivilegedHelper().start)
+        self.assertFalse(PrivilegedHelper().started)
+
+    def test_install(self):
+        """We send requests to the helper, forwarding its progress"""
+        helper = self.start_helper([sys.executable, "-c", FAKE_HELPER])
+        progress_callback = Mock()
+        helper.install(["foo", "bar"], progress_callback)
+        progress_callback.assert_called_once_with({"step": 0, "percentage": 50})
+        self.assertEqual(helper.add_foreign_archs(["i386"]), {"command": "add_foreign_archs", "archs": ["i386"]})
+
+    def test_error(self):
+        """We raise errors reported by the helper"""
+        helper = self.start_helper([sys.executable, "-c", FAKE_HELPER])
+        self.assertRaises(BaseException, helper._call, {"command": "fail"})
+        # the helper is still usable afterwards
+        helper.install(["foo"])
+
+    def test_helper_exited(self):
+        """We raise if the helper exits while we are waiting for an answer"""
+        helper = self.start_helper([sys.executable, "-c", FAKE_HELPER])
+        self.assertRaises(BaseException, helper._call, {"command": "exit"})
+        helper.stop()
+        self.assertFalse(helper.started)
+
+
+class TestPrivilegedHelperServer(LoggedTestCase):
+    """This will test the privileged helper requests handling"""
+
+    def serve(self, *requests):
+        handler = Mock()
+        handler.install_packages.side_effect = lambda packages, report: report({"step": 1, "percentage": 100})
+        handler.add_foreign_archs.return_value = True
+        responses = StringIO()
+        serve(StringIO("".join(json.dumps(request) + "\n" for request in requests)), responses, handler)
+        return handler, [json.loads(line) for line in responses.getvalue().splitlines()]
+
+    def test_ready(self):
+        """We tell we are ready before any request"""
+        handler, responses = self.serve()
+        self.assertEqual(responses, [{"ready": True}])
+
+    def test_install(self):
+        """We install packages, reporting progress"""
+        handler, responses = self.serve({"command": "install", "packages": ["foo"]})
+        handler.install_packages.assert_called_once_with(["foo"], handler.install_packages.call_args[0][1])
+        self.assertEqual(responses, [{"ready": True}, {"progress": {"step": 1, "percentage": 100}}, {"result": None}])
+
+    def test_add_foreign_archs(self):
+        """We add foreign archs and tell if any was added"""
+        handler, responses = self.serve({"command": "add_foreign_archs", "archs": ["i386"]})
+        self.assertEqual(handler.add_foreign_archs.call_args[0][0], ["i386"])
+        self.assertEqual(responses, [{"ready": True}, {"result": True}])
+
+    def test_error(self):
+        """We report errors and keep answering requests"""
+        handler, responses = self.serve({"command": "unknown"}, {"command": "install", "packages": ["foo"]})
+        self.assertIn("error", responses[1])
+        self.assertEqual(responses[-1], {"result": None})
@@ -21,14 +21,18 @@
 
 import os
 import shutil
+import stat
 import subprocess
 import sys
-from time import time
-from unittest.mock import Mock, call, patch
+import tempfile
+from time import monotonic, time
+from unittest.mock import ANY, Mock, call, mock_open, patch
 from contextlib import suppress
 import umake
 from . import DpkgAptSetup
-from umake.network.requirements_handler import RequirementsHandler
+from ..tools import LoggedTestCase
+from umake.network.requirements_handler import RequirementsHandler, get_apt_lock_holder, get_java_version, \
+    get_process_name, parse_java_version
 from umake import tools
 
 
@@ -232,6 +236,67 @@ class TestRequirementsHandler(DpkgAptSetup):
         self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
         self.assertFalse(progress_second_callback.called)
 
+    def test_install_batch(self):
+        """Buckets installed in a batch are installed in one transaction, with progress and results per bucket"""
+        done_callback = Mock()
+        done_callback0 = Mock()
+        progress_callback = Mock()
+        progress_callback0 = Mock()
+        with self.handler.batch():
+            self.handler.install_bucket(["testpackage"], progress_callback, done_callback)
+            self.handler.install_bucket(["testpackage0"], progress_callback0, done_callback0)
+        self.wait_for_callback(done_callback)
+        self.wait_for_callback(done_callback0)
+
+        done_callback.assert_called_once_with(RequirementsHandler.RequirementsResult(bucket=['testpackage'],
+                                                                                     error=None))
+        done_callback0.assert_called_once_with(RequirementsHandler.RequirementsResult(bucket=['testpackage0'],
+                                                                                      error=None))
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage", "testpackage0"]))
+        # one download, then one install step for both buckets
+        self.assertEqual(progress_callback.call_args_list, progress_callback0.call_args_list)
+        steps = [call_item[0][0]['step'] for call_item in progress_callback.call_args_list]
+        self.assertEqual(steps, sorted(steps))
+
+    def test_install_batch_waits_for_the_end(self):
+        """Buckets installed in a batch are only installed when leaving it"""
+        with self.handler.batch():
+            self.handler.install_bucket(["testpackage"], lambda x: "", self.done_callback)
+            with self.handler.batch():
+                self.handler.install_bucket(["testpackage0"], lambda x: "", self.done_callback)
+            self.assertFalse(self.done_callback.called)
+        self.wait_for_callback(self.done_callback)
+
+    def test_install_batch_one_bucket_fails(self):
+        """A bucket which can't be installed in a batch fails alone"""
+        done_callback = Mock()
+        done_callback0 = Mock()
+        with self.handler.batch():
+            self.handler.install_bucket(["foo"], lambda x: "", done_callback)
+            self.handler.install_bucket(["testpackage"], lambda x: "", done_callback0)
+        self.wait_for_callback(done_callback)
+        self.wait_for_callback(done_callback0)
+
+        self.assertIsNotNone(done_callback.call_args[0][0].error)
+        self.assertIsNone(done_callback0.call_args[0][0].error)
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+        self.expect_warn_error = True
+
+    def test_install_merge_window(self):
+        """Buckets installed within the merge window are installed in one transaction"""
+        done_callback = Mock()
+        progress_callback = Mock()
+        progress_callback0 = Mock()
+        with patch.object(RequirementsHandler, "MERGE_WINDOW", 0.1):
+            self.handler.install_bucket(["testpackage"], progress_callback, done_callback)
+            self.handler.install_bucket(["testpackage0"], progress_callback0, self.done_callback)
+            self.wait_for_callback(done_callback)
+            self.wait_for_callback(self.done_callback)
+
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage", "testpackage0"]))
+        self.assertTrue(progress_callback0.called)
+        self.assertEqual(progress_callback.call_args_list, progress_callback0.call_args_list)
+
     def test_deps(self):
         """Installing one package, ensure the dep (even with auto_fix=False) is installed"""
         self.handler.install_bucket(["testpackage1"], lambda x: "", self.done_callback)
@@ -415,6 +480,195 @@ class TestRequirementsHandler(DpkgAptSetup):
             self.wait_for_callback(self.done_callback)
             self.assertEqual(openaptcache_mock.call_count, 2)
 
+    def test_apt_cache_not_ready_waits_for_lock(self):
+        """When the apt cache can't be opened because another process holds the lock, we report it and wait"""
+        origin_open = self.handler.cache.open
+        progress_callback = Mock()
+
+        with patch.object(self.handler.cache, 'open', side_effect=[SystemError, origin_open]) as openaptcache_mock,\
+                patch("umake.network.requirements_handler.get_apt_lock_holder", side_effect=[1234, 1234, None]),\
+                patch("umake.network.requirements_handler.get_process_name", return_value="unattended-upgrades"):
+            self.handler._force_reload_apt_cache(progress_callback)
+
+        self.assertEqual(openaptcache_mock.call_count, 2)
+        progress_callback.assert_called_once_with({"step": RequirementsHandler.STATUS_WAITING_LOCK,
+                                                   "percentage": 0, "holder": "unattended-upgrades"})
+
+    def test_wait_for_apt_lock_timeout(self):
+        """We give up waiting for a package manager lock which is never released"""
+        with patch("umake.network.requirements_handler.get_apt_lock_holder", return_value=1234),\
+                patch("umake.network.requirements_handler.get_process_name", return_value="unattended-upgrades"):
+            self.assertRaises(BaseException, self.handler._wait_for_apt_lock, monotonic() - 1)
+
+    def test_wait_for_apt_lock_free(self):
+        """We don't wait nor report anything if the package manager lock is free"""
+        progress_callback = Mock()
+        with patch("umake.network.requirements_handler.get_apt_lock_holder", return_value=None):
+            self.assertFalse(self.handler._wait_for_apt_lock(monotonic() + 10, progress_callback))
+        progress_callback.assert_not_called()
+
+    def test_install_waits_for_lock(self):
+        """Installing a bucket waits for the package manager lock before committing"""
+        progress_callback = Mock()
+        with patch("umake.network.requirements_handler.get_apt_lock_holder", side_effect=[4321, None]),\
+                patch("umake.network.requirements_handler.get_process_name", return_value="apt-get (4321)"):
+            self.handler.install_bucket(["testpackage"], progress_callback, self.done_callback)
+            self.wait_for_callback(self.done_callback)
+
+        self.assertIsNone(self.done_callback.call_args[0][0].error)
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+        progress_callback.assert_any_call({"step": RequirementsHandler.STATUS_WAITING_LOCK, "percentage": 0,
+                                           "holder": "apt-get (4321)"})
+
+    def test_get_apt_lock_holder(self):
+        """We return the pid of the process locking the package manager"""
+        lock_file = os.path.join(self.chroot_path, "lock")
+        open(lock_file, "w").close()
+        locker = subprocess.Popen([sys.executable, "-c",
+                                   "import fcntl, sys; f = open(sys.argv[1], 'w'); fcntl.lockf(f, fcntl.LOCK_EX); "
+                                   "print('locked', flush=True); sys.stdin.read()", lock_file],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(locker.wait)
+        self.addCleanup(locker.stdin.close)
+        locker.stdout.readline()
+
+        self.assertEqual(get_apt_lock_holder(lock_files=(os.path.join(self.chroot_path, "doesnotexist"), lock_file)),
+                         locker.pid)
+
+    def test_get_apt_lock_holder_unreadable(self):
+        """We find the process locking the package manager even if we can't open the lock files"""
+        lock_file = os.path.join(self.chroot_path, "lock")
+        open(lock_file, "w").close()
+        locker = subprocess.Popen([sys.executable, "-c",
+                                   "import fcntl, sys; f = open(sys.argv[1], 'w'); fcntl.lockf(f, fcntl.LOCK_EX); "
+                                   "print('locked', flush=True); sys.stdin.read()", lock_file],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(locker.wait)
+        self.addCleanup(locker.stdin.close)
+        locker.stdout.readline()
+
+        origin_open = open
+
+        def _open(path, *args, **kwargs):
+            if path == lock_file:
+                raise PermissionError()
+            return origin_open(path, *args, **kwargs)
+        with patch("builtins.open", side_effect=_open):
+            self.assertEqual(get_apt_lock_holder(lock_files=(lock_file,)), locker.pid)
+
+    def test_get_apt_lock_holder_free(self):
+        """We return None if nothing is locking the package manager, or if the lock files don't exist"""
+        lock_file = os.path.join(self.chroot_path, "lock")
+        open(lock_file, "w").close()
+        self.assertIsNone(get_apt_lock_holder(lock_files=(lock_file, os.path.join(self.chroot_path, "doesnotexist"))))
+
+    def test_get_process_name(self):
+        """We return a readable name of the lock holder, with the truncated unattended-upgrades name fixed"""
+        with patch("builtins.open", mock_open(read_data="unattended-upgr\n")):
+            self.assertEqual(get_process_name(42), "unattended-upgrades")
+        with patch("builtins.open", mock_open(read_data="apt-get\n")):
+            self.assertEqual(get_process_name(42), "apt-get (42)")
+        with patch("builtins.open", side_effect=FileNotFoundError):
+            self.assertEqual(get_process_name(42), "another process")
+
+    def test_java_equiv_compares_versions_numerically(self):
+        """An installed java 17 satisfies an openjdk-9 requirement, but not an openjdk-21 one"""
+        self.handler._java_versions = {}
+        self.addCleanup(setattr, self.handler, "_java_versions", {})
+        with patch("umake.network.requirements_handler.get_java_version", return_value="17.0.2") as version_mock:
+            self.assertTrue(self.handler.check_java_equiv("openjdk-9-jdk"))
+            self.assertFalse(self.handler.check_java_equiv("openjdk-21-jdk"))
+            self.assertTrue(self.handler.check_java_equiv("openjdk-8-jre"))
+        self.assertEqual(version_mock.call_args_list, [call("javac"), call("java")])
+
+    def test_java_equiv_no_java(self):
+        """Openjdk isn't considered installed without any java command"""
+        self.handler._java_versions = {}
+        self.addCleanup(setattr, self.handler, "_java_versions", {})
+        with patch("umake.network.requirements_handler.get_java_version", return_value=None):
+            self.assertFalse(self.handler.check_java_equiv("openjdk-8-jre"))
+
+    def test_install_with_uptodate_check(self):
+        """Installing a bucket checked beforehand doesn't check it again"""
+        bucket = ["testpackage"]
+        self.handler.check_bucket_uptodate(bucket)
+        self.handler.executor.submit(lambda: None).result()
+        with patch.object(self.handler, "is_bucket_uptodate") as uptodate_mock:
+            self.assertTrue(self.handler.install_bucket(bucket, lambda x: "", self.done_callback))
+            self.wait_for_callback(self.done_callback)
+        uptodate_mock.assert_not_called()
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+
+    def test_uptodate_check_on_bucket_copy(self):
+        """Checking a bucket in the background only resolves its alternatives once installing it"""
+        bucket = ["testpackagedoesntexist | testpackage"]
+        self.handler.check_bucket_uptodate(bucket)
+        self.handler.executor.submit(lambda: None).result()
+        self.assertEqual(bucket, ["testpackagedoesntexist | testpackage"])
+        self.assertTrue(self.handler.install_bucket(bucket, lambda x: "", self.done_callback))
+        self.wait_for_callback(self.done_callback)
+        self.assertEqual(bucket, ["testpackage"])
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+
+    def test_install_with_queued_uptodate_check(self):
+        """Installing a bucket doesn't wait for an up to date check queued behind another transaction"""
+        bucket = ["testpackage"]
+        with self.handler.batch():
+            self.handler.install_bucket(["testpackage1"], lambda x: "", Mock())
+        self.handler.check_bucket_uptodate(bucket)
+        self.assertTrue(self.handler.install_bucket(bucket, lambda x: "", self.done_callback))
+        self.wait_for_callback(self.done_callback)
+        self.assertTrue(self.handler.is_bucket_installed(["testpackage"]))
+        self.assertEqual(self.handler._uptodate_checks, [])
+
+    def test_install_with_privileged_helper(self):
+        """We install packages through the privileged helper when it's running"""
+        progress_callback = Mock()
+        with patch("umake.network.requirements_handler.PrivilegedHelper") as helper_mock:
+            helper_mock.return_value.started = True
+            helper_mock.return_value.install.side_effect = \
+                lambda packages, progress_callback: progress_callback({"step": 1, "percentage": 100})
+            self.handler.install_bucket(["testpackage"], progress_callback, self.done_callback)
+            self.wait_for_callback(self.done_callback)
+
+        helper_mock.return_value.install.assert_called_once_with(["testpackage"], ANY)
+        self.assertFalse(helper_mock.return_value.add_foreign_archs.called)
+        self.assertIsNone(self.done_callback.call_args[0][0].error)
+        progress_callback.assert_called_with({"step": 1, "percentage": 100})
+        self.assertFalse(os.seteuid.called)
+
+    def test_install_with_privileged_helper_error(self):
+        """We report errors from the privileged helper"""
+        with patch("umake.network.requirements_handler.PrivilegedHelper") as helper_mock:
+            helper_mock.return_value.started = True
+            helper_mock.return_value.install.side_effect = BaseException("Can't install")
+            self.handler.install_bucket(["testpackage"], lambda x: "", self.done_callback)
+            self.wait_for_callback(self.done_callback)
+
+        self.assertIn("Can't install", self.done_callback.call_args[0][0].error)
+        self.expect_warn_error = True
+
+    def test_install_foreign_arch_with_privileged_helper(self):
+        """We add foreign archs through the privileged helper when it's running"""
+        bucket = ["testpackagefoo:foo", "testpackage1"]
+        # don't depend on the foreign archs enabled on the host: the fake helper doesn't really add any
+        with patch("umake.network.requirements_handler.PrivilegedHelper") as helper_mock,\
+                patch.object(self.handler, "_mark_bucket") as mark_mock,\
+                patch.object(self.handler, "_force_reload_apt_cache") as reload_mock,\
+                patch.object(self.handler, "add_foreign_archs") as add_foreign_archs_mock:
+            helper_mock.return_value.started = True
+            helper_mock.return_value.add_foreign_archs.return_value = True
+            self.handler.install_bucket(bucket, lambda x: "", self.done_callback)
+            self.wait_for_callback(self.done_callback)
+
+        helper_mock.return_value.add_foreign_archs.assert_called_once_with(["foo"], ANY)
+        self.assertFalse(add_foreign_archs_mock.called)
+        # the cache is reloaded with the added arch before marking the packages
+        self.assertTrue(reload_mock.called)
+        mark_mock.assert_called_once_with(bucket)
+        helper_mock.return_value.install.assert_called_once_with(bucket, ANY)
+        self.assertIsNone(self.done_callback.call_args[0][0].error)
+
     def test_upgrade(self):
         """Upgrade one package already installed"""
         shutil.copy(os.path.join(self.apt_status_dir, "testpackage_installed_dpkg_status"),
@@ -544,3 +798,96 @@ class TestRequirementsHandler(DpkgAptSetup):
         self.handler.cache.open()
         self.assertTrue(self.handler.is_bucket_available(test_bucket))
         self.assertEqual(test_bucket, ['testpackage1', 'testpackage'])
+
+
+class TestJavaVersion(LoggedTestCase):
+    """This will test java version probing and its on disk cache"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.bin_dir = tempfile.mkdtemp()
+        self.probe_log = os.path.join(self.bin_dir, "probes")
+        xdg_patcher = patch("umake.network.requirements_handler.xdg_cache_home", self.cache_dir)
+        xdg_patcher.start()
+        self.addCleanup(xdg_patcher.stop)
+        path_patcher = patch.dict(os.environ, {"PATH": self.bin_dir})
+        path_patcher.start()
+        self.addCleanup(path_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.bin_dir)
+        super().tearDown()
+
+    def create_command(self, command, output):
+        """Create a fake command printing output on stderr, and logging each call"""
+        path = os.path.join(self.bin_dir, command)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\necho probed >> {}\necho '{}' >&2\n".format(self.probe_log, output))
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def number_of_probes(self):
+        with suppress(FileNotFoundError):
+            with open(self.probe_log) as f:
+                return len(f.readlines())
+        return 0
+
+    def test_parse_java_version(self):
+        """We parse java versions as numbers, with legacy 1.x versions"""
+        self.assertEqual(parse_java_version("17.0.2"), (17, 0, 2))
+        self.assertEqual(parse_java_version("1.8.0"), (8, 0))
+        self.assertEqual(parse_java_version("9"), (9,))
+        self.assertGreater(parse_java_version("17"), parse_java_version("9"))
+        self.assertGreater(parse_java_version("11.0.1"), parse_java_version("1.8.0"))
+
+    def test_get_java_version(self):
+        """We get java and javac versions from their output"""
+        self.create_command("java", 'openjdk version "17.0.2" 2022-01-18')
+        self.create_command("javac", "javac 11.0.4")
+        self.assertEqual(get_java_version("java"), "17.0.2")
+        self.assertEqual(get_java_version("javac"), "11.0.4")
+
+    def test_get_java_version_cached(self):
+        """We only probe a java command once, even across runs"""
+        self.create_command("java", 'openjdk version "17.0.2" 2022-01-18')
+        self.assertEqual(get_java_version("java"), "17.0.2")
+        self.assertEqual(get_java_version("java"), "17.0.2")
+        self.assertEqual(self.number_of_probes(), 1)
+
+    def test_get_java_version_changed(self):
+        """We probe again a java command which has been modified"""
+        path = self.create_command("java", 'openjdk version "11.0.4" 2019-07-16')
+        self.assertEqual(get_java_version("java"), "11.0.4")
+        self.create_command("java", 'openjdk version "17.0.2" 2022-01-18')
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(get_java_version("java"), "17.0.2")
+        self.assertEqual(self.number_of_probes(), 2)
+
+    def test_get_java_version_keyed_on_resolved_path(self):
+        """We probe again when the java command points to another binary"""
+        self.create_command("java-11", 'openjdk version "11.0.4" 2019-07-16')
+        self.create_command("java-17", 'openjdk version "17.0.2" 2022-01-18')
+        link = os.path.join(self.bin_dir, "java")
+        os.symlink("java-11", link)
+        self.assertEqual(get_java_version("java"), "11.0.4")
+        os.remove(link)
+        os.symlink("java-17", link)
+        self.assertEqual(get_java_version("java"), "17.0.2")
+        os.remove(link)
+        os.symlink("java-11", link)
+        self.assertEqual(get_java_version("java"), "11.0.4")
+        self.assertEqual(self.number_of_probes(), 2)
+
+    def test_get_java_version_missing(self):
+        """We return None if there is no java command"""
+        self.assertIsNone(get_java_version("java"))
+
+    def test_get_java_version_corrupted_cache(self):
+        """We probe again if the cache is corrupted"""
+        os.makedirs(os.path.join(self.cache_dir, "umake"))
+        with open(os.path.join(self.cache_dir, "umake", "java_versions.json"), "w") as f:
+            f.write("garbage")
+        self.create_command("java", 'openjdk version "17.0.2" 2022-01-18')
+        self.assertEqual(get_java_version("java"), "17.0.2")
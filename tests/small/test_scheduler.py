@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download scheduler sharing bandwidth between downloads"""
+
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake.network.scheduler import DownloadPriority, DownloadScheduler, TokenBucket, parse_rate
+from umake.tools import Singleton
+
+
+class TestParseRate(LoggedTestCase):
+    """This will test rate parsing"""
+
+    def test_bytes(self):
+        """We parse rates in bytes per second"""
+        self.assertEqual(parse_rate("1000"), 1000)
+
+    def test_suffixes(self):
+        """We parse k, m and g suffixes, in any case"""
+        self.assertEqual(parse_rate("500k"), 500 * 1024)
+        self.assertEqual(parse_rate("2M"), 2 * 1024 * 1024)
+        self.assertEqual(parse_rate("1.5m"), int(1.5 * 1024 * 1024))
+        self.assertEqual(parse_rate("1G"), 1024 ** 3)
+
+    def test_invalid(self):
+        """We raise on invalid rates"""
+        for rate in ("", "foo", "10x", "k", "0", "-5k"):
+            self.assertRaises(ValueError, parse_rate, rate)
+
+
+class TestTokenBucket(LoggedTestCase):
+    """This will test rate limiting"""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100
+        patcher = patch("umake.network.scheduler.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst(self):
+        """We allow a burst without waiting"""
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.consume(250), 0)
+
+    def test_debt(self):
+        """We wait for bytes read over the allowed rate"""
+        bucket = TokenBucket(1000)
+        self.assertAlmostEqual(bucket.consume(750), 0.5)
+
+    def test_refill(self):
+        """We refill the bucket over time, up to the burst size"""
+        bucket = TokenBucket(1000)
+        bucket.consume(750)
+        self.now += 0.5
+        self.assertEqual(bucket.consume(0), 0)
+        self.now += 10
+        self.assertAlmostEqual(bucket.consume(500), 0.25)
+
+
+class TestDownloadScheduler(LoggedTestCase):
+    """This will test download priorities and rate limits"""
+
+    def setUp(self):
+        super().setUp()
+        Singleton._instances.pop(DownloadScheduler, None)
+        self.addCleanup(Singleton._instances.pop, DownloadScheduler, None)
+        self.now = 100
+        patcher = patch("umake.network.scheduler.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = DownloadScheduler()
+
+    def test_no_limit(self):
+        """We don't wait without any limit nor more urgent download"""
+        with self.scheduler.start(DownloadPriority.artifact) as slot:
+            self.assertEqual(slot.consume(10 ** 9), 0)
+
+    def test_preempted(self):
+        """We pause less urgent downloads while more urgent ones are running"""
+        artifact = self.scheduler.start(DownloadPriority.artifact)
+        prefetch = self.scheduler.start(DownloadPriority.prefetch)
+        with self.scheduler.start(DownloadPriority.metadata) as metadata:
+            self.assertEqual(metadata.consume(8192), 0)
+            self.assertEqual(artifact.consume(8192), DownloadScheduler.POLL_DELAY)
+            self.assertEqual(prefetch.consume(8192), DownloadScheduler.POLL_DELAY)
+        self.assertEqual(artifact.consume(8192), 0)
+        self.assertEqual(prefetch.consume(8192), DownloadScheduler.POLL_DELAY)
+        artifact.close()
+        self.assertEqual(prefetch.consume(8192), 0)
+
+    def test_preemption_timeout(self):
+        """We stop pausing behind a download running for too long"""
+        metadata = self.scheduler.start(DownloadPriority.metadata)
+        artifact = self.scheduler.start(DownloadPriority.artifact)
+        self.assertEqual(artifact.consume(8192), DownloadScheduler.POLL_DELAY)
+        self.now += DownloadScheduler.PREEMPTION_TIMEOUT
+        self.assertEqual(artifact.consume(8192), 0)
+        metadata.close()
+        artifact.close()
+
+    def test_set_priority(self):
+        """We move running downloads to another priority"""
+        prefetch = self.scheduler.start(DownloadPriority.prefetch)
+        artifact = self.scheduler.start(DownloadPriority.artifact)
+        self.assertEqual(prefetch.consume(8192), DownloadScheduler.POLL_DELAY)
+        prefetch.set_priority(DownloadPriority.artifact)
+        self.assertEqual(prefetch.consume(8192), 0)
+        prefetch.set_priority(DownloadPriority.metadata)
+        self.assertEqual(artifact.consume(8192), DownloadScheduler.POLL_DELAY)
+        prefetch.close()
+        artifact.close()
+
+    def test_close_twice(self):
+        """We only unregister a download once"""
+        metadata = self.scheduler.start(DownloadPriority.metadata)
+        metadata.close()
+        metadata.close()
+        with self.scheduler.start(DownloadPriority.metadata), self.scheduler.start(DownloadPriority.artifact) as slot:
+            self.assertEqual(slot.consume(8192), DownloadScheduler.POLL_DELAY)
+
+    def test_total_rate(self):
+        """We cap the total rate of all downloads"""
+        self.scheduler.set_rate_limits(total=1000)
+        with self.scheduler.start(DownloadPriority.artifact) as first, \
+                self.scheduler.start(DownloadPriority.artifact) as second:
+            self.assertEqual(first.consume(250), 0)
+            # we wait at most POLL_DELAY at once, to check for cancellation
+            self.assertEqual(second.consume(250), DownloadScheduler.POLL_DELAY)
+            self.now += 0.25
+            self.assertEqual(second.consume(0), 0)
+
+    def test_per_download_rate(self):
+        """We cap the rate of each download"""
+        self.scheduler.set_rate_limits(per_download=1000)
+        with self.scheduler.start(DownloadPriority.artifact) as first, \
+                self.scheduler.start(DownloadPriority.artifact) as second:
+            self.assertEqual(first.consume(250), 0)
+            self.assertEqual(second.consume(250), 0)
+            self.assertEqual(first.consume(50), 0.05)
+
+    def test_throttle(self):
+        """We wait until allowed to read more, checking for cancellation"""
+        self.scheduler.set_rate_limits(total=1000)
+
+        def _sleep(delay):
+            self.assertLessEqual(delay, DownloadScheduler.POLL_DELAY)
+            self.now += delay
+        with patch("umake.network.scheduler.sleep", side_effect=_sleep), \
+                self.scheduler.start(DownloadPriority.artifact) as slot:
+            slot.throttle(750, lambda: None)
+        self.assertAlmostEqual(self.now, 100.5)
+
+    def test_throttle_cancelled(self):
+        """We stop waiting once cancelled"""
+        self.scheduler.set_rate_limits(total=1000)
+
+        def _check_cancelled():
+            raise BaseException("cancelled")
+        with patch("umake.network.scheduler.sleep"), self.scheduler.start(DownloadPriority.artifact) as slot:
+            self.assertRaises(BaseException, slot.throttle, 750, _check_cancelled)
@@ -23,6 +23,7 @@ import os
 import re
 import shutil
 import tempfile
+import time
 from ..tools import get_data_dir, LoggedTestCase
 from unittest.mock import patch
 
@@ -119,3 +120,64 @@ class TestVersionHandler(LoggedTestCase):
         # 2) Initiate a framework object
         # 3) assertEqual(framework.get_current_user_version(install_path), '3.2.4')
         pass
+
+
+class TestLatestVersionCache(LoggedTestCase):
+    """This will test the on disk latest version cache"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        xdg_patcher = patch("umake.settings.xdg_cache_home", self.cache_dir)
+        xdg_patcher.start()
+        self.addCleanup(xdg_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def refresh(self):
+        thread = settings.refresh_latest_version_in_background()
+        if thread:
+            thread.join()
+        return thread
+
+    def test_no_cache(self):
+        """We return None without any network access if nothing was cached"""
+        self.assertIsNone(settings.get_cached_latest_version())
+
+    @patch("umake.settings.get_latest_version", return_value="42.03")
+    def test_refresh_cache(self, get_latest_version_mock):
+        """We fetch and store the latest version in background"""
+        self.assertIsNotNone(self.refresh())
+        self.assertEqual(settings.get_cached_latest_version(), "42.03")
+        self.assertTrue(get_latest_version_mock.called)
+
+    @patch("umake.settings.get_latest_version", return_value="42.03")
+    def test_refresh_only_once_a_day(self, get_latest_version_mock):
+        """We don't fetch again the latest version if the cache is fresh"""
+        self.refresh()
+        get_latest_version_mock.reset_mock()
+        self.assertIsNone(self.refresh())
+        self.assertFalse(get_latest_version_mock.called)
+
+    @patch("umake.settings.get_latest_version", return_value="42.03")
+    def test_refresh_outdated_cache(self, get_latest_version_mock):
+        """We fetch again the latest version once the cache is outdated"""
+        self.refresh()
+        get_latest_version_mock.return_value = "42.04"
+        with patch("umake.settings.time.time", return_value=time.time() + settings.LATEST_VERSION_CHECK_INTERVAL + 1):
+            self.assertIsNotNone(self.refresh())
+        self.assertEqual(settings.get_cached_latest_version(), "42.04")
+
+    @patch("umake.settings.get_latest_version", side_effect=OSError("offline"))
+    def test_refresh_failure_keeps_previous_version(self, get_latest_version_mock):
+        """We keep previous known version and don't retry before the interval if fetching failed"""
+        with patch("umake.settings.get_latest_version", return_value="42.03"):
+            self.refresh()
+        with patch("umake.settings.time.time", return_value=time.time() + settings.LATEST_VERSION_CHECK_INTERVAL + 1):
+            self.refresh()
+            get_latest_version_mock.reset_mock()
+            self.assertIsNone(self.refresh())
+        self.assertFalse(get_latest_version_mock.called)
+        self.assertEqual(settings.get_cached_latest_version(), "42.03")
@@ -20,7 +20,9 @@
 """Tests the various umake tools"""
 
 from concurrent import futures
+from io import BytesIO
 from gi.repository import GLib
+import json
 import os
 import shutil
 import subprocess
@@ -116,6 +118,34 @@ class TestConfigHandler(LoggedTestCase):
 
         self.assertEqual(len(os.listdir(self.config_dir)), 0)
 
+    def test_deferred_writes(self):
+        """Deferred config changes are only saved on flush"""
+        content = {'foo': 'bar'}
+        ConfigHandler().defer_writes()
+        ConfigHandler().config = content
+
+        self.assertEqual(ConfigHandler().config, content)
+        self.assertEqual(len(os.listdir(self.config_dir)), 0)
+        ConfigHandler().flush()
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME)) as f:
+            self.assertEqual(f.read(), 'foo: bar\n')
+
+    def test_flush_without_changes(self):
+        """We don't create any file when flushing without any deferred change"""
+        ConfigHandler().defer_writes()
+        ConfigHandler().flush()
+
+        self.assertEqual(len(os.listdir(self.config_dir)), 0)
+
+    def test_writes_after_flush(self):
+        """Config changes are saved right away after a flush"""
+        ConfigHandler().defer_writes()
+        ConfigHandler().flush()
+        ConfigHandler().config = {'foo': 'bar'}
+
+        with open(os.path.join(self.config_dir, settings.CONFIG_FILENAME)) as f:
+            self.assertEqual(f.read(), 'foo: bar\n')
+
     def test_transition_old_config(self):
         """Transition udtc old config to new umake one"""
         with tempfile.TemporaryDirectory() as tmpdirname:
@@ -292,6 +322,10 @@ class TestToolsThreads(LoggedTestCase):
 
     def setUp(self):
         super().setUp()
+        # those tests drive the GLib main loop directly
+        env_patcher = patch.dict(os.environ, {settings.UMAKE_MAINLOOP_ENVIRON_VARIABLE: "glib"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
         self.mainloop_object = tools.MainLoop()
         self.mainloop_thread = None
         self.function_thread = None
@@ -423,6 +457,121 @@ class TestToolsThreads(LoggedTestCase):
         self.expect_warn_error = True
 
 
+class TestQueueMainLoop(LoggedTestCase):
+    """Test the queue main loop backend, used without a graphical session"""
+
+    def setUp(self):
+        super().setUp()
+        env_patcher = patch.dict(os.environ, {settings.UMAKE_MAINLOOP_ENVIRON_VARIABLE: "queue"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        self.mainloop_object = tools.MainLoop()
+        self.calls = []
+
+    def tearDown(self):
+        Singleton._instances = {}
+        super().tearDown()
+
+    def run_mainloop(self):
+        """Run the main loop in another thread, returning it"""
+        thread = threading.Thread(target=self.mainloop_object.run)
+        thread.start()
+        return thread
+
+    def test_backend(self):
+        """We use the queue backend"""
+        self.assertIsInstance(self.mainloop_object.mainloop, tools.QueueMainLoopBackend)
+
+    def test_default_backend_headless(self):
+        """We default to the queue backend without any graphical session"""
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertEqual(tools.get_mainloop_backend_class(), tools.QueueMainLoopBackend)
+
+    def test_default_backend_graphical_session(self):
+        """We default to the GLib backend in a graphical session"""
+        with patch.dict(os.environ, {"WAYLAND_DISPLAY": "wayland-0"}, clear=True):
+            self.assertEqual(tools.get_mainloop_backend_class(), tools.GLibMainLoopBackend)
+
+    def test_unknown_backend(self):
+        """We warn and choose the default backend if an unknown one is requested"""
+        with patch.dict(os.environ, {settings.UMAKE_MAINLOOP_ENVIRON_VARIABLE: "foo"}, clear=True):
+            self.assertEqual(tools.get_mainloop_backend_class(), tools.QueueMainLoopBackend)
+        self.expect_warn_error = True
+
+    @patch("umake.tools.sys")
+    def test_run_functions_in_order(self, mocksys):
+        """We run callbacks in the mainloop thread, in the order they were scheduled"""
+        @tools.MainLoop.in_mainloop_thread
+        def _function_in_mainloop_thread(value):
+            self.calls.append((value, threading.current_thread().ident))
+
+        _function_in_mainloop_thread(1)
+        thread = self.run_mainloop()
+        _function_in_mainloop_thread(2)
+        self.mainloop_object.quit(raise_exception=False)
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([value for (value, _) in self.calls], [1, 2])
+        self.assertEqual({ident for (_, ident) in self.calls}, {thread.ident})
+        mocksys.exit.assert_called_once_with(0)
+
+    @patch("umake.tools.sys")
+    def test_mainloop_quit_with_exit_value(self, mocksys):
+        """We quit the process with a return code, once scheduled callbacks ran"""
+        self.mainloop_object.idle_add(self.calls.append, "before")
+        self.mainloop_object.quit(42, raise_exception=False)
+        self.mainloop_object.idle_add(self.calls.append, "after")
+        self.mainloop_object.run()
+
+        self.assertEqual(self.calls, ["before", "after"])
+        self.assertFalse(self.mainloop_object.mainloop.is_running())
+        mocksys.exit.assert_called_once_with(42)
+
+    def test_mainloop_exit(self):
+        """We exit the mainloop and the process when quitting"""
+        self.mainloop_object.quit(3, raise_exception=False)
+        with self.assertRaises(SystemExit) as cm:
+            self.mainloop_object.run()
+        self.assertEqual(cm.exception.code, 3)
+
+    @patch("umake.tools.sys")
+    def test_unhandled_exception_in_mainloop_thead_exit(self, mocksys):
+        """We quit the process in error for any unhandled exception, logging it"""
+        @tools.MainLoop.in_mainloop_thread
+        def _function_raising_exception():
+            raise BaseException("foo bar")
+
+        _function_raising_exception()
+        self.mainloop_object.run()
+
+        mocksys.exit.assert_called_once_with(1)
+        self.expect_warn_error = True
+
+    @patch("umake.tools.sys")
+    def test_return_mainloop_in_callback(self, mocksys):
+        """We carry on running callbacks returning to the mainloop"""
+        def _return_mainloop():
+            raise tools.MainLoop.ReturnMainLoop()
+
+        self.mainloop_object.idle_add(_return_mainloop)
+        self.mainloop_object.idle_add(self.calls.append, "next")
+        self.mainloop_object.quit(raise_exception=False)
+        self.mainloop_object.run()
+
+        self.assertEqual(self.calls, ["next"])
+
+    def test_no_glib_import(self):
+        """We don't need GLib with the queue backend"""
+        glib_mock = Mock()
+        with patch.object(tools, "GLib", new=glib_mock):
+            Singleton._instances = {}
+            mainloop = tools.MainLoop()
+            mainloop.idle_add(self.calls.append, "foo")
+            mainloop.add_after_pending(50, self.calls.append, "bar")
+        self.assertFalse(glib_mock.mock_calls)
+
+
 class TestLauncherIcons(LoggedTestCase):
     """Test module for launcher icons handling"""
 
@@ -615,6 +764,8 @@ class TestLauncherIcons(LoggedTestCase):
     def test_create_exec_path(self, settings_module):
         """Create link to the executable"""
         settings_module.DEFAULT_BINARY_LINK_PATH = os.path.join(self.local_dir, ".local", "share", "umake", "bin")
+        settings_module.DEFAULT_USER_ENV_PATH = os.path.join(self.local_dir, ".local", "share", "umake", "env.d")
+        settings_module.DEFAULT_USER_ENV_FILE_PATH = os.path.join(self.local_dir, ".local", "share", "umake", "env.sh")
         add_exec_link(os.path.join(self.server_dir, "simplefile"), "foo")
         self.assertTrue(os.path.exists(os.path.join(settings_module.DEFAULT_BINARY_LINK_PATH, "foo")))
 
@@ -697,6 +848,39 @@ class TestMiscTools(LoggedTestCase):
                                           "\ncontent content"),
                          "content content content contentcontent\n content\ncontent content")
 
+    def test_iter_json_array(self):
+        """We iterate over all elements of a json array, whatever the chunk boundaries are"""
+        content = [{"name": "é" * 20, "assets": [1, 2, {"id": None}]}, 1234567, "foo", True, [], {}]
+        for chunk_size in (1, 3, 64, 8192):
+            self.assertEqual(list(tools.iter_json_array(BytesIO(json.dumps(content, ensure_ascii=False).encode()),
+                                                        chunk_size=chunk_size)),
+                             content)
+
+    def test_iter_json_array_empty(self):
+        """We don't yield anything on an empty json array"""
+        self.assertEqual(list(tools.iter_json_array(BytesIO(b" [ ]\n"))), [])
+
+    def test_iter_json_array_lazy(self):
+        """We only read the content needed for the requested elements"""
+        fd = BytesIO(b"[1, " + b"2, " * 10000 + b"3]")
+        self.assertEqual(next(tools.iter_json_array(fd, chunk_size=16)), 1)
+        self.assertEqual(fd.tell(), 16)
+
+    def test_iter_json_array_big_element(self):
+        """We don't parse an element spanning many chunks again after each of them"""
+        content = [{"body": "a" * 4 * 1024 * 1024}, "foo"]
+        fd = BytesIO(json.dumps(content).encode())
+        with patch.object(fd, "read", wraps=fd.read) as read_mock:
+            self.assertEqual(list(tools.iter_json_array(fd)), content)
+        # 4 MB read in 8 KB chunks would be 512 reads
+        self.assertLess(read_mock.call_count, 20)
+
+    def test_iter_json_array_invalid(self):
+        """We raise a JSONDecodeError on invalid content or non array"""
+        for content in (b"", b"{}", b"[1, ", b"[1 2]"):
+            with self.assertRaises(json.JSONDecodeError):
+                list(tools.iter_json_array(BytesIO(content), chunk_size=1))
+
     def test_raise_inputerror(self):
         def foo():
             raise tools.InputError("Foo bar")
@@ -814,6 +998,12 @@ class TestUserENV(LoggedTestCase):
         self.orig_environ = os.environ.copy()
         self.local_dir = tempfile.mkdtemp()
         os.environ['SHELL'] = '/bin/bash'
+        self.env_dir = os.path.join(self.local_dir, "env.d")
+        self.env_file = os.path.join(self.local_dir, "env.sh")
+        for name, value in (("DEFAULT_USER_ENV_PATH", self.env_dir), ("DEFAULT_USER_ENV_FILE_PATH", self.env_file)):
+            patcher = patch.object(tools.settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     def tearDown(self):
         shutil.rmtree(self.local_dir)
@@ -833,8 +1023,9 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=bar\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=bar\n" in env_content, env_content)
         self.assertTrue("bar" in os.environ["FOOO"], os.environ["FOOO"])
 
     @patch("umake.tools.os.path.expanduser")
@@ -847,8 +1038,9 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=bar:baz\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=bar:baz\n" in env_content, env_content)
         self.assertTrue("bar" in os.environ["FOOO"], os.environ["FOOO"])
 
     @patch("umake.tools.os.path.expanduser")
@@ -862,8 +1054,9 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=bar\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=bar\n" in env_content, env_content)
         self.assertTrue("bar" in os.environ["FOOO"], os.environ["FOOO"])
 
     @patch("umake.tools.os.path.expanduser")
@@ -877,8 +1070,9 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=bar:$FOOO\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=bar:$FOOO\n" in env_content, env_content)
         self.assertEqual(os.environ["FOOO"], "bar:foo")
 
     @patch("umake.tools.os.path.expanduser")
@@ -892,8 +1086,9 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=bar\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=bar\n" in env_content, env_content)
         self.assertTrue("bar" in os.environ["FOOO"], os.environ["FOOO"])
         self.assertFalse("foo" in os.environ["FOOO"], os.environ["FOOO"])
         self.assertEqual(os.environ["FOOO"], "bar")
@@ -907,7 +1102,9 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
-        self.assertTrue("export FOOO=/tmp/foo\n" in profile_content, profile_content)
+        env_content = open(self.env_file).read()
+        self.assertIn('. "{}"'.format(self.env_file), profile_content)
+        self.assertTrue("export FOOO=/tmp/foo\n" in env_content, env_content)
         self.assertTrue("/tmp/foo" in os.environ["FOOO"], os.environ["FOOO"])
 
     @patch("umake.tools.os.path.expanduser")
@@ -920,14 +1117,15 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=/tmp/foo\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=/tmp/foo\n" in env_content, env_content)
 
         tools.add_env_to_user("add twice", {"FOOO": {"value": "/tmp/foo"}})
 
         # ensure, it's only there once
-        profile_content = open(profile_file).read()
-        self.assertEqual(profile_content.count("export FOOO=/tmp/foo"), 1, profile_content)
+        env_content = open(self.env_file).read()
+        self.assertEqual(env_content.count("export FOOO=/tmp/foo"), 1, env_content)
 
     @patch("umake.tools.os.path.expanduser")
     def test_add_to_user_path_twice_with_new_content(self, expanderusermock):
@@ -939,14 +1137,15 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=/tmp/foo\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=/tmp/foo\n" in env_content, env_content)
 
         tools.add_env_to_user("add twice", {"FOOO": {"value": "/tmp/bar"}})
 
         # ensure, it's only there once
-        profile_content = open(profile_file).read()
-        self.assertEqual(profile_content.count("export FOOO=/tmp/bar"), 1, profile_content)
+        env_content = open(self.env_file).read()
+        self.assertEqual(env_content.count("export FOOO=/tmp/bar"), 1, env_content)
 
     @patch("umake.tools.os.path.expanduser")
     def test_add_to_user_path_twice_other_framework(self, expanderusermock):
@@ -958,15 +1157,16 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=/tmp/foo\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=/tmp/foo\n" in env_content, env_content)
 
         tools.add_env_to_user("add twice with other framework", {"BAR": {"value": "/tmp/bar"}})
 
         # ensure, it's only there once
-        profile_content = open(profile_file).read()
-        self.assertTrue("export FOOO=/tmp/foo\n" in profile_content, profile_content)
-        self.assertTrue("export BAR=/tmp/bar\n" in profile_content, profile_content)
+        env_content = open(self.env_file).read()
+        self.assertTrue("export FOOO=/tmp/foo\n" in env_content, env_content)
+        self.assertTrue("export BAR=/tmp/bar\n" in env_content, env_content)
 
     @patch("umake.tools.os.path.expanduser")
     def test_add_env_to_user_multiple(self, expanderusermock):
@@ -978,9 +1178,10 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("export FOOO=bar\n" in profile_content, profile_content)
-        self.assertTrue("export BAR=foo\n" in profile_content, profile_content)
+        self.assertTrue("export FOOO=bar\n" in env_content, env_content)
+        self.assertTrue("export BAR=foo\n" in env_content, env_content)
         self.assertEqual(os.environ["FOOO"], "bar")
         self.assertEqual(os.environ["BAR"], "foo")
 
@@ -994,8 +1195,9 @@ class TestUserENV(LoggedTestCase):
 
         expanderusermock.assert_called_with('~')
         profile_content = open(profile_file).read()
+        env_content = open(self.env_file).read()
         self.assertTrue("Foo\nBar\n" in profile_content, profile_content)  # we kept previous content
-        self.assertTrue("\nPATH=/tmp/bar:$PATH\n" in profile_content, profile_content)
+        self.assertTrue("\nPATH=/tmp/bar:$PATH\n" in env_content, env_content)
         self.assertTrue("/tmp/bar" in os.environ["PATH"], os.environ["PATH"])
 
     @patch("umake.tools.os.path.expanduser")
@@ -1092,6 +1294,112 @@ class TestUserENV(LoggedTestCase):
         profile_content = open(profile_file).read()
         self.assertEqual(profile_content, "Foo\nBar\nexport BAR=baz")
 
+    @patch("umake.tools.os.path.expanduser")
+    def test_add_env_to_user_sources_env_file_once(self, expanderusermock):
+        """Adding envs of multiple frameworks only adds one line sourcing the env file to .profile"""
+        expanderusermock.return_value = self.local_dir
+        profile_file = os.path.join(self.local_dir, ".profile")
+        open(profile_file, 'w').write("Foo\nBar")
+        tools.add_env_to_user("framework A", {"FOO": {"value": "bar"}})
+        tools.add_env_to_user("framework B", {"BAR": {"value": "baz"}})
+
+        self.assertEqual(open(profile_file).read(), 'Foo\nBar\n# Ubuntu make environment\n'
+                                                    '[ -f "{path}" ] && . "{path}"\n'.format(path=self.env_file))
+        self.assertEqual(sorted(os.listdir(self.env_dir)), ["0001-framework-a.sh", "0002-framework-b.sh"])
+        self.assertEqual(open(self.env_file).read(), "# Ubuntu make installation of framework A\nexport FOO=bar\n\n"
+                                                     "# Ubuntu make installation of framework B\nexport BAR=baz\n")
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_add_env_to_user_unchanged(self, expanderusermock):
+        """Adding the same envs again doesn't rewrite any file"""
+        expanderusermock.return_value = self.local_dir
+        tools.add_env_to_user("framework A", {"FOO": {"value": "bar", "keep": False}})
+        with patch("umake.tools._write_atomically") as write_mock:
+            tools.add_env_to_user("framework A", {"FOO": {"value": "bar", "keep": False}})
+        self.assertFalse(write_mock.called)
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_add_env_to_user_install_order(self, expanderusermock):
+        """Envs of the framework installed last come last in the env file, whatever its name"""
+        expanderusermock.return_value = self.local_dir
+        tools.add_env_to_user("framework B", {"PATH": {"value": "/b"}})
+        tools.add_env_to_user("framework A", {"PATH": {"value": "/a"}})
+        self.assertEqual(open(self.env_file).read(), "# Ubuntu make installation of framework B\nPATH=/b:$PATH\n\n"
+                                                     "# Ubuntu make installation of framework A\nPATH=/a:$PATH\n")
+
+        # installing B again, even with the same envs, gives it precedence back
+        os.environ["PATH"] = self.orig_environ["PATH"]
+        tools.add_env_to_user("framework B", {"PATH": {"value": "/b"}})
+        self.assertEqual(sorted(os.listdir(self.env_dir)), ["0002-framework-a.sh", "0003-framework-b.sh"])
+        self.assertEqual(open(self.env_file).read(), "# Ubuntu make installation of framework A\nPATH=/a:$PATH\n\n"
+                                                     "# Ubuntu make installation of framework B\nPATH=/b:$PATH\n")
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_add_env_to_user_moves_profile_envs(self, expanderusermock):
+        """Adding envs moves the ones appended to .profile by previous versions to the env file"""
+        expanderusermock.return_value = self.local_dir
+        profile_file = os.path.join(self.local_dir, ".profile")
+        open(profile_file, 'w').write("Foo\n# Ubuntu make installation of framework A\nexport FOO=bar\n\n"
+                                      "# Ubuntu make installation of framework B\nexport BAR=bar\nBAZ=baz\n\n"
+                                      "Bar\n")
+        tools.add_env_to_user("framework A", {"FOO": {"value": "baz"}})
+
+        profile_content = open(profile_file).read()
+        self.assertTrue(profile_content.startswith("Foo\nBar\n# Ubuntu make environment\n"), profile_content)
+        self.assertNotIn("export", profile_content)
+        env_content = open(self.env_file).read()
+        self.assertIn("# Ubuntu make installation of framework B\nexport BAR=bar\nBAZ=baz\n", env_content)
+        self.assertIn("export FOO=baz\n", env_content)
+        self.assertNotIn("export FOO=bar\n", env_content)
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_remove_user_env_file(self, expanderusermock):
+        """Remove an env from the env file"""
+        expanderusermock.return_value = self.local_dir
+        tools.add_env_to_user("framework A", {"FOO": {"value": "bar"}})
+        tools.add_env_to_user("framework B", {"BAR": {"value": "baz"}})
+        tools.remove_framework_envs_from_user("framework A")
+
+        self.assertEqual(os.listdir(self.env_dir), ["0002-framework-b.sh"])
+        self.assertEqual(open(self.env_file).read(), "# Ubuntu make installation of framework B\nexport BAR=baz\n")
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_defer_user_env_writes(self, expanderusermock):
+        """Write the env file once, when flushing deferred writes"""
+        expanderusermock.return_value = self.local_dir
+        tools.defer_user_env_writes()
+        self.addCleanup(tools.flush_user_env)
+        tools.add_env_to_user("framework A", {"FOO": {"value": "bar"}})
+        tools.add_env_to_user("framework B", {"BAR": {"value": "baz"}})
+        self.assertFalse(os.path.exists(self.env_file))
+
+        with patch("umake.tools._write_user_env", wraps=tools._write_user_env) as write_mock:
+            tools.flush_user_env()
+        write_mock.assert_called_once_with()
+        env_content = open(self.env_file).read()
+        self.assertIn("export FOO=bar\n", env_content)
+        self.assertIn("export BAR=baz\n", env_content)
+
+    @patch("umake.tools.os.path.expanduser")
+    def test_reinstall_writes_user_env_once(self, expanderusermock):
+        """Replacing the envs of a framework in deferred writes only writes the env file with the final ones"""
+        expanderusermock.return_value = self.local_dir
+        tools.add_env_to_user("framework A", {"FOO": {"value": "bar", "keep": False}})
+        with patch("umake.tools._write_user_env", wraps=tools._write_user_env) as write_mock:
+            self.assertTrue(tools.defer_user_env_writes())
+            self.addCleanup(tools.flush_user_env)
+            tools.remove_framework_envs_from_user("framework A")
+            tools.add_env_to_user("framework A", {"FOO": {"value": "baz", "keep": False}})
+            tools.flush_user_env()
+        write_mock.assert_called_once_with()
+        self.assertEqual(open(self.env_file).read(), "# Ubuntu make installation of framework A\nexport FOO=baz\n")
+
+    def test_defer_user_env_writes_nested(self):
+        """Only the first caller deferring writes is in charge of flushing them"""
+        self.assertTrue(tools.defer_user_env_writes())
+        self.addCleanup(tools.flush_user_env)
+        self.assertFalse(tools.defer_user_env_writes())
+
 
 class TestUserShell(LoggedTestCase):
 
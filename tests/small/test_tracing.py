@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the tracing of install phases"""
+
+from concurrent import futures
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake import tracing
+
+
+class TestTracing(LoggedTestCase):
+    """This will test recording spans and saving them as a Chrome trace"""
+
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.trace_path = os.path.join(self.tempdir, "trace.json")
+
+    def tearDown(self):
+        # disable tracing, so that nothing is saved at exit
+        tracing._events = None
+        tracing._thread_names = {}
+        tracing._path = None
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def load_trace(self):
+        tracing.save()
+        with open(self.trace_path) as f:
+            return json.load(f)["traceEvents"]
+
+    def test_disabled_by_default(self):
+        """We don't record anything if tracing isn't enabled"""
+        self.assertFalse(tracing.is_enabled())
+        with tracing.span("foo") as span:
+            span.end(bar="baz")
+        tracing.save()
+        self.assertFalse(os.path.exists(self.trace_path))
+
+    def test_enable_from_args(self):
+        """We enable tracing with --profile FILE"""
+        tracing.enable_from_args(["umake", "--profile", self.trace_path, "ide"])
+        self.assertTrue(tracing.is_enabled())
+        self.assertEqual(tracing._path, self.trace_path)
+
+    def test_enable_from_args_with_equal(self):
+        """We enable tracing with --profile=FILE"""
+        tracing.enable_from_args(["umake", "--profile={}".format(self.trace_path)])
+        self.assertEqual(tracing._path, self.trace_path)
+
+    def test_enable_from_env(self):
+        """We enable tracing with UMAKE_PROFILE"""
+        with patch.dict(os.environ, {"UMAKE_PROFILE": self.trace_path}):
+            tracing.enable_from_args(["umake", "ide"])
+        self.assertEqual(tracing._path, self.trace_path)
+
+    def test_not_enabled_without_profile(self):
+        """We don't enable tracing without any profile option"""
+        with patch.dict(os.environ):
+            os.environ.pop("UMAKE_PROFILE", None)
+            tracing.enable_from_args(["umake", "ide"])
+        self.assertFalse(tracing.is_enabled())
+
+    def test_span_context_manager(self):
+        """We record a complete event with a duration and its args"""
+        tracing.enable(self.trace_path)
+        with tracing.span("foo", "cat", url="http://foo") as span:
+            span.end(size=42)
+        events = [event for event in self.load_trace() if event["ph"] == "X"]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["name"], "foo")
+        self.assertEqual(events[0]["cat"], "cat")
+        self.assertEqual(events[0]["args"], {"url": "http://foo", "size": 42})
+        self.assertGreaterEqual(events[0]["dur"], 0)
+
+    def test_span_error(self):
+        """We record the exception which ended a span"""
+        tracing.enable(self.trace_path)
+        with self.assertRaises(BaseException):
+            with tracing.span("foo"):
+                raise BaseException("oops")
+        events = [event for event in self.load_trace() if event["ph"] == "X"]
+        self.assertIn("oops", events[0]["args"]["error"])
+
+    def test_span_ended_later(self):
+        """We can end a span in another place than where it started, only once"""
+        tracing.enable(self.trace_path)
+        span = tracing.span("foo")
+        span.end()
+        span.end()
+        events = [event for event in self.load_trace() if event["ph"] == "X"]
+        self.assertEqual(len(events), 1)
+
+    def test_traced_decorator(self):
+        """We record each call of a traced function with its qualified name"""
+        tracing.enable(self.trace_path)
+
+        @tracing.traced("cat")
+        def foo():
+            return 42
+
+        self.assertEqual(foo(), 42)
+        events = [event for event in self.load_trace() if event["ph"] == "X"]
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0]["name"].endswith("foo"))
+        self.assertEqual(events[0]["cat"], "cat")
+
+    def test_threads_have_their_track(self):
+        """We name each thread which recorded a span"""
+        tracing.enable(self.trace_path)
+        with tracing.span("main"):
+            pass
+        with futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Worker") as executor:
+            executor.submit(lambda: tracing.span("worker").end()).result()
+        events = self.load_trace()
+        thread_names = {event["tid"]: event["args"]["name"] for event in events if event["name"] == "thread_name"}
+        spans = {event["name"]: event["tid"] for event in events if event["ph"] == "X"}
+        self.assertNotEqual(spans["main"], spans["worker"])
+        self.assertEqual(thread_names[spans["main"]], "MainThread")
+        self.assertTrue(thread_names[spans["worker"]].startswith("Worker"))
@@ -21,10 +21,12 @@
 
 from concurrent import futures
 from gi.repository import GLib
+import os
 from time import time
 from unittest.mock import Mock, patch
 from ..tools import LoggedTestCase
 import threading
+from umake.settings import UMAKE_MAINLOOP_ENVIRON_VARIABLE
 from umake.tools import MainLoop, Singleton
 from umake.ui import UI
 
@@ -38,6 +40,10 @@ class TestUI(LoggedTestCase):
         self.mockUIPlug._display.side_effect = self.display_UIPlug
         self.contentType = Mock()
         self.ui = UI(self.mockUIPlug)
+        # those tests drive the GLib main loop directly
+        env_patcher = patch.dict(os.environ, {UMAKE_MAINLOOP_ENVIRON_VARIABLE: "glib"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
         self.mainloop_object = MainLoop()
         self.mainloop_thread = None
         self.function_thread = None
@@ -87,6 +93,24 @@ class TestUI(LoggedTestCase):
         UI.return_main_screen()
         self.assertTrue(self.mockUIPlug._return_main_screen.called)
 
+    @patch("umake.ui.get_version", return_value="42.02")
+    @patch("umake.ui.get_cached_latest_version", return_value="42.03")
+    @patch("builtins.print")
+    def test_return_to_mainscreen_on_error_outdated(self, print_mock, latest_mock, version_mock):
+        """We warn from the cached latest version on error, without going to the network"""
+        UI.return_main_screen(status_code=1)
+        self.assertTrue(self.mockUIPlug._return_main_screen.called)
+        self.assertIn("42.03", print_mock.call_args[0][0])
+
+    @patch("umake.ui.get_version", return_value="42.03")
+    @patch("umake.ui.get_cached_latest_version", return_value=None)
+    @patch("builtins.print")
+    def test_return_to_mainscreen_on_error_no_cache(self, print_mock, latest_mock, version_mock):
+        """We don't warn if the latest version was never fetched"""
+        UI.return_main_screen(status_code=1)
+        self.assertTrue(self.mockUIPlug._return_main_screen.called)
+        self.assertFalse(print_mock.called)
+
     @patch("umake.tools.sys")
     def test_call_display(self, mocksys):
         """We call the display method from the UIPlug"""
@@ -157,3 +181,36 @@ class TestUI(LoggedTestCase):
         self.assertNotEqual(self.mainloop_thread, self.function_thread)
         self.assertEqual(self.mainloop_thread, self.display_thread)
         self.assertTrue(self.time_display_call - now > 0.05)
+
+
+class TestUIQueueMainLoop(LoggedTestCase):
+    """This will test the UI generic module with the queue main loop backend"""
+
+    def setUp(self):
+        super().setUp()
+        self.displayed = []
+        self.mockUIPlug = Mock()
+        self.mockUIPlug._display.side_effect = self.displayed.append
+        self.ui = UI(self.mockUIPlug)
+        env_patcher = patch.dict(os.environ, {UMAKE_MAINLOOP_ENVIRON_VARIABLE: "queue"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        self.mainloop_object = MainLoop()
+
+    def tearDown(self):
+        Singleton._instances = {}
+        super().tearDown()
+
+    @patch("umake.tools.sys")
+    def test_delayed_display_after_pending(self, mocksys):
+        """We display delayed content once already scheduled content is displayed, without waiting"""
+        UI.delayed_display("delayed")
+        UI.display("first")
+        UI.display("second")
+        MainLoop().quit(raise_exception=False)
+        now = time()
+        self.mainloop_object.run()
+
+        self.assertEqual(self.displayed, ["first", "second", "delayed"])
+        self.assertLess(time() - now, 0.05)
+        mocksys.exit.assert_called_once_with(0)
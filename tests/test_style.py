@@ -46,7 +46,8 @@ class CodeCheck(TestCase):
         pep8style = pycodestyle.StyleGuide(config_file=os.path.join(get_root_dir(), 'setup.cfg'))
 
         results = pep8style.check_files([umake_dir, os.path.join(get_root_dir(), "tests"),
-                                         os.path.join(get_root_dir(), "bin")])
+                                         os.path.join(get_root_dir(), "bin"),
+                                         os.path.join(get_root_dir(), "benchmarks")])
         self.assertEqual(results.get_statistics(), [])
 
     @mark.skipif("pycodestyle" not in sys.modules.keys(), reason="requires pycodestyle")
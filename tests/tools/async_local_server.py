@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Class enabling having a local asyncio http server, keeping connections alive"""
+
+import asyncio
+import email.utils
+import http.cookies
+import logging
+import mimetypes
+import os
+import posixpath
+import threading
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLocalHttp:
+    """Local asyncio http/1.1 server serving path content, with the same special paths than LocalHttp
+
+    Connections are kept alive, and counted in connections, to check they are reused. Paths ending with -chunked are
+    sent with a chunked transfer encoding, -redirect ones redirect to their location parameter if any, and -stalled
+    ones are never answered. Request headers are recorded in request_headers."""
+
+    def __init__(self, path, port=0):
+        self.path = path
+        self.connections = 0
+        self.requests = 0
+        # headers of every request, lowercased
+        self.request_headers = []
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._writers = set()
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(port, started), daemon=True)
+        self._thread.start()
+        started.wait(5)
+
+    def _serve(self, port, started):
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, "localhost", port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Serving locally from {} on {}".format(self.path, self.get_address()))
+        started.set()
+        self._loop.run_forever()
+
+    def get_address(self, localhost=True):
+        """Get public address"""
+        return "http://localhost:{}".format(self.port)
+
+    def stop(self):
+        """Stop local server"""
+        logger.info("Stopping serving on {}".format(self.port))
+
+        async def _stop():
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(_stop(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+        self._loop.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1")
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                self.requests += 1
+                self.request_headers.append(headers)
+                method, target, version = request_line.decode("latin-1").split()
+                if target.endswith("-stalled"):
+                    # never answer, until the client gives up
+                    await reader.read()
+                    break
+                if not await self._respond(writer, target, headers):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, writer, target, headers):
+        """Answer the request, returning if the connection is kept alive"""
+        response_headers = []
+        cookies = http.cookies.SimpleCookie(headers.get("cookie"))
+        if 'int' in cookies:
+            cookies['int'] = int(cookies['int'].value) + 1
+        for cookie in cookies.values():
+            response_headers.append(('Set-Cookie', cookie.OutputString(None)))
+
+        url = urllib.parse.urlparse(target)
+        path = url.path
+        params = urllib.parse.parse_qs(url.query)
+        if path.endswith('-redirect'):
+            response_headers.append(('Location', params.get('location', [path[:-len('-redirect')]])[0]))
+            return await self._send(writer, 302, "Found", response_headers, b"")
+        if path.endswith('-setheaders'):
+            for key, values in params.items():
+                for value in values:
+                    response_headers.append((key, value))
+            path = path[:-len('-setheaders')]
+        elif path.endswith('-headers'):
+            for key in params:
+                if headers.get(key.lower()) != params[key][0]:
+                    return await self._send(writer, 404, "File not found", response_headers, b"")
+            path = path[:-len('-headers')]
+
+        chunked = path.endswith("-chunked")
+        if chunked:
+            path = path[:-len("-chunked")]
+        no_content_length = path.endswith("-with-no-content-length")
+        if no_content_length:
+            path = path[:-len("-with-no-content-length")]
+
+        file_path = os.path.join(self.path, posixpath.normpath(urllib.parse.unquote(path)).lstrip("/"))
+        if not os.path.isfile(file_path):
+            return await self._send(writer, 404, "File not found", response_headers, b"")
+        with open(file_path, "rb") as f:
+            content = f.read()
+        response_headers.append(("Content-Type", mimetypes.guess_type(file_path)[0] or "application/octet-stream"))
+        return await self._send(writer, 200, "OK", response_headers, content, chunked=chunked,
+                                content_length=not no_content_length)
+
+    async def _send(self, writer, status, reason, headers, content, chunked=False, content_length=True):
+        lines = ["HTTP/1.1 {} {}".format(status, reason), "Date: {}".format(email.utils.formatdate(usegmt=True))]
+        keep_alive = True
+        if chunked:
+            lines.append("Transfer-Encoding: chunked")
+        elif content_length:
+            lines.append("Content-Length: {}".format(len(content)))
+        else:
+            lines.append("Connection: close")
+            keep_alive = False
+        lines.extend("{}: {}".format(key, value) for key, value in headers)
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if chunked:
+            for i in range(0, len(content), 1000):
+                chunk = content[i:i + 1000]
+                writer.write("{:x}\r\n".format(len(chunk)).encode() + chunk + b"\r\n")
+            writer.write(b"0\r\n\r\n")
+        else:
+            writer.write(content)
+        await writer.drain()
+        return keep_alive
@@ -25,6 +25,7 @@ import http.cookies
 import logging
 import os
 import posixpath
+import re
 import ssl
 from . import get_data_dir
 import urllib
@@ -42,19 +43,23 @@ logger = logging.getLogger(__name__)
 class LocalHttp:
     """Local threaded http server. will be serving path content"""
 
-    def __init__(self, path, multi_hosts=False, use_ssl=[], port=9876, ftp_redir=False):
+    def __init__(self, path, multi_hosts=False, use_ssl=[], port=9876, ftp_redir=False, ranges=True):
         """path is the local path to server
         multi_hosts will transfer http://hostname/foo to path/hostname/foo. This is used when we potentially serve
         multiple paths.
         set use_ssl to a specific array of hostnames. We'll use the corresponding certificates.
+        ranges enables serving single byte ranges of files. Served (start, end) ranges are appended to served_ranges.
         """
         self.port = port
         self.path = path
         self.use_ssl = use_ssl
+        self.served_ranges = []
         handler = RequestHandler
         handler.root_path = path
         handler.multi_hosts = multi_hosts
         handler.ftp_redir = ftp_redir
+        handler.ranges = ranges
+        handler.served_ranges = self.served_ranges
         # can be TCPServer, but we don't have a self.httpd.server_name then
         self.httpd = HTTPServer(("", self.port), RequestHandler)
         handler.hostname = self.httpd.server_name
@@ -105,11 +110,57 @@ class LocalHttp:
 class RequestHandler(SimpleHTTPRequestHandler):
 
     root_path = os.getcwd()
+    ranges = True
+    served_ranges = []
 
     def __init__(self, request, client_address, server):
         self.headers_to_send = []
+        self.range_length = None
         super().__init__(request, client_address, server)
 
+    def send_head(self):
+        """Serve a single byte range of a file if requested and enabled"""
+        self.range_length = None
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if not RequestHandler.ranges or not range_header or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        match = re.match(r"bytes=(\d*)-(\d*)$", range_header)
+        if not match or not any(match.groups()):
+            self.send_error(416)
+            return None
+        start, end = match.groups()
+        if not start:
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        if start > end:
+            self.send_error(416)
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range_length = end - start + 1
+        RequestHandler.served_ranges.append((start, end + 1))
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(self.range_length))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        """Only copy the requested range, if any"""
+        if self.range_length is None:
+            return super().copyfile(source, outputfile)
+        remaining = self.range_length
+        while remaining > 0:
+            data = source.read(min(remaining, 64 * 1024))
+            if not data:
+                break
+            outputfile.write(data)
+            remaining -= len(data)
+
     def end_headers(self):
         """don't send Content-Length header for a particular file"""
         # we can send 404, so ensure that we have a valid path attribute
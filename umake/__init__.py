@@ -27,10 +27,6 @@ import logging
 import logging.config
 import os
 import sys
-from umake.frameworks import load_frameworks
-from umake.tools import MainLoop
-from .ui import cli
-import yaml
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +63,7 @@ def _setup_logging(env_key='LOG_CFG', level=_default_log_level):
         requests_log.propagate = True
     if level == _default_log_level:
         if os.path.exists(path):
+            import yaml
             with open(path, 'rt') as f:
                 config = yaml.load(f.read())
             logging.config.dictConfig(config)
@@ -103,6 +100,11 @@ def should_load_all_frameworks(args):
     return False
 
 
+def should_only_print_version(args):
+    """Return if we are only requested to print the version"""
+    return "--version" in args[1:] and "--help" not in args[1:]
+
+
 class _HelpAction(argparse._HelpAction):
 
     def __call__(self, parser, namespace, values, option_string=None):
@@ -119,13 +121,17 @@ class _HelpAction(argparse._HelpAction):
         parser.exit()
 
 
-def main():
-    """Main entry point of the program"""
+def rate_argument(value):
+    """Parse a bandwidth rate command line argument"""
+    from umake.network.scheduler import parse_rate
+    try:
+        return parse_rate(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
-    if "udtc" in sys.argv[0]:
-        print(_("WARNING: 'udtc' command is the previous name of Ubuntu Make. Please use the 'umake' command from now "
-                "on providing the exact same features. The 'udtc' command will be removed soon."))
 
+def get_parser():
+    """Return the main command line parser, without any framework"""
     parser = argparse.ArgumentParser(description=_("Deploy and setup developers environment easily on ubuntu"),
                                      epilog=_("Note that you can also configure different debug logging behavior using "
                                               "LOG_CFG that points to a log yaml profile."),
@@ -143,16 +149,103 @@ def main():
     list_group.add_argument('--list-json', action="store_true", help=_("List installable frameworks (json)"))
 
     parser.add_argument('--version', action="store_true", help=_("Print version and exit"))
+    parser.add_argument('--profile', metavar="FILE",
+                        help=_("Save a timeline of the installation steps to FILE, in Chrome trace format. This can "
+                               "also be enabled with the UMAKE_PROFILE environment variable"))
+
+    parser.add_argument('--install-from', metavar="MANIFEST",
+                        help=_("Install all frameworks listed in a yaml manifest file, with their path, license "
+                               "acceptance and options, in parallel and without prompting"))
+
+    parser.add_argument('--prefetch', action="store_true",
+                        help=_("Start downloading while the license agreement is displayed. The download is thrown "
+                               "away if the license isn't accepted"))
+
+    parser.add_argument('--delta-updates', action="store_true",
+                        help=_("On update, only download what changed in artifacts whose server publishes a block "
+                               "index next to them, like a local mirror"))
+
+    bandwidth_group = parser.add_argument_group("Bandwidth")
+    bandwidth_group.add_argument('--limit-rate', metavar="RATE", type=rate_argument,
+                                 help=_("Cap the total download rate, in bytes per second. RATE can be suffixed with "
+                                        "k, m or g, like 500k"))
+    bandwidth_group.add_argument('--limit-rate-per-download', metavar="RATE", type=rate_argument,
+                                 help=_("Cap the rate of each download, in bytes per second"))
+
+    progress_group = parser.add_argument_group("Progress reporting")
+    progress_group.add_argument('--progress', choices=["bar", "jsonl"], default="bar",
+                                help=_("Progress display: interactive progress bars, or a stream of JSON lines events "
+                                       "for other tools to consume"))
+    progress_group.add_argument('--progress-socket', metavar="SOCKET",
+                                help=_("Send JSON lines events to this unix socket instead of stdout"))
+
+    parser.add_argument('--daemon', action="store_true",
+                        help=_("Run as a daemon keeping frameworks, configuration and package cache loaded, to which "
+                               "next umake commands are forwarded"))
+
+    bundle_group = parser.add_argument_group("Offline installations")
+    bundle_group.add_argument('--offline', action="store_true", help=_("Don't access the network"))
+    bundle_exclusive_group = bundle_group.add_mutually_exclusive_group()
+    bundle_exclusive_group.add_argument('--create-bundle', metavar="BUNDLE_DIR",
+                                        help=_("Store everything fetched while installing in a bundle directory"))
+    bundle_exclusive_group.add_argument('--from-bundle', metavar="BUNDLE_DIR",
+                                        help=_("Install from a previously created bundle directory, without "
+                                               "accessing the network"))
+    return parser
+
+
+def main():
+    """Main entry point of the program"""
+
+    # answer shell completion from the static cache without loading any framework, if possible
+    from umake import completion
+    if completion.complete_from_cache():
+        sys.exit(0)
+
+    if "udtc" in sys.argv[0]:
+        print(_("WARNING: 'udtc' command is the previous name of Ubuntu Make. Please use the 'umake' command from now "
+                "on providing the exact same features. The 'udtc' command will be removed soon."))
+
+    parser = get_parser()
 
     # set logging ignoring unknown options
     set_logging_from_args(sys.argv, parser)
 
-    mainloop = MainLoop()
+    if "--daemon" in sys.argv[1:]:
+        from umake import daemon
+        daemon.run_daemon()
+        sys.exit(0)
+
+    # the version doesn't need any framework to be loaded
+    if should_only_print_version(sys.argv):
+        from umake.settings import get_version
+        print(get_version())
+        sys.exit(0)
+
+    # let a running daemon run the command from its already loaded state
+    from umake import daemon
+    exit_code = daemon.forward_to_daemon(sys.argv)
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+    run(parser)
+
+
+def run(parser, frameworks_loaded=False):
+    """Load frameworks if needed, and run the command in sys.argv"""
+    from umake import tracing
+    tracing.enable_from_args(sys.argv)
+
+    from umake.frameworks import load_frameworks
+    from umake.tools import MainLoop
+    from umake.ui import cli
 
     # load frameworks
-    load_frameworks(force_loading=should_load_all_frameworks(sys.argv))
+    if not frameworks_loaded:
+        with tracing.span("load_frameworks"):
+            load_frameworks(force_loading=should_load_all_frameworks(sys.argv))
 
     # initialize parser
     cli.main(parser)
 
-    mainloop.run()
+    MainLoop().run()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2026 Canonical
+#
+# Authors:
+#  agent
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Static shell completion cache
+
+Shell completion is served from a json dump of the argparse tree, so that we can answer without loading any framework
+(and thus without importing GLib, apt, requests…). Only stdlib and xdg are imported in this module for that reason.
+The cache is regenerated on the slow path whenever its stamp (umake and frameworks modules, configuration) is stale."""
+
+import argparse
+from contextlib import suppress
+import json
+import logging
+import os
+import shlex
+from umake import settings
+from xdg.BaseDirectory import load_first_config, xdg_cache_home
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+
+# characters argcomplete escapes or bash splits words on: we leave completions containing them to argcomplete
+_SPECIAL_CHARS = "\\();<>|&!`$*?[]{} \t\n\"'=:"
+# a single completion ending with them isn't followed by a space, to carry on typing
+_CONTINUATION_CHARS = "=/:"
+
+
+def get_cache_path():
+    """Return completion cache file path"""
+    return os.path.join(xdg_cache_home, settings.CONFIG_FILENAME, settings.COMPLETION_CACHE_FILENAME)
+
+
+def _get_frameworks_dirs():
+    """Return all directories framework modules can be loaded from"""
+    dirs = [os.path.join(os.path.dirname(__file__), "frameworks"),
+            os.path.expanduser(os.path.join('~', '.umake', 'frameworks'))]
+    environment_path = os.environ.get(settings.UMAKE_FRAMEWORKS_ENVIRON_VARIABLE)
+    if environment_path:
+        dirs.append(environment_path)
+    return dirs
+
+
+def get_stamp():
+    """Return a stamp which changes on umake upgrade, frameworks or configuration change
+
+    Only stat() calls are made, so that this is cheap enough to be called on every completion request."""
+    mtimes = []
+    for frameworks_dir in _get_frameworks_dirs():
+        with suppress(FileNotFoundError, NotADirectoryError):
+            for entry in os.scandir(frameworks_dir):
+                if entry.name.endswith(".py"):
+                    mtimes.append(entry.stat().st_mtime_ns)
+    version_mtime = None
+    with suppress(FileNotFoundError):
+        version_mtime = os.stat(os.path.join(os.path.dirname(__file__), 'version')).st_mtime_ns
+    config_mtime = None
+    config_file = load_first_config(settings.CONFIG_FILENAME)
+    if config_file:
+        with suppress(FileNotFoundError):
+            config_mtime = os.stat(config_file).st_mtime_ns
+    return [CACHE_FORMAT_VERSION, os.path.dirname(__file__), version_mtime, max(mtimes, default=None),
+            len(mtimes), config_mtime, os.environ.get(settings.UMAKE_FRAMEWORKS_ENVIRON_VARIABLE)]
+
+
+def parser_to_tree(parser):
+    """Return a json serializable tree of parser options, subcommands and positional arguments"""
+    tree = {"options": [], "options_with_value": [], "subcommands": {}, "positional": False}
+    for action in parser._actions:
+        if action.option_strings:
+            if action.help == argparse.SUPPRESS:
+                continue
+            tree["options"].extend(action.option_strings)
+            if action.nargs != 0:
+                tree["options_with_value"].extend(action.option_strings)
+        elif isinstance(action, argparse._SubParsersAction):
+            for name, subparser in action.choices.items():
+                tree["subcommands"][name] = parser_to_tree(subparser)
+        else:
+            tree["positional"] = True
+    return tree
+
+
+def save_cache(parser):
+    """Dump parser tree to the completion cache"""
+    cache_path = get_cache_path()
+    content = {"stamp": get_stamp(), "tree": parser_to_tree(parser)}
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + ".new", "w") as f:
+            json.dump(content, f)
+        os.rename(cache_path + ".new", cache_path)
+    except OSError as e:
+        logger.debug("Couldn't save completion cache: {}".format(e))
+
+
+def invalidate_cache():
+    """Remove current completion cache"""
+    with suppress(FileNotFoundError):
+        os.remove(get_cache_path())
+
+
+def load_tree():
+    """Return the cached parser tree if up to date, None otherwise"""
+    try:
+        with open(get_cache_path()) as f:
+            content = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if content.get("stamp") != get_stamp():
+        logger.debug("Completion cache is outdated")
+        return None
+    return content.get("tree")
+
+
+def _complete_path(prefix):
+    """Return directories and files matching prefix, directories having a trailing /"""
+    dirname, basename = os.path.split(prefix)
+    candidates = []
+    with suppress(OSError):
+        for entry in os.scandir(os.path.expanduser(dirname) or os.curdir):
+            if not entry.name.startswith(basename):
+                continue
+            if basename == "" and entry.name.startswith("."):
+                continue
+            candidate = os.path.join(dirname, entry.name)
+            if entry.is_dir():
+                candidate += os.sep
+            candidates.append(candidate)
+    return sorted(candidates)
+
+
+def get_completions(tree, words, prefix):
+    """Return completion candidates for prefix, words being the already typed ones (without program name)"""
+    node = tree
+    skip_next = False
+    for word in words:
+        if skip_next:
+            skip_next = False
+            continue
+        if word in node["options_with_value"]:
+            skip_next = True
+        elif word in node["subcommands"]:
+            node = node["subcommands"][word]
+    if prefix.startswith("-"):
+        return [option for option in node["options"] if option.startswith(prefix)]
+    if node["subcommands"]:
+        return sorted(name for name in node["subcommands"] if name.startswith(prefix))
+    if node["positional"]:
+        return _complete_path(prefix)
+    return []
+
+
+def complete_from_cache():
+    """Answer shell completion request from the cache, following argcomplete protocol
+
+    Return True if the completion was answered, False if the caller has to fallback to the slow path."""
+    if os.environ.get('_ARGCOMPLETE') != '1':
+        return False
+    tree = load_tree()
+    if tree is None:
+        return False
+    comp_line = os.environ.get("COMP_LINE", "")
+    comp_point = int(os.environ.get("COMP_POINT", len(comp_line)))
+    comp_line = comp_line[:comp_point]
+    try:
+        words = shlex.split(comp_line)
+    except ValueError:
+        # unbalanced quotes, let argcomplete deal with it
+        return False
+    prefix = ""
+    if words and not comp_line[-1:].isspace():
+        prefix = words.pop()
+        if comp_line.split()[-1] != prefix:
+            # quoted or escaped word
+            return False
+    completions = get_completions(tree, words[1:], prefix)
+    if any(char in _SPECIAL_CHARS for completion in completions for char in completion):
+        return False
+    # like argcomplete, let the shell move to the next word on a single match
+    if len(completions) == 1 and completions[0][-1] not in _CONTINUATION_CHARS and \
+            os.environ.get("_ARGCOMPLETE_SUPPRESS_SPACE") != "1":
+        completions[0] += " "
+    ifs = os.environ.get("_ARGCOMPLETE_IFS", "\013")
+    output_filename = os.environ.get("_ARGCOMPLETE_STDOUT_FILENAME")
+    try:
+        output_stream = open(output_filename, "w") if output_filename else os.fdopen(8, "w")
+    except OSError:
+        return False
+    with output_stream:
+        output_stream.write(ifs.join(completions))
+    return True
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Optional user daemon running umake commands from a warm state
+
+Each command is run in a forked child of the daemon, inheriting the already loaded frameworks, configuration and apt
+cache. The client passes its standard file descriptors over the unix socket, so that the child directly talks to the
+user terminal, and only waits for the exit code.
+"""
+
+from contextlib import suppress
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import time
+from umake import settings
+
+logger = logging.getLogger(__name__)
+
+# exit code sent back by the daemon when the client has to run the command by itself
+RUN_LOCALLY = 256
+
+# the daemon stops after that many seconds without any request, when started by socket activation
+IDLE_TIMEOUT = 10 * 60
+
+# how long, in seconds, to wait for a client to send its request once connected
+REQUEST_TIMEOUT = 5
+
+# environment variables the warm state depends on: the command is run locally if they differ
+WARM_ENV_VARIABLES = ["HOME", "XDG_CONFIG_HOME", "XDG_DATA_HOME", "XDG_CACHE_HOME", "LANG", "LANGUAGE", "LC_ALL",
+                      settings.UMAKE_FRAMEWORKS_ENVIRON_VARIABLE]
+
+# first file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+_HEADER = struct.Struct("!I")
+_EXIT_CODE = struct.Struct("!i")
+
+# connection to the client, in a child running a command
+_client = None
+
+
+def get_socket_path():
+    """Return the daemon socket path, in the user runtime directory if available"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        from xdg.BaseDirectory import xdg_cache_home
+        runtime_dir = xdg_cache_home
+    return os.path.join(runtime_dir, settings.CONFIG_FILENAME, settings.DAEMON_SOCKET_FILENAME)
+
+
+def forward_to_daemon(argv):
+    """Ask a running daemon to run the command, passing our standard file descriptors
+
+    Return the command exit code, or None if the command needs to be run locally."""
+    # shell completion talks to extra file descriptors we don't pass, and the user daemon can't run root commands
+    if os.environ.get(settings.UMAKE_NO_DAEMON_ENVIRON_VARIABLE) or os.environ.get("_ARGCOMPLETE") == "1" or \
+            os.geteuid() == 0:
+        return None
+    path = get_socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+            payload = json.dumps({"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}).encode("utf-8")
+            socket.send_fds(sock, [_HEADER.pack(len(payload))], [0, 1, 2])
+            sock.sendall(payload)
+        except OSError as e:
+            logger.debug("Couldn't reach the umake daemon at {}: {}".format(path, e))
+            return None
+        while True:
+            try:
+                data = _recv_exactly(sock, _EXIT_CODE.size)
+                break
+            except KeyboardInterrupt:
+                # the terminal only interrupts us: forward it to the command
+                with suppress(OSError):
+                    sock.sendall(b"i")
+            except OSError:
+                data = b""
+                break
+        if not data:
+            logger.debug("The umake daemon closed the connection without returning an exit code")
+            return None
+        exit_code = _EXIT_CODE.unpack(data)[0]
+        if exit_code == RUN_LOCALLY:
+            logger.debug("The umake daemon asked us to run the command locally")
+            return None
+        return exit_code
+    finally:
+        sock.close()
+
+
+def _recv_exactly(sock, size):
+    """Receive size bytes, or less if the connection is closed"""
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _send_exit_code(conn, exit_code):
+    # the client may have already gone away
+    with suppress(OSError):
+        conn.sendall(_EXIT_CODE.pack(exit_code))
+
+
+def is_running_command():
+    """Return True if we are running a command in the daemon, without a terminal of our own"""
+    return _client is not None
+
+
+def hand_back_to_client():
+    """Ask the client to run the command by itself if we are running it in the daemon
+
+    This is needed when we can't ask for credentials, which requires the client controlling terminal."""
+    if _client is None:
+        return
+    logger.debug("Hand the command back to the client")
+    _send_exit_code(_client, RUN_LOCALLY)
+    _client.close()
+    os._exit(0)
+
+
+def _get_listening_socket():
+    """Return the socket passed by systemd, or bind our own, and if we were socket activated"""
+    with suppress(KeyError, ValueError):
+        if int(os.environ["LISTEN_PID"]) == os.getpid() and int(os.environ["LISTEN_FDS"]) >= 1:
+            for var in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+                os.environ.pop(var, None)
+            return (socket.socket(fileno=SD_LISTEN_FDS_START), True)
+
+    path = get_socket_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    with suppress(FileNotFoundError):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o600)
+    sock.listen()
+    return (sock, False)
+
+
+def _get_stamp_paths():
+    """Paths the warm state is built from"""
+    from umake.tools import get_user_frameworks_path
+    from xdg.BaseDirectory import xdg_config_home
+    return ["/var/lib/dpkg/status", os.path.join(xdg_config_home, settings.CONFIG_FILENAME),
+            get_user_frameworks_path()]
+
+
+def _get_stamp():
+    stamp = []
+    for path in _get_stamp_paths():
+        try:
+            stamp.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+
+def warm_up(force_loading=False):
+    """(Re)load the configuration, package cache and frameworks the commands are run from"""
+    from umake.frameworks import BaseCategory, load_frameworks
+    from umake.network.requirements_handler import RequirementsHandler
+    from umake.tools import ConfigHandler, NoneDict, Singleton
+
+    Singleton._instances.pop(ConfigHandler, None)
+    BaseCategory.categories = NoneDict()
+    if RequirementsHandler in Singleton._instances:
+        handler = RequirementsHandler()
+        handler.cache.open()
+        handler._java_versions = {}
+    else:
+        # open the apt cache now, rather than in each command
+        RequirementsHandler().cache
+    load_frameworks(force_loading=force_loading)
+
+
+class Daemon(object):
+    """Accept commands on a unix socket and run each of them in a forked child"""
+
+    def __init__(self, sock, idle_timeout=None, run_command=None):
+        self.sock = sock
+        self.idle_timeout = idle_timeout
+        self.run_command = run_command if run_command is not None else _run_umake_command
+        self._children = {}
+        self._warm_env = {var: os.environ.get(var) for var in WARM_ENV_VARIABLES}
+        self._stamp = None
+        self._selector = None
+        self._wakeup_fds = None
+
+    def warm_up(self):
+        self._stamp = _get_stamp()
+        warm_up()
+
+    def serve_forever(self):
+        """Serve commands until being idle for idle_timeout seconds"""
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_fds = os.pipe()
+        for fd in self._wakeup_fds:
+            os.set_blocking(fd, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        old_wakeup_fd = signal.set_wakeup_fd(self._wakeup_fds[1])
+        self._selector.register(self.sock, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_fds[0], selectors.EVENT_READ)
+        try:
+            last_activity = time.monotonic()
+            while True:
+                timeout = None
+                if self.idle_timeout is not None and not self._children:
+                    timeout = max(0, last_activity + self.idle_timeout - time.monotonic())
+                events = self._selector.select(timeout)
+                if not events and not self._children and timeout is not None:
+                    logger.info("No request for {} seconds, stop the daemon".format(self.idle_timeout))
+                    return
+                for key, mask in events:
+                    if key.fileobj is self.sock:
+                        self._accept()
+                    elif key.fileobj == self._wakeup_fds[0]:
+                        with suppress(BlockingIOError):
+                            os.read(self._wakeup_fds[0], 512)
+                    else:
+                        self._client_event(key.fileobj, key.data)
+                if self._reap():
+                    self._refresh_if_needed()
+                last_activity = time.monotonic()
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            self._selector.close()
+            for fd in self._wakeup_fds:
+                os.close(fd)
+
+    def _accept(self):
+        conn, _ = self.sock.accept()
+        conn.settimeout(REQUEST_TIMEOUT)
+        fds = []
+        try:
+            msg, fds, _, _ = socket.recv_fds(conn, _HEADER.size, 3)
+            if len(msg) != _HEADER.size or len(fds) != 3:
+                raise ValueError("unexpected request header")
+            payload = _recv_exactly(conn, _HEADER.unpack(msg)[0])
+            request = json.loads(payload.decode("utf-8"))
+            argv, cwd, env = request["argv"], request["cwd"], request["env"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring invalid request: {}".format(e))
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+
+        if any(env.get(var) != value for var, value in self._warm_env.items()):
+            logger.info("Client environment differs from the daemon one, let it run the command")
+            _send_exit_code(conn, RUN_LOCALLY)
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+
+        logger.debug("Run {}".format(argv))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            logger.error("Couldn't fork to run {}: {}".format(argv, e))
+            _send_exit_code(conn, RUN_LOCALLY)
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+        if pid == 0:
+            self._run_child(conn, fds, argv, cwd, env)
+        for fd in fds:
+            os.close(fd)
+        conn.setblocking(False)
+        self._children[pid] = conn
+        self._selector.register(conn, selectors.EVENT_READ, pid)
+
+    def _run_child(self, conn, fds, argv, cwd, env):
+        """Run the command in the forked child, never returning"""
+        global _client
+        exit_code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in (signal.SIGCHLD, signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            self._selector.close()
+            self.sock.close()
+            for fd in self._wakeup_fds:
+                os.close(fd)
+            for other_conn in self._children.values():
+                other_conn.close()
+            for target_fd, fd in enumerate(fds):
+                os.dup2(fd, target_fd)
+                os.close(fd)
+            conn.setblocking(True)
+            _client = conn
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+            sys.argv = argv
+            exit_code = self.run_command(argv)
+        except SystemExit as e:
+            if e.code is None:
+                exit_code = 0
+            elif isinstance(e.code, int):
+                exit_code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException:
+            logger.exception("Command {} failed".format(argv))
+        finally:
+            import atexit
+            with suppress(BaseException):
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            os._exit(exit_code if isinstance(exit_code, int) else 0)
+
+    def _client_event(self, conn, pid):
+        try:
+            data = conn.recv(64)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if data:
+            logger.debug("Forward interruption to {}".format(pid))
+            with suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGINT)
+            return
+        logger.debug("Client of {} went away, terminate it".format(pid))
+        self._selector.unregister(conn)
+        with suppress(ProcessLookupError):
+            os.kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        """Send back the exit code of finished children, returning if any finished"""
+        reaped = False
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            conn = self._children.pop(pid, None)
+            if conn is None:
+                continue
+            reaped = True
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code < 0:
+                exit_code = 128 - exit_code
+            logger.debug("Command {} exited with {}".format(pid, exit_code))
+            with suppress(KeyError, ValueError):
+                self._selector.unregister(conn)
+            conn.setblocking(True)
+            _send_exit_code(conn, exit_code)
+            conn.close()
+        return reaped
+
+    def _refresh_if_needed(self):
+        """Reload the warm state if a command changed what it is built from"""
+        stamp = _get_stamp()
+        if stamp == self._stamp:
+            return
+        logger.info("Installed packages, configuration or user frameworks changed, reload them")
+        self._stamp = stamp
+        warm_up()
+
+
+def _run_umake_command(argv):
+    """Run umake with argv, as the command line entry point does"""
+    import umake
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    parser = umake.get_parser()
+    umake.set_logging_from_args(argv, parser)
+    if umake.should_load_all_frameworks(argv):
+        warm_up(force_loading=True)
+    umake.run(parser, frameworks_loaded=True)
+    return 0
+
+
+def run_daemon():
+    """Entry point of umake --daemon"""
+    sock, socket_activated = _get_listening_socket()
+    daemon = Daemon(sock, idle_timeout=IDLE_TIMEOUT if socket_activated else None)
+    logger.info("Load frameworks")
+    daemon.warm_up()
+    logger.info("Waiting for commands on {}".format(sock.getsockname()))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not socket_activated:
+            with suppress(OSError):
+                os.remove(sock.getsockname())
+        sock.close()
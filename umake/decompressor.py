@@ -28,7 +28,7 @@ import subprocess
 import tarfile
 import tempfile
 import zipfile
-
+from umake import tracing
 
 logger = logging.getLogger(__name__)
 
@@ -51,9 +51,12 @@ class Decompressor:
             os.chmod(targetpath, mode)
             return targetpath
 
-    def __init__(self, orders, on_done):
+    def __init__(self, orders, on_done, report=lambda x: None):
         """Decompress all fds in threads and send on_done callback once finished
 
+        report, if not None, will be called while archives are extracted, reporting a dict of
+        archive names with the number of files extracted so far ({"files": count}).
+
 
         order is:
         {
@@ -72,8 +75,10 @@ class Decompressor:
         self._orders = orders
         self._decompressed = {}
         self._done_callback = on_done
+        self._report = report
+        self._extract_progress = {}
 
-        executor = futures.ThreadPoolExecutor(max_workers=3)
+        executor = futures.ThreadPoolExecutor(max_workers=3, thread_name_prefix="Decompressor")
         for fd in orders:
             logger.info("Requesting decompression to {}".format(orders[fd].dest))
             future = executor.submit(self._decompress, fd, orders[fd].dir, orders[fd].dest)
@@ -81,6 +86,7 @@ class Decompressor:
             future.tag_dest = orders[fd].dest
             future.add_done_callback(self._one_done)
 
+    @tracing.traced("decompress")
     def _decompress(self, fd, dir, dest):
         """decompress one entry
 
@@ -105,7 +111,7 @@ class Decompressor:
             # exec tar xf and hope for the best (tar binary seems to be more acceptive of slightly misformed
             # archives)
             try:
-                archive.extractall(tempdest)
+                archive.extractall(tempdest, members=self._reporting_members(fd.name, archive))
             except tarfile.ReadError:
                 logger.debug("Trigger fallback direct tar execution")
                 shutil.rmtree(tempdest)
@@ -137,6 +143,14 @@ class Decompressor:
             shutil.move(os.path.join(dir_path, filename), os.path.join(dest, filename))
         shutil.rmtree(tempdest)
 
+    def _reporting_members(self, name, archive):
+        """Yield all archive members, reporting how many were extracted"""
+        members = archive if isinstance(archive, tarfile.TarFile) else archive.infolist()
+        for count, member in enumerate(members, 1):
+            yield member
+            self._extract_progress[name] = {"files": count}
+            self._report(self._extract_progress)
+
     def _one_done(self, future):
         """Callback that will be called once one decompress finishes.
 
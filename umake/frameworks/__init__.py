@@ -31,10 +31,13 @@ import pkgutil
 import sys
 import subprocess
 import re
+from umake.daemon import hand_back_to_client
+from umake.network.privileged_helper import PrivilegedHelper
 from umake.network.requirements_handler import RequirementsHandler
 from umake.settings import DEFAULT_INSTALL_TOOLS_PATH, UMAKE_FRAMEWORKS_ENVIRON_VARIABLE, DEFAULT_BINARY_LINK_PATH
 from umake.tools import ConfigHandler, NoneDict, classproperty, get_current_arch, get_current_distro_version,\
-    is_completion_mode, switch_to_current_user, MainLoop, get_user_frameworks_path, get_current_distro_id
+    is_completion_mode, switch_to_current_user, MainLoop, get_user_frameworks_path, get_current_distro_id,\
+    get_root_command
 from umake.ui import UI
 
 
@@ -122,6 +125,12 @@ class BaseCategory():
         """Return if a category has one framework"""
         return len(self.frameworks) == 1
 
+    def process_download_link(self, url, checksum):
+        """Post process the url and checksum found by the page scanner of any framework of this category
+
+        Return a tuple of (url, checksum)"""
+        return (url, checksum)
+
     def run_for(self, args):
         """Running commands from args namespace"""
         # try to call default framework if any
@@ -176,9 +185,12 @@ class BaseFramework(metaclass=abc.ABCMeta):
             return
 
         self.need_root_access = need_root_access
+        # root access only to install package requirements is handled by the privileged helper
+        self.need_root_for_requirements_only = False
         if not need_root_access:
             with suppress(KeyError):
                 self.need_root_access = not RequirementsHandler().is_bucket_installed(self.packages_requirements)
+                self.need_root_for_requirements_only = self.need_root_access
 
         if self.is_category_default:
             if self.category == BaseCategory.main_category:
@@ -253,25 +265,10 @@ class BaseFramework(metaclass=abc.ABCMeta):
             UI.return_main_screen(status_code=2)
 
         if not self.dry_run and self.need_root_access and os.geteuid() != 0:
-            logger.debug("Requesting root access")
-            env_variables = ["HOME", "PATH", "LD_LIBRARY_PATH", "PYTHONUSERBASE", "PYTHONHOME", "PYTHONPATH"]
-            cmd = ["sudo"]
-            # sudo-rs returns the version in stderr
-            is_sudo_rs = "sudo-rs" in subprocess.run(["sudo", "--version"], capture_output=True).stderr.decode()
-            # -E is not supported by sudo-rs, so we need to use --preserve-env for each variable needed
-            if not is_sudo_rs:
-                cmd = ["sudo", "-E", "env"]
-            for var in env_variables:
-                if os.getenv(var):
-                    if is_sudo_rs:
-                        cmd.append("--preserve-env={}".format(var))
-                    else:
-                        cmd.append("{}={}".format(var, os.getenv(var)))
-            if os.getenv("SNAP"):
-                logger.debug("Found snap environment. Running correct python version")
-                cmd.extend(["{}/usr/bin/python3.12".format(os.getenv("SNAP"))])
-            cmd.extend(sys.argv)
-            MainLoop().quit(subprocess.call(cmd))
+            if self.need_root_for_requirements_only:
+                start_privileged_helper()
+            else:
+                MainLoop().quit(run_as_root())
 
         # be a normal, kind user as we don't want normal files to be written as root
         switch_to_current_user()
@@ -357,6 +354,30 @@ class BaseFramework(metaclass=abc.ABCMeta):
         return None
 
 
+def run_as_root():
+    """Run the current command again as root, keeping the user environment. Return its exit code"""
+    # asking for credentials needs the user terminal, that a command run by the daemon doesn't control
+    hand_back_to_client()
+    logger.debug("Requesting root access")
+    cmd = get_root_command()
+    if os.getenv("SNAP"):
+        logger.debug("Found snap environment. Running correct python version")
+        cmd.extend(["{}/usr/bin/python3.12".format(os.getenv("SNAP"))])
+    cmd.extend(sys.argv)
+    return subprocess.call(cmd)
+
+
+def start_privileged_helper():
+    """Start the helper installing package requirements as root, exiting if we can't get root access"""
+    # same than run_as_root(), credentials may be asked on the user terminal
+    hand_back_to_client()
+    try:
+        PrivilegedHelper().start()
+    except BaseException as e:
+        logger.error(str(e))
+        UI.return_main_screen(status_code=1)
+
+
 class MainCategory(BaseCategory):
 
     def __init__(self):
@@ -20,19 +20,30 @@
 
 """Android module"""
 import json
-from contextlib import suppress
 from gettext import gettext as _
 import logging
 import os
 import re
 import umake.frameworks.baseinstaller
 from umake.interactions import DisplayMessage
+from umake.page_scanner import PageScanner
 from umake.ui import UI
 from umake.tools import add_env_to_user, create_launcher, get_application_desktop_file, ChecksumType
 
 logger = logging.getLogger(__name__)
 
 _supported_archs = ['i386', 'amd64']
+# ensure the size can match a md5 or sha1 checksum
+_checksum_regex = re.compile(r'<td>(\w{16,})</td>')
+_studio_url_regex = re.compile(r'href=\"(.*android-studio-.*-linux.tar.gz)\"')
+_sdk_url_regex = re.compile(r'href=\"(https://dl.google.com.*-linux.*.zip)\"')
+_ndk_url_regex = re.compile(r'href=\"(https://dl.google.com.*-linux.zip)\"')
+
+
+def _get_page_scanner(download_tag, url_regex, license_tag):
+    """Return a page scanner for the download section starting with download_tag, expecting a checksum"""
+    return PageScanner(url=url_regex, checksum=_checksum_regex, section_start=download_tag, section_end="</tr>",
+                       license_start=license_tag, license_end='<input id="agree_')
 
 
 class AndroidCategory(umake.frameworks.BaseCategory):
@@ -40,39 +51,11 @@ class AndroidCategory(umake.frameworks.BaseCategory):
     def __init__(self):
         super().__init__(name="Android", description=_("Android Development Environment"), logo_path=None)
 
-    def parse_license(self, tag, line, license_txt, in_license):
-        """Parse Android download page for license"""
-        if tag in line:
-            in_license = True
-        if in_license:
-            if '<input id="agree_' in line:
-                in_license = False
-            else:
-                license_txt.write(line)
-        return in_license
-
-    def parse_download_link(self, tag, line, in_download, regex):
-        """Parse Android download links, expect to find a sha1sum and a url"""
-        url, sha1sum = (None, None)
-        if tag in line:
-            in_download = True
-        if in_download:
-            p = re.search(regex, line)
-            with suppress(AttributeError):
-                url = p.group(1)
-            p = re.search(r'<td>(\w+)</td>', line)
-            with suppress(AttributeError):
-                # ensure the size can match a md5 or sha1 checksum
-                if len(p.group(1)) > 15:
-                    sha1sum = p.group(1)
-            if "</tr>" in line:
-                in_download = False
-
-        if url is None and sha1sum is None:
-            return (None, in_download)
-        if url and url.startswith("//"):
+    def process_download_link(self, url, checksum):
+        """Make protocol-relative urls absolute"""
+        if url.startswith("//"):
             url = "https:" + url
-        return ((url, sha1sum), in_download)
+        return (url, checksum)
 
 
 class AndroidStudio(umake.frameworks.baseinstaller.BaseInstaller):
@@ -89,17 +72,10 @@ class AndroidStudio(umake.frameworks.baseinstaller.BaseInstaller):
                          required_files_path=[os.path.join("bin", "studio.sh")],
                          version_regex=r'(\d+\.\d+)',
                          supports_update=True,
+                         page_scanner=_get_page_scanner('studio_linux_bundle_download', _studio_url_regex,
+                                                        '<div id="studio_linux_bundle_download"'),
                          **kwargs)
 
-    def parse_license(self, line, license_txt, in_license):
-        """Parse Android Studio download page for license"""
-        return self.category.parse_license('<div id="studio_linux_bundle_download"', line, license_txt, in_license)
-
-    def parse_download_link(self, line, in_download):
-        """Parse Android Studio download link, expect to find a sha1sum and a url"""
-        return self.category.parse_download_link('studio_linux_bundle_download', line, in_download,
-                                                 r'href=\"(.*android-studio-.*-linux.tar.gz)\"')
-
     def post_install(self):
         """Create the Android Studio launcher"""
         add_env_to_user(self.name, {"ANDROID_HOME": {"value": self.install_path, "keep": False}})
@@ -135,16 +111,10 @@ class AndroidSDK(umake.frameworks.baseinstaller.BaseInstaller):
                          dir_to_decompress_in_tarball=".",
                          required_files_path=[os.path.join("tools", "android"),
                                               os.path.join("tools", "bin", "sdkmanager")],
-                         override_install_path="cmdline-tools", **kwargs)
-
-    def parse_license(self, line, license_txt, in_license):
-        """Parse Android SDK download page for license"""
-        return self.category.parse_license('<div id="sdk_linux_download"', line, license_txt, in_license)
-
-    def parse_download_link(self, line, in_download):
-        """Parse Android SDK download link, expect to find a SHA-1 and a url"""
-        return self.category.parse_download_link('sdk_linux_download', line, in_download,
-                                                 r'href=\"(https://dl.google.com.*-linux.*.zip)\"')
+                         override_install_path="cmdline-tools",
+                         page_scanner=_get_page_scanner('sdk_linux_download', _sdk_url_regex,
+                                                        '<div id="sdk_linux_download"'),
+                         **kwargs)
 
     def post_install(self):
         """Add necessary environment variables"""
@@ -171,18 +141,10 @@ class AndroidPlatformTools(umake.frameworks.baseinstaller.BaseInstaller):
                          download_page="https://developer.android.com/studio/releases/platform-tools/index.html",
                          dir_to_decompress_in_tarball=".",
                          required_files_path=[os.path.join("platform-tools", "adb")],
+                         page_scanner=_get_page_scanner('dac-download-linux', _sdk_url_regex,
+                                                        '<div class="dialog-content-stretch sdk-terms">'),
                          **kwargs)
 
-    def parse_license(self, line, license_txt, in_license):
-        """Parse Android SDK download page for license"""
-        return self.category.parse_license('<div class="dialog-content-stretch sdk-terms">',
-                                           line, license_txt, in_license)
-
-    def parse_download_link(self, line, in_download):
-        """Parse Android SDK download link, expect to find a SHA-1 and a url"""
-        return self.category.parse_download_link('dac-download-linux', line, in_download,
-                                                 r'href=\"(https://dl.google.com.*-linux.*.zip)\"')
-
     def post_install(self):
         """Add necessary environment variables"""
         add_env_to_user(self.name, {"PATH": {"value": [os.path.join(self.install_path, "platform-tools")]}})
@@ -197,16 +159,10 @@ class AndroidNDK(umake.frameworks.baseinstaller.BaseInstaller):
                          download_page="https://developer.android.com/ndk/downloads",
                          packages_requirements=['clang'],
                          dir_to_decompress_in_tarball="android-ndk-*",
-                         required_files_path=[os.path.join("ndk-build")], **kwargs)
-
-    def parse_license(self, line, license_txt, in_license):
-        """Parse Android NDK download page for license"""
-        return self.category.parse_license('<div id=\"ndk_lts_linux64_download\"', line, license_txt, in_license)
-
-    def parse_download_link(self, line, in_download):
-        """Parse Android NDK download link, expect to find a sha1sum and a url"""
-        return self.category.parse_download_link('agree_ndk_lts_linux64_download', line, in_download,
-                                                 r'href=\"(https://dl.google.com.*-linux.zip)\"')
+                         required_files_path=[os.path.join("ndk-build")],
+                         page_scanner=_get_page_scanner('agree_ndk_lts_linux64_download', _ndk_url_regex,
+                                                        '<div id="ndk_lts_linux64_download"'),
+                         **kwargs)
 
     def post_install(self):
         """Add necessary environment variables"""
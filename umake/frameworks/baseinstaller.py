@@ -20,24 +20,31 @@
 
 """Downloader abstract module"""
 
+import codecs
 from contextlib import suppress
 from gettext import gettext as _
 from io import StringIO
-import gnupg
 import json
 import logging
-from progressbar import ProgressBar
 import os
 import shutil
+from urllib.parse import urlsplit
+from xdg.BaseDirectory import xdg_cache_home
 import umake.frameworks
+from umake import tracing
 from umake.decompressor import Decompressor
 from umake.interactions import InputText, YesNo, LicenseAgreement, DisplayMessage, UnknownProgress
-from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.bundle import get_current_bundle
+from umake.network.delta import is_delta_updates_enabled, remove_stale_seeds
+from umake.network.download_center import DownloadCenter, DownloadItem, SpeculativeDownload, is_prefetch_enabled
+from umake.network.gpg import Signature
 from umake.network.requirements_handler import RequirementsHandler
+from umake.page_scanner import decode_lines
 from umake.ui import UI
-from umake.settings import DEFAULT_INSTALL_TOOLS_PATH
+from umake.settings import CONFIG_FILENAME, DEFAULT_INSTALL_TOOLS_PATH, DELTA_SEEDS_DIRNAME
 from umake.tools import MainLoop, strip_tags, launcher_exists, get_icon_path, get_launcher_path, \
-    Checksum, remove_framework_envs_from_user, add_exec_link, validate_url
+    Checksum, remove_framework_envs_from_user, add_exec_link, validate_url, iter_json_array, defer_user_env_writes, \
+    flush_user_env
 
 logger = logging.getLogger(__name__)
 
@@ -71,18 +78,29 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.match_last_link = kwargs.get("match_last_link", False)
         self.json = kwargs.get("json", False)
         self.override_install_path = kwargs.get("override_install_path", None)
+        self.page_scanner = kwargs.get("page_scanner", None)
+        self.delta_updates = kwargs.get("delta_updates", False)
         for extra_arg in ["download_page", "checksum_type", "dir_to_decompress_in_tarball",
                           "desktop_filename", "icon_filename", "required_files_path",
-                          "match_last_link"]:
+                          "match_last_link", "page_scanner", "delta_updates"]:
             with suppress(KeyError):
                 kwargs.pop(extra_arg)
         super().__init__(*args, **kwargs)
 
         self._install_done = False
         self._paths_to_clean = set()
+        self._flush_user_env = False
         self._arg_install_path = None
+        self._prefetch = None
+        self._provider_page = None
         self.download_requests = []
 
+    @property
+    def delta_seeds_dir(self):
+        """Directory keeping the previous downloads, to only download their changes on update"""
+        return os.path.join(xdg_cache_home, CONFIG_FILENAME, DELTA_SEEDS_DIRNAME, self.category.prog_name,
+                            self.prog_name)
+
     @property
     def exec_link_name(self):
         if self.desktop_filename:
@@ -109,22 +127,37 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.dry_run = dry_run
         self.assume_yes = assume_yes
         super().setup()
+        # fetch the provider page while the user answers our questions. Frameworks downloading it their own way
+        # wouldn't use it
+        if self.download_page and type(self).download_provider_page is BaseInstaller.download_provider_page:
+            self._provider_page = SpeculativeDownload([self.provider_page_request], download=False)
 
         # first step, check if installed or dry_run
         if self.dry_run:
             self.download_provider_page()
-        elif self.is_installed:
+            return
+        is_installed = self.is_installed
+        # we are done with the apt cache here: check package requirements in the background as well
+        RequirementsHandler().check_bucket_uptodate(self.packages_requirements)
+        if is_installed:
             if self.assume_yes:
                 self.reinstall()
             else:
                 UI.display(YesNo("{} is already installed on your system, do you want to reinstall "
-                                 "it anyway?".format(self.name), self.reinstall, UI.return_main_screen))
+                                 "it anyway?".format(self.name), self.reinstall, self.cancel_setup))
         else:
             self.confirm_path(self.arg_install_path)
 
+    def cancel_setup(self):
+        """Return to the main screen without installing, throwing away the provider page download started at setup"""
+        self.discard_provider_page()
+        UI.return_main_screen()
+
     def reinstall(self):
         logger.debug("Mark previous installation path for cleaning.")
         self._paths_to_clean.add(self.install_path)  # remove previous installation path
+        # only write the user env file with the envs of the new installation
+        self._flush_user_env = defer_user_env_writes()
         self.confirm_path(self.arg_install_path)
         remove_framework_envs_from_user(self.name)
 
@@ -135,6 +168,7 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         packages as they might be in used for other framework"""
         # check if it's installed and so on.
         super().remove()
+        self.discard_provider_page()
 
         UI.display(DisplayMessage("Removing {}".format(self.name)))
         if self.desktop_filename:
@@ -154,6 +188,8 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                     path = os.path.dirname(path)
                 else:
                     break
+        with suppress(FileNotFoundError):
+            shutil.rmtree(self.delta_seeds_dir)
         remove_framework_envs_from_user(self.name)
         self.remove_from_config()
 
@@ -187,7 +223,7 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                         return
                     self.install_path = path_dir  # we don't set it before to not repropose / as installation path
                     UI.display(YesNo("{} isn't an empty directory, do you want to remove its content and install "
-                                     "there?".format(path_dir), self.set_installdir_to_clean, UI.return_main_screen))
+                                     "there?".format(path_dir), self.set_installdir_to_clean, self.cancel_setup))
                     return
         self.install_path = path_dir
         if self.override_install_path is not None:
@@ -202,9 +238,32 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.set_exec_path()
         self.download_provider_page()
 
+    @property
+    def provider_page_request(self):
+        """DownloadItem to fetch the provider page"""
+        return DownloadItem(self.download_page)
+
     def download_provider_page(self):
         logger.debug("Download application provider page")
-        DownloadCenter([DownloadItem(self.download_page)], self.get_metadata_and_check_license, download=False)
+        self.fetch_provider_page(self.get_metadata_and_check_license)
+
+    def fetch_provider_page(self, on_done):
+        """Download the provider page and call on_done with the DownloadCenter result
+
+        The download started at setup is used if it's for the same request"""
+        provider_page, self._provider_page = self._provider_page, None
+        if provider_page is not None:
+            if provider_page.urls == [self.provider_page_request]:
+                provider_page.attach(on_done)
+                return
+            provider_page.discard()
+        DownloadCenter([self.provider_page_request], on_done, download=False)
+
+    def discard_provider_page(self):
+        """Cancel the provider page download started at setup, if it wasn't used"""
+        provider_page, self._provider_page = self._provider_page, None
+        if provider_page is not None:
+            provider_page.discard()
 
     def parse_license(self, line, license_txt, in_license):
         """Parse license per line, eventually write to license_txt if it's in the license part.
@@ -220,6 +279,12 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                           ((url, md5sum), in_download=True/False)"""
         pass
 
+    def process_download_link(self, url, checksum):
+        """Post process the url and checksum found by the page scanner. Return a tuple of (url, checksum)
+
+        Defaults to the category one, shared by all its frameworks."""
+        return self.category.process_download_link(url, checksum)
+
     def store_package_url(self, result):
         logger.debug("Parse download metadata")
         self.auto_accept_license = True
@@ -235,6 +300,7 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             url, checksum = self.get_metadata(result, license_txt)
             self.package_url = url
 
+    @tracing.traced("install")
     def get_metadata(self, result, license_txt):
 
         url, checksum = (None, None)
@@ -242,14 +308,17 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         if self.json is True:
             logger.debug("Using json parser")
             try:
-                latest = json.loads(page.buffer.read().decode())
                 # On a download from github, if the page is not .../releases/latest
                 # we want to download the latest version (beta/development)
-                # So we get the first element in the json tree.
+                # So we get the first element in the json tree, without parsing the other releases.
                 # In the framework we only change the url and this condition is satisfied.
                 if self.download_page.startswith("https://api.github.com") and \
                         not self.download_page.endswith("/latest"):
-                    latest = latest[0]
+                    latest = next(iter_json_array(page.buffer), None)
+                    if latest is None:
+                        raise IndexError
+                else:
+                    latest = json.load(codecs.getreader("utf-8")(page.buffer))
                 url = None
                 in_download = False
                 (url, in_download) = self.parse_download_link(latest, in_download)
@@ -264,6 +333,18 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                 UI.return_main_screen(status_code=1)
             logger.debug("Found download URL: " + url)
 
+        elif self.page_scanner is not None:
+            logger.debug("Using page scanner")
+            url, checksum = self.page_scanner.scan_lines(
+                decode_lines(page.buffer), match_last=self.match_last_link,
+                license_txt=license_txt if self.expect_license and not self.auto_accept_license else None)
+            if url is not None:
+                url, checksum = self.process_download_link(url, checksum)
+                if self.checksum_type and checksum:
+                    logger.debug("Found download link for {}, checksum: {}".format(url, checksum))
+                elif not self.checksum_type:
+                    logger.debug("Found download link for {}".format(url))
+
         else:
             in_license = False
             in_download = False
@@ -321,7 +402,22 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             logger.error("Download page changed its syntax or is not parsable (checksum missing)")
             logger.error("URL is: {}".format(url))
             UI.return_main_screen(status_code=1)
-        self.download_requests.append(DownloadItem(url, Checksum(self.checksum_type, checksum)))
+        self.download_requests.append(DownloadItem(url, Checksum(self.checksum_type, checksum),
+                                                   seeds=self.get_delta_seeds()))
+
+        bundle = get_current_bundle()
+        framework_path = "{}/{}".format(self.category.prog_name, self.prog_name)
+        if bundle is not None and bundle.capture and not self.dry_run:
+            bundle.add_framework(framework_path, url, Checksum(self.checksum_type, checksum), license_txt.getvalue())
+        if bundle is not None and bundle.replay:
+            recorded = bundle.get_framework(framework_path)
+            if recorded is None:
+                logger.error("{} isn't part of the bundle {}".format(framework_path, bundle.path))
+                UI.return_main_screen(status_code=1)
+            if recorded["url"] != url:
+                logger.error("The bundle {} recorded {} for {}, not {}".format(bundle.path, recorded["url"],
+                                                                               framework_path, url))
+                UI.return_main_screen(status_code=1)
 
         if self.dry_run:
             if validate_url(url):
@@ -332,9 +428,11 @@ class BaseInstaller(umake.frameworks.BaseFramework):
 
         if license_txt.getvalue() != "":
             logger.debug("Check license agreement.")
+            if is_prefetch_enabled():
+                self._prefetch = SpeculativeDownload(self.download_requests)
             UI.display(LicenseAgreement(strip_tags(license_txt.getvalue()).strip(),
                                         self.start_download_and_install,
-                                        UI.return_main_screen))
+                                        self.decline_license))
         elif self.expect_license and not self.auto_accept_license:
             logger.error("We were expecting to find a license on the download page, we didn't.")
             UI.return_main_screen(status_code=1)
@@ -350,11 +448,24 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.result_download = None
         self._download_done_callback_called = False
         UI.display(DisplayMessage("Downloading and installing requirements"))
-        self.pbar = ProgressBar().start()
+        self._download_span = tracing.span("download_and_requirements", "install")
+        self.pbar = UI.new_progress_bar()
         self.pkg_to_install = RequirementsHandler().install_bucket(self.packages_requirements,
                                                                    self.get_progress_requirement,
                                                                    self.requirement_done)
-        DownloadCenter(urls=self.download_requests, on_done=self.download_done, report=self.get_progress_download)
+        if self._prefetch is not None:
+            # the download started while the license was displayed
+            self._prefetch.attach(on_done=self.download_done, report=self.get_progress_download)
+            self._prefetch = None
+        else:
+            DownloadCenter(urls=self.download_requests, on_done=self.download_done,
+                           report=self.get_progress_download)
+
+    def decline_license(self):
+        if self._prefetch is not None:
+            self._prefetch.discard()
+            self._prefetch = None
+        UI.return_main_screen()
 
     @MainLoop.in_mainloop_thread
     def get_progress(self, progress_download, progress_requirement):
@@ -398,9 +509,16 @@ class BaseInstaller(umake.frameworks.BaseFramework):
     def get_progress_requirement(self, status):
         """Chain up to main get_progress, returning current value between 0 and 100"""
 
+        if status["step"] == RequirementsHandler.STATUS_WAITING_LOCK:
+            UI.report("requirements", step="waiting", percentage=0, holder=status["holder"])
+            UI.display(DisplayMessage("Waiting for {} to release the package manager lock".format(status["holder"])))
+            return
+
         percentage = status["percentage"]
+        downloading = status["step"] == RequirementsHandler.STATUS_DOWNLOADING
+        UI.report("requirements", step="downloading" if downloading else "installing", percentage=percentage)
         # 60% is download, 40% is installing
-        if status["step"] == RequirementsHandler.STATUS_DOWNLOADING:
+        if downloading:
             self.pkg_size_download = status["pkg_size_download"]
             progress = 0.6 * percentage
         else:
@@ -414,6 +532,8 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         """Chain up to main get_progress, returning current value between 0 and 100
 
         First call initialize the balance between requirements and download progress"""
+        for url, download in list(downloads.items()):
+            UI.report("download", url=url, current=download["current"], size=download["size"])
         # don't push any progress until we have the total download size
         if len(downloads) != len(self.download_requests):
             return
@@ -425,6 +545,11 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.total_download_size = total_size
         self.get_progress(total_current_size / total_size * 100, None)
 
+    def get_progress_decompress(self, archives):
+        """Report the number of files extracted per archive"""
+        for archive, progress in list(archives.items()):
+            UI.report("extract", archive=archive, files=progress["files"])
+
     def requirement_done(self, result):
         # set requirement download as finished if no error
         if not result.error:
@@ -448,6 +573,7 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         if self._download_done_callback_called or (not self.result_download or not self.result_requirement):
             return
         self._download_done_callback_called = True
+        self._download_span.end()
 
         self.pbar.finish()
         # display eventual errors
@@ -471,6 +597,7 @@ class BaseInstaller(umake.frameworks.BaseFramework):
 
     def decompress_and_install(self, fds):
         UI.display(DisplayMessage("Installing {}".format(self.name)))
+        self._decompress_span = tracing.span("decompress_and_install", "install")
         # empty destination directory if reinstall
         for dir_to_remove in self._paths_to_clean:
             with suppress(FileNotFoundError):
@@ -491,40 +618,73 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             else:
                 decompress_fds[fd] = Decompressor.DecompressOrder(dir=self.dir_to_decompress_in_tarball,
                                                                   dest=self.install_path)
-        Decompressor(decompress_fds, self.decompress_and_install_done)
+        Decompressor(decompress_fds, self.decompress_and_install_done, report=self.get_progress_decompress)
         UI.display(UnknownProgress(self.iterate_until_install_done))
 
-    def _check_gpg_signature(gnupgdir, asc_content, sig):
-        """check gpg signature (temporary stock in dir)"""
-        gpg = gnupg.GPG(gnupghome=gnupgdir)
-        imported_keys = gpg.import_keys(asc_content)
-        if imported_keys.count == 0:
-            logger.error("Keys not valid")
-            UI.return_main_screen(status_code=1)
-        verify = gpg.verify(sig)
-        if verify is False:
-            logger.error("Signature not valid")
-            UI.return_main_screen(status_code=1)
+    def add_signed_download_request(self, url, signature, keyring, checksum=None):
+        """Download url, verifying its detached gpg signature content against keyring while it's downloaded
+
+        keyring is a gpg.Keyring, typically shared by every install of the framework."""
+        self.download_requests.append(DownloadItem(url, checksum, signature=Signature(keyring, signature)))
 
     def post_install(self):
         """Call the post_install process, like creating a launcher, adding env variables…"""
         pass
 
+    def get_delta_seeds(self):
+        """Return the previous downloads to only download changes from, or None if the framework has no delta updates
+
+        Artifacts are compressed archives, whose blocks aren't found in the installed tree: we rather keep the
+        previous archives, but only if their server publishes block indexes."""
+        if not self.delta_updates and not is_delta_updates_enabled():
+            return None
+        try:
+            return sorted(os.path.join(self.delta_seeds_dir, filename)
+                          for filename in os.listdir(self.delta_seeds_dir) if not filename.endswith(".new"))
+        except FileNotFoundError:
+            return []
+
+    def keep_delta_seeds(self):
+        """Keep downloads with a block index as seeds for the next update, replacing the previous ones"""
+        if not (self.delta_updates or is_delta_updates_enabled()) or not self.result_download:
+            return
+        kept = []
+        for url, result in self.result_download.items():
+            if not result.block_index or result.fd is None:
+                continue
+            path = os.path.join(self.delta_seeds_dir, os.path.basename(urlsplit(url).path) or "download")
+            try:
+                os.makedirs(self.delta_seeds_dir, exist_ok=True)
+                shutil.copyfile(result.fd.name, path + ".new")
+                os.replace(path + ".new", path)
+                kept.append(path)
+            except OSError as e:
+                logger.warning("Couldn't keep {} for next delta update: {}".format(url, e))
+        remove_stale_seeds(self.delta_seeds_dir, kept)
+
     @MainLoop.in_mainloop_thread
     def decompress_and_install_done(self, result):
+        self._decompress_span.end()
         self._install_done = True
         error_detected = False
         for fd in result:
             if result[fd].error:
                 logger.error(result[fd].error)
                 error_detected = True
+        if not error_detected:
+            self.keep_delta_seeds()
+        for fd in result:
             fd.close()
         if error_detected:
             UI.return_main_screen(status_code=1)
 
         if self.exec_link_name:
             add_exec_link(self.exec_path, self.exec_link_name)
-        self.post_install()
+        with tracing.span("post_install", "install", framework=self.name):
+            self.post_install()
+        if self._flush_user_env:
+            self._flush_user_env = False
+            flush_user_env()
         # Mark as installation done in configuration
         self.mark_in_config()
 
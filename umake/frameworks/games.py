@@ -29,11 +29,15 @@ import shutil
 import stat
 
 import umake.frameworks.baseinstaller
-from umake.network.download_center import DownloadItem, DownloadCenter
+from umake.network.download_center import DownloadItem, DownloadCenter, DownloadPriority
+from umake.page_scanner import PageScanner
 from umake.tools import as_root, create_launcher, get_application_desktop_file, get_current_arch
 
 logger = logging.getLogger(__name__)
 
+_godot_url_regex = re.compile(r'href=\"?([^\s]+\.zip)')
+_godot_bin_regex = re.compile(r'(Godot.*)\.zip')
+
 
 class GamesCategory(umake.frameworks.BaseCategory):
 
@@ -118,7 +122,7 @@ class Twine(umake.frameworks.baseinstaller.BaseInstaller):
 
     def post_install(self):
         """Create the Twine launcher"""
-        DownloadCenter(urls=[DownloadItem(self.icon_url, None)],
+        DownloadCenter(urls=[DownloadItem(self.icon_url, None, priority=DownloadPriority.metadata)],
                        on_done=self.save_icon, download=True)
         create_launcher(self.desktop_filename, get_application_desktop_file(name=_("Twine"),
                         icon_path=os.path.join(self.install_path, self.icon_name),
@@ -190,11 +194,15 @@ class GDevelop(umake.frameworks.baseinstaller.BaseInstaller):
 class Godot(umake.frameworks.baseinstaller.BaseInstaller):
 
     def __init__(self, **kwargs):
+        # the download link is on the line naming the archive for the current arch
+        archive_suffix = "{}.zip".format(self.arch_trans.get(get_current_arch()))
         super().__init__(name="Godot", description=_("The game engine you waited for"),
                          only_on_archs=['amd64'],
                          download_page="https://godotengine.org/download/linux",
                          desktop_filename="godot.desktop",
                          required_files_path=['godot'],
+                         page_scanner=PageScanner(url=_godot_url_regex, section_start=archive_suffix,
+                                                  section_end="\n"),
                          **kwargs)
         self.icon_url = "https://godotengine.org/assets/press/icon_color.svg"
         self.icon_filename = "Godot.svg"
@@ -203,20 +211,12 @@ class Godot(umake.frameworks.baseinstaller.BaseInstaller):
         "amd64": "x86_64",
     }
 
-    def parse_download_link(self, line, in_download):
-        """Parse Godot download links"""
-        url = None
-        if '{}.zip'.format(self.arch_trans[get_current_arch()]) in line:
-            in_download = True
-            p = re.search(r'href=\"?([^\s]+\.zip)', line)
-            with suppress(AttributeError):
-                url = p.group(1)
-                bin = re.search(r'(Godot.*)\.zip', url)
-                self.required_files_path[0] = bin.group(1)
-
-        if url is None:
-            return (None, in_download)
-        return ((url, None), in_download)
+    def process_download_link(self, url, checksum):
+        """Get the versioned binary name from the url"""
+        binary = _godot_bin_regex.search(url)
+        if binary:
+            self.required_files_path[0] = binary.group(1)
+        return (url, checksum)
 
     def post_install(self):
         """Create the Godot launcher"""
@@ -226,7 +226,7 @@ class Godot(umake.frameworks.baseinstaller.BaseInstaller):
         shutil.move(self.exec_path, os.path.join(self.install_path, 'godot'))
         self.exec_path = os.path.join(self.install_path, 'godot')
 
-        DownloadCenter(urls=[DownloadItem(self.icon_url, None)],
+        DownloadCenter(urls=[DownloadItem(self.icon_url, None, priority=DownloadPriority.metadata)],
                        on_done=self.save_icon, download=True)
         create_launcher(self.desktop_filename, get_application_desktop_file(name=_("Godot"),
                         icon_path=os.path.join(self.install_path, self.icon_filename),
@@ -20,18 +20,21 @@
 
 """Go module"""
 
-from contextlib import suppress
 from gettext import gettext as _
 import logging
 import os
 import re
 import umake.frameworks.baseinstaller
 from umake.interactions import DisplayMessage
+from umake.page_scanner import PageScanner
 from umake.tools import get_current_arch, add_env_to_user, ChecksumType
 from umake.ui import UI
 
 logger = logging.getLogger(__name__)
 
+_url_regex = re.compile(r'href="(.*)">')
+_checksum_regex = re.compile(r'<td><tt>(\w+)</tt></td>')
+
 
 class GoCategory(umake.frameworks.BaseCategory):
 
@@ -51,6 +54,9 @@ class GoLang(umake.frameworks.baseinstaller.BaseInstaller):
                          required_files_path=[os.path.join("bin", "go")],
                          version_regex=r'go(\d+(\.\d+)+)',
                          supports_update=True,
+                         page_scanner=PageScanner(url=_url_regex, checksum=_checksum_regex,
+                                                  section_start="linux-{}".format(self.get_framework_arch()),
+                                                  section_end="</tr>"),
                          **kwargs)
 
     arch_trans = {
@@ -65,30 +71,11 @@ class GoLang(umake.frameworks.baseinstaller.BaseInstaller):
             return self.arch_trans[arch]
         return arch
 
-    def parse_download_link(self, line, in_download):
-        """Parse Go download link, expect to find a sha and a url"""
-        url, sha = (None, None)
-        if "linux-{}".format(self.get_framework_arch()) in line:
-            in_download = True
-        if in_download:
-            p = re.search(r'href="(.*)">', line)
-            with suppress(AttributeError):
-                url = p.group(1)
-            p = re.search(r'<td><tt>(\w+)</tt></td>', line)
-            with suppress(AttributeError):
-                sha = p.group(1)
-            if "</tr>" in line:
-                in_download = False
-
-        if url is None and sha is None:
-            return (None, in_download)
-
-        # The url representaion changes often,
-        # add a custom check that the url is correct.
-        if url is not None and not url.startswith("https://"):
+    def process_download_link(self, url, checksum):
+        """The url representation changes often, add a custom check that the url is correct"""
+        if not url.startswith("https://"):
             url = "https://golang.org" + url
-
-        return ((url, sha), in_download)
+        return (url, checksum)
 
     def post_install(self):
         """Add go necessary env variables"""
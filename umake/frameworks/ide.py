@@ -32,7 +32,7 @@ import re
 import shutil
 
 import umake.frameworks.baseinstaller
-from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.download_center import DownloadCenter, DownloadItem, DownloadPriority
 from umake.tools import create_launcher, get_application_desktop_file, ChecksumType, MainLoop,\
     get_current_arch, get_current_distro_version
 
@@ -72,10 +72,9 @@ class BaseEclipse(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCMet
     def executable(self):
         pass
 
-    def download_provider_page(self):
-        logger.debug("Download application provider page")
-        DownloadCenter([DownloadItem(self.download_page, headers=self.headers)],
-                       self.get_metadata_and_check_license, download=False)
+    @property
+    def provider_page_request(self):
+        return DownloadItem(self.download_page, headers=self.headers)
 
     def parse_download_link(self, line, in_download):
         """Parse Eclipse download links"""
@@ -100,7 +99,7 @@ class BaseEclipse(umake.frameworks.baseinstaller.BaseInstaller, metaclass=ABCMet
         """Create the Eclipse launcher"""
         icon_path = os.path.join(self.install_path, "icon.xpm")
         if not os.path.exists(icon_path):
-            DownloadCenter(urls=[DownloadItem(self.icon_url, None)],
+            DownloadCenter(urls=[DownloadItem(self.icon_url, None, priority=DownloadPriority.metadata)],
                            on_done=self.save_icon, download=True)
             icon_path = os.path.join(self.install_path, self.icon_filename)
         comment = self.description
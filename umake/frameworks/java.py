@@ -26,9 +26,9 @@ import logging
 import os
 import re
 import json
-import requests
 import umake.frameworks.baseinstaller
 from umake.interactions import DisplayMessage
+from umake.network.bundle import is_url_available
 from umake.network.download_center import DownloadCenter, DownloadItem
 from umake.tools import add_env_to_user, MainLoop, ChecksumType
 from umake.ui import UI
@@ -60,10 +60,13 @@ class AdoptOpenJDK(umake.frameworks.baseinstaller.BaseInstaller):
         self.headers = {'User-agent': "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu "
                                       "Chromium/41.0.2272.76 Chrome/41.0.2272.76 Safari/537.36"}
 
+    @property
+    def provider_page_request(self):
+        return DownloadItem(self.download_page, headers=self.headers)
+
     def download_provider_page(self):
         logger.debug("Download application provider page")
-        DownloadCenter([DownloadItem(self.download_page, headers=self.headers)],
-                       self.complete_download_url, download=False)
+        self.fetch_provider_page(self.complete_download_url)
 
     def complete_download_url(self, result):
         """Parse the download page and get the SHASUMS256.txt page"""
@@ -93,7 +96,11 @@ class AdoptOpenJDK(umake.frameworks.baseinstaller.BaseInstaller):
 
         self.download_page = "https://api.adoptopenjdk.net/v3/assets/latest/{}/{}".format(version, self.jvm_impl)
         # Check download page, or revert to previous version
-        if requests.get(self.download_page, headers=self.headers).json() == []:
+        page_available = is_url_available(self.download_page)
+        if page_available is None:
+            import requests
+            page_available = requests.get(self.download_page, headers=self.headers).json() != []
+        if not page_available:
             self.download_page = "https://api.adoptopenjdk.net/v3/assets/latest/{}/{}".format(version_prev,
                                                                                               self.jvm_impl)
         DownloadCenter([DownloadItem(self.download_page, headers=self.headers)], self.get_metadata_and_check_license, download=False)
@@ -58,7 +58,7 @@ class NodejsLang(umake.frameworks.baseinstaller.BaseInstaller):
 
     def download_provider_page(self):
         logger.debug("Download application provider page")
-        DownloadCenter([DownloadItem(self.download_page)], self.parse_shasum_page, download=False)
+        self.fetch_provider_page(self.parse_shasum_page)
 
     def parse_shasum_page(self, result):
         """Parse the download page and get the SHASUMS256.txt page"""
@@ -25,12 +25,12 @@ from gettext import gettext as _
 import logging
 import os
 import re
-import tempfile
 
 import umake.frameworks.baseinstaller
 from umake.interactions import DisplayMessage
-from umake.tools import add_env_to_user, as_root, MainLoop, get_current_distro_version
+from umake.tools import add_env_to_user, MainLoop, get_current_distro_version
 from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.network.gpg import Keyring
 from umake.ui import UI
 
 logger = logging.getLogger(__name__)
@@ -55,6 +55,7 @@ class SwiftLang(umake.frameworks.baseinstaller.BaseInstaller):
                          required_files_path=[os.path.join("usr", "bin", "swift")],
                          **kwargs)
         self.asc_url = "https://swift.org/keys/all-keys.asc"
+        self.keyring = Keyring("swift", [self.asc_url])
 
     def parse_download_link(self, line, in_download):
         """Parse Swift download link, expect to find a .sig file"""
@@ -95,41 +96,23 @@ class SwiftLang(umake.frameworks.baseinstaller.BaseInstaller):
         if self.dry_run:
             UI.display(DisplayMessage("Found download URL: " + sig_url))
             UI.return_main_screen(status_code=0)
-        DownloadCenter(urls=[DownloadItem(sig_url, None), DownloadItem(self.asc_url, None)],
-                       on_done=self.check_gpg_and_start_download, download=False)
+        # keys are only downloaded again once expired or too old, while we fetch the signature
+        self.keyring.ensure_in_background()
+        DownloadCenter(urls=[DownloadItem(sig_url, None)], on_done=self.start_signed_download, download=False)
 
     @MainLoop.in_mainloop_thread
-    def check_gpg_and_start_download(self, download_result):
-        asc_content = download_result.pop(self.asc_url).buffer.getvalue().decode('utf-8')
-        sig_url = list(download_result.keys())[0]
-        res = download_result[sig_url]
-        sig = res.buffer.getvalue().decode('utf-8').split()[0]
-
-        # When we install new packages, we are executing as root and then dropping
-        # as the user for extracting and such. However, for signature verification,
-        # we use gpg. This one doesn't like privilege drop (if uid = 0 and
-        # euid = 1000) and asserts if uid != euid.
-        # Importing the key as root as well creates new gnupg files owned as root if
-        # new keys weren't imported first.
-        # Consequently, run gpg as root if we needed root access or as the user
-        # otherwise. We store the gpg public key in a temporary gnupg directory that
-        # will be removed under the same user rights (this directory needs to be owned
-        # by the same user id to not be rejected by gpg).Z
-        if self.need_root_access:
-            with as_root():
-                with tempfile.TemporaryDirectory() as tmpdirname:
-                    _check_gpg_signature(tmpdirname, asc_content, sig)
-        else:
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                _check_gpg_signature(tmpdirname, asc_content, sig)
-
-        # you get and store self.download_url
-        url = re.sub('.sig', '', sig_url)
-        if url is None:
-            logger.error("Download page changed its syntax or is not parsable (missing url)")
+    def start_signed_download(self, download_result):
+        """Download the release, verifying it against its signature while it's downloaded"""
+        sig_url, res = download_result.popitem()
+        if res.error:
+            logger.error("An error occurred while downloading {}: {}".format(sig_url, res.error))
             UI.return_main_screen(status_code=1)
+        with res.buffer:
+            signature = res.buffer.getvalue()
+
+        url = sig_url[:-len(".sig")]
         logger.debug("Found download link for {}".format(url))
-        self.download_requests.append(DownloadItem(url, None))
+        self.add_signed_download_request(url, signature, self.keyring)
         self.start_download_and_install()
 
     def post_install(self):
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+"""apt progress handlers, reporting the progress of a requirements transaction
+
+They are kept out of the requirements handler module, so that importing it doesn't import apt."""
+
+import apt.progress.base
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class FetchProgress(apt.progress.base.AcquireProgress):
+    """Progress handler for downloading a bucket"""
+    def __init__(self, bucket, status, progress_callback,):
+        apt.progress.base.AcquireProgress.__init__(self)
+        self._bucket = bucket
+        self._status = status
+        self._progress_callback = progress_callback
+
+    def pulse(self, owner):
+        percent = (((self.current_bytes + self.current_items) * 100.0) /
+                   float(self.total_bytes + self.total_items))
+        logger.debug("{} download update: {}% of {}".format(self._bucket['bucket'], percent, self.total_bytes))
+        report = {"step": self._status, "percentage": percent, "pkg_size_download": self.total_bytes}
+        self._progress_callback(report)
+
+
+class InstallProgress(apt.progress.base.InstallProgress):
+    """Progress handler for installing a bucket"""
+    def __init__(self, bucket, status, progress_callback, force_load_apt_cache, exchange_filename):
+        apt.progress.base.InstallProgress.__init__(self)
+        self._bucket = bucket
+        self._status = status
+        self._progress_callback = progress_callback
+        self._force_reload_apt_cache = force_load_apt_cache
+        self._exchange_filename = exchange_filename
+
+    def error(self, pkg, msg):
+        logger.error("{} installation finished with an error: {}".format(self._bucket['bucket'], msg))
+        self._force_reload_apt_cache()  # reload apt cache
+        raise BaseException(msg)
+
+    def finish_update(self):
+        # warning: this function can be called even if dpkg failed (it raised an exception around commit()
+        # DO NOT CALL directly the callbacks from there.
+        logger.debug("Install for {} ended.".format(self._bucket['bucket']))
+        self._force_reload_apt_cache()  # reload apt cache
+
+    def status_change(self, pkg, percent, status):
+        logger.debug("{} install update: {}".format(self._bucket['bucket'], percent))
+        self._progress_callback({"step": self._status, "percentage": percent})
+
+    @staticmethod
+    def _redirect_stdin():  # pragma: no cover (in a fork)
+        os.dup2(os.open(os.devnull, os.O_RDWR), 0)
+
+    def _redirect_output(self):  # pragma: no cover (in a fork)
+        fd = os.open(self._exchange_filename, os.O_RDWR)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+
+    def _fixup_fds(self):  # pragma: no cover (in a fork)
+        required_fds = [0, 1, 2,  # stdin, stdout, stderr
+                        self.writefd,
+                        self.write_stream.fileno(),
+                        self.statusfd,
+                        self.status_stream.fileno()
+                        ]
+        # ensure that our required fds close on exec
+        for fd in required_fds[3:]:
+            old_flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, old_flags | fcntl.FD_CLOEXEC)
+        # close all fds
+        proc_fd = "/proc/self/fd"
+        if os.path.exists(proc_fd):
+            error_count = 0
+            for fdname in os.listdir(proc_fd):
+                try:
+                    fd = int(fdname)
+                except ValueError:
+                    print("ERROR: can not get fd for '%s'" % fdname)
+                if fd in required_fds:
+                    continue
+                try:
+                    os.close(fd)
+                except OSError as e:
+                    # there will be one fd that can not be closed
+                    # as its the fd from pythons internal diropen()
+                    # so its ok to ignore one close error
+                    error_count += 1
+                    if error_count > 1:
+                        print("ERROR: os.close(%s): %s" % (fd, e))
+
+    def fork(self):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            # be root
+            os.seteuid(0)
+            os.setegid(0)
+            self._fixup_fds()
+            self._redirect_stdin()
+            self._redirect_output()
+        return pid
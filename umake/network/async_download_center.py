@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Download center engine fetching all urls from a single asyncio event loop
+
+It is selected with UMAKE_DOWNLOAD_ENGINE=asyncio. Instead of a thread and a connection per url, every fetch is a
+coroutine of a shared event loop, and connections are kept alive and reused for the next fetch to the same host.
+This makes a large number of small concurrent fetches (metadata, checksums, icons, version checks) cheap.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager, suppress
+import http.client
+import http.cookies
+import logging
+import os
+import ssl
+import threading
+from urllib.parse import urljoin, urlsplit
+import urllib.request
+import zlib
+
+from umake import tracing
+from umake.network.bundle import get_current_bundle, is_offline
+from umake.network.download_center import DownloadCenter
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for a connection, or for any data from the server, before giving up
+TIMEOUT = 60
+
+
+def _get_origin(parts):
+    """Return the (scheme, host, port) a split url is fetched from"""
+    return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+
+async def _with_timeout(awaitable, url):
+    try:
+        return await asyncio.wait_for(awaitable, TIMEOUT)
+    except asyncio.TimeoutError:
+        raise BaseException("Timed out after {} seconds waiting for {}".format(TIMEOUT, url))
+
+
+class AsyncEngine(metaclass=Singleton):
+    """Event loop running all asynchronous fetches, in its own thread"""
+
+    # maximum number of concurrent requests, and of concurrent requests (thus connections) to the same host
+    MAX_CONNECTIONS = 256
+    MAX_CONNECTIONS_PER_HOST = 6
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.pool = ConnectionPool(self.MAX_CONNECTIONS, self.MAX_CONNECTIONS_PER_HOST)
+        # the event loop only keeps weak references to tasks: keep them alive until done
+        self._pending = set()
+        self._thread = threading.Thread(target=self._run, name="AsyncDownloadCenter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """Schedule the coroutine in the engine loop, returning a concurrent.futures.Future"""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+
+class Connection:
+    """A kept alive connection to a host"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self.keep_alive = False
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Pool of kept alive connections, limiting concurrent requests overall and per host"""
+
+    def __init__(self, max_connections, max_connections_per_host):
+        self.max_connections_per_host = max_connections_per_host
+        self.opened_connections = 0
+        self._slots = asyncio.Semaphore(max_connections)
+        self._host_slots = {}
+        self._idle = {}
+        self._ssl_context = None
+
+    def _get_ssl_context(self):
+        if self._ssl_context is None:
+            # trust the same certificates than the requests based engine
+            import requests.certs
+            cafile = os.environ.get("REQUESTS_CA_BUNDLE") or requests.certs.where()
+            self._ssl_context = ssl.create_default_context(cafile=cafile)
+        return self._ssl_context
+
+    async def _open(self, scheme, host, port):
+        ssl_context = self._get_ssl_context() if scheme == "https" else None
+        reader, writer = await _with_timeout(asyncio.open_connection(host, port, ssl=ssl_context, limit=2 ** 20),
+                                             "{}://{}:{}".format(scheme, host, port))
+        self.opened_connections += 1
+        logger.debug("Opened connection to {}://{}:{}".format(scheme, host, port))
+        return Connection(reader, writer)
+
+    @asynccontextmanager
+    async def connection(self, scheme, host, port, fresh=False):
+        """Yield a connection to host, reusing an idle one unless fresh is set
+
+        The connection goes back to the pool after use if its keep_alive attribute was set"""
+        key = (scheme, host, port)
+        host_slots = self._host_slots.setdefault(key, asyncio.Semaphore(self.max_connections_per_host))
+        async with host_slots, self._slots:
+            connection = None
+            idle = self._idle.setdefault(key, [])
+            while idle and not fresh:
+                connection = idle.pop()
+                if not connection.reader.at_eof():
+                    connection.reused = True
+                    break
+                connection.close()
+                connection = None
+            if connection is None:
+                connection = await self._open(scheme, host, port)
+            connection.keep_alive = False
+            try:
+                yield connection
+            finally:
+                if connection.keep_alive:
+                    idle.append(connection)
+                else:
+                    connection.close()
+
+
+class AsyncDownloadCenter(DownloadCenter):
+    """Read or download requested urls as coroutines of the shared AsyncEngine loop.
+
+    The constructor, callbacks and results are the same than DownloadCenter ones."""
+
+    MAX_REDIRECTS = 30
+    REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+    def _submit(self, download_item, dest):
+        return AsyncEngine().submit(self._async_fetch(download_item, dest))
+
+    @staticmethod
+    def _needs_threaded_fetch(url):
+        """Bundles, offline mode, proxies and other protocols are handled by the threaded engine"""
+        if get_current_bundle() is not None or is_offline():
+            return True
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            return True
+        return parts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(parts.hostname or "")
+
+    async def _async_fetch(self, download_item, dest):
+        """Coroutine version of _fetch()"""
+        loop = asyncio.get_running_loop()
+        # delta downloads are rare and mostly copying from seeds, signatures are verified while writing
+        if download_item.seeds is not None or download_item.signature is not None or \
+                self._needs_threaded_fetch(download_item.url):
+            return await loop.run_in_executor(None, self._fetch, download_item, dest)
+        with tracing.span("fetch", "download", url=download_item.url) as fetch_span, \
+                self._scheduled(download_item) as slot:
+            final_url, cookies = await self._async_fetch_from_network(download_item, dest, slot)
+            # hashing big files would block every other fetch
+            await loop.run_in_executor(None, self._check_and_store, download_item, dest, final_url)
+            fetch_span.end(final_url=final_url, size=dest.tell())
+        return dest, final_url, cookies
+
+    async def _async_fetch_from_network(self, download_item, dest, slot):
+        """Download url content to dest, following redirects, throttled by the scheduler slot
+
+        Return a tuple of (final_url, cookies)
+        """
+        url = download_item.url
+        headers = dict(download_item.headers or {})
+        cookies = dict(download_item.cookies or {})
+        if "api.github.com" in url and os.getenv("UMAKE_GITHUB_TOKEN") is not None:
+            headers["Authorization"] = os.getenv("UMAKE_GITHUB_TOKEN")
+
+        for _ in range(self.MAX_REDIRECTS + 1):
+            location = await self._get(url, headers, cookies, dest, download_item, slot)
+            if location is None:
+                return url, cookies
+            previous_parts = urlsplit(url)
+            url = urljoin(url, location)
+            parts = urlsplit(url)
+            if previous_parts.scheme == "https" and parts.scheme != "https":
+                raise BaseException("Refusing to follow the redirect from {} to {}".format(download_item.url, url))
+            # credentials are only meant for the requested host
+            if _get_origin(parts) != _get_origin(previous_parts):
+                headers.pop("Authorization", None)
+                for name in download_item.cookies or {}:
+                    cookies.pop(name, None)
+        raise BaseException("Exceeded {} redirects.".format(self.MAX_REDIRECTS))
+
+    async def _get(self, url, headers, cookies, dest, download_item, slot):
+        """GET url, writing the content to dest on success, updating cookies
+
+        Return the redirect location if any"""
+        parts = urlsplit(url)
+        scheme, host, port = _get_origin(parts)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request_headers = {"Host": parts.netloc.rsplit("@", 1)[-1], "User-Agent": "umake",
+                           "Accept-Encoding": "gzip, deflate", "Accept": "*/*", "Connection": "keep-alive"}
+        if cookies:
+            request_headers["Cookie"] = "; ".join("{}={}".format(key, value) for key, value in cookies.items())
+        request_headers.update(headers)
+        request = "GET {} HTTP/1.1\r\n{}\r\n".format(path, "".join("{}: {}\r\n".format(key, value)
+                                                                   for key, value in request_headers.items()))
+
+        pool = AsyncEngine().pool
+        # an idle connection may have been closed by the server meanwhile: retry once on a new one
+        for fresh in (False, True):
+            async with pool.connection(scheme, host, port, fresh=fresh) as connection:
+                try:
+                    connection.writer.write(request.encode("latin-1"))
+                    await connection.writer.drain()
+                    status_line = await _with_timeout(connection.reader.readline(), url)
+                    if not status_line:
+                        raise ConnectionResetError("Connection closed by {}".format(parts.netloc))
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if connection.reused and not fresh:
+                        continue
+                    raise
+                return await self._read_response(url, status_line, connection, cookies, dest, download_item, slot)
+
+    async def _read_response(self, url, status_line, connection, cookies, dest, download_item, slot):
+        reader = connection.reader
+        try:
+            version, status, reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+            status = int(status)
+        except ValueError:
+            try:
+                version, status = status_line.decode("latin-1").split()
+                status, reason = int(status), ""
+            except ValueError:
+                raise BaseException("Invalid response from {}: {!r}".format(url, status_line))
+        header_lines = []
+        while True:
+            line = await _with_timeout(reader.readline(), url)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            header_lines.append(line)
+        response_headers = http.client.parse_headers(_BytesLines(header_lines))
+
+        for set_cookie in response_headers.get_all("Set-Cookie") or []:
+            cookie = http.cookies.SimpleCookie()
+            with suppress(http.cookies.CookieError):
+                cookie.load(set_cookie)
+            for name, morsel in cookie.items():
+                cookies[name] = morsel.value
+
+        location = response_headers.get("Location")
+        if status in self.REDIRECT_STATUS and location:
+            await self._read_body(connection, response_headers, version, None, url, None)
+            return location
+        if status >= 400:
+            connection.keep_alive = False
+            raise BaseException("{} {} Error: {} for url: {}".format(status, "Client" if status < 500 else "Server",
+                                                                     reason, url))
+
+        content_size = int(response_headers.get("Content-Length", -1))
+        decompressor = None
+        encoding = response_headers.get("Content-Encoding", "").lower()
+        if not download_item.ignore_encoding and encoding in ("gzip", "deflate"):
+            decompressor = _Decompressor(encoding)
+
+        block_num = 0
+
+        async def _on_block(data):
+            nonlocal block_num
+            self._check_cancelled(url)
+            dest.write(decompressor.decompress(data) if decompressor else data)
+            delay = slot.consume(len(data))
+            while delay:
+                await asyncio.sleep(delay)
+                self._check_cancelled(url)
+                delay = slot.consume(0)
+            block_num += 1
+            self._report_progress(url, block_num, self.BLOCK_SIZE, content_size)
+
+        self._report_progress(url, block_num, self.BLOCK_SIZE, content_size)
+        await self._read_body(connection, response_headers, version, _on_block, url, content_size)
+        if decompressor:
+            dest.write(decompressor.flush())
+        return None
+
+    async def _read_body(self, connection, headers, version, on_block, url, content_size):
+        """Read the response body in BLOCK_SIZE blocks, passing them to the on_block coroutine if not None
+
+        This marks the connection as reusable if the body was delimited and the server keeps it alive."""
+        reader = connection.reader
+        keep_alive = version == "HTTP/1.1" and "close" not in headers.get("Connection", "").lower()
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            while True:
+                size_line = await _with_timeout(reader.readline(), url)
+                size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    # skip trailers
+                    while (await _with_timeout(reader.readline(), url)) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                while size > 0:
+                    data = await _with_timeout(reader.readexactly(min(size, self.BLOCK_SIZE)), url)
+                    size -= len(data)
+                    if on_block is not None:
+                        await on_block(data)
+                await _with_timeout(reader.readline(), url)
+        elif "Content-Length" in headers:
+            remaining = int(headers["Content-Length"])
+            while remaining > 0:
+                try:
+                    data = await _with_timeout(reader.readexactly(min(remaining, self.BLOCK_SIZE)), url)
+                except asyncio.IncompleteReadError:
+                    raise BaseException("Connection closed while downloading {}".format(url))
+                remaining -= len(data)
+                if on_block is not None:
+                    await on_block(data)
+        else:
+            keep_alive = False
+            while True:
+                data = await _with_timeout(reader.read(self.BLOCK_SIZE), url)
+                if not data:
+                    break
+                if on_block is not None:
+                    await on_block(data)
+        connection.keep_alive = keep_alive
+
+
+class _BytesLines:
+    """Readline interface over already read header lines, for http.client.parse_headers()"""
+
+    def __init__(self, lines):
+        self._lines = iter(lines + [b"\r\n"])
+
+    def readline(self, size=-1):
+        return next(self._lines, b"")
+
+
+class _Decompressor:
+    """Decode gzip and deflate content encodings, deflate being zlib wrapped or raw depending on servers"""
+
+    def __init__(self, encoding):
+        self._raw_fallback = encoding == "deflate"
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        try:
+            return self._decompressor.decompress(data)
+        except zlib.error:
+            if not self._raw_fallback:
+                raise
+            self._raw_fallback = False
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
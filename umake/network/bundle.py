@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Offline bundles, storing fetched urls content to replay installations without any network access
+
+A bundle is a directory containing a manifest.json and one file per fetched url (provider pages, checksums, artifacts…)
+It is created with --create-bundle while installing, then replayed on another machine with --from-bundle."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+_current_bundle = None
+_offline = False
+
+
+class Bundle:
+    """Store and lookup url content in a bundle directory"""
+
+    MANIFEST_FILENAME = "manifest.json"
+    FORMAT_VERSION = 1
+
+    def __init__(self, path, create=False):
+        """Open an existing bundle to replay it, or create (or complete) one if create is set
+
+        Raise a BaseException if the bundle can't be opened"""
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.capture = create
+        self.replay = not create
+        self._lock = Lock()
+        self._manifest = {"version": self.FORMAT_VERSION, "urls": {}, "frameworks": {}}
+        if create:
+            os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(os.path.join(self.path, self.MANIFEST_FILENAME)) as f:
+                self._manifest = json.load(f)
+        except FileNotFoundError:
+            if not create:
+                raise BaseException("{} isn't a valid bundle: no manifest found".format(self.path))
+        except ValueError as e:
+            raise BaseException("Invalid bundle manifest in {}: {}".format(self.path, e))
+        if self._manifest.get("version") != self.FORMAT_VERSION:
+            raise BaseException("Unsupported bundle version in {}: {}".format(self.path,
+                                                                              self._manifest.get("version")))
+
+    def get(self, url):
+        """Return a (content file path, final url) tuple for url if it's in the bundle, None otherwise"""
+        entry = self._manifest["urls"].get(url)
+        if entry is None:
+            return None
+        return os.path.join(self.path, entry["file"]), entry["final_url"]
+
+    def add(self, url, fd, final_url):
+        """Store fd content (from its start) as url content"""
+        filename = hashlib.sha256(url.encode()).hexdigest()
+        logger.debug("Store {} in bundle {}".format(url, self.path))
+        fd.seek(0)
+        with open(os.path.join(self.path, filename + ".new"), "wb") as f:
+            shutil.copyfileobj(fd, f)
+        os.rename(os.path.join(self.path, filename + ".new"), os.path.join(self.path, filename))
+        fd.seek(0)
+        with self._lock:
+            self._manifest["urls"][url] = {"file": filename, "final_url": final_url}
+            self._save()
+
+    def add_framework(self, framework_path, url, checksum, license_txt):
+        """Record resolved metadata (url, checksum, license) for framework_path (category/framework)"""
+        with self._lock:
+            self._manifest["frameworks"][framework_path] = {
+                "url": url,
+                "checksum_type": checksum.checksum_type.name if checksum and checksum.checksum_type else None,
+                "checksum": checksum.checksum_value if checksum else None,
+                "license": license_txt
+            }
+            self._save()
+
+    def get_framework(self, framework_path):
+        """Return resolved metadata dict recorded for framework_path, None if not present"""
+        return self._manifest["frameworks"].get(framework_path)
+
+    def _save(self):
+        manifest_path = os.path.join(self.path, self.MANIFEST_FILENAME)
+        with open(manifest_path + ".new", "w") as f:
+            json.dump(self._manifest, f, indent=2, sort_keys=True)
+        os.rename(manifest_path + ".new", manifest_path)
+
+
+def use_bundle(bundle):
+    """Set bundle as the one DownloadCenter will capture to or replay from. Replaying a bundle implies offline mode"""
+    global _current_bundle
+    _current_bundle = bundle
+    if bundle is not None and bundle.replay:
+        set_offline(True)
+
+
+def get_current_bundle():
+    """Return current bundle, None if not using any"""
+    return _current_bundle
+
+
+def set_offline(offline):
+    """Forbid (or allow back) any network access"""
+    global _offline
+    _offline = offline
+
+
+def is_offline():
+    """Return if we are forbidden any network access"""
+    return _offline
+
+
+def is_url_available(url):
+    """Return True if url is served from current bundle, False if it isn't and we are offline, None otherwise"""
+    bundle = get_current_bundle()
+    if bundle is not None and bundle.replay and bundle.get(url) is not None:
+        return True
+    if is_offline():
+        return False
+    return None
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Block level delta downloads, rebuilding a new artifact from a previous one and only the changed byte ranges
+
+The server publishes a block index next to the artifact (same url, with INDEX_SUFFIX appended to its path), listing a
+weak and a strong checksum of each fixed size block. Blocks found in a seed file, like the previously downloaded
+archive, are copied locally, and only missing ones are fetched with HTTP Range requests.
+
+Like zsync, this is mostly useful for uncompressed or rsyncable archives."""
+
+import base64
+from contextlib import closing, suppress
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from urllib.parse import urlsplit, urlunsplit
+import zlib
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".umake-index"
+
+_enabled = False
+
+
+def enable_delta_updates(enabled=True):
+    """Look for block indexes when updating any framework, like when using a mirror publishing them"""
+    global _enabled
+    _enabled = enabled
+
+
+def is_delta_updates_enabled():
+    """Return if block indexes are looked for when updating any framework"""
+    return _enabled
+
+
+def get_index_url(url):
+    """Return the block index url of an artifact url"""
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path=parts.path + INDEX_SUFFIX))
+
+
+class BlockIndex:
+    """Checksums of every fixed size block of a file
+
+    Each block is described by its adler32 weak checksum, its first HEAD_SIZE bytes, used to find it again in a seed
+    file after an insertion or a deletion, and the start of its sha256 digest as a strong checksum."""
+
+    VERSION = 1
+    DEFAULT_BLOCK_SIZE = 64 * 1024
+    HEAD_SIZE = 8
+    _BLOCK = struct.Struct(">I{}s16s".format(HEAD_SIZE))
+
+    def __init__(self, block_size, length, sha256, blocks):
+        self.block_size = block_size
+        self.length = length
+        self.sha256 = sha256
+        self.blocks = blocks
+
+    @classmethod
+    def from_file(cls, f, block_size=DEFAULT_BLOCK_SIZE):
+        """Build the index of f content, from its current position"""
+        checksum = hashlib.sha256()
+        blocks = []
+        length = 0
+        for data in iter(lambda: f.read(block_size), b""):
+            checksum.update(data)
+            blocks.append(cls.describe_block(data))
+            length += len(data)
+        return cls(block_size, length, checksum.hexdigest(), blocks)
+
+    @classmethod
+    def describe_block(cls, data):
+        """Return a (weak checksum, head, strong checksum) tuple describing data"""
+        return zlib.adler32(data), bytes(data[:cls.HEAD_SIZE]), hashlib.sha256(data).digest()[:16]
+
+    def dumps(self):
+        """Serialize the index as a json string"""
+        packed = b"".join(self._BLOCK.pack(*block) for block in self.blocks)
+        return json.dumps({"version": self.VERSION, "block_size": self.block_size, "length": self.length,
+                           "sha256": self.sha256, "blocks": base64.b64encode(packed).decode("ascii")})
+
+    @classmethod
+    def loads(cls, content):
+        """Load an index serialized by dumps()
+
+        Raise a BaseException if the index isn't valid"""
+        try:
+            index = json.loads(content)
+            if index["version"] != cls.VERSION:
+                raise BaseException("Unsupported block index version: {}".format(index["version"]))
+            blocks = list(cls._BLOCK.iter_unpack(base64.b64decode(index["blocks"])))
+            result = cls(int(index["block_size"]), int(index["length"]), index["sha256"], blocks)
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            raise BaseException("Invalid block index: {}".format(e))
+        if result.block_size <= 0 or len(blocks) != -(-result.length // result.block_size):
+            raise BaseException("Invalid block index: {} blocks for {} bytes".format(len(blocks), result.length))
+        if blocks:
+            # a last block shorter than HEAD_SIZE has a padded head
+            weak, head, strong = blocks[-1]
+            start, end = result.block_range(len(blocks) - 1)
+            blocks[-1] = (weak, head[:end - start], strong)
+        return result
+
+    def block_range(self, block_no):
+        """Return the (start, end) byte range of block_no"""
+        start = block_no * self.block_size
+        return start, min(start + self.block_size, self.length)
+
+
+def find_seed_blocks(index, seed_paths, window=4 * 1024 * 1024, max_candidates=16):
+    """Look for index blocks in seed files, returning a {block_no: (seed path, offset)} dict
+
+    Blocks are searched in order: each one is first expected right after the previous match, and otherwise looked for
+    by its head in the surrounding window, so that content shifted by an insertion or a deletion is found again."""
+    matches = {}
+    for path in seed_paths:
+        try:
+            with open(path, "rb") as f, closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as seed:
+                found = _find_blocks_in_seed(index, seed, matches, window, max_candidates)
+        except (OSError, ValueError) as e:
+            # unreadable or empty seed
+            logger.debug("Can't use {} as a seed: {}".format(path, e))
+            continue
+        logger.debug("Found {} blocks of {} in {}".format(len(found), len(index.blocks), path))
+        matches.update({block_no: (path, offset) for block_no, offset in found.items()})
+    return matches
+
+
+def _find_blocks_in_seed(index, seed, already_found, window, max_candidates):
+    found = {}
+    cursor = 0
+    for block_no, (weak, head, strong) in enumerate(index.blocks):
+        start, end = index.block_range(block_no)
+        size = end - start
+        if block_no in already_found:
+            cursor += size
+            continue
+        offset = None
+        if _is_block_at(seed, cursor, size, weak, strong):
+            offset = cursor
+        else:
+            search_start = max(0, cursor - window)
+            search_end = min(len(seed), cursor + window + size)
+            candidate = seed.find(head, search_start, search_end)
+            for _ in range(max_candidates):
+                if candidate == -1:
+                    break
+                if _is_block_at(seed, candidate, size, weak, strong):
+                    offset = candidate
+                    break
+                candidate = seed.find(head, candidate + 1, search_end)
+        if offset is not None:
+            found[block_no] = offset
+            cursor = offset
+        cursor += size
+    return found
+
+
+def _is_block_at(seed, offset, size, weak, strong):
+    if offset + size > len(seed):
+        return False
+    data = seed[offset:offset + size]
+    return zlib.adler32(data) == weak and hashlib.sha256(data).digest()[:16] == strong
+
+
+def plan(index, matches, merge_gap=4):
+    """Return the ordered steps rebuilding the indexed file from seed matches
+
+    Steps are ("seed", path, offset, size) to copy from a seed, or ("fetch", start, end) to download a byte range.
+    Missing blocks separated by less than merge_gap found blocks are fetched in a single range, limiting requests."""
+    steps = []
+    missing = [block_no for block_no in range(len(index.blocks)) if block_no not in matches]
+    # group missing blocks in (first, last) runs
+    runs = []
+    for block_no in missing:
+        if runs and block_no - runs[-1][1] <= merge_gap:
+            runs[-1][1] = block_no
+        else:
+            runs.append([block_no, block_no])
+    block_no = 0
+    for first, last in runs + [[len(index.blocks), None]]:
+        while block_no < first:
+            path, offset = matches[block_no]
+            start, end = index.block_range(block_no)
+            previous = steps[-1] if steps else None
+            # merge contiguous copies from the same seed
+            if previous and previous[0] == "seed" and previous[1] == path and previous[2] + previous[3] == offset:
+                steps[-1] = ("seed", path, previous[2], previous[3] + end - start)
+            else:
+                steps.append(("seed", path, offset, end - start))
+            block_no += 1
+        if last is None:
+            break
+        steps.append(("fetch", index.block_range(first)[0], index.block_range(last)[1]))
+        block_no = last + 1
+    return steps
+
+
+def copy_from_seed(path, offset, size, write, block_size):
+    """Pass size bytes of the seed file at path, from offset, to write() in block_size blocks"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while size > 0:
+            data = f.read(min(size, block_size))
+            if not data:
+                raise BaseException("{} changed while being used as a seed".format(path))
+            write(data)
+            size -= len(data)
+
+
+def remove_stale_seeds(seeds_dir, keep):
+    """Remove every file of seeds_dir but the keep ones"""
+    with suppress(FileNotFoundError):
+        for filename in os.listdir(seeds_dir):
+            path = os.path.join(seeds_dir, filename)
+            if path not in keep:
+                with suppress(OSError):
+                    os.remove(path)
@@ -21,54 +21,292 @@
 
 from collections import namedtuple
 from concurrent import futures
-from contextlib import closing
+from contextlib import closing, contextmanager, nullcontext
 import hashlib
-from io import BytesIO
 import logging
 import os
+import queue
 import tempfile
+from threading import Event, Lock, Thread
+from time import monotonic
 
-import requests
-import requests.exceptions
-from umake.network.ftp_adapter import FTPAdapter
+from umake import tracing
+from umake.network.bundle import get_current_bundle, is_offline
+from umake.network.scheduler import DownloadPriority, DownloadScheduler
+from umake.settings import UMAKE_DOWNLOAD_ENGINE_ENVIRON_VARIABLE, UMAKE_FSYNC_POLICY_ENVIRON_VARIABLE
 from umake.tools import ChecksumType, root_lock
 
 logger = logging.getLogger(__name__)
 
+_prefetch = False
 
-class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies'])):
+
+class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies',
+                                               'priority', 'seeds', 'signature'])):
     """An individual item to be downloaded and checked.
 
     Checksum should be an instance of tools.Checksum, if provided.
     Headers should be a dictionary of HTTP headers, if provided.
-    Cookies should be a cookie dictionary, if provided."""
-    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None):
-        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies)
+    Cookies should be a cookie dictionary, if provided.
+    Priority should be a DownloadPriority, if provided. It otherwise defaults to the DownloadCenter one.
+    Seeds should be a list of paths to previous versions of the content, if provided. Only blocks which aren't in
+    them are downloaded if the server publishes a block index. An empty list checks for a block index only.
+    Signature should be a gpg.Signature, if provided. It's verified while the content is downloaded."""
+    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None, priority=None,
+                seeds=None, signature=None):
+        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies, priority, seeds, signature)
+
+
+class SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """In memory buffer, rolling over to an anonymous temporary file once it exceeds max_size."""
+
+    def getvalue(self):
+        """Return the whole content as bytes, like BytesIO.getvalue()"""
+        position = self.tell()
+        self.seek(0)
+        content = self.read()
+        self.seek(position)
+        return content
+
+
+class WriteBehind:
+    """Write downloaded blocks to dest from a dedicated thread, so that reading from the network never waits for disk
+
+    Blocks are read in a bounded ring of reusable buffers: the reader only waits once all of them are still to be
+    written. In memory destinations are written directly, without any thread.
+
+    The fsync policy is "none" (temporary files don't need to survive a crash), "end" to sync once everything is
+    written, or "periodic" to also sync every PERIODIC_FSYNC_SIZE bytes, bounding dirty pages on slow disks. It
+    defaults to the UMAKE_FSYNC_POLICY environment variable.
+
+    on_write, if not None, is called from the writing thread with every written block, like to verify it."""
+
+    BUFFERS = 64
+    PERIODIC_FSYNC_SIZE = 16 * 1024 * 1024
+    FSYNC_POLICIES = ("none", "end", "periodic")
+
+    def __init__(self, dest, block_size, size=-1, buffers=None, fsync_policy=None, on_write=None):
+        self._dest = dest
+        self._on_write = on_write
+        self._block_size = block_size
+        self._max_buffers = buffers if buffers is not None else self.BUFFERS
+        self._allocated_buffers = 0
+        self._free = queue.Queue()
+        self._error = None
+        self._aborted = False
+        self._unsynced = 0
+        self._preallocated = False
+
+        if fsync_policy is None:
+            fsync_policy = os.environ.get(UMAKE_FSYNC_POLICY_ENVIRON_VARIABLE, "none")
+        if fsync_policy not in self.FSYNC_POLICIES:
+            logger.warning("Unknown fsync policy {}, choose one of {}".format(
+                fsync_policy, ", ".join(self.FSYNC_POLICIES)))
+            fsync_policy = "none"
+        self._fsync_policy = fsync_policy
+
+        # network side: time waiting for blocks, disk side: time writing them
+        self.network_bytes = 0
+        self.network_time = 0
+        self.disk_bytes = 0
+        self.disk_time = 0
+
+        self._thread = None
+        if not isinstance(dest, SpooledBuffer):
+            self._pending = queue.Queue(maxsize=self._max_buffers)
+            self._thread = Thread(target=self._write_loop, args=(size,), name="DownloadWriter", daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(abort=exc_type is not None)
+
+    def readinto(self, read):
+        """Read a block with read(buffer), returning the read size, and queue it for writing
+
+        Return 0 at the end of the content."""
+        buffer = self._get_free_buffer()
+        start = monotonic()
+        try:
+            size = read(buffer)
+        except BaseException:
+            self._free.put(buffer)
+            raise
+        self.network_time += monotonic() - start
+        if not size:
+            self._free.put(buffer)
+            return 0
+        self.network_bytes += size
+        self._queue((buffer, size))
+        return size
+
+    def timed(self, iterator):
+        """Yield blocks from iterator, accounting the time waiting for them as network time"""
+        iterator = iter(iterator)
+        while True:
+            start = monotonic()
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return
+            self.network_time += monotonic() - start
+            self.network_bytes += len(data)
+            yield data
+
+    def write(self, data):
+        """Queue data, a bytes object, for writing"""
+        self._queue((data, None))
+
+    def close(self, abort=False):
+        """Wait for every block to be written, and sync them as requested by the fsync policy
+
+        If abort is set, pending blocks are discarded."""
+        if self._thread is None:
+            self._raise_on_error()
+            return
+        self._aborted = abort
+        self._pending.put(None)
+        self._thread.join()
+        self._thread = None
+        if abort:
+            return
+        self._raise_on_error()
+        start = monotonic()
+        if self._preallocated:
+            # the announced size may not be the written one, like with content encoding
+            self._dest.truncate(self._dest.tell())
+        if self._fsync_policy != "none":
+            self._sync()
+        self.disk_time += monotonic() - start
+
+    @property
+    def network_throughput(self):
+        """Network throughput in bytes per second, or None if too fast to be measured"""
+        return self.network_bytes / self.network_time if self.network_time else None
+
+    @property
+    def disk_throughput(self):
+        """Disk throughput in bytes per second, or None if too fast to be measured"""
+        return self.disk_bytes / self.disk_time if self.disk_time else None
+
+    def _get_free_buffer(self):
+        self._raise_on_error()
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        # grow the ring on demand: small downloads don't need many buffers
+        if self._allocated_buffers < self._max_buffers:
+            self._allocated_buffers += 1
+            return bytearray(self._block_size)
+        buffer = self._free.get()
+        self._raise_on_error()
+        return buffer
+
+    def _queue(self, item):
+        self._raise_on_error()
+        if self._thread is None:
+            self._write(item)
+        else:
+            self._pending.put(item)
+
+    def _write_loop(self, size):
+        start = monotonic()
+        self._preallocate(size)
+        self.disk_time += monotonic() - start
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            # once in error or aborted, only give buffers back to the reader
+            if self._error is None and not self._aborted:
+                try:
+                    self._write(item)
+                except BaseException as e:
+                    self._error = e
+            elif item[1] is not None:
+                self._free.put(item[0])
+
+    def _write(self, item):
+        data, size = item
+        start = monotonic()
+        buffer = None
+        if size is None:
+            size = len(data)
+        else:
+            buffer, data = data, memoryview(data)[:size]
+        self._dest.write(data)
+        if self._on_write is not None:
+            self._on_write(data)
+        if buffer is not None:
+            self._free.put(buffer)
+        self.disk_bytes += size
+        self._unsynced += size
+        if self._fsync_policy == "periodic" and self._unsynced >= self.PERIODIC_FSYNC_SIZE:
+            self._sync()
+        self.disk_time += monotonic() - start
+
+    def _preallocate(self, size):
+        """Reserve the file size upfront if known, avoiding fragmentation and late disk full errors"""
+        if size <= 0 or not hasattr(os, "posix_fallocate"):
+            return
+        try:
+            os.posix_fallocate(self._dest.fileno(), 0, size)
+            self._preallocated = True
+        except OSError as e:
+            logger.debug("Couldn't preallocate {} bytes: {}".format(size, e))
+
+    def _sync(self):
+        self._dest.flush()
+        os.fdatasync(self._dest.fileno())
+        self._unsynced = 0
+
+    def _raise_on_error(self):
+        if self._error is not None:
+            raise self._error
 
 
 class DownloadCenter:
     """Read or download requested urls in separate threads."""
 
     BLOCK_SIZE = 1024 * 8  # from urlretrieve code
-    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "final_url", "cookies"])
-
-    def __init__(self, urls, on_done, download=True, report=lambda x: None):
+    # content not downloaded to a file is kept in memory up to this size, and then spilled to disk
+    MEMORY_THRESHOLD = 1024 * 1024
+    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "final_url", "cookies", "block_index"],
+                                defaults=(None,))
+
+    def __new__(cls, *args, **kwargs):
+        # the download engine is chosen by the environment, without any change in callers
+        if cls is DownloadCenter and os.environ.get(UMAKE_DOWNLOAD_ENGINE_ENVIRON_VARIABLE) == "asyncio":
+            from umake.network.async_download_center import AsyncDownloadCenter
+            cls = AsyncDownloadCenter
+        return super().__new__(cls)
+
+    def __init__(self, urls, on_done, download=True, report=lambda x: None, memory_threshold=None, priority=None):
         """Generate a threaded download machine.
 
         urls is a list of DownloadItems to download or read from.
         on_done is the callback that will be called once all those urls are downloaded.
         report, if not None, will be called once any download is in progress, reporting
         a dict of current download with current/size parameters
+        memory_threshold is the maximum size kept in memory when download is set to False
+        (MEMORY_THRESHOLD if None).
+        priority is the DownloadPriority of urls not having their own. If None, downloads to a file are artifacts,
+        and in memory ones are metadata.
 
         The callback will get a dictionary parameter like:
         {
             "url":
-                DownloadResult(buffer=page content as bytes if download is set to False. close() will clean it from
-                                      memory,
+                DownloadResult(buffer=page content as a SpooledBuffer if download is set to False. close() will clean it
+                                      from memory or disk,
                                error=string detailing the error which occurred (path and content would be empty),
                                fd=temporary file descriptor. close() will delete it from disk,
                                final_url=the final url, which may be different from the start if there were redirects,
-                               cookies=a dictionary of cookies after the request
+                               cookies=a dictionary of cookies after the request,
+                               block_index=True if the server publishes a block index for delta downloads, and seeds
+                                           were requested
                 )
         }
         """
@@ -81,8 +319,17 @@ class DownloadCenter:
         self._downloaded_content = {}
 
         self._download_progress = {}
-
-        executor = futures.ThreadPoolExecutor(max_workers=len(urls))
+        self._cancelled = Event()
+        if priority is None:
+            priority = DownloadPriority.artifact if download else DownloadPriority.metadata
+        self._priority = priority
+        self._slots = {}
+        self._slots_lock = Lock()
+        self._block_indexes = set()
+        if memory_threshold is None:
+            memory_threshold = self.MEMORY_THRESHOLD
+
+        self._executor = None
         for url_request in self._urls:
             # grab the md5sum if any
             # switch between inline memory and temp file
@@ -91,39 +338,171 @@ class DownloadCenter:
                 # http://bugs.python.org/issue21044
                 # also, ensure we keep the same suffix
                 path, ext = os.path.splitext(url_request.url)
-                # We want to ensure that we don't create files as root
-                root_lock.acquire()
-                dest = tempfile.NamedTemporaryFile(suffix=ext)
-                root_lock.release()
+                # We want to ensure that we don't create files as root, if we are running as root
+                with root_lock if os.getuid() == 0 else nullcontext():
+                    dest = tempfile.NamedTemporaryFile(suffix=ext)
                 logger.info("Start downloading {} to a temp file".format(url_request))
             else:
-                dest = BytesIO()
+                # rolls over to an anonymous temp file, never visible on disk
+                dest = SpooledBuffer(max_size=memory_threshold)
                 logger.info("Start downloading {} in memory".format(url_request))
-            future = executor.submit(self._fetch, url_request, dest)
+            future = self._submit(url_request, dest)
             future.tag_url = url_request.url
             future.tag_download = download
             future.tag_dest = dest
             future.add_done_callback(self._one_done)
 
+    def _submit(self, download_item, dest):
+        """Start fetching download_item to dest, returning a concurrent.futures.Future of _fetch() result"""
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(max_workers=len(self._urls),
+                                                        thread_name_prefix="DownloadCenter")
+        return self._executor.submit(self._fetch, download_item, dest)
+
+    def set_priority(self, priority):
+        """Change the DownloadPriority of every download without its own priority, even already running ones"""
+        with self._slots_lock:
+            self._priority = priority
+            for url_request, slot in self._slots.values():
+                if url_request.priority is None:
+                    slot.set_priority(priority)
+
+    @contextmanager
+    def _scheduled(self, download_item):
+        """Context manager registering download_item as running to the download scheduler, yielding its slot"""
+        with self._slots_lock:
+            slot = DownloadScheduler().start(download_item.priority or self._priority)
+            self._slots[download_item.url] = (download_item, slot)
+        try:
+            yield slot
+        finally:
+            with self._slots_lock:
+                del self._slots[download_item.url]
+            slot.close()
+
     def _fetch(self, download_item, dest):
         """Get an url content and close the connexion.
 
         This will write the content to dest and check for md5sum.
+        Content is served from the current bundle if we replay one, and stored in it if we are creating one.
         Return a tuple of (dest, final_url, cookies)
         """
+        with tracing.span("fetch", "download", url=download_item.url) as fetch_span:
+            dest, final_url, cookies = self._fetch_and_check(download_item, dest)
+            fetch_span.end(final_url=final_url, size=dest.tell())
+        return dest, final_url, cookies
+
+    def _report_progress(self, url, block_no, block_size, total_size):
+        current_size = int(block_no * block_size)
+        if total_size != -1:
+            current_size = min(current_size, total_size)
+        self._download_progress[url] = {"current": current_size, "size": total_size}
+        # formatting every download progress is costly with many concurrent downloads
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Deliver download update: {}".format(self._download_progress))
+        self._wired_report(self._download_progress)
+
+    def _fetch_and_check(self, download_item, dest):
+        signature = download_item.signature
+        with signature.verifier(download_item.url) if signature is not None else nullcontext() as verifier:
+            return self._fetch_and_verify(download_item, dest, verifier)
+
+    def _fetch_and_verify(self, download_item, dest, verifier):
+        url = download_item.url
+        on_write = verifier.update if verifier is not None else None
+
+        def _report(block_no, block_size, total_size):
+            self._report_progress(url, block_no, block_size, total_size)
+
+        bundle = get_current_bundle()
+        bundle_entry = bundle.get(url) if bundle is not None and bundle.replay else None
+        if bundle_entry is not None:
+            logger.debug("Serving {} from bundle {}".format(url, bundle.path))
+            content_path, final_url = bundle_entry
+            cookies = None
+            content_size = os.path.getsize(content_path)
+            block_num = 0
+            _report(block_num, self.BLOCK_SIZE, content_size)
+            with open(content_path, "rb") as f, \
+                    WriteBehind(dest, self.BLOCK_SIZE, content_size, on_write=on_write) as writer:
+                while writer.readinto(f.readinto):
+                    self._check_cancelled(url)
+                    block_num += 1
+                    _report(block_num, self.BLOCK_SIZE, content_size)
+            self._log_throughput(url, writer)
+        elif is_offline():
+            raise BaseException("{} isn't available in offline mode.".format(url))
+        else:
+            fetched = None
+            if download_item.seeds is not None:
+                try:
+                    fetched = self._fetch_delta(download_item, dest, _report, on_write)
+                except BaseException as e:
+                    self._check_cancelled(url)
+                    logger.warning("Couldn't download only changes of {}, downloading it fully: {}".format(url, e))
+                    dest.seek(0)
+                    dest.truncate()
+                    if verifier is not None:
+                        verifier.restart()
+            if fetched is None:
+                fetched = self._fetch_from_network(download_item, dest, _report, on_write)
+            final_url, cookies = fetched
+
+        self._check_and_store(download_item, dest, final_url, verifier)
+        return dest, final_url, cookies
+
+    def _check_and_store(self, download_item, dest, final_url, verifier=None):
+        """Check dest checksum and signature, and add it to the bundle we are creating, if any"""
         url = download_item.url
         checksum = download_item.checksum
+        if checksum and checksum.checksum_value:
+            checksum_type = checksum.checksum_type
+            checksum_value = checksum.checksum_value
+            logger.debug("Checking checksum ({}).".format(checksum_type.name))
+            dest.seek(0)
+
+            with tracing.span("checksum", "download", url=url, type=checksum_type.name):
+                if checksum_type is ChecksumType.sha1:
+                    actual_checksum = self.sha1_for_fd(dest)
+                elif checksum_type is ChecksumType.md5:
+                    actual_checksum = self.md5_for_fd(dest)
+                elif checksum_type is ChecksumType.sha256:
+                    actual_checksum = self.sha256_for_fd(dest)
+                elif checksum_type is ChecksumType.sha512:
+                    actual_checksum = self.sha512_for_fd(dest)
+                else:
+                    msg = "Unsupported checksum type: {}.".format(checksum_type)
+                    raise BaseException(msg)
+
+            logger.debug("Expected: {}, actual: {}.".format(checksum_value,
+                                                            actual_checksum))
+            if checksum_value != actual_checksum:
+                msg = ("The checksum of {} doesn't match. Corrupted download? "
+                       "Aborting.").format(url)
+                raise BaseException(msg)
+
+        if verifier is not None:
+            with tracing.span("signature", "download", url=url):
+                verifier.finish(dest)
+
+        bundle = get_current_bundle()
+        if bundle is not None and bundle.capture:
+            bundle.add(url, dest, final_url)
+
+    def _fetch_from_network(self, download_item, dest, report, on_write=None):
+        """Download url content to dest, calling report(block_no, block_size, total_size) on progress, and
+        on_write(data) with every written block
+
+        Return a tuple of (final_url, cookies)
+        """
+        import requests
+        import requests.exceptions
+        from umake.network.ftp_adapter import FTPAdapter
+
+        url = download_item.url
         headers = download_item.headers or {}
         cookies = download_item.cookies
 
-        def _report(block_no, block_size, total_size):
-            current_size = int(block_no * block_size)
-            if total_size != -1:
-                current_size = min(current_size, total_size)
-            self._download_progress[url] = {"current": current_size, "size": total_size}
-            logger.debug("Deliver download update: {}".format(self._download_progress))
-            self._wired_report(self._download_progress)
-
         # Requests support redirection out of the box.
         # Create a session so we can mount our own FTP adapter.
         session = requests.Session()
@@ -132,48 +511,126 @@ class DownloadCenter:
         if "api.github.com" in url and os.getenv("UMAKE_GITHUB_TOKEN") is not None:
             headers["Authorization"] = os.getenv("UMAKE_GITHUB_TOKEN")
         try:
-            with closing(session.get(url, stream=True, headers=headers, cookies=cookies)) as r:
+            with self._scheduled(download_item) as slot, \
+                    closing(session.get(url, stream=True, headers=headers, cookies=cookies)) as r:
                 r.raise_for_status()
                 content_size = int(r.headers.get('content-length', -1))
 
-                # read in chunk and send report updates
+                # read in chunk and send report updates, while another thread writes them
                 block_num = 0
-                _report(block_num, self.BLOCK_SIZE, content_size)
-                for data in r.raw.stream(amt=self.BLOCK_SIZE, decode_content=not download_item.ignore_encoding):
-                    dest.write(data)
-                    block_num += 1
-                    _report(block_num, self.BLOCK_SIZE, content_size)
+                report(block_num, self.BLOCK_SIZE, content_size)
+                decode_content = not download_item.ignore_encoding and "content-encoding" in r.headers
+                with WriteBehind(dest, self.BLOCK_SIZE, content_size, on_write=on_write) as writer:
+                    if hasattr(r.raw, "readinto") and not decode_content:
+                        # read straight into the writer buffers
+                        r.raw.decode_content = False
+                        while True:
+                            size = writer.readinto(r.raw.readinto)
+                            if not size:
+                                break
+                            self._check_cancelled(url)
+                            slot.throttle(size, lambda: self._check_cancelled(url))
+                            block_num += 1
+                            report(block_num, self.BLOCK_SIZE, content_size)
+                    else:
+                        for data in writer.timed(r.raw.stream(amt=self.BLOCK_SIZE, decode_content=decode_content)):
+                            self._check_cancelled(url)
+                            writer.write(data)
+                            slot.throttle(len(data), lambda: self._check_cancelled(url))
+                            block_num += 1
+                            report(block_num, self.BLOCK_SIZE, content_size)
+                self._log_throughput(url, writer)
                 final_url = r.url
                 cookies = session.cookies
         except requests.exceptions.InvalidSchema as exc:
             # Wrap this for a nicer error message.
             raise BaseException("Protocol not supported.") from exc
+        return final_url, cookies
 
-        if checksum and checksum.checksum_value:
-            checksum_type = checksum.checksum_type
-            checksum_value = checksum.checksum_value
-            logger.debug("Checking checksum ({}).".format(checksum_type.name))
-            dest.seek(0)
+    def _fetch_delta(self, download_item, dest, report, on_write=None):
+        """Rebuild url content in dest from download_item seeds and the changed ranges, if the server publishes a
+        block index
 
-            if checksum_type is ChecksumType.sha1:
-                actual_checksum = self.sha1_for_fd(dest)
-            elif checksum_type is ChecksumType.md5:
-                actual_checksum = self.md5_for_fd(dest)
-            elif checksum_type is ChecksumType.sha256:
-                actual_checksum = self.sha256_for_fd(dest)
-            elif checksum_type is ChecksumType.sha512:
-                actual_checksum = self.sha512_for_fd(dest)
-            else:
-                msg = "Unsupported checksum type: {}.".format(checksum_type)
-                raise BaseException(msg)
+        Return a tuple of (final_url, cookies), or None if there is no block index or no block in seeds."""
+        import requests
+        from umake.network import delta
 
-            logger.debug("Expected: {}, actual: {}.".format(checksum_value,
-                                                            actual_checksum))
-            if checksum_value != actual_checksum:
-                msg = ("The checksum of {} doesn't match. Corrupted download? "
-                       "Aborting.").format(url)
-                raise BaseException(msg)
-        return dest, final_url, cookies
+        url = download_item.url
+        headers = dict(download_item.headers or {})
+        session = requests.Session()
+        try:
+            with closing(session.get(delta.get_index_url(url), headers=headers, cookies=download_item.cookies)) as r:
+                r.raise_for_status()
+                content = r.text
+        except requests.exceptions.RequestException as e:
+            # most servers don't publish any, or forbid unknown paths
+            logger.debug("No block index for {}: {}".format(url, e))
+            return None
+        index = delta.BlockIndex.loads(content)
+        self._block_indexes.add(url)
+
+        with tracing.span("delta_seeds", "download", url=url):
+            matches = delta.find_seed_blocks(index, download_item.seeds)
+        if not matches:
+            logger.debug("No block of {} found in {}".format(url, download_item.seeds))
+            return None
+        logger.info("{} of {} blocks of {} found locally".format(len(matches), len(index.blocks), url))
+
+        checksum = hashlib.sha256()
+        written = 0
+        final_url = url
+        report(written, 1, index.length)
+        with self._scheduled(download_item) as slot, \
+                WriteBehind(dest, self.BLOCK_SIZE, index.length, on_write=on_write) as writer:
+            def _write(data):
+                nonlocal written
+                self._check_cancelled(url)
+                checksum.update(data)
+                writer.write(data)
+                written += len(data)
+                report(written, 1, index.length)
+
+            for step in delta.plan(index, matches):
+                if step[0] == "seed":
+                    _, path, offset, size = step
+                    delta.copy_from_seed(path, offset, size, _write, self.BLOCK_SIZE)
+                    continue
+                _, start, end = step
+                range_headers = dict(headers)
+                range_headers.update({"Range": "bytes={}-{}".format(start, end - 1), "Accept-Encoding": "identity"})
+                with closing(session.get(url, stream=True, headers=range_headers,
+                                         cookies=download_item.cookies)) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise BaseException("{} doesn't support range requests".format(url))
+                    for data in writer.timed(r.raw.stream(amt=self.BLOCK_SIZE, decode_content=False)):
+                        _write(data)
+                        slot.throttle(len(data), lambda: self._check_cancelled(url))
+                    final_url = r.url
+        self._log_throughput(url, writer)
+
+        if written != index.length or checksum.hexdigest() != index.sha256:
+            raise BaseException("Content rebuilt from seeds doesn't match the block index")
+        return final_url, session.cookies
+
+    @staticmethod
+    def _log_throughput(url, writer):
+        def _rate(throughput):
+            return "{:.1f} MB/s".format(throughput / 1e6) if throughput is not None else "-"
+        logger.debug("{} read from network at {}, written to disk at {}".format(
+            url, _rate(writer.network_throughput), _rate(writer.disk_throughput)))
+
+    def cancel(self):
+        """Abort all pending downloads. They will finish with an error"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _check_cancelled(self, url):
+        if self._cancelled.is_set():
+            raise BaseException("Download of {} cancelled".format(url))
 
     def _one_done(self, future):
         """Callback that will be called once the download finishes.
@@ -182,7 +639,10 @@ class DownloadCenter:
         """
 
         if future.exception():
-            logger.error("{} couldn't finish download: {}".format(future.tag_url, future.exception()))
+            if self.cancelled:
+                logger.debug("{} download cancelled".format(future.tag_url))
+            else:
+                logger.error("{} couldn't finish download: {}".format(future.tag_url, future.exception()))
             result = self.DownloadResult(buffer=None, error=str(future.exception()), fd=None, final_url=None,
                                          cookies=None)
             # cleaned unusable temp file as something bad happened
@@ -191,10 +651,13 @@ class DownloadCenter:
             logger.info("{} download finished".format(future.tag_url))
             fd, final_url, cookies = future.result()
             fd.seek(0)
+            block_index = future.tag_url in self._block_indexes
             if future.tag_download:
-                result = self.DownloadResult(buffer=None, error=None, fd=fd, final_url=final_url, cookies=cookies)
+                result = self.DownloadResult(buffer=None, error=None, fd=fd, final_url=final_url, cookies=cookies,
+                                             block_index=block_index)
             else:
-                result = self.DownloadResult(buffer=fd, error=None, fd=None, final_url=final_url, cookies=cookies)
+                result = self.DownloadResult(buffer=fd, error=None, fd=None, final_url=final_url, cookies=cookies,
+                                             block_index=block_index)
         self._downloaded_content[future.tag_url] = result
         if len(self._urls) == len(self._downloaded_content):
             self._done()
@@ -233,3 +696,83 @@ class DownloadCenter:
     @classmethod
     def sha512_for_fd(cls, f, block_size=2 ** 20):
         return cls._checksum_for_fd(hashlib.sha512, f, block_size)
+
+
+class SpeculativeDownload:
+    """Download urls before knowing if they are needed, typically while a license agreement is displayed.
+
+    Content stays in anonymous temporary files until the download is committed by attaching the usual DownloadCenter
+    callbacks with attach(), or thrown away with discard()."""
+
+    def __init__(self, urls, download=True):
+        self.urls = urls
+        self._lock = Lock()
+        self._on_done = None
+        self._report = None
+        self._last_progress = None
+        self._result = None
+        self._discarded = False
+        logger.info("Start speculative download of {}".format(urls))
+        self._download_center = DownloadCenter(urls, on_done=self._done, download=download, report=self._progress,
+                                               priority=DownloadPriority.prefetch)
+
+    def _progress(self, progress):
+        with self._lock:
+            if not isinstance(progress, str):
+                self._last_progress = progress
+            report = self._report
+        if report is not None:
+            report(progress)
+
+    def _done(self, result):
+        with self._lock:
+            discarded = self._discarded
+            self._result = result
+            on_done = self._on_done
+        if discarded:
+            self._close(result)
+        elif on_done is not None:
+            on_done(result)
+
+    def attach(self, on_done, report=lambda x: None):
+        """Commit the download: on_done and report are DownloadCenter callbacks, and are called right away with the
+        progress and result we already have"""
+        with self._lock:
+            self._on_done = on_done
+            self._report = report
+            last_progress = self._last_progress
+            result = self._result
+        logger.debug("Speculative download committed")
+        self._download_center.set_priority(DownloadPriority.artifact)
+        if last_progress is not None:
+            report(last_progress)
+        if result is not None:
+            on_done(result)
+
+    def discard(self):
+        """Cancel the download and remove anything already downloaded"""
+        with self._lock:
+            self._discarded = True
+            result = self._result
+        logger.debug("Speculative download discarded")
+        self._download_center.cancel()
+        if result is not None:
+            self._close(result)
+
+    @staticmethod
+    def _close(result):
+        for download in result.values():
+            for fd in (download.fd, download.buffer):
+                if fd is not None:
+                    fd.close()
+
+
+def enable_prefetch(enabled=True):
+    """Start downloading artifacts while waiting for the user to accept their license"""
+    global _prefetch
+    _prefetch = enabled
+
+
+def is_prefetch_enabled():
+    """Return if artifacts are downloaded speculatively while waiting for license acceptance"""
+    return _prefetch
@@ -17,34 +17,106 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-from collections import namedtuple
-from ftplib import FTP, error_perm
-from queue import Queue
-from threading import Thread
+from collections import defaultdict, deque, namedtuple
+from contextlib import suppress
+from ftplib import FTP, error_perm, error_reply, error_temp
+from queue import Empty, Queue
+import re
+from threading import Lock, Thread
 import urllib.parse
 from requests import Response
 from requests.adapters import BaseAdapter
 import requests.exceptions
 
 
+class FTPConnectionPool:
+    """Thread-safe pool of anonymous, passive mode, FTP connections per host"""
+
+    def __init__(self, max_idle_per_host=4):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = defaultdict(deque)
+        self._lock = Lock()
+
+    def acquire(self, hostname, timeout=None):
+        """Return an idle and still alive connection to hostname, or a new one"""
+        while True:
+            with self._lock:
+                if not self._idle[hostname]:
+                    break
+                conn = self._idle[hostname].popleft()
+            try:
+                conn.voidcmd("NOOP")
+                return conn
+            except (error_reply, error_temp, error_perm, OSError, EOFError):
+                self.discard(conn)
+        conn = FTP(host=hostname, timeout=timeout, user='anonymous')
+        conn.set_pasv(True)
+        return conn
+
+    def release(self, hostname, conn):
+        """Give back a connection, which is idle again, to the pool"""
+        with self._lock:
+            if len(self._idle[hostname]) < self.max_idle_per_host:
+                self._idle[hostname].append(conn)
+                return
+        self.discard(conn)
+
+    @staticmethod
+    def discard(conn):
+        """Close a connection which can't be reused"""
+        with suppress(Exception):
+            conn.close()
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle = self._idle
+            self._idle = defaultdict(deque)
+        for connections in idle.values():
+            for conn in connections:
+                self.discard(conn)
+
+
 class FTPAdapter(BaseAdapter):
-    """An FTP adapter for requests. Supports streaming GETs and not much else."""
+    """An FTP adapter for requests. Supports streaming and non streaming GETs, resuming with a Range header and HEAD
+    (through SIZE).
+
+    Connections are taken from a pool shared by all adapters, so that one adapter can serve concurrent requests."""
+
+    pool = FTPConnectionPool()
+
+    # QUEUE_SIZE chunks (of the server block size) are buffered before applying backpressure to the transfer
+    QUEUE_SIZE = 100
+
+    @classmethod
+    def get_connection(cls, hostname, timeout=None):
+        return cls.pool.acquire(hostname, timeout)
 
     @staticmethod
-    def get_connection(hostname, timeout=None):
-        return FTP(host=hostname, timeout=timeout, user='anonymous')
+    def _get_range_start(request):
+        """Return the resume offset of a "bytes=N-" Range header, 0 if not set"""
+        range_header = request.headers.get("Range")
+        if not range_header:
+            return 0
+        match = re.match(r"bytes=(\d+)-$", range_header.strip())
+        if not match:
+            raise requests.exceptions.InvalidHeader("Unsupported FTP Range: {}".format(range_header))
+        return int(match.group(1))
 
     def send(self, request, stream=False, timeout=None, **kwargs):
 
         parsed_url = urllib.parse.urlparse(request.url)
+        hostname = parsed_url.netloc
         file_path = parsed_url.path
 
         # Strip the leading slash, if present.
         if file_path.startswith('/'):
             file_path = file_path[1:]
 
+        rest = self._get_range_start(request)
+
         try:
-            self.conn = self.get_connection(parsed_url.netloc, timeout)
+            conn = self.get_connection(hostname, timeout)
         except ConnectionRefusedError as exc:
             # Wrap this in a requests exception.
             # in requests 2.2.1, ConnectionError does not take keyword args
@@ -52,57 +124,124 @@ class FTPAdapter(BaseAdapter):
 
         resp = Response()
         resp.url = request.url
+        resp.request = request
 
         try:
-            size = self.conn.size(file_path)
+            size = conn.size(file_path)
         except error_perm:
+            self.pool.release(hostname, conn)
             resp.status_code = 404
             return resp
 
-        if stream:
-            # We have to do this in a background thread, since ftplib's and requests' approaches are the opposite:
-            # ftplib is callback based, and requests needs to expose an iterable. (Push vs pull)
+        resp.status_code = 206 if rest else 200
+        if size is not None:
+            resp.headers['content-length'] = size - rest
+            if rest:
+                resp.headers['content-range'] = "bytes {}-{}/{}".format(rest, size - 1, size)
 
-            # When the queue size is reached, puts will block. This provides some backpressure.
-            queue = Queue(maxsize=100)
-            done_sentinel = object()
-
-            def handle_transfer():
-                # Download all the chunks into a queue, then place a sentinel object into it to signal completion.
-                self.conn.retrbinary('RETR ' + file_path, queue.put)
-                queue.put(done_sentinel)
+        if request.method == 'HEAD':
+            self.pool.release(hostname, conn)
+            resp.close = lambda: None
+            return resp
 
-            Thread(target=handle_transfer).start()
+        if not stream:
+            chunks = []
+            try:
+                conn.retrbinary('RETR ' + file_path, chunks.append, rest=rest or None)
+            except BaseException:
+                self.pool.discard(conn)
+                raise
+            self.pool.release(hostname, conn)
+            resp._content = b"".join(chunks)
+            resp.close = lambda: None
+            return resp
 
-            def stream(amt=8192, decode_content=False):
-                """A generator, yielding chunks from the queue."""
-                # We maintain a buffer so the consumer gets exactly the number of bytes requested.
-                buffer = bytearray()
-                while True:
+        # We have to do this in a background thread, since ftplib's and requests' approaches are the opposite:
+        # ftplib is callback based, and requests needs to expose an iterable. (Push vs pull)
+
+        # When the queue size is reached, puts will block. This provides some backpressure.
+        queue = Queue(maxsize=self.QUEUE_SIZE)
+        done_sentinel = object()
+        transfer = {"done": False, "error": None, "cancelled": False}
+
+        def put(data):
+            if transfer["cancelled"]:
+                raise requests.exceptions.ConnectionError("Transfer cancelled")
+            queue.put(data)
+
+        def handle_transfer():
+            # Download all the chunks into a queue, then place a sentinel object into it to signal completion.
+            try:
+                conn.retrbinary('RETR ' + file_path, put, rest=rest or None)
+                transfer["done"] = True
+            except BaseException as exc:
+                transfer["error"] = exc
+            queue.put(done_sentinel)
+
+        Thread(target=handle_transfer, daemon=True).start()
+
+        def stream(amt=8192, decode_content=False):
+            """A generator, yielding chunks of amt bytes (but the last one) from the queue.
+
+            Received chunks are kept in a deque and sliced through memoryviews: only the bytes yielded are copied."""
+            chunks = deque()
+            # offset of the first unconsumed byte in chunks[0], and total unconsumed bytes
+            offset = 0
+            available = 0
+            finished = False
+            while not finished or available:
+                if not finished and available < amt:
                     data = queue.get()
+                    if data is done_sentinel:
+                        finished = True
+                        if transfer["error"] is not None:
+                            raise requests.exceptions.ConnectionError() from transfer["error"]
+                    elif data:
+                        chunks.append(memoryview(data))
+                        available += len(data)
+                    continue
+                chunk = chunks[0]
+                if len(chunk) - offset >= amt or finished and len(chunks) == 1:
+                    # the first chunk is enough: don't copy anything
+                    result = chunk[offset:offset + amt]
+                    offset += len(result)
+                    available -= len(result)
+                    if offset == len(chunk):
+                        chunks.popleft()
+                        offset = 0
+                    yield result
+                    continue
+                result = bytearray(min(amt, available))
+                filled = 0
+                while filled < len(result):
+                    chunk = chunks[0]
+                    length = min(len(chunk) - offset, len(result) - filled)
+                    result[filled:filled + length] = chunk[offset:offset + length]
+                    filled += length
+                    offset += length
+                    if offset == len(chunk):
+                        chunks.popleft()
+                        offset = 0
+                available -= filled
+                yield result
+
+        def close():
+            # only give back the connection if the transfer is complete, otherwise, it's in an unknown state
+            if transfer["done"]:
+                self.pool.release(hostname, conn)
+                return
+            # abort the transfer, unblocking it if it's waiting on a full queue
+            transfer["cancelled"] = True
+            with suppress(Empty):
+                while True:
+                    queue.get_nowait()
+            self.pool.discard(conn)
 
-                    if data is not done_sentinel:
-                        buffer.extend(data)
-                        if len(buffer) >= amt:
-                            result = buffer[:amt]
-                            buffer = buffer[amt:]
-
-                            yield result
-                    else:
-                        if buffer:
-                            yield buffer
-                        return
-
-            Raw = namedtuple('raw', 'stream')
-
-            raw = Raw(stream)
+        Raw = namedtuple('raw', 'stream')
 
-            resp.status_code = 200
-            resp.raw = raw
-            resp.headers['content-length'] = size
-            resp.close = lambda: self.conn.close()
-            return resp
+        resp.raw = Raw(stream)
+        resp.close = close
+        return resp
 
-        else:
-            # Not relevant for Ubuntu Make.
-            raise NotImplementedError
+    def close(self):
+        pass
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Verify detached gpg signatures of downloads against persistent keyrings
+
+A Keyring is a user owned gnupg home in the cache directory, filled with keys downloaded from their publisher. It's
+refreshed when older than its max age or when any of its keys expired. Signatures are verified by feeding the
+downloaded content to gpg while it's written, so that no extra pass on big artifacts is needed."""
+
+from collections import namedtuple
+from contextlib import suppress
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from threading import Event, Lock, Thread
+import time
+from xdg.BaseDirectory import xdg_cache_home
+from umake.settings import CONFIG_FILENAME, KEYRINGS_DIRNAME
+
+logger = logging.getLogger(__name__)
+
+
+def _as_effective_user():
+    """Return Popen arguments running gpg as the effective user
+
+    gpg asserts if uid != euid, like when we dropped root privileges. This also keeps the keyring user owned."""
+    if os.getuid() != os.geteuid():
+        return {"user": os.geteuid(), "group": os.getegid()}
+    return {}
+
+
+def _parse_status(output):
+    """Return the list of gpg status keywords and their arguments, as lists"""
+    status = []
+    for line in output.decode("utf-8", "replace").splitlines():
+        if line.startswith("[GNUPG:] "):
+            status.append(line[len("[GNUPG:] "):].split())
+    return status
+
+
+class Keyring:
+    """Persistent keyring of name, filled with the keys published at key_urls"""
+
+    MAX_AGE = 7 * 24 * 60 * 60
+    STAMP_FILENAME = "umake-refreshed"
+
+    def __init__(self, name, key_urls, max_age=None):
+        self.name = name
+        self.key_urls = key_urls
+        self.max_age = max_age if max_age is not None else self.MAX_AGE
+        self.path = os.path.join(xdg_cache_home, CONFIG_FILENAME, KEYRINGS_DIRNAME, name)
+        self._lock = Lock()
+
+    def gpg_command(self, *args, homedir=None):
+        """Return the gpg command line running args on this keyring, or homedir"""
+        return ["gpg", "--homedir", homedir or self.path, "--batch", "--no-tty", "--no-autostart",
+                "--status-fd", "1"] + list(args)
+
+    def _run_gpg(self, *args, homedir=None, input=None):
+        """Run gpg on this keyring, returning its standard output"""
+        try:
+            return subprocess.run(self.gpg_command(*args, homedir=homedir), input=input, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, **_as_effective_user()).stdout
+        except OSError as e:
+            raise BaseException("Couldn't run gpg: {}".format(e))
+
+    def _keys_validity(self):
+        """Return a list telling for each key of the keyring if it can be used"""
+        if not os.path.isdir(self.path):
+            return []
+        validity = []
+        now = time.time()
+        for line in self._run_gpg("--with-colons", "--list-keys").decode("utf-8", "replace").splitlines():
+            fields = line.split(":")
+            if fields[0] != "pub" or len(fields) < 7:
+                continue
+            expired = fields[1] in ("e", "r") or (fields[6] and int(fields[6]) <= now)
+            validity.append(not expired)
+        return validity
+
+    def is_stale(self):
+        """Return if the keyring is missing, too old or has an expired key"""
+        from umake.network.bundle import get_current_bundle
+        bundle = get_current_bundle()
+        if bundle is not None and bundle.capture:
+            # the bundle needs the keys to verify signatures offline
+            return True
+        with suppress(FileNotFoundError):
+            if time.time() - os.path.getmtime(os.path.join(self.path, self.STAMP_FILENAME)) < self.max_age:
+                validity = self._keys_validity()
+                return not validity or not all(validity)
+        return True
+
+    def refresh(self):
+        """Download all keys again to a new keyring, replacing the current one once they are all imported
+
+        This drops keys which aren't published anymore. Raise a BaseException on failure."""
+        logger.info("Refreshing {} keyring".format(self.name))
+        keys = self._download_keys()
+        new_path = self.path + ".new"
+        old_path = self.path + ".old"
+        shutil.rmtree(new_path, ignore_errors=True)
+        os.makedirs(new_path, mode=0o700)
+        for url, content in keys:
+            status = _parse_status(self._run_gpg("--import", homedir=new_path, input=content))
+            if not any(keyword == "IMPORT_OK" for keyword, *_ in status):
+                shutil.rmtree(new_path, ignore_errors=True)
+                raise BaseException("No valid key found in {}".format(url))
+        open(os.path.join(new_path, self.STAMP_FILENAME), "w").close()
+        shutil.rmtree(old_path, ignore_errors=True)
+        with suppress(FileNotFoundError):
+            os.rename(self.path, old_path)
+        os.rename(new_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def _download_keys(self):
+        """Download keys, returning a list of (url, content). Don't call it from the main loop thread"""
+        from umake.network.download_center import DownloadCenter, DownloadItem
+
+        done = Event()
+        results = {}
+
+        def _done(result):
+            results.update(result)
+            done.set()
+        DownloadCenter([DownloadItem(url) for url in self.key_urls], _done, download=False)
+        done.wait()
+        keys = []
+        for url in self.key_urls:
+            if results[url].error:
+                raise BaseException("Couldn't download {}: {}".format(url, results[url].error))
+            with results[url].buffer as buffer:
+                keys.append((url, buffer.getvalue()))
+        return keys
+
+    def ensure(self):
+        """Refresh the keyring if it's stale. Keep using it if the refresh fails but any key is still valid
+
+        Raise a BaseException if there is no usable key."""
+        with self._lock:
+            if not self.is_stale():
+                return
+            try:
+                self.refresh()
+            except BaseException as e:
+                if not any(self._keys_validity()):
+                    raise
+                logger.warning("Couldn't refresh {} keyring, keeping the current one: {}".format(self.name, e))
+
+    def force_refresh(self):
+        """Refresh the keyring even if it isn't stale, like when a signing key is missing from it"""
+        with self._lock:
+            self.refresh()
+
+    def ensure_in_background(self):
+        """Refresh the keyring if needed in a separate thread, so that it's ready when verifying signatures"""
+        def _ensure():
+            try:
+                self.ensure()
+            except BaseException as e:
+                # we'll try again when verifying
+                logger.debug("Couldn't prepare {} keyring: {}".format(self.name, e))
+        Thread(target=_ensure, name="Keyring", daemon=True).start()
+
+
+class Signature(namedtuple("Signature", ["keyring", "content"])):
+    """Detached signature content, armored or not, to check against a Keyring"""
+
+    def verifier(self, name):
+        """Return a SignatureVerifier of name content. Don't call it from the main loop thread"""
+        return SignatureVerifier(self.keyring, self.content, name)
+
+
+class SignatureVerifier:
+    """Verify a detached signature of content fed with update() while it's downloaded"""
+
+    FEED_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, keyring, signature, name):
+        self._keyring = keyring
+        self._signature = signature
+        self._name = name
+        self._process = None
+        self._signature_file = None
+        keyring.ensure()
+        self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _start(self):
+        self._signature_file = tempfile.NamedTemporaryFile(suffix=".sig")
+        self._signature_file.write(self._signature)
+        self._signature_file.flush()
+        try:
+            self._process = subprocess.Popen(self._keyring.gpg_command("--verify", self._signature_file.name, "-"),
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                             stderr=subprocess.DEVNULL, **_as_effective_user())
+        except OSError as e:
+            raise BaseException("Couldn't run gpg: {}".format(e))
+        self._gpg_exited = False
+
+    def update(self, data):
+        """Feed the next block of content"""
+        if self._gpg_exited:
+            return
+        try:
+            self._process.stdin.write(data)
+        except BrokenPipeError:
+            # gpg stopped reading, like on an invalid signature: finish() will tell
+            self._gpg_exited = True
+
+    def _wait(self):
+        with suppress(BrokenPipeError):
+            self._process.stdin.close()
+        status = _parse_status(self._process.stdout.read())
+        self._process.wait()
+        return status
+
+    def finish(self, dest=None):
+        """Check the signature once all content was fed
+
+        If the key is missing or expired, refresh the keyring and check dest content again. Raise a BaseException
+        if the signature isn't valid."""
+        status = self._wait()
+        keywords = {keyword for keyword, *_ in status}
+        if not self._is_valid(keywords) and dest is not None and keywords & {"NO_PUBKEY", "EXPKEYSIG", "KEYEXPIRED"}:
+            logger.info("Key of {} signature is missing or expired, refreshing {} keyring".format(
+                self._name, self._keyring.name))
+            self._keyring.force_refresh()
+            self.restart()
+            dest.seek(0)
+            for data in iter(lambda: dest.read(self.FEED_BLOCK_SIZE), b""):
+                self.update(data)
+            status = self._wait()
+            keywords = {keyword for keyword, *_ in status}
+        if not self._is_valid(keywords):
+            raise BaseException("Signature of {} isn't valid: {}".format(
+                self._name, ", ".join(" ".join(line) for line in status
+                                      if line[0] in ("BADSIG", "ERRSIG", "EXPKEYSIG", "REVKEYSIG", "NO_PUBKEY",
+                                                     "NODATA")) or "no valid signature found"))
+        logger.debug("Signature of {} is valid".format(self._name))
+
+    def _is_valid(self, keywords):
+        return (self._process.returncode == 0 and {"GOODSIG", "VALIDSIG"} <= keywords and
+                not keywords & {"BADSIG", "ERRSIG", "EXPKEYSIG", "REVKEYSIG"})
+
+    def restart(self):
+        """Forget any content fed until now"""
+        self.close()
+        self._start()
+
+    def close(self):
+        """Stop verifying, cleaning everything up"""
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.wait()
+            for stream in (self._process.stdin, self._process.stdout):
+                with suppress(BrokenPipeError):
+                    stream.close()
+            self._process = None
+        if self._signature_file is not None:
+            self._signature_file.close()
+            self._signature_file = None
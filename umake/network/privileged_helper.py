@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Privileged helper, installing package requirements as root for an unprivileged umake process
+
+Instead of running the whole umake command again as root, we start this small helper once with sudo or pkexec. It only
+enables foreign architectures and commits apt transactions, receiving requests and sending progress as json lines
+on its stdin and stdout, which are connected to one end of a socket pair."""
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+from threading import Lock
+
+from umake.tools import Singleton, get_root_command
+
+logger = logging.getLogger(__name__)
+
+
+class PrivilegedHelper(metaclass=Singleton):
+    """Client side of the privileged helper"""
+
+    def __init__(self):
+        self._process = None
+        self._reader = None
+        self._writer = None
+        self._lock = Lock()
+
+    @property
+    def started(self):
+        return self._process is not None
+
+    def start(self):
+        """Start the helper, asking for root credentials, if it's not running yet
+
+        Raise a BaseException if we couldn't get root access"""
+        with self._lock:
+            if self._process is not None:
+                return
+            logger.debug("Starting the privileged helper")
+            # pkexec can ask for credentials without any terminal
+            use_pkexec = not sys.stdin.isatty() and os.path.exists("/usr/bin/pkexec")
+            cmd = get_root_command(use_pkexec=use_pkexec) + [sys.executable, "-m", __name__,
+                                                             str(logging.root.getEffectiveLevel())]
+            parent_socket, child_socket = socket.socketpair()
+            try:
+                process = subprocess.Popen(cmd, stdin=child_socket, stdout=child_socket)
+            except OSError as e:
+                parent_socket.close()
+                raise BaseException("Couldn't start the privileged helper: {}".format(e))
+            finally:
+                child_socket.close()
+            self._reader = parent_socket.makefile("r", encoding="utf-8")
+            self._writer = parent_socket.makefile("w", encoding="utf-8")
+            parent_socket.close()
+            if self._read() is None:
+                process.wait()
+                self._reader.close()
+                self._writer.close()
+                raise BaseException("Couldn't get root access to install package requirements")
+            self._process = process
+
+    def stop(self):
+        """Stop the helper, if it's running"""
+        with self._lock:
+            if self._process is None:
+                return
+            logger.debug("Stopping the privileged helper")
+            self._writer.close()
+            self._reader.close()
+            self._process.wait()
+            self._process = None
+
+    def add_foreign_archs(self, archs, progress_callback=None):
+        """Enable foreign archs, updating the apt cache if needed. Return if any arch was added"""
+        return self._call({"command": "add_foreign_archs", "archs": archs}, progress_callback)
+
+    def install(self, packages, progress_callback=None):
+        """Install or upgrade packages in one apt transaction"""
+        self._call({"command": "install", "packages": packages}, progress_callback)
+
+    def _read(self):
+        """Return next message from the helper, None if it exited"""
+        line = self._reader.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def _call(self, request, progress_callback=None):
+        self.start()
+        with self._lock:
+            self._writer.write(json.dumps(request) + "\n")
+            self._writer.flush()
+            while True:
+                message = self._read()
+                if message is None:
+                    raise BaseException("The privileged helper exited unexpectedly")
+                if "progress" in message:
+                    if progress_callback:
+                        progress_callback(message["progress"])
+                elif "error" in message:
+                    raise BaseException(message["error"])
+                else:
+                    return message.get("result")
+
+
+def serve(requests, responses, handler):
+    """Answer json lines requests read from requests until it's closed, running them with handler as root"""
+
+    def send(message):
+        responses.write(json.dumps(message) + "\n")
+        responses.flush()
+
+    def report(progress):
+        send({"progress": progress})
+
+    send({"ready": True})
+    for line in requests:
+        try:
+            request = json.loads(line)
+            command = request.get("command")
+            logger.debug("Privileged helper request: {}".format(request))
+            if command == "add_foreign_archs":
+                result = handler.add_foreign_archs(request["archs"], report)
+            elif command == "install":
+                result = handler.install_packages(request["packages"], report)
+            else:
+                raise BaseException("Unknown privileged helper command: {}".format(command))
+        except BaseException as e:
+            send({"error": str(e)})
+        else:
+            send({"result": result})
+
+
+def main():
+    """Run the privileged helper on stdin and stdout"""
+    logging.basicConfig(level=int(sys.argv[1]) if len(sys.argv) > 1 else logging.WARNING,
+                        format="%(levelname)s: %(message)s")
+    from umake.network.requirements_handler import RequirementsHandler
+
+    # keep the protocol on a private descriptor: anything printed by apt or dpkg goes to stderr
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(sys.stdin, responses, RequirementsHandler())
+
+
+if __name__ == '__main__':
+    main()
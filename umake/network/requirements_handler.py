@@ -19,154 +19,299 @@
 
 """Module delivering a DownloadCenter to download in parallel multiple requests"""
 
-import apt
-import apt.progress
-import apt.progress.base
 from collections import namedtuple
 from concurrent import futures
-from contextlib import suppress
+from contextlib import contextmanager, suppress
 import fcntl
+import json
 import logging
 import os
 import re
+import shutil
+import struct
 import subprocess
 import tempfile
+import threading
 import time
+from xdg.BaseDirectory import xdg_cache_home
+from umake import settings, tracing
+from umake.network.privileged_helper import PrivilegedHelper
 from umake.tools import Singleton, add_foreign_arch, get_foreign_archs, get_current_arch, as_root
 
 logger = logging.getLogger(__name__)
 
 
+# dpkg frontends take the first lock for the whole transaction, dpkg itself takes the second one
+APT_LOCK_FILES = ("/var/lib/dpkg/lock-frontend", "/var/lib/dpkg/lock")
+_FLOCK_FORMAT = "hhqqi"
+
+
+def _get_lock_holder_from_proc(lock_file):
+    """Return the pid of the process locking lock_file as listed in /proc/locks, or None
+
+    Unlike F_GETLK, this doesn't need to open lock_file, which is only readable by root."""
+    stat = os.stat(lock_file)
+    lock_id = "{:02x}:{:02x}:{}".format(os.major(stat.st_dev), os.minor(stat.st_dev), stat.st_ino)
+    with open("/proc/locks") as f:
+        for line in f:
+            # 1: POSIX  ADVISORY  WRITE 1234 08:01:5678 0 EOF, blocked requests having an extra "->" field
+            fields = line.split()
+            if len(fields) >= 6 and fields[1] != "->" and fields[5] == lock_id:
+                return int(fields[4])
+    return None
+
+
+def get_apt_lock_holder(lock_files=APT_LOCK_FILES):
+    """Return the pid of the process holding the package manager lock (0 if it's in another pid namespace)
+
+    Return None if the lock is free, or if we can't read the lock files"""
+    for lock_file in lock_files:
+        try:
+            with open(lock_file) as f:
+                flock = struct.pack(_FLOCK_FORMAT, fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+                flock = fcntl.fcntl(f, fcntl.F_GETLK, flock)
+        except PermissionError:
+            # we don't run as root while waiting for the lock
+            pid = None
+            with suppress(OSError, ValueError):
+                pid = _get_lock_holder_from_proc(lock_file)
+            if pid is not None:
+                return pid
+            continue
+        except OSError:
+            continue
+        lock_type, _, _, _, pid = struct.unpack(_FLOCK_FORMAT, flock)
+        if lock_type != fcntl.F_UNLCK:
+            return pid
+    return None
+
+
+def get_process_name(pid):
+    """Return a readable name of process pid"""
+    try:
+        with open("/proc/{}/comm".format(pid)) as f:
+            name = f.read().strip()
+    except OSError:
+        return "another process"
+    # comm is truncated to 15 characters
+    if name.startswith("unattended-upgr"):
+        return "unattended-upgrades"
+    return "{} ({})".format(name, pid)
+
+
+# how to find the version in "<command> -version" output
+JAVA_VERSION_REGEXES = {"java": r"version \"([\d\.]+).*\"", "javac": r"([\d\.]+).*"}
+
+
+def parse_java_version(version):
+    """Return a java version string as a tuple of integers which can be compared. Legacy 1.x versions are x"""
+    numbers = tuple(int(number) for number in version.split(".") if number.isdigit())
+    if len(numbers) > 1 and numbers[0] == 1:
+        numbers = numbers[1:]
+    return numbers
+
+
+def _get_java_version_cache_path():
+    return os.path.join(xdg_cache_home, settings.CONFIG_FILENAME, settings.JAVA_VERSION_CACHE_FILENAME)
+
+
+def _load_java_version_cache():
+    try:
+        with open(_get_java_version_cache_path()) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def get_java_version(command):
+    """Return the version printed by "command -version" (java or javac), or None if command isn't available
+
+    Probing starts a JVM: results are cached on disk, keyed on the resolved command path and its modification time
+    so that switching alternatives or upgrading the jdk probes again."""
+    path = shutil.which(command)
+    if path is None:
+        logger.debug("Missing {} command: consider it not installed".format(command))
+        return None
+    path = os.path.realpath(path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    cache = _load_java_version_cache()
+    entry = cache.get(path)
+    if isinstance(entry, dict) and entry.get("mtime") == mtime:
+        logger.debug("Using cached version of {}".format(path))
+        return entry.get("version")
+
+    try:
+        output = subprocess.check_output([path, "-version"], stderr=subprocess.STDOUT).decode()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug("Couldn't get {} version: {}".format(path, e))
+        return None
+    version = re.search(JAVA_VERSION_REGEXES[command], output)
+    version = version.group(1) if version else None
+
+    cache[path] = {"mtime": mtime, "version": version}
+    cache_path = _get_java_version_cache_path()
+    temp_cache_path = "{}.{}.new".format(cache_path, os.getpid())
+    with suppress(OSError):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(temp_cache_path, "w") as f:
+            json.dump(cache, f)
+        os.rename(temp_cache_path, cache_path)
+    return version
+
+
 class RequirementsHandler(object, metaclass=Singleton):
     """Handle platform requirements"""
 
-    STATUS_DOWNLOADING, STATUS_INSTALLING = range(2)
+    STATUS_DOWNLOADING, STATUS_INSTALLING, STATUS_WAITING_LOCK = range(3)
 
     RequirementsResult = namedtuple("RequirementsResult", ["bucket", "error"])
 
-    def __init__(self):
-        logger.info("Create a new apt cache")
-        self.cache = apt.Cache()
-        self.executor = futures.ThreadPoolExecutor(max_workers=1)
+    # buckets installed within that many seconds are merged in one apt transaction. 0 doesn't wait for other buckets
+    MERGE_WINDOW = 0
+
+    # maximum time, in seconds, to wait for another process to release the package manager lock
+    APT_LOCK_TIMEOUT = 600
+    APT_LOCK_MAX_POLL_DELAY = 2
 
-        # Set defaults for openjdk override
-        self.jre_installed_version = None
-        self.jdk_installed_version = None
+    def __init__(self):
+        self._cache = None
+        self.executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="RequirementsHandler")
+        self._pending_buckets = []
+        self._pending_lock = threading.Lock()
+        self._batch_depth = 0
+        self._merge_timer = None
+        self._uptodate_checks = []
+        # the cache is read from the main thread and from background up to date checks
+        self._cache_lock = threading.RLock()
+
+        # java and javac versions, for openjdk override
+        self._java_versions = {}
+
+    @property
+    def cache(self):
+        """apt cache, only opened when needed"""
+        with self._cache_lock:
+            if self._cache is None:
+                import apt
+                logger.info("Create a new apt cache")
+                self._cache = apt.Cache()
+            return self._cache
+
+    @cache.setter
+    def cache(self, cache):
+        self._cache = cache
 
     def is_bucket_installed(self, bucket):
         """Check if the bucket is installed
 
         The bucket is a list of packages to check if installed."""
-        logger.debug("Check if {} is installed".format(bucket))
-        is_installed = True
-        for pkg_name in bucket:
-            if ' | ' in pkg_name:
-                for package in pkg_name.split(' | '):
-                    if self.is_bucket_installed([package]):
-                        bucket.remove(pkg_name)
-                        bucket.append(package)
-                        pkg_name = package
-                        break
-            # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't
-            # understand that. strip :arch then
-            if ":" in pkg_name:
-                (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
-                if arch == get_current_arch():
-                    pkg_name = pkg_without_arch_name
-            if pkg_name not in self.cache or not self.cache[pkg_name].is_installed:
-                if "openjdk" in pkg_name:
-                    is_installed = self.check_java_equiv(pkg_name)
-                else:
-                    logger.info("{} isn't installed".format(pkg_name))
-                    is_installed = False
-        return is_installed
+        with self._cache_lock:
+            logger.debug("Check if {} is installed".format(bucket))
+            is_installed = True
+            for pkg_name in bucket:
+                if ' | ' in pkg_name:
+                    for package in pkg_name.split(' | '):
+                        if self.is_bucket_installed([package]):
+                            bucket.remove(pkg_name)
+                            bucket.append(package)
+                            pkg_name = package
+                            break
+                # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't
+                # understand that. strip :arch then
+                if ":" in pkg_name:
+                    (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
+                    if arch == get_current_arch():
+                        pkg_name = pkg_without_arch_name
+                if pkg_name not in self.cache or not self.cache[pkg_name].is_installed:
+                    if "openjdk" in pkg_name:
+                        is_installed = self.check_java_equiv(pkg_name)
+                    else:
+                        logger.info("{} isn't installed".format(pkg_name))
+                        is_installed = False
+            return is_installed
 
     def is_bucket_available(self, bucket):
         """Check if bucket available on the platform"""
-        all_in_cache = True
-        for pkg_name in bucket:
-            if ' | ' in pkg_name:
-                for package in pkg_name.split(' | '):
-                    if self.is_bucket_available([package]):
-                        bucket.remove(pkg_name)
-                        bucket.append(package)
-                        pkg_name = package
-                        break
-            if pkg_name not in self.cache:
-                # this can be also a foo:arch and we don't have <arch> added. Tell is may be available
-                if ":" in pkg_name:
-                    # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't
-                    # understand that. strip :arch then
-                    (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
-                    if arch == get_current_arch() and pkg_without_arch_name in self.cache:  # false positive, available
-                        continue
-                    elif arch not in get_foreign_archs():  # relax the constraint
-                        logger.info("{} isn't available on this platform, but {} isn't enabled. So it may be available "
-                                    "later on".format(pkg_name, arch))
-                        continue
-                if "openjdk" in pkg_name:
-                    if not self.check_java_equiv(pkg_name):
+        with self._cache_lock:
+            all_in_cache = True
+            for pkg_name in bucket:
+                if ' | ' in pkg_name:
+                    for package in pkg_name.split(' | '):
+                        if self.is_bucket_available([package]):
+                            bucket.remove(pkg_name)
+                            bucket.append(package)
+                            pkg_name = package
+                            break
+                if pkg_name not in self.cache:
+                    # this can be also a foo:arch and we don't have <arch> added. Tell is may be available
+                    if ":" in pkg_name:
+                        # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't
+                        # understand that. strip :arch then
+                        (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
+                        # false positive, available
+                        if arch == get_current_arch() and pkg_without_arch_name in self.cache:
+                            continue
+                        elif arch not in get_foreign_archs():  # relax the constraint
+                            logger.info("{} isn't available on this platform, but {} isn't enabled. So it may be "
+                                        "available later on".format(pkg_name, arch))
+                            continue
+                    if "openjdk" in pkg_name:
+                        if not self.check_java_equiv(pkg_name):
+                            all_in_cache = False
+                    else:
+                        logger.info("{} isn't available on this platform".format(pkg_name))
                         all_in_cache = False
-                else:
-                    logger.info("{} isn't available on this platform".format(pkg_name))
-                    all_in_cache = False
-        return all_in_cache
+            return all_in_cache
 
     def is_bucket_uptodate(self, bucket):
         """Check if the bucket is installed and up to date
 
         The bucket is a list of packages to check if installed."""
-        logger.debug("Check if {} is up to date".format(bucket))
-        is_installed_and_uptodate = True
-        for pkg_name in bucket:
-            if ' | ' in pkg_name:
-                for package in pkg_name.split(' | '):
-                    if self.is_bucket_available([package]):
-                        bucket.remove(pkg_name)
-                        bucket.append(package)
-                        pkg_name = package
-                        break
-            # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't
-            # understand that. strip :arch then
-            if ":" in pkg_name:
-                (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
-                if arch == get_current_arch():
-                    pkg_name = pkg_without_arch_name
-            if pkg_name not in self.cache or not self.cache[pkg_name].is_installed:
-                logger.info("{} isn't installed".format(pkg_name))
-                is_installed_and_uptodate = False
-            elif self.cache[pkg_name].is_upgradable:
-                logger.info("We can update {}".format(pkg_name))
-                is_installed_and_uptodate = False
-            if "openjdk" in pkg_name:
-                if self.check_java_equiv(pkg_name):
-                    is_installed_and_uptodate = True
-        return is_installed_and_uptodate
+        with self._cache_lock:
+            logger.debug("Check if {} is up to date".format(bucket))
+            is_installed_and_uptodate = True
+            for pkg_name in bucket:
+                if ' | ' in pkg_name:
+                    for package in pkg_name.split(' | '):
+                        if self.is_bucket_available([package]):
+                            bucket.remove(pkg_name)
+                            bucket.append(package)
+                            pkg_name = package
+                            break
+                # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't
+                # understand that. strip :arch then
+                if ":" in pkg_name:
+                    (pkg_without_arch_name, arch) = pkg_name.split(":", -1)
+                    if arch == get_current_arch():
+                        pkg_name = pkg_without_arch_name
+                if pkg_name not in self.cache or not self.cache[pkg_name].is_installed:
+                    logger.info("{} isn't installed".format(pkg_name))
+                    is_installed_and_uptodate = False
+                elif self.cache[pkg_name].is_upgradable:
+                    logger.info("We can update {}".format(pkg_name))
+                    is_installed_and_uptodate = False
+                if "openjdk" in pkg_name:
+                    if self.check_java_equiv(pkg_name):
+                        is_installed_and_uptodate = True
+            return is_installed_and_uptodate
 
     def check_java_equiv(self, pkg_name):
         """Add exception if java has been installed otherwhise"""
         openjdk_regex = re.search(r"openjdk-(\d+)-(j\w\w)", pkg_name)
         required_version = openjdk_regex.group(1)
         required_release = openjdk_regex.group(2)
-        if required_release == "jre":
-            if not self.jre_installed_version:
-                try:
-                    self.jre_installed_version = subprocess.check_output(["java", "-version"],
-                                                                         stderr=subprocess.STDOUT).decode()
-                except FileNotFoundError as e:
-                    logger.debug("Missing java command: consider it not installed")
-                    return False
-            installed_version = re.search(r"version \"([\d\.]+).*\"", self.jre_installed_version).group(1)
-        elif required_release == "jdk":
-            if not self.jdk_installed_version:
-                try:
-                    self.jdk_installed_version = subprocess.check_output(["javac", "-version"],
-                                                                         stderr=subprocess.STDOUT).decode()
-                except FileNotFoundError as e:
-                    logger.debug("Missing javac command: consider it not installed")
-                    return False
-            installed_version = re.search(r"([\d\.]+).*", self.jdk_installed_version).group(1)
-        if installed_version >= required_version:
+        command = "javac" if required_release == "jdk" else "java"
+        if command not in self._java_versions:
+            self._java_versions[command] = get_java_version(command)
+        installed_version = self._java_versions[command]
+        if not installed_version:
+            return False
+        if parse_java_version(installed_version) >= parse_java_version(required_version):
             logger.debug("Not installing openjdk since correct java version is already available")
             return True
         return False
@@ -175,47 +320,79 @@ class RequirementsHandler(object, metaclass=Singleton):
         """Install a specific bucket. If any other bucket is in progress, queue the request
 
         bucket is a list of packages to install.
+        Buckets installed in a batch() context, or within MERGE_WINDOW seconds, are installed in the same apt
+        transaction. Each bucket still gets its own progress and installed callbacks.
 
         Return a tuple (num packages to install, size packages to download)"""
         logger.info("Installation {} pending".format(bucket))
         bucket_pack = {
             "bucket": bucket,
             "progress_callback": progress_callback,
-            "installed_callback": installed_callback
+            "installed_callback": installed_callback,
+            "error": None,
+            "uptodate": False
         }
 
-        pkg_to_install = not self.is_bucket_uptodate(bucket)
-
-        future = self.executor.submit(self._really_install_bucket, bucket_pack)
-        future.tag_bucket = bucket_pack
-        future.add_done_callback(self._on_done)
+        with self._pending_lock:
+            uptodate_check = next((check for check in self._uptodate_checks if check[0] is bucket), None)
+            if uptodate_check is not None:
+                self._uptodate_checks.remove(uptodate_check)
+        # use the check started beforehand, unless it's still queued behind another transaction
+        if uptodate_check is not None and not uptodate_check[1].cancel():
+            pkg_to_install = not uptodate_check[1].result()
+            bucket[:] = uptodate_check[2]
+        else:
+            pkg_to_install = not self.is_bucket_uptodate(bucket)
+        bucket_pack["uptodate"] = not pkg_to_install
+
+        with self._pending_lock:
+            self._pending_buckets.append(bucket_pack)
+            if self._batch_depth or self._merge_timer is not None:
+                return pkg_to_install
+            if self.MERGE_WINDOW > 0:
+                self._merge_timer = threading.Timer(self.MERGE_WINDOW, self._submit_pending_buckets)
+                self._merge_timer.daemon = True
+                self._merge_timer.start()
+                return pkg_to_install
+        self._submit_pending_buckets()
         return pkg_to_install
 
-    def _really_install_bucket(self, current_bucket):
-        """Really install current bucket and bind signals"""
-        bucket = current_bucket["bucket"]
-        logger.debug("Starting {} installation".format(bucket))
-
-        # exchange file output for apt and dpkg after the fork() call (open it empty)
-        self.apt_fd = tempfile.NamedTemporaryFile(delete=False)
-        self.apt_fd.close()
-
-        if self.is_bucket_uptodate(bucket):
-            return True
-
-        need_cache_reload = False
-        for pkg_name in bucket:
-            if ":" in pkg_name:
-                arch = pkg_name.split(":", -1)[-1]
-                need_cache_reload = need_cache_reload or add_foreign_arch(arch)
-
-        if need_cache_reload:
-            with as_root():
-                self._force_reload_apt_cache()
-                self.cache.update()
-            self._force_reload_apt_cache()
+    def check_bucket_uptodate(self, bucket):
+        """Start checking if bucket is installed and up to date in the background
+
+        A later install_bucket() call on the same bucket list picks up the result instead of checking it again. The
+        check works on a copy of bucket, install_bucket() then applies the alternatives it resolved."""
+        checked_bucket = list(bucket)
+        future = self.executor.submit(self.is_bucket_uptodate, checked_bucket)
+        with self._pending_lock:
+            self._uptodate_checks.append((bucket, future, checked_bucket))
+
+    @contextmanager
+    def batch(self):
+        """Install all buckets requested in this context in one apt transaction, once leaving it"""
+        with self._pending_lock:
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._pending_lock:
+                self._batch_depth -= 1
+            self._submit_pending_buckets()
+
+    def _submit_pending_buckets(self):
+        """Queue one apt transaction for all pending buckets"""
+        with self._pending_lock:
+            self._merge_timer = None
+            if self._batch_depth or not self._pending_buckets:
+                return
+            bucket_packs = self._pending_buckets
+            self._pending_buckets = []
+        future = self.executor.submit(self._really_install_buckets, bucket_packs)
+        future.tag_buckets = bucket_packs
+        future.add_done_callback(self._on_done)
 
-        # mark for install and so on
+    def _mark_bucket(self, bucket):
+        """Mark all packages of the bucket for installation or upgrade"""
         for pkg_name in bucket:
             # /!\ danger: if current arch == ':appended_arch', on a non multiarch system, dpkg doesn't understand that
             # strip :arch then
@@ -235,132 +412,179 @@ class RequirementsHandler(object, metaclass=Singleton):
                 message = "Can't mark for install {}: {}".format(pkg_name, msg)
                 raise BaseException(message)
 
-        # this can raise on installedArchives() exception if the commit() fails
-        with as_root():
-            self.cache.commit(fetch_progress=self._FetchProgress(current_bucket,
-                                                                 self.STATUS_DOWNLOADING,
-                                                                 current_bucket["progress_callback"]),
-                              install_progress=self._InstallProgress(current_bucket,
-                                                                     self.STATUS_INSTALLING,
-                                                                     current_bucket["progress_callback"],
-                                                                     self._force_reload_apt_cache,
-                                                                     self.apt_fd.name))
+    @tracing.traced("apt")
+    def _really_install_buckets(self, bucket_packs):
+        """Really install all buckets in one transaction and bind signals"""
+        bucket = []
+        for bucket_pack in bucket_packs:
+            for pkg_name in bucket_pack["bucket"]:
+                if pkg_name not in bucket:
+                    bucket.append(pkg_name)
+        logger.debug("Starting {} installation".format(bucket))
+
+        # exchange file output for apt and dpkg after the fork() call (open it empty)
+        self.apt_fd = tempfile.NamedTemporaryFile(delete=False)
+        self.apt_fd.close()
+
+        # buckets were all checked when requested
+        if all(bucket_pack["uptodate"] for bucket_pack in bucket_packs):
+            return True
+
+        def progress_callback(report):
+            for bucket_pack in bucket_packs:
+                if not bucket_pack["error"]:
+                    bucket_pack["progress_callback"](report)
+
+        # when we aren't root, the privileged helper enables foreign archs and commits the transaction
+        helper = PrivilegedHelper() if PrivilegedHelper().started else None
+
+        archs = []
+        for pkg_name in bucket:
+            if ":" in pkg_name:
+                arch = pkg_name.split(":", -1)[-1]
+                if arch not in archs:
+                    archs.append(arch)
+        if archs:
+            if helper:
+                if helper.add_foreign_archs(archs, progress_callback):
+                    self._force_reload_apt_cache(progress_callback)
+            else:
+                self.add_foreign_archs(archs, progress_callback)
+
+        # mark for install and so on. A bucket which can't be marked fails alone, without its packages
+        marked_bucket_packs = []
+        for bucket_pack in bucket_packs:
+            try:
+                self._mark_bucket(bucket_pack["bucket"])
+                marked_bucket_packs.append(bucket_pack)
+            except BaseException as e:
+                bucket_pack["error"] = str(e)
+                self.cache.clear()
+                for marked_bucket_pack in marked_bucket_packs:
+                    self._mark_bucket(marked_bucket_pack["bucket"])
+        if not marked_bucket_packs:
+            return True
+
+        if helper:
+            packages = []
+            for marked_bucket_pack in marked_bucket_packs:
+                for pkg_name in marked_bucket_pack["bucket"]:
+                    if pkg_name not in packages:
+                        packages.append(pkg_name)
+            self.cache.clear()
+            helper.install(packages, progress_callback)
+            self._force_reload_apt_cache(progress_callback)
+        else:
+            self._commit(bucket, progress_callback)
 
         return True
 
+    def add_foreign_archs(self, archs, progress_callback=None):
+        """Enable foreign archs and update the apt cache if any was added, as root. Return if the cache was updated"""
+        need_cache_reload = False
+        for arch in archs:
+            need_cache_reload = add_foreign_arch(arch) or need_cache_reload
+
+        if need_cache_reload:
+            self._force_reload_apt_cache(progress_callback)
+            with as_root():
+                self.cache.update()
+            self._force_reload_apt_cache(progress_callback)
+        return need_cache_reload
+
+    def install_packages(self, packages, progress_callback=None):
+        """Install or upgrade packages in one apt transaction, as root"""
+        self.apt_fd = tempfile.NamedTemporaryFile(delete=False)
+        self.apt_fd.close()
+        try:
+            self._force_reload_apt_cache(progress_callback)
+            self._mark_bucket(packages)
+            self._commit(packages, progress_callback)
+        except BaseException as e:
+            with open(self.apt_fd.name) as f:
+                subprocess_content = f.read()
+            if subprocess_content:
+                raise BaseException("{}\nSubprocess output: {}".format(e, subprocess_content))
+            raise
+        finally:
+            os.remove(self.apt_fd.name)
+
+    def _commit(self, bucket, progress_callback):
+        """Commit packages marked for installation in one apt transaction, as root"""
+        from umake.network.apt_progress import FetchProgress, InstallProgress
+        transaction = {"bucket": bucket, "progress_callback": progress_callback}
+
+        def force_reload_apt_cache():
+            self._force_reload_apt_cache(progress_callback)
+
+        # don't block other threads needing root while waiting for the lock
+        self._wait_for_apt_lock(time.monotonic() + self.APT_LOCK_TIMEOUT, progress_callback)
+        # this can raise on installedArchives() exception if the commit() fails
+        with as_root():
+            self.cache.commit(fetch_progress=FetchProgress(transaction,
+                                                           self.STATUS_DOWNLOADING,
+                                                           transaction["progress_callback"]),
+                              install_progress=InstallProgress(transaction,
+                                                               self.STATUS_INSTALLING,
+                                                               transaction["progress_callback"],
+                                                               force_reload_apt_cache,
+                                                               self.apt_fd.name))
+
     def _on_done(self, future):
-        """Call future associated bucket done callback"""
-        result = self.RequirementsResult(bucket=future.tag_bucket["bucket"], error=None)
+        """Call the done callback of every bucket of the transaction"""
+        transaction_error = None
         if future.exception():
-            error_message = str(future.exception())
+            transaction_error = str(future.exception())
             with suppress(FileNotFoundError):
                 with open(self.apt_fd.name) as f:
                     subprocess_content = f.read()
                     if subprocess_content:
-                        error_message = "{}\nSubprocess output: {}".format(error_message, subprocess_content)
-            logger.error(error_message)
-            result = result._replace(error=error_message)
-        else:
-            logger.debug("{} installed".format(future.tag_bucket["bucket"]))
-        os.remove(self.apt_fd.name)
-        future.tag_bucket["installed_callback"](result)
-
-    def _force_reload_apt_cache(self):
-        """Loop on loading apt cache in case something else is updating"""
-        try:
-            self.cache.open()
-        except SystemError:
-            time.sleep(1)
-            self._force_reload_apt_cache()
-
-    class _FetchProgress(apt.progress.base.AcquireProgress):
-        """Progress handler for downloading a bucket"""
-        def __init__(self, bucket, status, progress_callback,):
-            apt.progress.base.AcquireProgress.__init__(self)
-            self._bucket = bucket
-            self._status = status
-            self._progress_callback = progress_callback
-
-        def pulse(self, owner):
-            percent = (((self.current_bytes + self.current_items) * 100.0) /
-                       float(self.total_bytes + self.total_items))
-            logger.debug("{} download update: {}% of {}".format(self._bucket['bucket'], percent, self.total_bytes))
-            report = {"step": self._status, "percentage": percent, "pkg_size_download": self.total_bytes}
-            self._progress_callback(report)
-
-    class _InstallProgress(apt.progress.base.InstallProgress):
-        """Progress handler for installing a bucket"""
-        def __init__(self, bucket, status, progress_callback, force_load_apt_cache, exchange_filename):
-            apt.progress.base.InstallProgress.__init__(self)
-            self._bucket = bucket
-            self._status = status
-            self._progress_callback = progress_callback
-            self._force_reload_apt_cache = force_load_apt_cache
-            self._exchange_filename = exchange_filename
-
-        def error(self, pkg, msg):
-            logger.error("{} installation finished with an error: {}".format(self._bucket['bucket'], msg))
-            self._force_reload_apt_cache()  # reload apt cache
-            raise BaseException(msg)
-
-        def finish_update(self):
-            # warning: this function can be called even if dpkg failed (it raised an exception around commit()
-            # DO NOT CALL directly the callbacks from there.
-            logger.debug("Install for {} ended.".format(self._bucket['bucket']))
-            self._force_reload_apt_cache()  # reload apt cache
-
-        def status_change(self, pkg, percent, status):
-            logger.debug("{} install update: {}".format(self._bucket['bucket'], percent))
-            self._progress_callback({"step": self._status, "percentage": percent})
-
-        @staticmethod
-        def _redirect_stdin():  # pragma: no cover (in a fork)
-            os.dup2(os.open(os.devnull, os.O_RDWR), 0)
-
-        def _redirect_output(self):  # pragma: no cover (in a fork)
-            fd = os.open(self._exchange_filename, os.O_RDWR)
-            os.dup2(fd, 1)
-            os.dup2(fd, 2)
-
-        def _fixup_fds(self):  # pragma: no cover (in a fork)
-            required_fds = [0, 1, 2,  # stdin, stdout, stderr
-                            self.writefd,
-                            self.write_stream.fileno(),
-                            self.statusfd,
-                            self.status_stream.fileno()
-                            ]
-            # ensure that our required fds close on exec
-            for fd in required_fds[3:]:
-                old_flags = fcntl.fcntl(fd, fcntl.F_GETFD)
-                fcntl.fcntl(fd, fcntl.F_SETFD, old_flags | fcntl.FD_CLOEXEC)
-            # close all fds
-            proc_fd = "/proc/self/fd"
-            if os.path.exists(proc_fd):
-                error_count = 0
-                for fdname in os.listdir(proc_fd):
-                    try:
-                        fd = int(fdname)
-                    except ValueError:
-                        print("ERROR: can not get fd for '%s'" % fdname)
-                    if fd in required_fds:
-                        continue
-                    try:
-                        os.close(fd)
-                    except OSError as e:
-                        # there will be one fd that can not be closed
-                        # as its the fd from pythons internal diropen()
-                        # so its ok to ignore one close error
-                        error_count += 1
-                        if error_count > 1:
-                            print("ERROR: os.close(%s): %s" % (fd, e))
-
-        def fork(self):
-            pid = os.fork()
-            if pid == 0:  # pragma: no cover
-                # be root
-                os.seteuid(0)
-                os.setegid(0)
-                self._fixup_fds()
-                self._redirect_stdin()
-                self._redirect_output()
-            return pid
+                        transaction_error = "{}\nSubprocess output: {}".format(transaction_error,
+                                                                               subprocess_content)
+            logger.error(transaction_error)
+        with suppress(FileNotFoundError):
+            os.remove(self.apt_fd.name)
+        for bucket_pack in future.tag_buckets:
+            result = self.RequirementsResult(bucket=bucket_pack["bucket"], error=transaction_error)
+            if bucket_pack["error"]:
+                logger.error(bucket_pack["error"])
+                result = result._replace(error=bucket_pack["error"])
+            elif not transaction_error:
+                logger.debug("{} installed".format(bucket_pack["bucket"]))
+            bucket_pack["installed_callback"](result)
+
+    def _force_reload_apt_cache(self, progress_callback=None):
+        """Load the apt cache, waiting for the package manager lock if something else is updating"""
+        deadline = time.monotonic() + self.APT_LOCK_TIMEOUT
+        delay = 0.1
+        while True:
+            try:
+                self.cache.open()
+                return
+            except SystemError:
+                if time.monotonic() > deadline:
+                    raise
+            # the cache can't be opened for another reason than the lock: retry later
+            if not self._wait_for_apt_lock(deadline, progress_callback):
+                time.sleep(delay)
+                delay = min(delay * 2, self.APT_LOCK_MAX_POLL_DELAY)
+
+    def _wait_for_apt_lock(self, deadline, progress_callback=None):
+        """Wait until deadline for the package manager lock to be released, reporting the process holding it.
+
+        Return False if the lock wasn't held"""
+        pid = get_apt_lock_holder()
+        if pid is None:
+            return False
+        holder = get_process_name(pid)
+        logger.info("Waiting for {} to release the package manager lock".format(holder))
+        if progress_callback:
+            progress_callback({"step": self.STATUS_WAITING_LOCK, "percentage": 0, "holder": holder})
+        delay = 0.1
+        while get_apt_lock_holder() is not None:
+            if time.monotonic() > deadline:
+                raise BaseException("{} didn't release the package manager lock in time".format(holder))
+            time.sleep(delay)
+            delay = min(delay * 2, self.APT_LOCK_MAX_POLL_DELAY)
+        logger.info("Package manager lock released by {}".format(holder))
+        return True
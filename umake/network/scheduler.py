@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Share the bandwidth between downloads, by priority class and under optional rate limits
+
+Downloads are metadata (provider pages, checksums, icons… that the user is waiting for), artifacts, or background
+prefetches. While a download of a more urgent class is running, less urgent ones pause, so that small interactive
+fetches don't queue behind a multi-GB tarball. Total and per download rates can be capped with --limit-rate and
+--limit-rate-per-download."""
+
+from collections import Counter
+from enum import Enum
+import logging
+from threading import Lock
+from time import monotonic, sleep
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadPriority(Enum):
+    """Download priority classes, the most urgent first"""
+    metadata = 0
+    artifact = 1
+    prefetch = 2
+
+
+def parse_rate(rate):
+    """Parse a rate in bytes per second, with an optional k, m or g suffix (like 500k or 1.5M)
+
+    Raise a ValueError if rate isn't valid"""
+    multiplier = 1
+    suffix = rate[-1:].lower()
+    if suffix in ("k", "m", "g"):
+        multiplier = 1024 ** ("kmg".index(suffix) + 1)
+        rate = rate[:-1]
+    try:
+        value = int(float(rate) * multiplier)
+    except ValueError:
+        raise ValueError("invalid rate: {}".format(rate))
+    if value <= 0:
+        raise ValueError("rate should be positive: {}".format(rate))
+    return value
+
+
+class TokenBucket:
+    """Allow rate bytes per second on average, with bursts of up to burst_duration seconds of traffic
+
+    Bytes are taken once read: the bucket can go in debt, which is then paid back by waiting."""
+
+    def __init__(self, rate, burst_duration=0.25):
+        self.rate = rate
+        self._burst = rate * burst_duration
+        self._tokens = self._burst
+        self._last = monotonic()
+        self._lock = Lock()
+
+    def consume(self, size):
+        """Take size bytes, returning how long to wait, in seconds, before reading more"""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= size
+            return max(0, -self._tokens / self.rate)
+
+
+class DownloadSlot:
+    """A running download, as seen by the scheduler. Use DownloadScheduler().start() to get one"""
+
+    def __init__(self, scheduler, priority, rate=None):
+        self._scheduler = scheduler
+        self.priority = priority
+        self._bucket = TokenBucket(rate) if rate else None
+        self._preempted_since = None
+        self.running = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def set_priority(self, priority):
+        self._scheduler._move(self, priority)
+
+    def consume(self, size):
+        """Account size bytes just read, returning how long to wait, in seconds, before reading more
+
+        Call it again with 0 after waiting, until there is nothing more to wait."""
+        delay = self._scheduler._consume(size)
+        if self._bucket is not None:
+            delay = max(delay, self._bucket.consume(size))
+        if self._scheduler._is_preempted(self):
+            now = monotonic()
+            if self._preempted_since is None:
+                logger.debug("Pausing {} download for more urgent ones".format(self.priority.name))
+                self._preempted_since = now
+            # don't pause forever behind a stalled download
+            if now - self._preempted_since < self._scheduler.PREEMPTION_TIMEOUT:
+                delay = max(delay, self._scheduler.POLL_DELAY)
+        else:
+            self._preempted_since = None
+        return min(delay, self._scheduler.POLL_DELAY)
+
+    def throttle(self, size, check_cancelled=lambda: None):
+        """Account size bytes just read, and wait as long as needed before reading more
+
+        check_cancelled is called while waiting, and should raise to stop the download."""
+        delay = self.consume(size)
+        while delay:
+            sleep(delay)
+            check_cancelled()
+            delay = self.consume(0)
+
+    def close(self):
+        self._scheduler._stop(self)
+
+
+class DownloadScheduler(metaclass=Singleton):
+    """Keep track of running downloads priority, and of the total rate limit"""
+
+    # less urgent downloads pause for at most this long, in seconds, and poll at this interval
+    PREEMPTION_TIMEOUT = 10
+    POLL_DELAY = 0.1
+
+    def __init__(self):
+        self._lock = Lock()
+        self._running = Counter()
+        self._bucket = None
+        self._per_download_rate = None
+
+    def set_rate_limits(self, total=None, per_download=None):
+        """Cap the total and per download rates, in bytes per second. None means unlimited"""
+        logger.debug("Download rate limits: {} total, {} per download".format(total or "unlimited",
+                                                                              per_download or "unlimited"))
+        self._bucket = TokenBucket(total) if total else None
+        self._per_download_rate = per_download
+
+    def start(self, priority):
+        """Register a new running download of priority, returning its DownloadSlot"""
+        slot = DownloadSlot(self, priority, self._per_download_rate)
+        with self._lock:
+            self._running[priority] += 1
+        return slot
+
+    def _move(self, slot, priority):
+        with self._lock:
+            if slot.running:
+                self._running[slot.priority] -= 1
+                self._running[priority] += 1
+            slot.priority = priority
+
+    def _stop(self, slot):
+        with self._lock:
+            if slot.running:
+                self._running[slot.priority] -= 1
+                slot.running = False
+
+    def _is_preempted(self, slot):
+        with self._lock:
+            return any(count > 0 for priority, count in self._running.items()
+                       if priority.value < slot.priority.value)
+
+    def _consume(self, size):
+        bucket = self._bucket
+        return bucket.consume(size) if bucket is not None else 0
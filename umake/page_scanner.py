@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Single pass extraction of download links from provider pages"""
+
+import codecs
+from io import StringIO
+import re
+
+
+def decode_lines(buffer, encoding="utf-8"):
+    """Generate the decoded lines of a binary buffer, without reading it whole"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for line in buffer:
+        yield decoder.decode(line)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+class PageScanner:
+    """Extract download url, checksum and license from a provider page, declared with precompiled patterns.
+
+    url and checksum are regular expressions (as strings or compiled) whose first group is the extracted value. They
+    are matched within a line.
+    If section_start is set, they are only searched in sections going from the line containing section_start to the
+    line containing section_end included (or the end of the page).
+    The license text goes from the line containing license_start to the line containing license_end excluded.
+
+    The page is scanned line by line, stopping as soon as a section delivered the url (and the checksum if there is a
+    checksum pattern) and no license is requested."""
+
+    def __init__(self, url, checksum=None, section_start=None, section_end=None, license_start=None,
+                 license_end=None):
+        self.url_regex = re.compile(url)
+        self.checksum_regex = re.compile(checksum) if checksum is not None else None
+        self.section_start = section_start
+        self.section_end = section_end
+        self.license_start = license_start
+        self.license_end = license_end
+
+    @staticmethod
+    def _search(regex, line, last):
+        match = None
+        if last:
+            for match in regex.finditer(line):
+                pass
+        else:
+            match = regex.search(line)
+        return match.group(1) if match else None
+
+    def scan_lines(self, lines, match_last=False, license_txt=None):
+        """Return (url, checksum) found in lines, with None for missing values.
+
+        If match_last is set, the last url and checksum of the page are returned instead of the first ones.
+        If license_txt is set, the license text is written to it, and all lines are read."""
+        url, checksum = (None, None)
+        section_url, section_checksum = (None, None)
+        in_section = self.section_start is None
+        in_license = False
+        for line in lines:
+            if license_txt is not None and self.license_start is not None:
+                in_license = self._scan_license_line(line, license_txt, in_license)
+
+            if not in_section:
+                if url is not None and not match_last and \
+                        (self.checksum_regex is None or checksum is not None):
+                    if license_txt is None:
+                        break
+                    continue
+                if self.section_start not in line:
+                    continue
+                in_section = True
+
+            if match_last or section_url is None:
+                section_url = self._search(self.url_regex, line, match_last) or section_url
+            if self.checksum_regex is not None and (match_last or section_checksum is None):
+                section_checksum = self._search(self.checksum_regex, line, match_last) or section_checksum
+
+            if self.section_start is not None and self.section_end is not None and self.section_end in line:
+                in_section = False
+                url = section_url or url
+                checksum = section_checksum or checksum
+                section_url, section_checksum = (None, None)
+            elif license_txt is None and not match_last and section_url is not None and \
+                    (self.checksum_regex is None or section_checksum is not None):
+                # the rest of the section can't change anything
+                break
+        # last section, up to the end of the page
+        url = section_url or url
+        checksum = section_checksum or checksum
+        return url, checksum
+
+    def _scan_license_line(self, line, license_txt, in_license):
+        """Write line to license_txt if it belongs to the license, return if we are in the license after it"""
+        if in_license:
+            if self.license_end is not None and self.license_end in line:
+                in_license = False
+            else:
+                license_txt.write(line)
+                return True
+            # another license can start on the line ending the previous one
+            if self.license_start not in line:
+                return False
+        elif self.license_start not in line:
+            return False
+        # the license ends on the line it starts on
+        if self.license_end is not None and self.license_end in line:
+            return False
+        license_txt.write(line)
+        return True
+
+    def scan(self, content, match_last=False):
+        """Return (url, checksum) found in content, with None for missing values.
+
+        If match_last is set, the last url and checksum of the page are returned instead of the first ones."""
+        return self.scan_lines(content.splitlines(keepends=True), match_last=match_last)
+
+    def scan_license(self, content):
+        """Return the license text found in content, empty if there is none"""
+        with StringIO() as license_txt:
+            self.scan_lines(content.splitlines(keepends=True), license_txt=license_txt)
+            return license_txt.getvalue()
@@ -17,19 +17,40 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+from contextlib import suppress
+import json
+import logging
 import os
-import requests
-from xdg.BaseDirectory import xdg_data_home
+from threading import Thread
+import time
+from xdg.BaseDirectory import xdg_cache_home, xdg_data_home
 
 DEFAULT_INSTALL_TOOLS_PATH = os.path.expanduser(os.path.join(xdg_data_home, "umake"))
 DEFAULT_BINARY_LINK_PATH = os.path.expanduser(os.path.join(DEFAULT_INSTALL_TOOLS_PATH, "bin"))
+DEFAULT_USER_ENV_PATH = os.path.join(DEFAULT_INSTALL_TOOLS_PATH, "env.d")
+DEFAULT_USER_ENV_FILE_PATH = os.path.join(DEFAULT_INSTALL_TOOLS_PATH, "env.sh")
 OLD_CONFIG_FILENAME = "udtc"
 CONFIG_FILENAME = "umake"
+COMPLETION_CACHE_FILENAME = "completion.json"
+DAEMON_SOCKET_FILENAME = "daemon.sock"
+DELTA_SEEDS_DIRNAME = "delta"
+JAVA_VERSION_CACHE_FILENAME = "java_versions.json"
+KEYRINGS_DIRNAME = "keyrings"
+LATEST_VERSION_CACHE_FILENAME = "latest_version.json"
+LATEST_VERSION_CHECK_INTERVAL = 24 * 60 * 60
+LATEST_VERSION_TIMEOUT = 5
 OS_RELEASE_FILE = "/etc/os-release"
+UMAKE_DOWNLOAD_ENGINE_ENVIRON_VARIABLE = "UMAKE_DOWNLOAD_ENGINE"
 UMAKE_FRAMEWORKS_ENVIRON_VARIABLE = "UMAKE_FRAMEWORKS"
+UMAKE_FSYNC_POLICY_ENVIRON_VARIABLE = "UMAKE_FSYNC_POLICY"
+UMAKE_MAINLOOP_ENVIRON_VARIABLE = "UMAKE_MAINLOOP"
+UMAKE_PROFILE_ENVIRON_VARIABLE = "UMAKE_PROFILE"
+UMAKE_NO_DAEMON_ENVIRON_VARIABLE = "UMAKE_NO_DAEMON"
 
 from_dev = False
 
+logger = logging.getLogger(__name__)
+
 
 def get_version():
     '''Get version depending if on dev or released version'''
@@ -49,12 +70,60 @@ def get_version():
     return version
 
 
-def get_latest_version():
+def get_latest_version(timeout=LATEST_VERSION_TIMEOUT):
     '''Get latest available version from github'''
-    try:
-        page = requests.get("https://api.github.com/repos/ubuntu/ubuntu-make/releases/latest")
-        page.raise_for_status()
-    except Exception as e:
-        raise e
+    import requests
+    page = requests.get("https://api.github.com/repos/ubuntu/ubuntu-make/releases/latest", timeout=timeout)
+    page.raise_for_status()
     latest = page.json().get("tag_name")
     return latest
+
+
+def _get_latest_version_cache_path():
+    return os.path.join(xdg_cache_home, CONFIG_FILENAME, LATEST_VERSION_CACHE_FILENAME)
+
+
+def get_cached_latest_version():
+    '''Get latest available version from the on disk cache, without any network access
+
+    Return None if we never managed to fetch it'''
+    try:
+        with open(_get_latest_version_cache_path()) as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _is_latest_version_cache_fresh():
+    try:
+        with open(_get_latest_version_cache_path()) as f:
+            checked = json.load(f)["checked"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    return 0 <= time.time() - checked < LATEST_VERSION_CHECK_INTERVAL
+
+
+def _refresh_latest_version_cache():
+    '''Fetch latest version and store it on disk. We keep the previous known version on failure'''
+    version = get_cached_latest_version()
+    try:
+        version = get_latest_version()
+    except Exception as e:
+        logger.debug("Couldn't fetch latest umake version: {}".format(e))
+    cache_path = _get_latest_version_cache_path()
+    with suppress(OSError):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + ".new", "w") as f:
+            json.dump({"checked": time.time(), "version": version}, f)
+        os.rename(cache_path + ".new", cache_path)
+
+
+def refresh_latest_version_in_background():
+    '''Refresh latest version cache in a daemon thread, at most once per LATEST_VERSION_CHECK_INTERVAL
+
+    Return the started thread if any'''
+    if _is_latest_version_cache_fresh():
+        return None
+    thread = Thread(target=_refresh_latest_version_cache, daemon=True)
+    thread.start()
+    return thread
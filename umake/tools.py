@@ -17,30 +17,30 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import atexit
+import codecs
 from collections import namedtuple
 from contextlib import contextmanager, suppress
 from enum import unique, Enum
 from http.client import HTTPConnection
 from gettext import gettext as _
-from gi.repository import GLib, Gio
 from glob import glob
+from importlib import import_module
+import json
 from urllib.parse import urlsplit
 import logging
 import os
 import re
-import requests
 import shutil
 import signal
 import subprocess
 import sys
 from textwrap import dedent
 from time import sleep
+import threading
 from threading import Lock
-from umake import settings
+from umake import settings, tracing
 from xdg.BaseDirectory import load_first_config, xdg_config_home, xdg_data_home
-import yaml
-import yaml.scanner
-import yaml.parser
 
 logger = logging.getLogger(__name__)
 
@@ -51,9 +51,14 @@ _version = None
 _id = None
 
 profile_tag = _("# Ubuntu make installation of {}\n")
+user_env_tag = _("# Ubuntu make environment\n")
+_user_env_deferred = False
+_user_env_dirty = False
 
 root_lock = Lock()
 
+_JSON_WHITESPACES = re.compile(r"[ \t\n\r]*")
+
 
 @unique
 class ChecksumType(Enum):
@@ -69,6 +74,36 @@ class Checksum(namedtuple('Checksum', ['checksum_type', 'checksum_value'])):
     pass
 
 
+class LazyModule(object):
+    """Module proxy only importing the real module on first attribute access
+
+    This keeps heavy modules (GLib, Gio, progressbar…) out of code paths not using them, like umake --version."""
+
+    def __init__(self, module_name):
+        object.__setattr__(self, "_module_name", module_name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = object.__getattribute__(self, "_module")
+        if module is None:
+            module = import_module(object.__getattribute__(self, "_module_name"))
+            object.__setattr__(self, "_module", module)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._load(), name)
+
+
+GLib = LazyModule("gi.repository.GLib")
+Gio = LazyModule("gi.repository.Gio")
+
+
 class Singleton(type):
 
     _instances = {}
@@ -84,6 +119,8 @@ class ConfigHandler(metaclass=Singleton):
     def __init__(self):
         """Load the config"""
         self._config = {}
+        self._deferred = False
+        self._dirty = False
         old_config_file = load_first_config(settings.OLD_CONFIG_FILENAME)
         config_file = load_first_config(settings.CONFIG_FILENAME)
         if old_config_file:
@@ -92,12 +129,19 @@ class ConfigHandler(metaclass=Singleton):
             os.rename(old_config_file, config_file)
         logger.debug("Opening {}".format(config_file))
         try:
-            with open(config_file) as f:
-                self._config = yaml.safe_load(f)
+            f = open(config_file)
         except (TypeError, FileNotFoundError):
             logger.info("No configuration file found")
-        except (yaml.scanner.ScannerError, yaml.parser.ParserError) as e:
-            logger.error("Invalid configuration file found: {}".format(e))
+            return
+        # only parse yaml when there is a configuration
+        import yaml
+        import yaml.scanner
+        import yaml.parser
+        with f:
+            try:
+                self._config = yaml.safe_load(f)
+            except (yaml.scanner.ScannerError, yaml.parser.ParserError) as e:
+                logger.error("Invalid configuration file found: {}".format(e))
 
     @property
     def config(self):
@@ -105,6 +149,27 @@ class ConfigHandler(metaclass=Singleton):
 
     @config.setter
     def config(self, config):
+        if self._deferred:
+            self._config = config
+            self._dirty = True
+            return
+        self._save(config)
+
+    def defer_writes(self):
+        """Keep config changes in memory until flush() is called, or the process exits"""
+        if not self._deferred:
+            self._deferred = True
+            atexit.register(self.flush)
+
+    def flush(self):
+        """Write deferred config changes, if any, and stop deferring them"""
+        self._deferred = False
+        if self._dirty:
+            self._dirty = False
+            self._save(self._config)
+
+    def _save(self, config):
+        import yaml
         config_file = os.path.join(xdg_config_home, settings.CONFIG_FILENAME)
         logging.debug("Saving new configuration: {} in {}".format(config, config_file))
         os.makedirs(os.path.dirname(config_file), exist_ok=True)
@@ -130,20 +195,112 @@ class classproperty(object):
         return self.f(owner)
 
 
+class GLibMainLoopBackend(object):
+    """Main loop backend running the GLib main loop, for integrating with a graphical session"""
+
+    def __init__(self):
+        self.mainloop = GLib.MainLoop()
+
+    def run(self):
+        self.mainloop.run()
+
+    def quit(self):
+        self.mainloop.quit()
+
+    def is_running(self):
+        return self.mainloop.is_running()
+
+    def idle_add(self, function, *args):
+        return GLib.idle_add(function, *args)
+
+    def add_after_pending(self, delay, function, *args):
+        # GLib doesn't order idle and timeout sources: give already scheduled callbacks delay ms to run
+        def one_time_wrapper():
+            function(*args)
+            return False
+        return GLib.timeout_add(delay, one_time_wrapper)
+
+
+class QueueMainLoopBackend(object):
+    """Main loop backend running callbacks from a queue, in order, without importing GLib"""
+
+    def __init__(self):
+        import queue
+        self._queue = queue.Queue()
+        self._after_pending = []
+        self._after_pending_lock = Lock()
+        self._after_pending_count = 0
+        self._running = False
+
+    def run(self):
+        import heapq
+        import queue
+        self._running = True
+        try:
+            while self._running:
+                try:
+                    function, args = self._queue.get(block=not self._after_pending)
+                except queue.Empty:
+                    with self._after_pending_lock:
+                        (_, _, function, args) = heapq.heappop(self._after_pending)
+                try:
+                    function(*args)
+                except MainLoop.ReturnMainLoop:
+                    pass
+                except Exception:
+                    logger.exception("Unhandled exception in main loop callback")
+        finally:
+            self._running = False
+
+    def quit(self):
+        self._running = False
+        # wake up the loop if it is waiting for a callback
+        self._queue.put((lambda: None, ()))
+
+    def is_running(self):
+        return self._running
+
+    def idle_add(self, function, *args):
+        self._queue.put((function, args))
+
+    def add_after_pending(self, delay, function, *args):
+        # run once nothing else is pending, without waiting: shorter delays first, like with timeouts
+        import heapq
+        with self._after_pending_lock:
+            self._after_pending_count += 1
+            heapq.heappush(self._after_pending, (delay, self._after_pending_count, function, args))
+        # wake up the loop if it is waiting for a callback
+        self._queue.put((lambda: None, ()))
+
+
+def get_mainloop_backend_class():
+    """Return the main loop backend class, forced by UMAKE_MAINLOOP or GLib only in a graphical session"""
+    backends = {"glib": GLibMainLoopBackend, "queue": QueueMainLoopBackend}
+    name = os.environ.get(settings.UMAKE_MAINLOOP_ENVIRON_VARIABLE)
+    if name in backends:
+        return backends[name]
+    if name:
+        logger.warning("Unknown main loop backend {}, choose one of {}".format(name, ", ".join(backends)))
+    if os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"):
+        return GLibMainLoopBackend
+    return QueueMainLoopBackend
+
+
 class MainLoop(object, metaclass=Singleton):
     """Mainloop simple wrapper"""
 
     def __init__(self):
-        self.mainloop = GLib.MainLoop()
+        self.mainloop = get_mainloop_backend_class()()
         # Glib steals the SIGINT handler and so, causes issue in the callback
         # https://bugzilla.gnome.org/show_bug.cgi?id=622084
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
 
     def run(self):
         self.mainloop.run()
 
     def quit(self, status_code=0, raise_exception=True):
-        GLib.timeout_add(80, self._clean_up, status_code)
+        self.mainloop.add_after_pending(80, self._clean_up, status_code)
         # only raises exception if not turned down (like in tests, where we are not in the mainloop for sure)
         if raise_exception:
             raise self.ReturnMainLoop()
@@ -152,6 +309,16 @@ class MainLoop(object, metaclass=Singleton):
         self.mainloop.quit()
         sys.exit(exit_code)
 
+    def idle_add(self, function, *args):
+        """Run function in the mainloop thread"""
+        return self.mainloop.idle_add(function, *args)
+
+    def add_after_pending(self, delay, function, *args):
+        """Run function in the mainloop thread, once callbacks already scheduled ran
+
+        Backends not running callbacks in order wait for delay ms instead."""
+        return self.mainloop.add_after_pending(delay, function, *args)
+
     @staticmethod
     def in_mainloop_thread(function):
         """Decorator to run a function in a mainloop thread"""
@@ -164,10 +331,10 @@ class MainLoop(object, metaclass=Singleton):
                 pass
             except BaseException:
                 logger.exception("Unhandled exception")
-                GLib.idle_add(MainLoop().quit, 1, False)
+                MainLoop().idle_add(MainLoop().quit, 1, False)
 
         def inner(*args, **kwargs):
-            return GLib.idle_add(wrapper, *args, **kwargs)
+            return MainLoop().idle_add(lambda: wrapper(*args, **kwargs))
         return inner
 
     class ReturnMainLoop(BaseException):
@@ -314,6 +481,7 @@ def copy_icon(source_icon_filepath, icon_filename):
         logger.warning("Didn't find any icon for the launcher.")
 
 
+@tracing.traced("post_install")
 def create_launcher(desktop_filename, content):
     """Create a desktop file and an unity launcher icon"""
 
@@ -374,6 +542,65 @@ def strip_tags(content):
     return re.sub('<[^<]+?>', '', content)
 
 
+def iter_json_array(fd, chunk_size=8192):
+    """Iterate over elements of the JSON array read from the binary file object fd.
+
+    The content is parsed incrementally: only the element being decoded is kept in memory, and we stop reading
+    as soon as the caller stops iterating. An element spanning several chunks is parsed again after each read, so
+    the read size doubles while it is incomplete, to parse it a logarithmic number of times."""
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    idx = 0
+    eof = False
+    in_array = False
+
+    def fill(size=chunk_size):
+        nonlocal buf, idx, eof
+        data = fd.read(size)
+        eof = not data
+        buf = buf[idx:] + utf8_decoder.decode(data, final=eof)
+        idx = 0
+
+    def skip_whitespaces():
+        nonlocal idx
+        while True:
+            match = _JSON_WHITESPACES.match(buf, idx)
+            idx = match.end()
+            if idx < len(buf) or eof:
+                return
+            fill()
+
+    skip_whitespaces()
+    if buf[idx:idx + 1] != "[":
+        raise json.JSONDecodeError("Expecting JSON array", buf, idx)
+    idx += 1
+    while True:
+        skip_whitespaces()
+        if buf[idx:idx + 1] == "]":
+            return
+        if in_array:
+            if buf[idx:idx + 1] != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", buf, idx)
+            idx += 1
+            skip_whitespaces()
+        read_size = chunk_size
+        while True:
+            try:
+                element, end = decoder.raw_decode(buf, idx)
+                # a number or literal at the end of the buffer may continue in the next chunk
+                if end < len(buf) or eof:
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill(read_size)
+            read_size *= 2
+        idx = end
+        in_array = True
+        yield element
+
+
 def switch_to_current_user():
     """Switch euid and guid to current user if current user is root"""
     if os.geteuid() != 0:
@@ -383,6 +610,32 @@ def switch_to_current_user():
     os.seteuid(int(os.getenv("SUDO_UID", default=0)))
 
 
+def get_root_command(use_pkexec=False):
+    """Return the command prefix to run a command as root, keeping the user environment needed to run umake"""
+    env_variables = ["HOME", "PATH", "LD_LIBRARY_PATH", "PYTHONUSERBASE", "PYTHONHOME", "PYTHONPATH"]
+    if use_pkexec:
+        # pkexec resets the environment
+        cmd = ["pkexec", "env"]
+        is_sudo_rs = False
+    else:
+        cmd = ["sudo"]
+        # sudo-rs returns the version in stderr
+        try:
+            is_sudo_rs = "sudo-rs" in subprocess.run(["sudo", "--version"], capture_output=True).stderr.decode()
+        except OSError:
+            is_sudo_rs = False
+        # -E is not supported by sudo-rs, so we need to use --preserve-env for each variable needed
+        if not is_sudo_rs:
+            cmd = ["sudo", "-E", "env"]
+    for var in env_variables:
+        if os.getenv(var):
+            if is_sudo_rs:
+                cmd.append("--preserve-env={}".format(var))
+            else:
+                cmd.append("{}={}".format(var, os.getenv(var)))
+    return cmd
+
+
 @contextmanager
 def as_root():
     # block all other threads making sensitive operations
@@ -404,32 +657,161 @@ def _get_shell_profile_file_path():
     return os.path.join(os.path.expanduser('~'), profile_filename)
 
 
+def _get_user_env_dropin_name(framework_tag):
+    return re.sub(r"[^\w.-]+", "-", framework_tag.lower()).strip("-") + ".sh"
+
+
+def _get_user_env_dropins():
+    """Return (framework file name, path) of env drop-ins in install order
+
+    Drop-ins are named <install sequence>-<framework>.sh: envs of frameworks installed last come last, and take
+    precedence, like when they were appended to the user profile."""
+    dropins = []
+    with suppress(FileNotFoundError):
+        for filename in os.listdir(settings.DEFAULT_USER_ENV_PATH):
+            sequence, separator, name = filename.partition("-")
+            if sequence.isdigit() and separator and name.endswith(".sh"):
+                dropins.append((int(sequence), name, os.path.join(settings.DEFAULT_USER_ENV_PATH, filename)))
+    return [(name, path) for sequence, name, path in sorted(dropins)]
+
+
+def _get_user_env_dropin_path(framework_tag):
+    """Return the path of the env drop-in of framework_tag, None if there is none"""
+    name = _get_user_env_dropin_name(framework_tag)
+    return next((path for dropin_name, path in _get_user_env_dropins() if dropin_name == name), None)
+
+
+def _write_atomically(path, content):
+    with open(path + ".new", "w", encoding='utf-8') as f:
+        f.write(content)
+    os.rename(path + ".new", path)
+
+
+def _write_user_env_dropin(framework_tag, content):
+    """Write the env drop-in of framework_tag after all the others, return True if it changed"""
+    name = _get_user_env_dropin_name(framework_tag)
+    dropins = _get_user_env_dropins()
+    path = next((dropin_path for dropin_name, dropin_path in dropins if dropin_name == name), None)
+    if path is not None and path == dropins[-1][1]:
+        with open(path, encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    sequence = int(os.path.basename(dropins[-1][1]).partition("-")[0]) + 1 if dropins else 1
+    os.makedirs(settings.DEFAULT_USER_ENV_PATH, exist_ok=True)
+    _write_atomically(os.path.join(settings.DEFAULT_USER_ENV_PATH, "{:04d}-{}".format(sequence, name)), content)
+    if path is not None:
+        os.remove(path)
+    return True
+
+
+def _write_user_env():
+    """Concatenate all env drop-ins to the env file sourced by the user profile"""
+    contents = []
+    for framework_name, path in _get_user_env_dropins():
+        with open(path, encoding='utf-8') as f:
+            contents.append(f.read())
+    logger.debug("Writing {} env drop-ins to {}".format(len(contents), settings.DEFAULT_USER_ENV_FILE_PATH))
+    os.makedirs(os.path.dirname(settings.DEFAULT_USER_ENV_FILE_PATH), exist_ok=True)
+    _write_atomically(settings.DEFAULT_USER_ENV_FILE_PATH, "\n".join(contents))
+
+
+def _user_env_changed():
+    global _user_env_dirty
+    if _user_env_deferred:
+        _user_env_dirty = True
+        return
+    _write_user_env()
+
+
+def defer_user_env_writes():
+    """Keep the env file sourced by the user profile as is until flush_user_env() is called, or the process exits
+
+    Return True if writes weren't already deferred, the caller being then in charge of flushing them."""
+    global _user_env_deferred
+    if _user_env_deferred:
+        return False
+    _user_env_deferred = True
+    atexit.register(flush_user_env)
+    return True
+
+
+def flush_user_env():
+    """Write the env file sourced by the user profile if any env changed, and stop deferring it"""
+    global _user_env_deferred, _user_env_dirty
+    _user_env_deferred = False
+    if _user_env_dirty:
+        _user_env_dirty = False
+        _write_user_env()
+
+
+def _strip_profile_envs(content, framework_tag=None):
+    """Return content without envs previous versions appended for framework_tag, or any framework if None
+
+    Also return a dict of the removed envs per framework tag. Those are blocks starting with profile_tag and ending
+    with an empty line."""
+    header_start, header_end = profile_tag.split("{}")
+    tag_pattern = re.escape(framework_tag) if framework_tag is not None else ".*?"
+    pattern = re.compile(r"{}(?P<tag>{}){}(?P<envs>.*?)(?:\n\n|\Z)".format(re.escape(header_start), tag_pattern,
+                                                                           re.escape(header_end)), re.DOTALL)
+    envs = {}
+
+    def _strip(match):
+        envs[match.group("tag")] = envs.get(match.group("tag"), "") + match.group("envs").rstrip("\n") + "\n"
+        return ""
+    return pattern.sub(_strip, content), envs
+
+
+def _read_profile():
+    with open(_get_shell_profile_file_path(), "r", encoding='utf-8') as f:
+        return f.read()
+
+
+def _source_user_env_from_profile(framework_tag):
+    """Ensure the user profile sources the env file, moving envs appended to it by previous versions to drop-ins
+
+    Envs of framework_tag are dropped as they are replaced. Return True if any drop-in was written."""
+    content = ""
+    with suppress(FileNotFoundError):
+        content = _read_profile()
+    new_content, envs = _strip_profile_envs(content)
+    changed = False
+    for tag in envs:
+        if tag != framework_tag and _get_user_env_dropin_path(tag) is None:
+            logger.debug("Moving {} envs from user's profile to its own file".format(tag))
+            changed |= _write_user_env_dropin(tag, profile_tag.format(tag) + envs[tag])
+    source_line = '[ -f "{path}" ] && . "{path}"\n'.format(path=settings.DEFAULT_USER_ENV_FILE_PATH)
+    if source_line not in new_content:
+        if new_content and not new_content.endswith("\n"):
+            new_content += "\n"
+        new_content += user_env_tag + source_line
+    if new_content != content:
+        _write_atomically(_get_shell_profile_file_path(), new_content)
+    return changed
+
+
 def remove_framework_envs_from_user(framework_tag):
     """Remove all envs from user if found"""
-    profile_filepath = _get_shell_profile_file_path()
-    content = ""
-    framework_header = profile_tag.format(framework_tag)
+    path = _get_user_env_dropin_path(framework_tag)
+    if path is not None:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+            _user_env_changed()
+
     try:
-        with open(profile_filepath, "r", encoding='utf-8') as f:
-            content = f.read()
+        content = _read_profile()
     except FileNotFoundError:
         return
-    if framework_header not in content:
+    if profile_tag.format(framework_tag) not in content:
         return
-
-    while framework_header in content:
-        framework_start_index = content.find(framework_header)
-        framework_end_index = content[framework_start_index:].find("\n\n")
-        content = content[:framework_start_index] + content[framework_start_index + framework_end_index + len("\n\n"):]
-
     # rewrite .profile and omit framework_tag
-    with open(profile_filepath + ".new", "w", encoding='utf-8') as f:
-        f.write(content)
-    os.rename(profile_filepath + ".new", profile_filepath)
+    _write_atomically(_get_shell_profile_file_path(), _strip_profile_envs(content, framework_tag)[0])
 
 
 def add_env_to_user(framework_tag, env_dict):
-    """Add args to user env in .profile (.zprofile if zsh) if the user doesn't have that env with those args
+    """Add args to user env if the user doesn't have that env with those args
+
+    Envs are written in a drop-in file per framework. All of them are concatenated to one env file, sourced by
+    .profile (.zprofile if zsh).
 
     env_dict is a dictionary of:
     { env_variable: { value: value,
@@ -438,9 +820,7 @@ def add_env_to_user(framework_tag, env_dict):
     value is either a list (in that case, it's concatenated) or a string
     If keep is set to True, we keep previous values with :$OLDERENV."""
 
-    profile_filepath = _get_shell_profile_file_path()
-    remove_framework_envs_from_user(framework_tag)
-    envs_to_insert = {}
+    content = profile_tag.format(framework_tag)
     for env in env_dict:
         value = env_dict[env]["value"]
         if isinstance(value, list):
@@ -450,19 +830,22 @@ def add_env_to_user(framework_tag, env_dict):
             value = "{}{}${}".format(value, os.pathsep, env)
         else:
             os.environ[env] = value
-        envs_to_insert[env] = value
+        logger.debug("Adding {} to user's {} for {}".format(value, env, framework_tag))
+        export = ""
+        if env != "PATH":
+            export = "export "
+        content += "{}{}={}\n".format(export, env, value)
 
-    with open(profile_filepath, "a", encoding='utf-8') as f:
-        f.write(profile_tag.format(framework_tag))
-        for env in envs_to_insert:
-            value = envs_to_insert[env]
-            logger.debug("Adding {} to user's {} for {}".format(value, env, framework_tag))
-            export = ""
-            if env != "PATH":
-                export = "export "
-            f.write("{}{}={}\n".format(export, env, value))
-        f.write("\n")
+    changed = _source_user_env_from_profile(framework_tag)
+    changed |= _write_user_env_dropin(framework_tag, content)
+    if changed or not os.path.exists(settings.DEFAULT_USER_ENV_FILE_PATH):
+        _user_env_changed()
 
 
 def validate_url(url):
+    from umake.network.bundle import is_url_available
+    available = is_url_available(url)
+    if available is not None:
+        return available
+    import requests
     return requests.head(url).ok
\ No newline at end of file
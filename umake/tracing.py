@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Timing spans of the install pipeline, saved as a Chrome trace timeline
+
+Tracing is enabled with --profile FILE or the UMAKE_PROFILE environment variable. The resulting json file can be
+loaded in chrome://tracing or https://ui.perfetto.dev, each thread (mainloop, downloads, decompression, apt) having
+its own track."""
+
+import atexit
+from contextlib import suppress
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from umake.settings import UMAKE_PROFILE_ENVIRON_VARIABLE
+
+logger = logging.getLogger(__name__)
+
+# recorded events, None when tracing is disabled
+_events = None
+_thread_names = {}
+_lock = threading.Lock()
+_path = None
+
+
+def enable(path):
+    """Start recording spans, saved to path on exit"""
+    global _events, _path
+    if _events is not None:
+        return
+    _path = path
+    _events = []
+    atexit.register(save)
+
+
+def enable_from_args(args):
+    """Enable tracing if --profile FILE is in args or UMAKE_PROFILE is set, ignoring any other option"""
+    path = os.getenv(UMAKE_PROFILE_ENVIRON_VARIABLE)
+    for i, arg in enumerate(args):
+        if arg == "--profile" and i + 1 < len(args):
+            path = args[i + 1]
+        elif arg.startswith("--profile="):
+            path = arg[len("--profile="):]
+    if path:
+        enable(os.path.abspath(os.path.expanduser(path)))
+
+
+def is_enabled():
+    return _events is not None
+
+
+def _now():
+    """Current timestamp in µs, as expected by the trace format"""
+    return time.perf_counter_ns() // 1000
+
+
+def _record(event):
+    thread = threading.current_thread()
+    event["pid"] = os.getpid()
+    event["tid"] = thread.native_id
+    with _lock:
+        _thread_names.setdefault(thread.native_id, thread.name)
+        _events.append(event)
+
+
+class Span:
+    """A timed operation. It can end in another callback than the one it started in, like a download"""
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = _now()
+        self._ended = False
+
+    def end(self, **args):
+        """Record the span, with optional additional args. Only the first call counts"""
+        if self._ended or _events is None:
+            return
+        self._ended = True
+        self.args.update(args)
+        _record({"name": self.name, "cat": self.category, "ph": "X", "ts": self.start, "dur": _now() - self.start,
+                 "args": self.args})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = repr(exc_value)
+        self.end()
+
+
+class _NoSpan:
+    """Span doing nothing, when tracing is disabled"""
+
+    def end(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def span(name, category="umake", **args):
+    """Return a span starting now, to use as a context manager or to end() later"""
+    if _events is None:
+        return _no_span
+    return Span(name, category, args)
+
+
+def traced(category="umake"):
+    """Decorator recording each call of the function as a span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(function.__qualname__, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def save():
+    """Save the recorded events to the trace file"""
+    if _events is None:
+        return
+    with _lock:
+        events = list(_events)
+        thread_names = dict(_thread_names)
+    pid = os.getpid()
+    events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "umake"}})
+    for tid, name in thread_names.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+    try:
+        with open(_path + ".new", "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.rename(_path + ".new", _path)
+    except OSError as e:
+        logger.error("Couldn't save profile to {}: {}".format(_path, e))
+        with suppress(OSError):
+            os.remove(_path + ".new")
@@ -20,13 +20,25 @@
 """Abstracted UI interface that will be overridden by different UI types"""
 
 import logging
-from gi.repository import GLib
 from umake.tools import Singleton, MainLoop
-from umake.settings import get_version, get_latest_version
+from umake.settings import get_version, get_cached_latest_version
 
 logger = logging.getLogger(__name__)
 
 
+class NullProgressBar:
+    """Progress bar not drawing anything, for UIs not displaying progress"""
+
+    def __init__(self):
+        self.finished = False
+
+    def update(self, percentage):
+        pass
+
+    def finish(self):
+        self.finished = True
+
+
 class UI(object, metaclass=Singleton):
 
     currentUI = None
@@ -37,13 +49,14 @@ class UI(object, metaclass=Singleton):
     @classmethod
     def return_main_screen(cls, status_code=0):
         try:
-            truncated_version = get_version().split("+")[0]
-            if status_code == 1 and not (get_latest_version() == truncated_version):
+            # only use the cached latest version, refreshed in background, to never block on the network
+            latest_version = get_cached_latest_version() if status_code == 1 else None
+            if latest_version and latest_version != get_version().split("+")[0]:
                 print('''
 Your currently installed version ({}) differs from the latest release ({})
 Many issues are usually fixed in more up to date versions.
 To get the latest version you can read the instructions at https://github.com/ubuntu/ubuntu-make
-'''.format(get_version(), get_latest_version()))
+'''.format(get_version(), latest_version))
         except Exception as e:
             logger.error(e)
         cls.currentUI._return_main_screen(status_code=status_code)
@@ -58,10 +71,19 @@ To get the latest version you can read the instructions at https://github.com/ub
     @classmethod
     @MainLoop.in_mainloop_thread
     def delayed_display(cls, contentType):
-        GLib.timeout_add(50, cls._one_time_wrapper, cls.currentUI._display, contentType)
+        MainLoop().add_after_pending(50, cls.currentUI._display, contentType)
+
+    @classmethod
+    def report(cls, event, **data):
+        """report a progress event (download, requirements, extract…) with its data. Can be called from any thread"""
+        if cls.currentUI is not None:
+            cls.currentUI._report(event, data)
+
+    @classmethod
+    def new_progress_bar(cls):
+        """return a started progress bar of the current UI, with update(percentage) and finish() methods"""
+        return cls.currentUI._new_progress_bar()
 
-    @staticmethod
-    def _one_time_wrapper(fun, contentType):
-        """To be called with GLib.timeout_add(), return False to only have one call"""
-        fun(contentType)
-        return False
+    def _report(self, event, data):
+        """UIs not streaming progress events ignore them"""
+        pass
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module for installing multiple frameworks listed in a manifest, in one process"""
+
+from gettext import gettext as _
+import logging
+import os
+import threading
+from umake.interactions import InputText, TextWithChoices, LicenseAgreement, UnknownProgress
+from umake.ui import NullProgressBar, UI
+from umake.tools import ConfigHandler, MainLoop, defer_user_env_writes, flush_user_env
+
+logger = logging.getLogger(__name__)
+
+
+def load_manifest(path):
+    """Return the command line arguments installing each framework listed in the yaml manifest at path
+
+    The manifest looks like:
+    frameworks:
+      - category: ide
+        framework: pycharm
+        path: ~/tools/pycharm
+        accept_license: true
+        options: [--eap]
+      - category: go
+    category or framework can be omitted for main category and category default frameworks."""
+    import yaml
+    import yaml.scanner
+    import yaml.parser
+    try:
+        with open(path) as f:
+            manifest = yaml.safe_load(f)
+    except OSError as e:
+        raise BaseException("Can't read manifest {}: {}".format(path, e))
+    except (yaml.scanner.ScannerError, yaml.parser.ParserError) as e:
+        raise BaseException("Invalid manifest {}: {}".format(path, e))
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("frameworks"), list):
+        raise BaseException("Manifest {} doesn't contain a list of frameworks".format(path))
+
+    commands = []
+    for entry in manifest["frameworks"]:
+        if not isinstance(entry, dict) or not (entry.get("category") or entry.get("framework")):
+            raise BaseException("Manifest entry {} doesn't name any category or framework".format(entry))
+        args = [str(entry[key]) for key in ("category", "framework") if entry.get(key)]
+        if entry.get("path"):
+            args.append(os.path.abspath(os.path.expanduser(str(entry["path"]))))
+        if entry.get("accept_license"):
+            args.append("--accept-license")
+        args.extend(str(option) for option in entry.get("options", []))
+        commands.append(args)
+    return commands
+
+
+class BatchUI(UI):
+    """Non interactive UI waiting for all frameworks installations to be done before returning to the main screen
+
+    Messages and progress events are forwarded to another UI. Config and user env changes are written once, at the
+    end."""
+
+    def __init__(self, ui, num_frameworks):
+        super().__init__(self)
+        self._ui = ui
+        self._pending = num_frameworks
+        self._status_code = 0
+        self._lock = threading.Lock()
+        ConfigHandler().defer_writes()
+        defer_user_env_writes()
+
+    def _return_main_screen(self, status_code=0):
+        with self._lock:
+            self._status_code = max(self._status_code, status_code)
+            self._pending -= 1
+            done = self._pending <= 0
+        if done:
+            ConfigHandler().flush()
+            flush_user_env()
+            self._ui._return_main_screen(status_code=self._status_code)
+        # stop the current framework installation, others continue
+        raise MainLoop.ReturnMainLoop()
+
+    def _new_progress_bar(self):
+        # one progress bar per framework installed in parallel can't be displayed
+        return NullProgressBar()
+
+    def _report(self, event, data):
+        self._ui._report(event, data)
+
+    def _display(self, contentType):
+        if isinstance(contentType, LicenseAgreement):
+            logger.error(_("A license wasn't accepted in the manifest, skipping this framework"))
+            with self._lock:
+                self._status_code = 1
+            contentType.choose(choice_id=1)
+        elif isinstance(contentType, InputText):
+            contentType.run_callback(result=contentType.default_input)
+        elif isinstance(contentType, TextWithChoices):
+            contentType.choose()
+        elif isinstance(contentType, UnknownProgress):
+            return False
+        else:
+            self._ui._display(contentType)
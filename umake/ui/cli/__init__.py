@@ -25,18 +25,27 @@ from contextlib import suppress
 from gettext import gettext as _
 import logging
 import os
-from progressbar import ProgressBar, BouncingBar
 import readline
 import sys
+from umake import completion
+from umake.daemon import hand_back_to_client
 from umake.interactions import InputText, TextWithChoices, LicenseAgreement, DisplayMessage, UnknownProgress
-from umake.network.download_center import DownloadItem, DownloadCenter
+from umake.network.bundle import Bundle, use_bundle, set_offline, is_offline
+from umake.network.delta import enable_delta_updates
+from umake.network.download_center import DownloadItem, DownloadCenter, enable_prefetch
+from umake.network.scheduler import DownloadScheduler
+from umake.network.privileged_helper import PrivilegedHelper
+from umake.network.requirements_handler import RequirementsHandler
 from umake.ui import UI
-from umake.frameworks import BaseCategory, list_frameworks
-from umake.tools import InputError, MainLoop
-from umake.settings import get_version
+from umake.ui.batch import BatchUI, load_manifest
+from umake.frameworks import BaseCategory, list_frameworks, run_as_root
+from umake.tools import InputError, MainLoop, is_completion_mode, LazyModule
+from umake.settings import get_version, refresh_latest_version_in_background
 
 logger = logging.getLogger(__name__)
 
+progressbar = LazyModule("progressbar")
+
 
 def rlinput(prompt, prefill=''):
     readline.set_startup_hook(lambda: readline.insert_text(prefill))
@@ -56,6 +65,9 @@ class CliUI(UI):
         # quit the shell
         MainLoop().quit(status_code=status_code)
 
+    def _new_progress_bar(self):
+        return progressbar.ProgressBar().start()
+
     def _display(self, contentType):
         # print depending on the content type
         while True:
@@ -71,7 +83,7 @@ class CliUI(UI):
                     print(contentType.text)
                 elif isinstance(contentType, UnknownProgress):
                     if not contentType.bar:
-                        contentType.bar = ProgressBar(widgets=[BouncingBar()])
+                        contentType.bar = progressbar.ProgressBar(widgets=[progressbar.BouncingBar()])
                     with suppress(StopIteration, AttributeError):
                         # pulse and add a timeout callback
                         contentType.bar(contentType._iterator()).next()
@@ -99,11 +111,12 @@ def run_command_for_args(args):
     target.run_for(args)
 
 
-def mangle_args_for_default_framework(args):
+def mangle_args_for_default_framework(args, options_with_value=()):
     """return the potentially changed args_to_parse for the parser for handling default frameworks
 
     "./<command> [global_or_common_options] category [options from default framework]"
     as subparsers can't define default options and are not optional: http://bugs.python.org/issue9253
+    options_with_value are global options taking a separate value, which isn't a category name then.
     """
 
     result_args = []
@@ -112,8 +125,17 @@ def mangle_args_for_default_framework(args):
     category_name = None
     framework_completed = False
     args_to_append = []
+    is_option_value = False
 
     for arg in args:
+        if is_option_value:
+            is_option_value = False
+            pending_args.append(arg)
+            continue
+        if not category_name and arg in options_with_value:
+            is_option_value = True
+            pending_args.append(arg)
+            continue
         # --remove is both installed as global and per-framework optional arguments. argparse will only analyze the
         # per framework one and will override the global one. So if --remove is before the category name, it will be
         # ignored. Mangle the arg and append it last then.
@@ -163,6 +185,12 @@ def mangle_args_for_default_framework(args):
     return result_args
 
 
+def get_options_with_value(parser):
+    """Return all global option strings taking a separate value"""
+    return [option for action in parser._actions if action.option_strings and action.nargs != 0
+            for option in action.option_strings]
+
+
 def get_frameworks_list_output(args):
     """
     Get a frameworks list based on the arguments. It returns a string ready to be printed.
@@ -278,22 +306,109 @@ def pretty_print_versions(data):
         #       f"User Version: {user_version_color}{user_version} {symbol}{reset_color}")
 
 
+def create_ui(args):
+    """Create and return the UI requested on the command line"""
+    if args.progress == "jsonl":
+        from umake.ui.jsonl import JsonLinesUI
+        return JsonLinesUI(socket_path=args.progress_socket)
+    return CliUI()
+
+
+def get_framework_for_args(args):
+    """Return the framework targeted by args, None if there is none"""
+    category = BaseCategory.categories[args.category]
+    if category is None:
+        return BaseCategory.main_category.frameworks[args.category]
+    if args.framework:
+        return category.frameworks[args.framework]
+    return category.default_framework
+
+
+def run_batch(parser, args):
+    """Install concurrently all frameworks listed in the args.install_from manifest"""
+    try:
+        commands = load_manifest(args.install_from)
+    except BaseException as e:
+        logger.error(str(e))
+        sys.exit(1)
+    options_with_value = get_options_with_value(parser)
+    frameworks = []
+    frameworks_args = []
+    for command in commands:
+        framework_args = parser.parse_args(mangle_args_for_default_framework(command, options_with_value))
+        framework = get_framework_for_args(framework_args)
+        if framework is None:
+            logger.error(_("No framework to install for {}").format(" ".join(command)))
+            sys.exit(1)
+        if framework in frameworks:
+            logger.error(_("{} is listed multiple times in the manifest").format(framework.name))
+            sys.exit(1)
+        framework_args.assume_yes = True
+        frameworks.append(framework)
+        frameworks_args.append(framework_args)
+    if not frameworks:
+        sys.exit(0)
+
+    # request root access once for all frameworks
+    if os.geteuid() != 0:
+        if any(framework.need_root_access and not framework.need_root_for_requirements_only
+               for framework in frameworks):
+            sys.exit(run_as_root())
+        if any(framework.need_root_access for framework in frameworks):
+            hand_back_to_client()
+            try:
+                PrivilegedHelper().start()
+            except BaseException as e:
+                logger.error(str(e))
+                sys.exit(1)
+    else:
+        for framework in frameworks:
+            framework.need_root_access = False
+
+    BatchUI(create_ui(args), len(frameworks))
+    # all requirements are installed in one apt transaction, queued before the frameworks ones which are then no-ops
+    with RequirementsHandler().batch():
+        for framework in frameworks:
+            if not RequirementsHandler().is_bucket_installed(framework.packages_requirements):
+                RequirementsHandler().install_bucket(framework.packages_requirements, lambda status: None,
+                                                     lambda result: None)
+    for framework_args in frameworks_args:
+        run_command_for_args(framework_args)
+
+
 def main(parser):
     """Main entry point of the cli command"""
     categories_parser = parser.add_subparsers(help='Developer environment', dest="category")
     for category in BaseCategory.categories.values():
         category.install_category_parser(categories_parser)
 
+    if is_completion_mode():
+        completion.save_cache(parser)
     argcomplete.autocomplete(parser)
     # autocomplete will stop there. Can start more expensive operations now.
 
     arg_to_parse = sys.argv[1:]
     if "--help" not in arg_to_parse:
         # manipulate sys.argv for default frameworks:
-        arg_to_parse = mangle_args_for_default_framework(arg_to_parse)
+        arg_to_parse = mangle_args_for_default_framework(arg_to_parse, get_options_with_value(parser))
     args = parser.parse_args(arg_to_parse)
     assume_yes = args.assume_yes
 
+    if args.create_bundle or args.from_bundle:
+        try:
+            use_bundle(Bundle(args.create_bundle or args.from_bundle, create=bool(args.create_bundle)))
+        except BaseException as e:
+            logger.error(str(e))
+            sys.exit(1)
+    if args.offline:
+        set_offline(True)
+    if args.prefetch:
+        enable_prefetch()
+    if args.delta_updates:
+        enable_delta_updates()
+    if args.limit_rate or args.limit_rate_per_download:
+        DownloadScheduler().set_rate_limits(args.limit_rate, args.limit_rate_per_download)
+
     if args.list or args.list_installed or args.list_available:
         print(get_frameworks_list_output(args))
         sys.exit(0)
@@ -343,16 +458,24 @@ def main(parser):
         else:
             pretty_print_versions(outdated_frameworks)
             for outdated_framework in outdated_frameworks:
+                progress, progress_socket = args.progress, args.progress_socket
                 args = parser.parse_args([outdated_framework['category_name'], outdated_framework['framework_name']])
                 args.assume_yes = assume_yes
-                CliUI()
+                args.progress, args.progress_socket = progress, progress_socket
+                create_ui(args)
                 run_command_for_args(args)
                 return
             sys.exit(0)
 
+    if args.install_from:
+        run_batch(parser, args)
+        return
+
     if not args.category:
         parser.print_help()
         sys.exit(0)
 
-    CliUI()
+    if not is_offline():
+        refresh_latest_version_in_background()
+    create_ui(args)
     run_command_for_args(args)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module for the JSON lines interface, streaming install events to orchestration tools
+
+Each event is a json object on its own line, with "event" and "time" keys:
+    - message: text displayed to the user
+    - prompt: question waiting for an answer line on stdin (type, text and choices or default)
+    - download: current and total size in bytes, and average rate in bytes/s, per url
+    - requirements: apt step (downloading or installing) and percentage
+    - extract: number of files extracted per archive
+    - progress: overall download and requirements installation percentage
+    - error: error message
+    - done: status_code of the command
+"""
+
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from umake.interactions import InputText, TextWithChoices, LicenseAgreement, DisplayMessage, UnknownProgress
+from umake.ui import UI
+from umake.tools import InputError, MainLoop
+
+logger = logging.getLogger(__name__)
+
+
+class _ErrorEventHandler(logging.Handler):
+    """Forward errors logged anywhere as error events"""
+
+    def __init__(self, ui):
+        super().__init__(level=logging.ERROR)
+        self._ui = ui
+
+    def emit(self, record):
+        self._ui.emit("error", {"message": record.getMessage()})
+
+
+class _ProgressBar:
+    """Progress bar sending its updates as progress events"""
+
+    def __init__(self, ui):
+        self._ui = ui
+        self.finished = False
+
+    def update(self, percentage):
+        self._ui._report("progress", {"percentage": percentage})
+
+    def finish(self):
+        self.finished = True
+
+
+def _take_over_stdout():
+    """Return a stream to the real stdout, now reserved to events: anything else writing to it goes to stderr"""
+    sys.stdout.flush()
+    output = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return output
+
+
+class JsonLinesUI(UI):
+
+    # minimum delay, in seconds, between two progress events for the same item. Intermediate ones are coalesced.
+    PROGRESS_INTERVAL = 0.2
+    # progress events, with the data key identifying their item
+    PROGRESS_EVENTS = {"download": "url", "extract": "archive", "requirements": None, "progress": None}
+
+    def __init__(self, output=None, socket_path=None):
+        """Stream events to output, the unix socket at socket_path or by default, stdout"""
+        super().__init__(self)
+        if socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(socket_path)
+            output = sock.makefile("w")
+        elif output is None:
+            output = _take_over_stdout()
+        self._output = output
+        self._lock = threading.RLock()
+        self._last_emitted = {}
+        self._pending = {}
+        self._download_starts = {}
+        self._error_handler = _ErrorEventHandler(self)
+        logging.getLogger().addHandler(self._error_handler)
+
+    def _return_main_screen(self, status_code=0):
+        self.emit("done", {"status_code": status_code})
+        MainLoop().quit(status_code=status_code)
+
+    def _new_progress_bar(self):
+        return _ProgressBar(self)
+
+    def _display(self, contentType):
+        if isinstance(contentType, DisplayMessage):
+            self.emit("message", {"text": contentType.text})
+        elif isinstance(contentType, UnknownProgress):
+            # extraction progress is streamed as extract events
+            return False
+        elif isinstance(contentType, (InputText, TextWithChoices)):
+            self._prompt(contentType)
+        else:
+            logger.error("Unexcepted content type to display to JSON lines UI: {}".format(contentType))
+            MainLoop().quit(status_code=1)
+
+    def _prompt(self, contentType):
+        """Emit a prompt event and answer it with the next line on stdin. An empty line selects the default"""
+        while True:
+            if isinstance(contentType, InputText):
+                self.emit("prompt", {"type": "input", "text": contentType.content,
+                                     "default": contentType.default_input})
+            else:
+                self.emit("prompt", {"type": "license" if isinstance(contentType, LicenseAgreement) else "choices",
+                                     "text": contentType.content,
+                                     "choices": [{"label": choice.label, "shortcut": choice.txt_shorcut,
+                                                  "default": choice.is_default} for choice in contentType.choices]})
+            line = sys.stdin.readline()
+            answer = line.strip()
+            try:
+                if isinstance(contentType, InputText):
+                    contentType.run_callback(result=answer or contentType.default_input)
+                else:
+                    contentType.choose(answer=answer)
+                return
+            except InputError as e:
+                logger.error(str(e))
+                # stdin is closed, we won't get any other answer
+                if not line:
+                    self._return_main_screen(status_code=1)
+                    return
+
+    def emit(self, event, data):
+        """Emit an event right away, after the coalesced progress events which are still pending"""
+        with self._lock:
+            for key in list(self._pending):
+                self._emit_progress(key, self._pending.pop(key), time.monotonic())
+            self._write(event, data)
+
+    def _report(self, event, data):
+        if event not in self.PROGRESS_EVENTS:
+            self.emit(event, data)
+            return
+        key = (event, data.get(self.PROGRESS_EVENTS[event]))
+        with self._lock:
+            now = time.monotonic()
+            if event == "download":
+                start_time, start_size = self._download_starts.setdefault(data["url"], (now, data["current"]))
+                elapsed = now - start_time
+                data = dict(data, rate=int((data["current"] - start_size) / elapsed) if elapsed > 0 else 0)
+            last_emitted = self._last_emitted.get(key)
+            if last_emitted is None or now - last_emitted >= self.PROGRESS_INTERVAL or self._is_complete(event, data):
+                self._pending.pop(key, None)
+                self._emit_progress(key, data, now)
+            else:
+                self._pending[key] = data
+
+    @staticmethod
+    def _is_complete(event, data):
+        """Final progress events are never delayed"""
+        if event == "download":
+            return data["current"] == data["size"]
+        if event in ("requirements", "progress"):
+            return data["percentage"] >= 100
+        return False
+
+    def _emit_progress(self, key, data, now):
+        self._last_emitted[key] = now
+        self._write(key[0], data)
+
+    def _write(self, event, data):
+        line = {"event": event, "time": round(time.time(), 3)}
+        line.update(data)
+        try:
+            self._output.write(json.dumps(line) + "\n")
+            self._output.flush()
+        except OSError as e:
+            # don't log an error, which would be emitted again
+            logger.warning("Couldn't emit event {}: {}".format(event, e))